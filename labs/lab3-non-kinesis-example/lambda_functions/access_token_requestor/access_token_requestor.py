@@ -1,11 +1,12 @@
 import boto3
+from botocore.config import Config
+import threading
 import traceback
 import os
 import json
 import logging
 from datetime import datetime
 import sys
-from inspect import getframeinfo, stack
 # Other imports here...
 
 def get_logger(level=logging.INFO):
@@ -20,8 +21,26 @@ def get_logger(level=logging.INFO):
     logger.setLevel(level)
     return logger
 
-def get_client(client_name: str, region: str='eu-central-1', boto3_clazz=boto3):
-    return boto3_clazz.client(client_name, region_name=region)
+CLIENT_REGISTRY = dict()
+CLIENT_REGISTRY_LOCK = threading.Lock()
+try:
+    CLIENT_CONFIG = Config(max_pool_connections=25, connect_timeout=5, read_timeout=30, retries={'max_attempts': 5, 'mode': 'standard'}, tcp_keepalive=True)
+except TypeError:   # tcp_keepalive requires botocore 1.27.84 or later
+    CLIENT_CONFIG = Config(max_pool_connections=25, connect_timeout=5, read_timeout=30, retries={'max_attempts': 5, 'mode': 'standard'})
+
+
+def get_client(client_name: str, region: str='eu-central-1', boto3_clazz=boto3, endpoint_url: str=None):
+    """
+        Clients are created on first use and kept in CLIENT_REGISTRY for the lifetime of the execution environment, so
+        warm invocations re-use the client and its pool of keep-alive connections. Only the services actually used by
+        the function are ever created.
+    """
+    registry_key = (client_name, region, endpoint_url, id(boto3_clazz))
+    if registry_key not in CLIENT_REGISTRY:
+        with CLIENT_REGISTRY_LOCK:
+            if registry_key not in CLIENT_REGISTRY:
+                CLIENT_REGISTRY[registry_key] = boto3_clazz.client(client_name, region_name=region, endpoint_url=endpoint_url, config=CLIENT_CONFIG)
+    return CLIENT_REGISTRY[registry_key]
 
 CACHE_TTL_DEFAULT = 600
 cache = dict()
@@ -68,6 +87,26 @@ def refresh_environment_cache(logger=get_logger()):
     logger.debug('cache: {}'.format((json.dumps(cache))))
 
 
+class DebugMessage:
+    """
+        Defers the `str.format()` of a debug message until a handler actually emits the log record
+    """
+    __slots__ = ('message', 'variables_as_dict', 'variable_as_list')
+
+    def __init__(self, message: str, variables_as_dict: dict, variable_as_list: list):
+        self.message = message
+        self.variables_as_dict = variables_as_dict
+        self.variable_as_list = variable_as_list
+
+    def __str__(self):
+        try:
+            if len(self.variables_as_dict) > 0:
+                return self.message.format(**self.variables_as_dict)
+            return self.message.format(*self.variable_as_list)
+        except:
+            return self.message
+
+
 def debug_log(message: str, variables_as_dict: dict=dict(), variable_as_list: list=list(), logger=get_logger(level=logging.INFO)):
     """
         See:
@@ -90,16 +129,9 @@ def debug_log(message: str, variables_as_dict: dict=dict(), variable_as_list: li
 
     """
     if cache['Environment']['Data']['DEBUG'] is True:
-        try:
-            caller = getframeinfo(stack()[1][0])
-            caller_str = '{}():{}'.format(caller.function, caller.lineno)
-            message = '[{}]  {}'.format(caller_str, message)
-            if len(variables_as_dict) > 0:
-                logger.debug(message.format(**variables_as_dict))
-            else:
-                logger.debug(message.format(*variable_as_list))
-        except:
-            pass
+        if logger.isEnabledFor(logging.DEBUG) is True:
+            # stacklevel=2 attributes the record (funcName/lineno) to the caller without inspecting the stack
+            logger.debug(DebugMessage(message=message, variables_as_dict=variables_as_dict, variable_as_list=variable_as_list), stacklevel=2)
 
 
 ###############################################################################
@@ -1,11 +1,14 @@
 import boto3
+from botocore.config import Config
+import threading
 import traceback
 import os
 import json
 import logging
 from datetime import datetime
 import sys
-from inspect import getframeinfo, stack
+import time
+from collections import OrderedDict
 # Other imports here...
 
 
@@ -23,11 +26,33 @@ def get_logger(level=logging.INFO):
     return logger
 
 
-def get_client(client_name: str, region: str = 'eu-central-1', boto3_clazz=boto3):
-    return boto3_clazz.client(client_name, region_name=region)
+CLIENT_REGISTRY = dict()
+CLIENT_REGISTRY_LOCK = threading.Lock()
+try:
+    CLIENT_CONFIG = Config(max_pool_connections=25, connect_timeout=5, read_timeout=30, retries={'max_attempts': 5, 'mode': 'standard'}, tcp_keepalive=True)
+except TypeError:   # tcp_keepalive requires botocore 1.27.84 or later
+    CLIENT_CONFIG = Config(max_pool_connections=25, connect_timeout=5, read_timeout=30, retries={'max_attempts': 5, 'mode': 'standard'})
+
+
+def get_client(client_name: str, region: str='eu-central-1', boto3_clazz=boto3, endpoint_url: str=None):
+    """
+        Clients are created on first use and kept in CLIENT_REGISTRY for the lifetime of the execution environment, so
+        warm invocations re-use the client and its pool of keep-alive connections. Only the services actually used by
+        the function are ever created.
+    """
+    registry_key = (client_name, region, endpoint_url, id(boto3_clazz))
+    if registry_key not in CLIENT_REGISTRY:
+        with CLIENT_REGISTRY_LOCK:
+            if registry_key not in CLIENT_REGISTRY:
+                CLIENT_REGISTRY[registry_key] = boto3_clazz.client(client_name, region_name=region, endpoint_url=endpoint_url, config=CLIENT_CONFIG)
+    return CLIENT_REGISTRY[registry_key]
 
 
 CACHE_TTL_DEFAULT = 600
+STATUS_CACHE_TTL_DEFAULT = 5
+STATUS_CACHE_MAX_ENTRIES_DEFAULT = 1000
+SHARED_STATUS_CACHE_TTL_DEFAULT = 300
+SHARED_STATUS_CACHE_SK = 'CACHE#ACCESS_CARD_STATUS'
 cache = dict()
 
 
@@ -56,6 +81,14 @@ def get_cache_ttl(logger=get_logger()) -> int:
     return CACHE_TTL_DEFAULT
 
 
+def get_int_from_environment(name: str, default: int, minimum: int=0, logger=get_logger())->int:
+    try:
+        return max(minimum, int(os.getenv(name, '{}'.format(default))))
+    except:
+        logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+    return default
+
+
 def refresh_environment_cache(logger=get_logger()):
     global cache
     now = get_utc_timestamp(with_decimal=False)
@@ -67,12 +100,36 @@ def refresh_environment_cache(logger=get_logger()):
         'Data': {
             'CACHE_TTL': get_cache_ttl(logger=logger),
             'DEBUG': get_debug(),
+            'STATUS_CACHE_TTL': get_int_from_environment(name='STATUS_CACHE_TTL', default=STATUS_CACHE_TTL_DEFAULT, logger=logger),
+            'STATUS_CACHE_MAX_ENTRIES': get_int_from_environment(name='STATUS_CACHE_MAX_ENTRIES', default=STATUS_CACHE_MAX_ENTRIES_DEFAULT, minimum=1, logger=logger),
+            'SHARED_STATUS_CACHE': bool(get_int_from_environment(name='SHARED_STATUS_CACHE', default=0, logger=logger)),
+            'SHARED_STATUS_CACHE_TTL': get_int_from_environment(name='SHARED_STATUS_CACHE_TTL', default=SHARED_STATUS_CACHE_TTL_DEFAULT, minimum=1, logger=logger),
             # Other ENVIRONMENT variables can be added here... The environment will be re-read after the CACHE_TTL
         }
     }
     logger.debug('cache: {}'.format((json.dumps(cache))))
 
 
+class DebugMessage:
+    """
+        Defers the `str.format()` of a debug message until a handler actually emits the log record
+    """
+    __slots__ = ('message', 'variables_as_dict', 'variable_as_list')
+
+    def __init__(self, message: str, variables_as_dict: dict, variable_as_list: list):
+        self.message = message
+        self.variables_as_dict = variables_as_dict
+        self.variable_as_list = variable_as_list
+
+    def __str__(self):
+        try:
+            if len(self.variables_as_dict) > 0:
+                return self.message.format(**self.variables_as_dict)
+            return self.message.format(*self.variable_as_list)
+        except:
+            return self.message
+
+
 def debug_log(message: str, variables_as_dict: dict = dict(), variable_as_list: list = list(), logger=get_logger(level=logging.INFO)):
     """
         See:
@@ -95,16 +152,65 @@ def debug_log(message: str, variables_as_dict: dict = dict(), variable_as_list:
 
     """
     if cache['Environment']['Data']['DEBUG'] is True:
-        try:
-            caller = getframeinfo(stack()[1][0])
-            caller_str = '{}():{}'.format(caller.function, caller.lineno)
-            message = '[{}]  {}'.format(caller_str, message)
-            if len(variables_as_dict) > 0:
-                logger.debug(message.format(**variables_as_dict))
-            else:
-                logger.debug(message.format(*variable_as_list))
-        except:
-            pass
+        if logger.isEnabledFor(logging.DEBUG) is True:
+            # stacklevel=2 attributes the record (funcName/lineno) to the caller without inspecting the stack
+            logger.debug(DebugMessage(message=message, variables_as_dict=variables_as_dict, variable_as_list=variable_as_list), stacklevel=2)
+
+
+###############################################################################
+###                                                                         ###
+###                         S T A T U S    C A C H E                        ###
+###                                                                         ###
+###############################################################################
+
+
+class TtlLruCache:
+    """
+        In-process cache of the access card status per employee ID, kept for the lifetime of the execution
+        environment. Entries expire after their TTL and the least recently used entry is evicted when the cache holds
+        more than `max_entries` entries.
+
+        Other execution environments can not invalidate this cache, so the TTL (`STATUS_CACHE_TTL`) must be short: it
+        is the longest time a changed status can be hidden from a client polling the same execution environment.
+    """
+
+    def __init__(self, max_entries: int=STATUS_CACHE_MAX_ENTRIES_DEFAULT):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.stats = {'Hits': 0, 'Misses': 0, 'Expired': 0, 'Evictions': 0}
+
+    def get(self, key: str, now: float=None):
+        if now is None:
+            now = time.time()
+        if key not in self.entries:
+            self.stats['Misses'] += 1
+            return None
+        expires, value = self.entries[key]
+        if expires <= now:
+            del self.entries[key]
+            self.stats['Expired'] += 1
+            self.stats['Misses'] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.stats['Hits'] += 1
+        return value
+
+    def put(self, key: str, value, ttl: int, now: float=None):
+        if ttl <= 0:
+            return
+        if now is None:
+            now = time.time()
+        self.entries.pop(key, None)
+        self.entries[key] = (now + ttl, value,)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats['Evictions'] += 1
+
+    def invalidate(self, key: str):
+        self.entries.pop(key, None)
+
+
+STATUS_CACHE = TtlLruCache()
 
 
 ###############################################################################
@@ -165,6 +271,113 @@ def get_employee_access_card_record(
     return result
 
 
+def get_shared_status_cache_record(
+    employee_id,
+    client=get_client(client_name="dynamodb"),
+    logger=get_logger(level=logging.INFO)
+) -> dict:
+    """
+        Returns the cached status from the shared cache record (`SK` is `CACHE#ACCESS_CARD_STATUS`) in the employee
+        partition, or `None` when there is no current cached status. The record is read with an eventually consistent
+        `GetItem`, so a status invalidated less than a second ago may still be returned once.
+    """
+    try:
+        response = client.get_item(
+            TableName='lab3-access-card-app',
+            Key={
+                'PK': {'S': 'EMP#{}'.format(employee_id), },
+                'SK': {'S': SHARED_STATUS_CACHE_SK, },
+            },
+            ConsistentRead=False,
+            ReturnConsumedCapacity='TOTAL'
+        )
+        logger.debug('response={}'.format(json.dumps(response, default=str)))
+        if 'Item' in response:
+            item = response['Item']
+            if 'CachedStatus' in item and int(item['CacheExpiresTimestamp']['N']) > get_utc_timestamp(with_decimal=False):
+                return json.loads(item['CachedStatus']['S'])
+    except:
+        logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+    return None
+
+
+def put_shared_status_cache_record(
+    employee_id,
+    status: dict,
+    read_started_timestamp: float,
+    client=get_client(client_name="dynamodb"),
+    logger=get_logger(level=logging.INFO)
+) -> bool:
+    """
+        Stores the status in the shared cache record, unless the event processor invalidated the record after
+        `read_started_timestamp` - the status that was read may then already be outdated. `UpdateItem` keeps the
+        `InvalidatedTimestamp` of the record, so a slow reader can never overwrite the status of a faster one with an
+        older status.
+    """
+    try:
+        client.update_item(
+            TableName='lab3-access-card-app',
+            Key={
+                'PK': {'S': 'EMP#{}'.format(employee_id), },
+                'SK': {'S': SHARED_STATUS_CACHE_SK, },
+            },
+            UpdateExpression='SET CachedStatus = :status, CacheExpiresTimestamp = :expires',
+            ConditionExpression='attribute_not_exists(InvalidatedTimestamp) OR InvalidatedTimestamp < :read_started',
+            ExpressionAttributeValues={
+                ':status': {'S': json.dumps(status), },
+                ':expires': {'N': '{}'.format(get_utc_timestamp(with_decimal=False) + cache['Environment']['Data']['SHARED_STATUS_CACHE_TTL']), },
+                ':read_started': {'N': '{}'.format(read_started_timestamp), },
+            },
+            ReturnValues='NONE'
+        )
+        return True
+    except client.exceptions.ConditionalCheckFailedException:
+        logger.info('Status of employee {} changed while it was read - not cached'.format(employee_id))
+    except:
+        logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+    return False
+
+
+def get_employee_access_card_status(
+    employee_id,
+    client=get_client(client_name="dynamodb"),
+    logger=get_logger(level=logging.INFO)
+) -> dict:
+    """
+        Read-through lookup of the access card status: the in-process `STATUS_CACHE` first, then the shared cache
+        record when `SHARED_STATUS_CACHE` is enabled, and only then the strongly consistent query of
+        `get_employee_access_card_record()`. Failed lookups (an empty result) are never cached.
+    """
+    STATUS_CACHE.max_entries = cache['Environment']['Data']['STATUS_CACHE_MAX_ENTRIES']
+    result = STATUS_CACHE.get(key=employee_id)
+    if result is not None:
+        logger.info('Status of employee {} served from the in-process cache'.format(employee_id))
+        return result
+
+    shared_cache_enabled = cache['Environment']['Data']['SHARED_STATUS_CACHE']
+    if shared_cache_enabled is True:
+        result = get_shared_status_cache_record(employee_id=employee_id, client=client, logger=logger)
+        if result is not None:
+            logger.info('Status of employee {} served from the shared cache'.format(employee_id))
+
+    if result is None:
+        read_started_timestamp = get_utc_timestamp(with_decimal=True)
+        result = get_employee_access_card_record(employee_id=employee_id, client=client, logger=logger)
+        if len(result) > 0 and shared_cache_enabled is True:
+            put_shared_status_cache_record(
+                employee_id=employee_id,
+                status=result,
+                read_started_timestamp=read_started_timestamp,
+                client=client,
+                logger=logger
+            )
+
+    if len(result) > 0:
+        STATUS_CACHE.put(key=employee_id, value=result, ttl=cache['Environment']['Data']['STATUS_CACHE_TTL'])
+    logger.debug('STATUS_CACHE stats={}'.format(STATUS_CACHE.stats))
+    return result
+
+
 ###############################################################################
 ###                                                                         ###
 ###                         M A I N    H A N D L E R                        ###
@@ -223,7 +436,7 @@ def handler(
     employee_id = _extract_employee_id_from_path(event=event, logger=logger)
     if employee_id is not None:
         logger.info('Requesting status for employee ID {}'.format(employee_id))
-        result = get_employee_access_card_record(
+        result = get_employee_access_card_status(
             employee_id=employee_id,
             logger=logger
         )
@@ -1,13 +1,17 @@
 import boto3
+from botocore.config import Config
+import threading
 import traceback
 import os
 import json
 import logging
 from datetime import datetime
 import sys
-from inspect import getframeinfo, stack
 from decimal import Decimal
 import copy
+import time
+import bisect
+from collections import OrderedDict
 # Other imports here...
 
 
@@ -28,11 +32,33 @@ def get_logger(level=logging.INFO):
     return logger
 
 
-def get_client(client_name: str, region: str='eu-central-1', boto3_clazz=boto3):
-    return boto3_clazz.client(client_name, region_name=region)
+CLIENT_REGISTRY = dict()
+CLIENT_REGISTRY_LOCK = threading.Lock()
+try:
+    CLIENT_CONFIG = Config(max_pool_connections=25, connect_timeout=5, read_timeout=30, retries={'max_attempts': 5, 'mode': 'standard'}, tcp_keepalive=True)
+except TypeError:   # tcp_keepalive requires botocore 1.27.84 or later
+    CLIENT_CONFIG = Config(max_pool_connections=25, connect_timeout=5, read_timeout=30, retries={'max_attempts': 5, 'mode': 'standard'})
+
+
+def get_client(client_name: str, region: str='eu-central-1', boto3_clazz=boto3, endpoint_url: str=None):
+    """
+        Clients are created on first use and kept in CLIENT_REGISTRY for the lifetime of the execution environment, so
+        warm invocations re-use the client and its pool of keep-alive connections. Only the services actually used by
+        the function are ever created.
+    """
+    registry_key = (client_name, region, endpoint_url, id(boto3_clazz))
+    if registry_key not in CLIENT_REGISTRY:
+        with CLIENT_REGISTRY_LOCK:
+            if registry_key not in CLIENT_REGISTRY:
+                CLIENT_REGISTRY[registry_key] = boto3_clazz.client(client_name, region_name=region, endpoint_url=endpoint_url, config=CLIENT_CONFIG)
+    return CLIENT_REGISTRY[registry_key]
 
 
 CACHE_TTL_DEFAULT = 600
+SHARED_STATUS_CACHE_TTL_DEFAULT = 300
+SHARED_STATUS_CACHE_SK = 'CACHE#ACCESS_CARD_STATUS'
+PERMISSION_CACHE_TTL_DEFAULT = 60
+PERMISSION_CACHE_MAX_ENTRIES_DEFAULT = 100
 cache = dict()
 
 
@@ -61,6 +87,14 @@ def get_cache_ttl(logger=get_logger())->int:
     return CACHE_TTL_DEFAULT
 
 
+def get_int_from_environment(name: str, default: int, minimum: int=0, logger=get_logger())->int:
+    try:
+        return max(minimum, int(os.getenv(name, '{}'.format(default))))
+    except:
+        logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+    return default
+
+
 def refresh_environment_cache(logger=get_logger()):
     global cache
     now = get_utc_timestamp(with_decimal=False)
@@ -72,12 +106,34 @@ def refresh_environment_cache(logger=get_logger()):
         'Data': {
             'CACHE_TTL': get_cache_ttl(logger=logger),
             'DEBUG': get_debug(),
+            'PERMISSION_CACHE_TTL': get_int_from_environment(name='PERMISSION_CACHE_TTL', default=PERMISSION_CACHE_TTL_DEFAULT, logger=logger),
+            'PERMISSION_CACHE_MAX_ENTRIES': get_int_from_environment(name='PERMISSION_CACHE_MAX_ENTRIES', default=PERMISSION_CACHE_MAX_ENTRIES_DEFAULT, minimum=1, logger=logger),
             # Other ENVIRONMENT variables can be added here... The environment will be re-read after the CACHE_TTL 
         }
     }
     logger.debug('cache: {}'.format((json.dumps(cache))))
 
 
+class DebugMessage:
+    """
+        Defers the `str.format()` of a debug message until a handler actually emits the log record
+    """
+    __slots__ = ('message', 'variables_as_dict', 'variable_as_list')
+
+    def __init__(self, message: str, variables_as_dict: dict, variable_as_list: list):
+        self.message = message
+        self.variables_as_dict = variables_as_dict
+        self.variable_as_list = variable_as_list
+
+    def __str__(self):
+        try:
+            if len(self.variables_as_dict) > 0:
+                return self.message.format(**self.variables_as_dict)
+            return self.message.format(*self.variable_as_list)
+        except:
+            return self.message
+
+
 def debug_log(message: str, variables_as_dict: dict=dict(), variable_as_list: list=list(), logger=get_logger(level=logging.INFO)):
     """
         See:
@@ -100,16 +156,9 @@ def debug_log(message: str, variables_as_dict: dict=dict(), variable_as_list: li
 
     """
     if cache['Environment']['Data']['DEBUG'] is True:
-        try:
-            caller = getframeinfo(stack()[1][0])
-            caller_str = '{}():{}'.format(caller.function, caller.lineno)
-            message = '[{}]  {}'.format(caller_str, message)
-            if len(variables_as_dict) > 0:
-                logger.debug(message.format(**variables_as_dict))
-            else:
-                logger.debug(message.format(*variable_as_list))
-        except:
-            pass
+        if logger.isEnabledFor(logging.DEBUG) is True:
+            # stacklevel=2 attributes the record (funcName/lineno) to the caller without inspecting the stack
+            logger.debug(DebugMessage(message=message, variables_as_dict=variables_as_dict, variable_as_list=variable_as_list), stacklevel=2)
 
 
 ###############################################################################
@@ -260,49 +309,262 @@ def validate_record_structure_and_data(event_data: dict, logger=get_logger())->b
     return True
 
 
-def process_permission_record_and_extract_permissions_if_current_at_the_time_of_event(permission_record: dict, event_timestamp: Decimal, logger=get_logger())->list:
+###############################################################################
+###                                                                         ###
+###                  P E R M I S S I O N    R E S O L V E R                 ###
+###                                                                         ###
+###############################################################################
+
+
+class PermissionIndex:
     """
-        permission_record={
-            'PK'                    : 'EMP#100000000021',
-            'SK'                    : 'PERSON#PERSONAL_DATA#PERMISSIONS#1666679226',
-            'CardIdx'               : '100000000087',
-            'CognitoSubjectId'      : 'bbba18b6-7c46-4652-a2a4-f7b014af42ce',
-            'EndTimestamp'          : '-1',                                             # Decimal
-            'ScannedBuildingIdx'    : '???',
-            'StartTimestamp'        : '1234567890',                                     # Decimal
-            'SystemPermissions'     : 'aa,bb,cc,...',
-        }
+        Point in time index of the permission history of one user. A permission record grants its
+        `SystemPermissions` strictly after `StartTimestamp` and, unless `EndTimestamp` is `-1` (still active), strictly
+        before `EndTimestamp`:
+
+            permission_record={
+                'PK'                    : 'EMP#100000000021',
+                'SK'                    : 'PERSON#PERSONAL_DATA#PERMISSIONS#1666679226',
+                'CognitoSubjectId'      : 'bbba18b6-7c46-4652-a2a4-f7b014af42ce',
+                'EndTimestamp'          : '-1',                                             # Decimal
+                'StartTimestamp'        : '1234567890',                                     # Decimal
+                'SystemPermissions'     : 'aa,bb,cc,...',
+            }
+
+        All start and end timestamps are sorted into `boundaries`, which split the time line into the open ranges
+        between two boundaries and the boundaries themselves. The permissions of every range and of every boundary are
+        resolved once, so `permissions_at()` is a single `bisect` lookup.
     """
-    permissions = list()
-    debug_log(message='permission_record={}', variable_as_list=[permission_record,], logger=logger)
-    debug_log(message='event_timestamp={}', variable_as_list=[event_timestamp,], logger=logger)
-    try:
-        record_is_active_at_time_of_event = False
-        if permission_record['EndTimestamp'].compare(Decimal('-1')) == Decimal(0):
-            # Still active permission - check StartTimestamp < event_timestamp
-            logger.info('Processing still active permission. Ensuring permission start timestamp {} is before the event timestamp {}'.format(str(permission_record['StartTimestamp']), str(event_timestamp)))
-            if permission_record['StartTimestamp'].compare(event_timestamp) == Decimal(-1):
-                record_is_active_at_time_of_event = True
-                logger.info('Found a valid permission in the event time range')
-            else:
-                logger.info('Found an invalid permission in the event time range')
-        elif permission_record['EndTimestamp'].compare(Decimal('-1')) != Decimal(0):
-            # No longer active permission - check StartTimestamp < event_timestamp AND EndTimestamp > event_timestamp
-            logger.info('Processing now in-active permission. Ensuring permission start timestamp {} is before the event timestamp {} and the the end timestamp {} is after'.format(
-                str(permission_record['StartTimestamp']), 
-                str(event_timestamp)),
-                str(permission_record['EndTimestamp'])
-            )
-            if permission_record['StartTimestamp'].compare(event_timestamp) == Decimal(-1) and permission_record['EndTimestamp'].compare(event_timestamp) == Decimal(1):
-                record_is_active_at_time_of_event = True
-                logger.info('Found a valid permission in the event time range')
+
+    def __init__(self, permission_records: list, logger=get_logger()):
+        intervals = list()
+        for permission_record in permission_records:
+            try:
+                start = Decimal('{}'.format(permission_record['StartTimestamp']))
+                end = Decimal('{}'.format(permission_record['EndTimestamp']))
+                if end == Decimal('-1'):
+                    end = None
+                permissions = frozenset(permission for permission in '{}'.format(permission_record['SystemPermissions']).split(',') if len(permission) > 0)
+                intervals.append((start, end, permissions,))
+            except:
+                logger.error('Ignoring invalid permission record {}'.format(permission_record))
+                logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+        boundaries = set()
+        for start, end, permissions in intervals:
+            boundaries.add(start)
+            if end is not None:
+                boundaries.add(end)
+        self.boundaries = sorted(boundaries)
+        self.intervals = intervals
+        self.point_permissions = [self._resolve(timestamp=boundary) for boundary in self.boundaries]
+        self.range_permissions = [frozenset()]    # Before the first start timestamp
+        for idx in range(1, len(self.boundaries)):
+            self.range_permissions.append(self._resolve(timestamp=(self.boundaries[idx - 1] + self.boundaries[idx]) / 2))
+        if len(self.boundaries) > 0:
+            self.range_permissions.append(self._resolve(timestamp=self.boundaries[-1] + 1))
+        self.intervals = None
+
+    def _resolve(self, timestamp: Decimal)->frozenset:
+        permissions = set()
+        for start, end, interval_permissions in self.intervals:
+            if start < timestamp and (end is None or end > timestamp):
+                permissions.update(interval_permissions)
+        return frozenset(permissions)
+
+    def permissions_at(self, timestamp: Decimal)->frozenset:
+        idx = bisect.bisect_left(self.boundaries, timestamp)
+        if idx < len(self.boundaries) and self.boundaries[idx] == timestamp:
+            return self.point_permissions[idx]
+        return self.range_permissions[idx]
+
+
+class TtlLruCache:
+    """
+        In-process cache kept for the lifetime of the execution environment. Entries expire after their TTL and the
+        least recently used entry is evicted when the cache holds more than `max_entries` entries.
+    """
+
+    def __init__(self, max_entries: int=PERMISSION_CACHE_MAX_ENTRIES_DEFAULT):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.stats = {'Hits': 0, 'Misses': 0, 'Expired': 0, 'Evictions': 0}
+
+    def get(self, key: str, now: float=None):
+        if now is None:
+            now = time.time()
+        if key not in self.entries:
+            self.stats['Misses'] += 1
+            return None
+        expires, value = self.entries[key]
+        if expires <= now:
+            del self.entries[key]
+            self.stats['Expired'] += 1
+            self.stats['Misses'] += 1
+            return None
+        self.entries.move_to_end(key)
+        self.stats['Hits'] += 1
+        return value
+
+    def put(self, key: str, value, ttl: int, now: float=None):
+        if ttl <= 0:
+            return
+        if now is None:
+            now = time.time()
+        self.entries.pop(key, None)
+        self.entries[key] = (now + ttl, value,)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats['Evictions'] += 1
+
+    def invalidate(self, key: str):
+        self.entries.pop(key, None)
+
+
+PERMISSION_CACHE = TtlLruCache()
+
+
+###############################################################################
+###                                                                         ###
+###                  D Y N A M O D B    A T T R I B U T E S                 ###
+###                                                                         ###
+###############################################################################
+
+
+def _decode_list(value: list)->list:
+    return [decode_attribute_value(attribute_value=element) for element in value]
+
+
+def _decode_map(value: dict)->dict:
+    return decode_item(item=value)
+
+
+# Types mapped to None are already returned by the client as the correct Python type and need no conversion
+ATTRIBUTE_VALUE_DECODERS = {
+    'S': None,
+    'N': Decimal,
+    'BOOL': None,
+    'NULL': lambda value: None,
+    'B': None,
+    'SS': set,
+    'NS': lambda value: set(Decimal(element) for element in value),
+    'BS': set,
+    'L': _decode_list,
+    'M': _decode_map,
+}
+
+
+def decode_attribute_value(attribute_value: dict):
+    """
+        Convert a single DynamoDB AttributeValue, for example `{'N': '10.5'}`, to the Python value (`Decimal('10.5')`)
+
+        Numbers are always returned as `Decimal`, `L` and `M` values are decoded recursively and sets are returned as
+        Python `set` objects. Unknown types raise a `KeyError`.
+    """
+    for data_type, data_value in attribute_value.items():
+        decoder = ATTRIBUTE_VALUE_DECODERS[data_type]
+        if decoder is None:
+            return data_value
+        return decoder(data_value)
+
+
+def decode_item(item: dict)->dict:
+    """
+        Convert a DynamoDB item (as returned by the low level client) to a plain Python dict
+    """
+    decoders = ATTRIBUTE_VALUE_DECODERS
+    record = dict()
+    for field_name, field_data in item.items():
+        for data_type, data_value in field_data.items():
+            decoder = decoders[data_type]
+            if decoder is None:
+                record[field_name] = data_value
             else:
-                logger.info('Found an invalid permission in the event time range')
-        if record_is_active_at_time_of_event is True:
-            permissions = permission_record['SystemPermissions'].split(',')
-    except:
-        logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
-    return permissions
+                record[field_name] = decoder(data_value)
+    return record
+
+
+def decode_items(items: list)->list:
+    """
+        Convert a complete `Items` list from a Query or Scan response
+    """
+    return [decode_item(item=item) for item in items]
+
+
+def _encode_number(value)->dict:
+    return {'N': str(value)}
+
+
+def _encode_float(value: float)->dict:
+    # repr() gives the shortest string that round trips, which avoids binary floating point noise in the stored value
+    return {'N': repr(value)}
+
+
+def _encode_set(value)->dict:
+    if len(value) == 0:
+        raise ValueError('DynamoDB does not support empty sets')
+    elements = tuple(value)
+    if all(isinstance(element, str) for element in elements):
+        return {'SS': list(elements)}
+    if all(isinstance(element, (bytes, bytearray)) for element in elements):
+        return {'BS': [bytes(element) for element in elements]}
+    if all(isinstance(element, (int, float, Decimal)) and not isinstance(element, bool) for element in elements):
+        return {'NS': [_encode_number_value(element) for element in elements]}
+    raise ValueError('Sets must contain only strings, only numbers or only binary values')
+
+
+def _encode_number_value(value)->str:
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+ATTRIBUTE_VALUE_ENCODERS = {
+    str: lambda value: {'S': value},
+    bool: lambda value: {'BOOL': value},
+    int: _encode_number,
+    float: _encode_float,
+    Decimal: _encode_number,
+    type(None): lambda value: {'NULL': True},
+    bytes: lambda value: {'B': value},
+    bytearray: lambda value: {'B': bytes(value)},
+    set: _encode_set,
+    frozenset: _encode_set,
+    list: lambda value: {'L': [encode_attribute_value(value=element) for element in value]},
+    tuple: lambda value: {'L': [encode_attribute_value(value=element) for element in value]},
+    dict: lambda value: {'M': encode_item(record=value)},
+}
+
+
+def encode_attribute_value(value)->dict:
+    """
+        Convert a Python value to a DynamoDB AttributeValue. The exact type is looked up first and sub classes (for
+        example `OrderedDict`) fall back to an `isinstance()` check.
+    """
+    encoder = ATTRIBUTE_VALUE_ENCODERS.get(type(value))
+    if encoder is None:
+        for python_type, type_encoder in ATTRIBUTE_VALUE_ENCODERS.items():
+            if isinstance(value, python_type):
+                encoder = type_encoder
+                break
+    if encoder is None:
+        raise TypeError('Unsupported type for DynamoDB attribute: {}'.format(type(value)))
+    return encoder(value)
+
+
+def encode_item(record: dict)->dict:
+    """
+        Convert a plain Python dict to a DynamoDB item
+    """
+    encoders = ATTRIBUTE_VALUE_ENCODERS
+    item = dict()
+    for field_name, field_value in record.items():
+        encoder = encoders.get(type(field_value))
+        if encoder is not None:
+            item[field_name] = encoder(field_value)
+        else:
+            item[field_name] = encode_attribute_value(value=field_value)
+    return item
+
 
 ###############################################################################
 ###                                                                         ###
@@ -315,68 +577,48 @@ def db_get_user_permissions_by_cognito_id(
     cognito_id: str,
     client=get_client(client_name='dynamodb', region='eu-central-1'),
     logger=get_logger(),
-    next_token: dict=None
+    next_token: dict=None,
+    page_size: int=100
 )->tuple:
+    """
+        Returns the complete permission history of the user, following `LastEvaluatedKey` from `next_token` (or the
+        start of the history) to the last page. Returns `None` when the history could not be read, as an incomplete
+        history must not be cached.
+    """
     permissions = list()
     try:
-        response = dict()
-        if next_token is not None:
-            response = client.query(
-                TableName='lab3-access-card-app',
-                IndexName='CognitoIdx',
-                Select='ALL_ATTRIBUTES',
-                Limit=10,
-                ConsistentRead=False,
-                KeyConditions={
-                    'CognitoSubjectId': {
-                        'AttributeValueList': [{'S': '{}'.format(cognito_id),},],
-                        'ComparisonOperator': 'EQ'
-                    },
-                    'SK': {
-                        'AttributeValueList': [
-                            {'S': 'PERSON#PERSONAL_DATA#PERMISSIONS#',},],
-                        'ComparisonOperator': 'BEGINS_WITH'
-                    }
+        parameters = {
+            'TableName': 'lab3-access-card-app',
+            'IndexName': 'CognitoIdx',
+            'Select': 'ALL_ATTRIBUTES',
+            'Limit': page_size,
+            'ConsistentRead': False,
+            'KeyConditions': {
+                'CognitoSubjectId': {
+                    'AttributeValueList': [{'S': '{}'.format(cognito_id),},],
+                    'ComparisonOperator': 'EQ'
                 },
-                ExclusiveStartKey=next_token
-            )
-        else:
-            response = client.query(
-                TableName='lab3-access-card-app',
-                IndexName='CognitoIdx',
-                Select='ALL_ATTRIBUTES',
-                Limit=10,
-                ConsistentRead=False,
-                KeyConditions={
-                    'CognitoSubjectId': {
-                        'AttributeValueList': [{'S': '{}'.format(cognito_id),},],
-                        'ComparisonOperator': 'EQ'
-                    },
-                    'SK': {
-                        'AttributeValueList': [
-                            {'S': 'PERSON#PERSONAL_DATA#PERMISSIONS#',},],
-                        'ComparisonOperator': 'BEGINS_WITH'
-                    }
+                'SK': {
+                    'AttributeValueList': [
+                        {'S': 'PERSON#PERSONAL_DATA#PERMISSIONS#',},],
+                    'ComparisonOperator': 'BEGINS_WITH'
                 }
-            )
-
-        debug_log(message='response={}', variable_as_list=[response,], logger=logger)
-        if 'Items' in response:
-            if len(response['Items']) > 0:
-                for item in response['Items']:
-                    record = dict()
-                    for key, data in item.items():
-                        for data_key, data_value in data.items():
-                            if data_key.lower() == 's':
-                                record[key] = data_value
-                            if data_key.lower() == 'n':
-                                record[key] = Decimal(data_value)
-                            if data_key.lower() == 'bool':
-                                record[key] = data_value
-                    debug_log(message='record={}', variable_as_list=[record,], logger=logger)
-                    permissions.append(record)
+            },
+        }
+        if next_token is not None:
+            parameters['ExclusiveStartKey'] = next_token
+        while True:
+            response = client.query(**parameters)
+            debug_log(message='response={}', variable_as_list=[response,], logger=logger)
+            for record in decode_items(items=response.get('Items', list())):
+                debug_log(message='record={}', variable_as_list=[record,], logger=logger)
+                permissions.append(record)
+            if 'LastEvaluatedKey' not in response:
+                break
+            parameters['ExclusiveStartKey'] = response['LastEvaluatedKey']
     except:
         logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+        return None
     return tuple(permissions)
 
 
@@ -407,14 +649,7 @@ def get_card_issued_status(
         )
         debug_log(message='response={}', variable_as_list=[response,], logger=logger)
         for item in response['Items']:
-            for key, data in item.items():
-                for data_key, data_value in data.items():
-                    if data_key.lower() == 's':
-                        card_status_data[key] = data_value
-                    if data_key.lower() == 'n':
-                        card_status_data[key] = Decimal(data_value)
-                    if data_key.lower() == 'bool':
-                        card_status_data[key] = data_value
+            card_status_data.update(decode_item(item=item))
     except:
         logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
     debug_log(message='card_status_data={}', variable_as_list=[card_status_data,], logger=logger)
@@ -447,14 +682,7 @@ def get_employee_profile(
         )
         debug_log(message='response={}', variable_as_list=[response,], logger=logger)
         for item in response['Items']:
-            for key, data in item.items():
-                for data_key, data_value in data.items():
-                    if data_key.lower() == 's':
-                        employee_profile[key] = data_value
-                    if data_key.lower() == 'n':
-                        employee_profile[key] = Decimal(data_value)
-                    if data_key.lower() == 'bool':
-                        employee_profile[key] = data_value
+            employee_profile.update(decode_item(item=item))
     except:
         logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
     debug_log(message='employee_profile={}', variable_as_list=[employee_profile,], logger=logger)
@@ -504,6 +732,36 @@ def create_dynamodb_record(
     return False
 
 
+def invalidate_shared_status_cache_record(
+    key: dict,
+    client=get_client(client_name='dynamodb', region='eu-central-1'),
+    logger=get_logger()
+)->bool:
+    """
+        Removes the cached access card status of the `employee_access_card_status` function and records the time of
+        the invalidation, so that a status that was read before this point can no longer be stored in the cache.
+    """
+    try:
+        logger.info('Invalidating cached status with key {}'.format(key))
+        now = get_utc_timestamp(with_decimal=True)
+        response = client.update_item(
+            TableName='lab3-access-card-app',
+            Key=key,
+            UpdateExpression='SET InvalidatedTimestamp = :now, CacheExpiresTimestamp = :expires REMOVE CachedStatus',
+            ExpressionAttributeValues={
+                ':now': {'N': '{}'.format(now), },
+                ':expires': {'N': '{}'.format(int(now) + SHARED_STATUS_CACHE_TTL_DEFAULT), },
+            },
+            ReturnValues='NONE',
+            ReturnConsumedCapacity='TOTAL'
+        )
+        debug_log(message='response={}', variable_as_list=[response,], logger=logger)
+        return True
+    except:
+        logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+    return False
+
+
 def get_employee_record_from_cognito_id(
     cognito_id: str,
     client=get_client(client_name='dynamodb', region='eu-central-1'),
@@ -532,16 +790,7 @@ def get_employee_record_from_cognito_id(
         debug_log(message='response={}', variable_as_list=[response,], logger=logger)
         if 'Items' in response:
             if len(response['Items']) > 0:
-                for item in response['Items']:
-                    record = dict()
-                    for key, data in item.items():
-                        for data_key, data_value in data.items():
-                            if data_key.lower() == 's':
-                                record[key] = data_value
-                            if data_key.lower() == 'n':
-                                record[key] = Decimal(data_value)
-                            if data_key.lower() == 'bool':
-                                record[key] = data_value
+                for record in decode_items(items=response['Items']):
                     debug_log(message='record={}', variable_as_list=[record,], logger=logger)
                     employee_record = copy.deepcopy(record)
     except:
@@ -577,16 +826,7 @@ def get_employee_record_from_employee_id(
         debug_log(message='response={}', variable_as_list=[response,], logger=logger)
         if 'Items' in response:
             if len(response['Items']) > 0:
-                for item in response['Items']:
-                    record = dict()
-                    for key, data in item.items():
-                        for data_key, data_value in data.items():
-                            if data_key.lower() == 's':
-                                record[key] = data_value
-                            if data_key.lower() == 'n':
-                                record[key] = Decimal(data_value)
-                            if data_key.lower() == 'bool':
-                                record[key] = data_value
+                for record in decode_items(items=response['Items']):
                     debug_log(message='record={}', variable_as_list=[record,], logger=logger)
                     employee_record = copy.deepcopy(record)
     except:
@@ -602,19 +842,42 @@ def get_employee_record_from_employee_id(
 ###############################################################################
 
 
-def user_has_permissions(event_data: dict, event_timestamp: Decimal, logger:get_logger())->bool:
+def get_permission_index(cognito_id: str, logger=get_logger())->PermissionIndex:
+    """
+        Returns the `PermissionIndex` of the user from `PERMISSION_CACHE`, or loads the permission history when the
+        user is not cached. A burst of events linked by the same user therefore costs a single history load, but a
+        permission change can take up to `PERMISSION_CACHE_TTL` seconds to be seen. Returns `None` when the history
+        could not be loaded.
+    """
+    PERMISSION_CACHE.max_entries = cache['Environment']['Data']['PERMISSION_CACHE_MAX_ENTRIES']
+    permission_index = PERMISSION_CACHE.get(key=cognito_id)
+    if permission_index is not None:
+        logger.info('Permissions of {} served from the cache'.format(cognito_id))
+        return permission_index
     user_permission_records = db_get_user_permissions_by_cognito_id(
-        cognito_id=event_data['LinkedBy']['CognitoId'],
+        cognito_id=cognito_id,
         logger=logger
     )
     debug_log(message='user_permission_records={}', variable_as_list=[user_permission_records,], logger=logger)
-    final_active_permissions = list()
-    for permission_record in user_permission_records:
-        active_permissions_from_record = process_permission_record_and_extract_permissions_if_current_at_the_time_of_event(permission_record=permission_record, event_timestamp=event_timestamp, logger=logger)
-        for active_permission in active_permissions_from_record:
-            if active_permission not in final_active_permissions:
-                final_active_permissions.append(active_permission)
-    logger.info('Final active permissions at the time of event: {}'.format(final_active_permissions))
+    if user_permission_records is None:
+        return None
+    permission_index = PermissionIndex(permission_records=user_permission_records, logger=logger)
+    PERMISSION_CACHE.put(key=cognito_id, value=permission_index, ttl=cache['Environment']['Data']['PERMISSION_CACHE_TTL'])
+    logger.debug('PERMISSION_CACHE stats={}'.format(PERMISSION_CACHE.stats))
+    return permission_index
+
+
+def user_has_permissions(event_data: dict, event_timestamp: Decimal, logger:get_logger())->bool:
+    """
+        Returns `None` when the permission history of the linking user could not be loaded - the permissions are then
+        unknown and the event must be retried rather than rejected.
+    """
+    permission_index = get_permission_index(cognito_id=event_data['LinkedBy']['CognitoId'], logger=logger)
+    if permission_index is None:
+        logger.error('Permissions of the linking user could not be loaded')
+        return None
+    final_active_permissions = permission_index.permissions_at(timestamp=event_timestamp)
+    logger.info('Final active permissions at the time of event: {}'.format(sorted(final_active_permissions)))
     for required_permission in REQUIRED_PERMISSIONS:
         if required_permission in final_active_permissions:
             return True
@@ -696,21 +959,21 @@ def action_create_employee_access_card_record(
     target_employee_record :dict=dict(),
     logger=get_logger()
 )->bool:
-    record_data = {
-        'CardIssuedTimestamp'   : { 'N': '{}'.format(str(event_timestamp))                                  },
-        'CardRevokedTimestamp'  : { 'N': '0'                                                                },
-        'CardStatus'            : { 'S': 'issued'                                                           },
-        'CardIssuedTo'          : { 'S': '{}'.format(event_data['EmployeeId'])                              },
-        'CardIssuedBy'          : { 'S': '{}'.format(linking_user_employee_record['PK'].replace('EMP#','')) },
-        'CardIdx'               : { 'S': '{}'.format(event_data['CardId'])                                  },
-        'PersonName'            : { 'S': '{}'.format(target_employee_record['PersonName'])                  },
-        'PersonSurname'         : { 'S': '{}'.format(target_employee_record['PersonSurname'])               },
-        'PersonDepartment'      : { 'S': '{}'.format(target_employee_record['PersonDepartment'])            },
-        'PersonStatus'          : { 'S': '{}'.format(final_employee_status)                                 },
-        'ScannedBuildingIdx'    : { 'S': '{}'.format(event_data['Campus'])                                  },
-        'ScannedStatus'         : { 'S': 'scanned-in'                                                       },
-        'CognitoSubjectId'      : { 'S': '{}'.format(target_employee_record['CognitoSubjectId'])            }
-    }
+    record_data = encode_item(record={
+        'CardIssuedTimestamp'   : event_timestamp,
+        'CardRevokedTimestamp'  : 0,
+        'CardStatus'            : 'issued',
+        'CardIssuedTo'          : '{}'.format(event_data['EmployeeId']),
+        'CardIssuedBy'          : '{}'.format(linking_user_employee_record['PK'].replace('EMP#','')),
+        'CardIdx'               : '{}'.format(event_data['CardId']),
+        'PersonName'            : '{}'.format(target_employee_record['PersonName']),
+        'PersonSurname'         : '{}'.format(target_employee_record['PersonSurname']),
+        'PersonDepartment'      : '{}'.format(target_employee_record['PersonDepartment']),
+        'PersonStatus'          : '{}'.format(final_employee_status),
+        'ScannedBuildingIdx'    : '{}'.format(event_data['Campus']),
+        'ScannedStatus'         : 'scanned-in',
+        'CognitoSubjectId'      : '{}'.format(target_employee_record['CognitoSubjectId'])
+    })
     logger.info('   ACTION: key={}'.format(key))
     logger.info('   ACTION: record_data={}'.format(record_data))
     return create_dynamodb_record(
@@ -729,13 +992,16 @@ def action_update_employee_status(
     target_employee_record :dict=dict(),
     logger=get_logger()
 )->bool:
-    record_data = {
-        'PersonName'        : { 'S': '{}'.format(target_employee_record['PersonName'])          },
-        'PersonSurname'     : { 'S': '{}'.format(target_employee_record['PersonSurname'])       },
-        'PersonDepartment'  : { 'S': '{}'.format(target_employee_record['PersonDepartment'])    },
-        'PersonStatus'      : { 'S': '{}'.format(final_employee_status)                         },
-        'CognitoSubjectId'  : { 'S': '{}'.format(target_employee_record['CognitoSubjectId'])    }
-    }
+    record_data = encode_item(record={
+        'PersonName'        : '{}'.format(target_employee_record['PersonName']),
+        'PersonSurname'     : '{}'.format(target_employee_record['PersonSurname']),
+        'PersonDepartment'  : '{}'.format(target_employee_record['PersonDepartment']),
+        'PersonStatus'      : '{}'.format(final_employee_status),
+        'CognitoSubjectId'  : '{}'.format(target_employee_record['CognitoSubjectId']),
+        # Keys of the sparse PersonStatusIdx index, used to list the employees by status
+        'PersonStatusIdx'   : '{}'.format(final_employee_status),
+        'PersonDepartmentIdx': '{}#{}'.format(target_employee_record['PersonDepartment'], key['PK']['S'].replace('EMP#','')),
+    })
     logger.info('   ACTION: key={}'.format(key))
     logger.info('   ACTION: record_data={}'.format(record_data))
     return create_dynamodb_record(
@@ -745,6 +1011,26 @@ def action_update_employee_status(
     )
 
 
+def action_invalidate_employee_access_card_status_cache(
+    key: dict,
+    event_data: dict=dict(),
+    event_timestamp: Decimal=Decimal('0'),
+    final_employee_status: str=None,
+    linking_user_employee_record: dict=dict(),
+    target_employee_record :dict=dict(),
+    logger=get_logger()
+)->bool:
+    """
+        A failed invalidation is not retried: the employee records are already committed, and the cached status
+        expires after the `SHARED_STATUS_CACHE_TTL` of the `employee_access_card_status` function in any case.
+    """
+    logger.info('   ACTION: key={}'.format(key))
+    logger.info('   ACTION: record_data=n/a')
+    if invalidate_shared_status_cache_record(key=key, logger=logger) is False:
+        logger.warning('Cached access card status could not be invalidated - it stays outdated until it expires')
+    return True
+
+
 def action_create_card_link_event_record(
     key: dict,
     event_data: dict=dict(),
@@ -758,26 +1044,26 @@ def action_create_card_link_event_record(
         event_data['EventSourceArn'],
         event_data['EventId']
     )
-    record_data = {
-        'CardIdx'                           : { 'S': '{}'.format(event_data['CardId'])                                  },
-        'EventType'                         : { 'S': 'LinkCard'                                                         },
-        'EventBucketName'                   : { 'S': '{}'.format(event_data['EventBucket'])                             },
-        'EventBucketKey'                    : { 'S': '{}'.format(event_data['EventBucketKey'])                          },
-        'EventRequestId'                    : { 'S': '{}'.format(event_data['RequestId'])                               },
-        'EventRequestedByEmployeeId'        : { 'S': '{}'.format(linking_user_employee_record['PK'].replace('EMP#','')) },
-        'EventTimestamp'                    : { 'N': '{}'.format(str(event_timestamp))                                  },
-        'EventOutcomeDescription'           : { 'S': 'Card Linked Successfully'                                         },
-        'EventErrorMessage'                 : { 'S': 'No Errors'                                                        },
-        'EventCompletionStatus'             : { 'S': 'Success'                                                          },
-        'EventProcessorLockId'              : { 'S': 'None'                                                             },
-        'EventProcessorStartTimestamp'      : { 'N': '0'                                                                },
-        'EventProcessorExpiresTimestamp'    : { 'N': '0'                                                                },
-        'EventSqsAck'                       : { 'BOOL': True                                                            },
-        'EventSqsDelete'                    : { 'BOOL': True                                                            },
-        'EventSqsReject'                    : { 'BOOL': False                                                           },
-        'EventSqsId'                        : { 'S': '{}'.format(sqs_event_source_id)                                   },
-        'EventSqsOriginalPayloadJson'       : { 'S': '{}'.format(json.dumps(event_data))                                }
-    }
+    record_data = encode_item(record={
+        'CardIdx'                           : '{}'.format(event_data['CardId']),
+        'EventType'                         : 'LinkCard',
+        'EventBucketName'                   : '{}'.format(event_data['EventBucket']),
+        'EventBucketKey'                    : '{}'.format(event_data['EventBucketKey']),
+        'EventRequestId'                    : '{}'.format(event_data['RequestId']),
+        'EventRequestedByEmployeeId'        : '{}'.format(linking_user_employee_record['PK'].replace('EMP#','')),
+        'EventTimestamp'                    : event_timestamp,
+        'EventOutcomeDescription'           : 'Card Linked Successfully',
+        'EventErrorMessage'                 : 'No Errors',
+        'EventCompletionStatus'             : 'Success',
+        'EventProcessorLockId'              : 'None',
+        'EventProcessorStartTimestamp'      : 0,
+        'EventProcessorExpiresTimestamp'    : 0,
+        'EventSqsAck'                       : True,
+        'EventSqsDelete'                    : True,
+        'EventSqsReject'                    : False,
+        'EventSqsId'                        : '{}'.format(sqs_event_source_id),
+        'EventSqsOriginalPayloadJson'       : '{}'.format(json.dumps(event_data))
+    })
     logger.info('   ACTION: key={}'.format(key))
     logger.info('   ACTION: record_data={}'.format(record_data))
     return create_dynamodb_record(
@@ -813,14 +1099,14 @@ def action_create_new_card_status_record(
     target_employee_record :dict=dict(),
     logger=get_logger()
 )->bool:
-    record_data = {
-        'CardIdx'               : { 'S': '{}'.format(event_data['CardId'])                                      },
-        'LockIdentifier'        : { 'S': 'null'                                                                 },
-        'IsAvailableForIssue'   : { 'BOOL': False                                                               },
-        'CardIssuedTo'          : { 'S': '{}'.format(event_data['EmployeeId'])                                  },
-        'CardIssuedBy'          : { 'S': '{}'.format(linking_user_employee_record['PK']).replace('EMP#', '')    },
-        'CardIssuedTimestamp'   : { 'N': '{}'.format(str(event_timestamp))                                      }
-    }
+    record_data = encode_item(record={
+        'CardIdx'               : '{}'.format(event_data['CardId']),
+        'LockIdentifier'        : 'null',
+        'IsAvailableForIssue'   : False,
+        'CardIssuedTo'          : '{}'.format(event_data['EmployeeId']),
+        'CardIssuedBy'          : '{}'.format(linking_user_employee_record['PK']).replace('EMP#', ''),
+        'CardIssuedTimestamp'   : event_timestamp
+    })
     logger.info('   ACTION: key={}'.format(key))
     logger.info('   ACTION: record_data={}'.format(record_data))
     return create_dynamodb_record(
@@ -856,15 +1142,15 @@ def action_create_new_card_scanned_status_record(
     target_employee_record :dict=dict(),
     logger=get_logger()
 )->bool:
-    record_data = {
-        'PersonName'                : { 'S': '{}'.format(target_employee_record['PersonName'])      },
-        'PersonSurname'             : { 'S': '{}'.format(target_employee_record['PersonSurname'])   },
-        'ScannedInTimestamp'        : { 'N': '{}'.format(str(event_timestamp))                      },
-        'BuildingIdxWhereScanned'   : { 'S': '{}'.format(event_data['Campus'])                      },
-        'ScannedInEmployeeId'       : { 'S': '{}'.format(event_data['EmployeeId'])                  },
-        'ScannedStatus'             : { 'S': 'scanned-in'                                           },
-        'ScannedStatusComment'      : { 'S': 'Card Issued'                                          }
-    }
+    record_data = encode_item(record={
+        'PersonName'                : '{}'.format(target_employee_record['PersonName']),
+        'PersonSurname'             : '{}'.format(target_employee_record['PersonSurname']),
+        'ScannedInTimestamp'        : event_timestamp,
+        'BuildingIdxWhereScanned'   : '{}'.format(event_data['Campus']),
+        'ScannedInEmployeeId'       : '{}'.format(event_data['EmployeeId']),
+        'ScannedStatus'             : 'scanned-in',
+        'ScannedStatusComment'      : 'Card Issued'
+    })
     logger.info('   ACTION: key={}'.format(key))
     logger.info('   ACTION: record_data={}'.format(record_data))
     return create_dynamodb_record(
@@ -887,26 +1173,26 @@ def action_create_card_scanned_event_record(
         event_data['EventSourceArn'],
         event_data['EventId']
     )
-    record_data = {
-        'CardIdx'                           : { 'S': '{}'.format(event_data['CardId'])                                  },
-        'EventType'                         : { 'S': 'CardScanned'                                                      },
-        'EventBucketName'                   : { 'S': '{}'.format(event_data['EventBucket'])                             },
-        'EventBucketKey'                    : { 'S': '{}'.format(event_data['EventBucketKey'])                          },
-        'EventRequestId'                    : { 'S': '{}'.format(event_data['RequestId'])                               },
-        'EventRequestedByEmployeeId'        : { 'S': '{}'.format(linking_user_employee_record['PK'].replace('EMP#','')) },
-        'EventTimestamp'                    : { 'N': '{}'.format(str(event_timestamp))                                  },
-        'EventOutcomeDescription'           : { 'S': 'Card Scanned Successfully'                                        },
-        'EventErrorMessage'                 : { 'S': 'No Errors'                                                        },
-        'EventCompletionStatus'             : { 'S': 'Success'                                                          },
-        'EventProcessorLockId'              : { 'S': 'None'                                                             },
-        'EventProcessorStartTimestamp'      : { 'N': '0'                                                                },
-        'EventProcessorExpiresTimestamp'    : { 'N': '0'                                                                },
-        'EventSqsAck'                       : { 'BOOL': True                                                            },
-        'EventSqsDelete'                    : { 'BOOL': True                                                            },
-        'EventSqsReject'                    : { 'BOOL': False                                                           },
-        'EventSqsId'                        : { 'S': '{}'.format(sqs_event_source_id)                                   },
-        'EventSqsOriginalPayloadJson'       : { 'S': '{}'.format(json.dumps(event_data))                                }
-    }
+    record_data = encode_item(record={
+        'CardIdx'                           : '{}'.format(event_data['CardId']),
+        'EventType'                         : 'CardScanned',
+        'EventBucketName'                   : '{}'.format(event_data['EventBucket']),
+        'EventBucketKey'                    : '{}'.format(event_data['EventBucketKey']),
+        'EventRequestId'                    : '{}'.format(event_data['RequestId']),
+        'EventRequestedByEmployeeId'        : '{}'.format(linking_user_employee_record['PK'].replace('EMP#','')),
+        'EventTimestamp'                    : event_timestamp,
+        'EventOutcomeDescription'           : 'Card Scanned Successfully',
+        'EventErrorMessage'                 : 'No Errors',
+        'EventCompletionStatus'             : 'Success',
+        'EventProcessorLockId'              : 'None',
+        'EventProcessorStartTimestamp'      : 0,
+        'EventProcessorExpiresTimestamp'    : 0,
+        'EventSqsAck'                       : True,
+        'EventSqsDelete'                    : True,
+        'EventSqsReject'                    : False,
+        'EventSqsId'                        : '{}'.format(sqs_event_source_id),
+        'EventSqsOriginalPayloadJson'       : '{}'.format(json.dumps(event_data))
+    })
     logger.info('   ACTION: key={}'.format(key))
     logger.info('   ACTION: record_data={}'.format(record_data))
     return create_dynamodb_record(
@@ -916,7 +1202,7 @@ def action_create_card_scanned_event_record(
     )
 
 
-def process_event_record_body(event_data: dict, logger=get_logger()):
+def process_event_record_body(event_data: dict, logger=get_logger())->bool:
     """
         Example event_data dict:
 
@@ -936,27 +1222,34 @@ def process_event_record_body(event_data: dict, logger=get_logger()):
                 "EventBucket": "lab3-events-khjidgf", 
                 "EventBucketKey": "link_employee_and_access_card_10021.request"
             }
+
+        Returns False only when a required action failed and the event must be retried. Events rejected by any of the
+        validation steps can never succeed and return True, so that they are not redelivered.
     """
     logger.info('Processing event_data={}'.format(event_data))
 
     # 1) Validate message structure
     if validate_record_structure_and_data(event_data=event_data, logger=logger) is False:
         logger.error('Record validation failed. Not processing the record any further.')
-        return
+        return True
     else:
         logger.info('Validation passed')
     event_timestamp = Decimal(event_data['LinkedTimestamp'])
 
     # 2) Ensure the LinkedBy identity has sufficient permissions for this actions
-    if user_has_permissions(event_data=event_data, event_timestamp=event_timestamp, logger=logger) is False:
+    has_permissions = user_has_permissions(event_data=event_data, event_timestamp=event_timestamp, logger=logger)
+    if has_permissions is None:
+        logger.error('Permissions of the linking user could not be verified - the event will be retried')
+        return False
+    if has_permissions is False:
         logger.error('Linking user did not have the required permissions at the time of event')
-        return
+        return True
     logger.info('Permission test passed')
 
     # 3) Ensure card is currently in the correct state
     if card_is_in_correct_state(event_data=event_data, logger=logger) is False:
         logger.error('Card is not available for issue')
-        return
+        return True
     logger.info('Card status test passed')
 
     # 4) Ensure person is currently in correct state
@@ -966,7 +1259,7 @@ def process_event_record_body(event_data: dict, logger=get_logger()):
     )
     if employee_current_status == 'inactive':
         logger.error('Employee is in-active - can not link card')
-        return
+        return True
     final_employee_status = copy.deepcopy(employee_current_status)
     if employee_current_status == 'onboarding' and event_data['CompleteOnboarding'] is True:
         final_employee_status = 'active'
@@ -1002,6 +1295,14 @@ def process_event_record_body(event_data: dict, logger=get_logger()):
                 'Condition': event_data['CompleteOnboarding'],
             }
         },
+        {
+            'Invalidate Employee Access Card Status Cache': {
+                'PK': 'EMP#{}'.format(event_data['EmployeeId']),
+                'SK': SHARED_STATUS_CACHE_SK,
+                'Executor': action_invalidate_employee_access_card_status_cache,
+                'Condition': True,
+            }
+        },
         {
             'Create Card Link Event Record': {
                 'PK': 'CARD#{}'.format(event_data['CardId']),
@@ -1068,8 +1369,10 @@ def process_event_record_body(event_data: dict, logger=get_logger()):
                     logger.info('REQUIRED ACTION - COMPLETED - {} [PK={}] [SK={}]'.format(action_name, action_data['PK'], action_data['SK']))
                 else:
                     logger.info('REQUIRED ACTION - FAILED - {} [PK={}] [SK={}]'.format(action_name, action_data['PK'], action_data['SK']))
+                    return False
             else:
                 logger.info('REQUIRED ACTION - NO ACTION - {} [PK={}] [SK={}]'.format(action_name, action_data['PK'], action_data['SK']))
+    return True
 
 
 def extract_event_record(event_record: str, logger=get_logger())->dict:
@@ -1084,23 +1387,47 @@ def extract_event_record(event_record: str, logger=get_logger())->dict:
     return None
 
 
-def process_events(event: dict, logger=get_logger()):
+def process_events(event: dict, logger=get_logger())->list:
+    """
+        Process all SQS records and return the list of message IDs that failed and must be retried
+    """
+    failed_message_ids = list()
     if event is None:
         logger.error('event was None')
-        return
+        return failed_message_ids
     if isinstance(event, dict) is False:
         logger.error('event expected to be a dict but was {}'.format(type(event)))
-        return
-    try:
-        for event_record in event['Records']:
+        return failed_message_ids
+    for event_record in event.get('Records', list()):
+        try:
             logger.info('Processing event_record={}'.format(event_record))
             event_data = extract_event_record(event_record=event_record, logger=logger)
             if event_data is not None:
-                process_event_record_body(event_data=event_data, logger=logger)
+                if process_event_record_body(event_data=event_data, logger=logger) is False:
+                    failed_message_ids.append(event_record['messageId'])
             else:
                 logger.error('event_data was None - cannot process this record')
-    except:
-        logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+        except:
+            logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+            if 'messageId' in event_record:
+                failed_message_ids.append(event_record['messageId'])
+    return failed_message_ids
+
+
+def build_batch_response(failed_message_ids: list, logger=get_logger())->dict:
+    """
+        Build the handler response in the shape expected by an SQS event source mapping with ReportBatchItemFailures
+        enabled. Only the listed messages are returned to the queue, all other messages in the batch are deleted.
+    """
+    result = 'Ok'
+    if len(failed_message_ids) > 0:
+        result = 'PartialFailure'
+        logger.warning('Messages reported as failed: {}'.format(failed_message_ids))
+    return {
+        'Result': result,
+        'Message': None,
+        'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed_message_ids],
+    }
 
     
 def handler(
@@ -1116,9 +1443,9 @@ def handler(
     
     debug_log('event={}', variable_as_list=[event], logger=logger)
 
-    process_events(event=event, logger=logger)
-    
-    return {"Result": "Ok", "Message": None}    # Adapt to suite the use case....
+    failed_message_ids = process_events(event=event, logger=logger)
+
+    return build_batch_response(failed_message_ids=failed_message_ids, logger=logger)
 
 
 ###############################################################################
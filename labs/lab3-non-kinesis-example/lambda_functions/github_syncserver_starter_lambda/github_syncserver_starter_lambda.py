@@ -1,11 +1,12 @@
 import boto3
+from botocore.config import Config
+import threading
 import traceback
 import os
 import json
 import logging
 from datetime import datetime
 import sys
-from inspect import getframeinfo, stack
 import base64
 from urllib.parse import parse_qs
 import boto3
@@ -28,8 +29,26 @@ def get_logger(level=logging.INFO):
     logger.setLevel(level)
     return logger
     
-def get_client(client_name: str, region: str='eu-central-1', boto3_clazz=boto3):
-    return boto3_clazz.client(client_name, region_name=region)
+CLIENT_REGISTRY = dict()
+CLIENT_REGISTRY_LOCK = threading.Lock()
+try:
+    CLIENT_CONFIG = Config(max_pool_connections=25, connect_timeout=5, read_timeout=30, retries={'max_attempts': 5, 'mode': 'standard'}, tcp_keepalive=True)
+except TypeError:   # tcp_keepalive requires botocore 1.27.84 or later
+    CLIENT_CONFIG = Config(max_pool_connections=25, connect_timeout=5, read_timeout=30, retries={'max_attempts': 5, 'mode': 'standard'})
+
+
+def get_client(client_name: str, region: str='eu-central-1', boto3_clazz=boto3, endpoint_url: str=None):
+    """
+        Clients are created on first use and kept in CLIENT_REGISTRY for the lifetime of the execution environment, so
+        warm invocations re-use the client and its pool of keep-alive connections. Only the services actually used by
+        the function are ever created.
+    """
+    registry_key = (client_name, region, endpoint_url, id(boto3_clazz))
+    if registry_key not in CLIENT_REGISTRY:
+        with CLIENT_REGISTRY_LOCK:
+            if registry_key not in CLIENT_REGISTRY:
+                CLIENT_REGISTRY[registry_key] = boto3_clazz.client(client_name, region_name=region, endpoint_url=endpoint_url, config=CLIENT_CONFIG)
+    return CLIENT_REGISTRY[registry_key]
 
 
 CACHE_TTL_DEFAULT = 600
@@ -60,6 +79,26 @@ def get_cache_ttl(logger=get_logger())->int:
     return CACHE_TTL_DEFAULT
 
 
+class DebugMessage:
+    """
+        Defers the `str.format()` of a debug message until a handler actually emits the log record
+    """
+    __slots__ = ('message', 'variables_as_dict', 'variable_as_list')
+
+    def __init__(self, message: str, variables_as_dict: dict, variable_as_list: list):
+        self.message = message
+        self.variables_as_dict = variables_as_dict
+        self.variable_as_list = variable_as_list
+
+    def __str__(self):
+        try:
+            if len(self.variables_as_dict) > 0:
+                return self.message.format(**self.variables_as_dict)
+            return self.message.format(*self.variable_as_list)
+        except:
+            return self.message
+
+
 def debug_log(
     message: str,
     variables_as_dict: dict=dict(),
@@ -68,16 +107,9 @@ def debug_log(
     debug_override: bool=False
 ):
     if cache['Environment']['Data']['DEBUG'] is True or debug_override is True:
-        caller = getframeinfo(stack()[1][0])
-        caller_str = '{}():{}'.format(caller.function, caller.lineno)
-        try:
-            message = '[{}]  {}'.format(caller_str, message)
-            if len(variables_as_dict) > 0:
-                logger.debug(message.format(**variables_as_dict))
-            else:
-                logger.debug(message.format(*variable_as_list))
-        except:
-            pass
+        if logger.isEnabledFor(logging.DEBUG) is True:
+            # stacklevel=2 attributes the record (funcName/lineno) to the caller without inspecting the stack
+            logger.debug(DebugMessage(message=message, variables_as_dict=variables_as_dict, variable_as_list=variable_as_list), stacklevel=2)
 
 
 def refresh_environment_cache(logger=get_logger()):
@@ -180,23 +212,56 @@ def get_sqs_queue_size(
     return result
 
 
+def paginate_ec2_call(
+    method_name: str,
+    result_key: str,
+    parameters: dict=dict(),
+    page_size: int=None,
+    max_items: int=None,
+    logger=get_logger(),
+    boto3_clazz=boto3
+):
+    """
+        Generator that yields the elements of `response[result_key]` for an EC2 API call that supports `NextToken`,
+        requesting the next page only when the caller asks for more elements.
+
+        The `page_size` is passed as `MaxResults` (each EC2 API has its own valid range) and iteration stops after
+        `max_items` elements, or when the caller stops iterating.
+    """
+    client = get_client(client_name='ec2', boto3_clazz=boto3_clazz)
+    api_function = getattr(client, method_name)
+    call_parameters = dict(parameters)
+    if page_size is not None:
+        call_parameters['MaxResults'] = page_size
+    items_yielded = 0
+    while True:
+        response = api_function(**call_parameters)
+        debug_log('response={}', variable_as_list=[json.dumps(response, default=str),], logger=logger)
+        for element in response.get(result_key, list()):
+            yield element
+            items_yielded += 1
+            if max_items is not None and items_yielded >= max_items:
+                return
+        if response.get('NextToken', None) is None:
+            return
+        call_parameters['NextToken'] = response['NextToken']
+
+
 def get_running_ec2_instances(
     logger=get_logger(),
     boto3_clazz=boto3,
-    next_token: str=None
+    page_size: int=100
 )->list:
     result = list()
-    client = get_client(client_name='ec2', boto3_clazz=boto3_clazz)
     logger.debug('get_running_ec2_instances() called')
     try:
-        response = dict()
-        if next_token is not None:
-            response = client.describe_instances(NextToken=next_token)
-        else:
-            response = client.describe_instances()
-        debug_log('response={}', variable_as_list=[json.dumps(response, default=str),], logger=logger)
-        
-        for r in response['Reservations']:
+        for r in paginate_ec2_call(
+            method_name='describe_instances',
+            result_key='Reservations',
+            page_size=page_size,
+            logger=logger,
+            boto3_clazz=boto3_clazz
+        ):
             for instance in r['Instances']:
                 record = dict()
                 if instance['State']['Name'] in ('running', 'pending',):
@@ -207,13 +272,6 @@ def get_running_ec2_instances(
                         record['Tags'][tag['Key']] = tag['Value']
                     result.append(record)
         logger.info('Running instances qty: {}'.format(len(result)))
-
-        if 'NextToken' in response:
-            result += get_running_ec2_instances(
-                logger=logger,
-                boto3_clazz=boto3_clazz,
-                next_token=response['NextToken']
-            )
     except:
         logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
     debug_log('result={}', variable_as_list=[result,], logger=logger)
@@ -223,30 +281,19 @@ def get_running_ec2_instances(
 def get_launch_template_versions(
     logger=get_logger(),
     boto3_clazz=boto3,
-    next_token: str=None
+    page_size: int=100
 )->list:
     result = list()
-    client = get_client(client_name='ec2', boto3_clazz=boto3_clazz)
-    try:    
-        response = dict()
-        if next_token is not None:
-            response = client.describe_launch_template_versions(
-                LaunchTemplateId=os.getenv('LAUNCH_TEMPLATE_ID'),
-                NextToken=next_token
-            )
-        else:
-            response = client.describe_launch_template_versions(
-                LaunchTemplateId=os.getenv('LAUNCH_TEMPLATE_ID')
-            )
-        debug_log('response={}', variable_as_list=[json.dumps(response, default=str),], logger=logger)
-        for lt in response['LaunchTemplateVersions']:
+    try:
+        for lt in paginate_ec2_call(
+            method_name='describe_launch_template_versions',
+            result_key='LaunchTemplateVersions',
+            parameters={'LaunchTemplateId': os.getenv('LAUNCH_TEMPLATE_ID')},
+            page_size=page_size,
+            logger=logger,
+            boto3_clazz=boto3_clazz
+        ):
             result.append(int(lt['VersionNumber']))
-        if 'NextToken' in response:
-            result += get_launch_template_versions(
-                logger=logger,
-                boto3_clazz=boto3_clazz,
-                next_token=response['NextToken']
-            )
     except:
         logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
     result.sort()
@@ -1,12 +1,18 @@
 import boto3
+from botocore.config import Config
+import threading
 import traceback
 import os
 import json
 import logging
 from datetime import datetime
 import sys
-from inspect import getframeinfo, stack
 import base64
+import heapq
+import zlib
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import parse_qs
 
 
@@ -24,6 +30,19 @@ DEFAULT_FIELDS_TO_RETRIEVE = [
     'ScannedStatus',
 ]
 
+# index: query the PersonStatusIdx partitions of the requested statuses, scan: the original full table Scan
+EMPLOYEE_LISTING_MODES = ('index', 'scan',)
+EMPLOYEE_LISTING_MODE_DEFAULT = 'index'
+PERSON_STATUS_INDEX_NAME = 'PersonStatusIdx'
+PERSON_STATUS_INDEX_SORT_KEY = 'PersonDepartmentIdx'
+BATCH_GET_MAX_ATTEMPTS = 5
+SCAN_SEGMENTS_DEFAULT = 4
+SCAN_SEGMENTS_MAX = 16
+SCAN_WORKERS_MAX = 8
+SCAN_MAX_SECONDS_DEFAULT = 20
+SCAN_SEGMENT_DONE = 'DONE'
+CURSOR_VERSION = 1
+
 
 def get_logger(level=logging.INFO):
     logger = logging.getLogger()
@@ -37,8 +56,26 @@ def get_logger(level=logging.INFO):
     logger.setLevel(level)
     return logger
     
-def get_client(client_name: str, region: str='eu-central-1', boto3_clazz=boto3):
-    return boto3_clazz.client(client_name, region_name=region)
+CLIENT_REGISTRY = dict()
+CLIENT_REGISTRY_LOCK = threading.Lock()
+try:
+    CLIENT_CONFIG = Config(max_pool_connections=25, connect_timeout=5, read_timeout=30, retries={'max_attempts': 5, 'mode': 'standard'}, tcp_keepalive=True)
+except TypeError:   # tcp_keepalive requires botocore 1.27.84 or later
+    CLIENT_CONFIG = Config(max_pool_connections=25, connect_timeout=5, read_timeout=30, retries={'max_attempts': 5, 'mode': 'standard'})
+
+
+def get_client(client_name: str, region: str='eu-central-1', boto3_clazz=boto3, endpoint_url: str=None):
+    """
+        Clients are created on first use and kept in CLIENT_REGISTRY for the lifetime of the execution environment, so
+        warm invocations re-use the client and its pool of keep-alive connections. Only the services actually used by
+        the function are ever created.
+    """
+    registry_key = (client_name, region, endpoint_url, id(boto3_clazz))
+    if registry_key not in CLIENT_REGISTRY:
+        with CLIENT_REGISTRY_LOCK:
+            if registry_key not in CLIENT_REGISTRY:
+                CLIENT_REGISTRY[registry_key] = boto3_clazz.client(client_name, region_name=region, endpoint_url=endpoint_url, config=CLIENT_CONFIG)
+    return CLIENT_REGISTRY[registry_key]
 
 
 CACHE_TTL_DEFAULT = 600
@@ -69,6 +106,50 @@ def get_cache_ttl(logger=get_logger())->int:
     return CACHE_TTL_DEFAULT
 
 
+def get_scan_segments(logger=get_logger())->int:
+    try:
+        return min(SCAN_SEGMENTS_MAX, max(1, int(os.getenv('SCAN_SEGMENTS', '{}'.format(SCAN_SEGMENTS_DEFAULT)))))
+    except:
+        logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+    return SCAN_SEGMENTS_DEFAULT
+
+
+def get_scan_max_seconds(logger=get_logger())->int:
+    try:
+        return int(os.getenv('SCAN_MAX_SECONDS', '{}'.format(SCAN_MAX_SECONDS_DEFAULT)))
+    except:
+        logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+    return SCAN_MAX_SECONDS_DEFAULT
+
+
+def get_employee_listing_mode(logger=get_logger())->str:
+    mode = os.getenv('EMPLOYEE_LISTING_MODE', EMPLOYEE_LISTING_MODE_DEFAULT).lower()
+    if mode not in EMPLOYEE_LISTING_MODES:
+        logger.error('Unsupported EMPLOYEE_LISTING_MODE "{}" - using "{}"'.format(mode, EMPLOYEE_LISTING_MODE_DEFAULT))
+        return EMPLOYEE_LISTING_MODE_DEFAULT
+    return mode
+
+
+class DebugMessage:
+    """
+        Defers the `str.format()` of a debug message until a handler actually emits the log record
+    """
+    __slots__ = ('message', 'variables_as_dict', 'variable_as_list')
+
+    def __init__(self, message: str, variables_as_dict: dict, variable_as_list: list):
+        self.message = message
+        self.variables_as_dict = variables_as_dict
+        self.variable_as_list = variable_as_list
+
+    def __str__(self):
+        try:
+            if len(self.variables_as_dict) > 0:
+                return self.message.format(**self.variables_as_dict)
+            return self.message.format(*self.variable_as_list)
+        except:
+            return self.message
+
+
 def debug_log(
     message: str,
     variables_as_dict: dict=dict(),
@@ -77,16 +158,9 @@ def debug_log(
     debug_override: bool=False
 ):
     if cache['Environment']['Data']['DEBUG'] is True or debug_override is True:
-        caller = getframeinfo(stack()[1][0])
-        caller_str = '{}():{}'.format(caller.function, caller.lineno)
-        try:
-            message = '[{}]  {}'.format(caller_str, message)
-            if len(variables_as_dict) > 0:
-                logger.debug(message.format(**variables_as_dict))
-            else:
-                logger.debug(message.format(*variable_as_list))
-        except:
-            pass
+        if logger.isEnabledFor(logging.DEBUG) is True:
+            # stacklevel=2 attributes the record (funcName/lineno) to the caller without inspecting the stack
+            logger.debug(DebugMessage(message=message, variables_as_dict=variables_as_dict, variable_as_list=variable_as_list), stacklevel=2)
 
 
 def refresh_environment_cache(logger=get_logger()):
@@ -100,6 +174,9 @@ def refresh_environment_cache(logger=get_logger()):
         'Data': {
             'CACHE_TTL': get_cache_ttl(logger=logger),
             'DEBUG': get_debug(),
+            'EMPLOYEE_LISTING_MODE': get_employee_listing_mode(logger=logger),
+            'SCAN_SEGMENTS': get_scan_segments(logger=logger),
+            'SCAN_MAX_SECONDS': get_scan_max_seconds(logger=logger),
             # Other ENVIRONMENT variables can be added here... The environment will be re-read after the CACHE_TTL 
         }
     }
@@ -136,6 +213,87 @@ def decode_data(event, body: str):
     return body
 
 
+###############################################################################
+###                                                                         ###
+###                   P A G I N A T I O N    C U R S O R S                  ###
+###                                                                         ###
+###############################################################################
+
+
+def encode_scan_positions(segment_positions: list)->list:
+    """
+        The segment positions of a `ParallelScan` in a compact form: per segment 0 (not started), 1 (done) or the
+        `[PK, SK]` of the last item that was consumed
+    """
+    encoded_positions = list()
+    for position in segment_positions:
+        if position is None:
+            encoded_positions.append(0)
+        elif position == SCAN_SEGMENT_DONE:
+            encoded_positions.append(1)
+        else:
+            encoded_positions.append([position['PK']['S'], position['SK']['S']])
+    return encoded_positions
+
+
+def decode_scan_positions(encoded_positions: list)->list:
+    segment_positions = list()
+    for encoded_position in encoded_positions:
+        if encoded_position == 0:
+            segment_positions.append(None)
+        elif encoded_position == 1:
+            segment_positions.append(SCAN_SEGMENT_DONE)
+        else:
+            segment_positions.append({'PK': {'S': '{}'.format(encoded_position[0])}, 'SK': {'S': '{}'.format(encoded_position[1])}})
+    return segment_positions
+
+
+def encode_cursor(start_key: dict)->str:
+    """
+        The opaque `start_key` token returned to API clients: the listing mode and the exact resume position, as
+        compressed JSON in URL safe base64 without padding. An empty `start_key` (the last page) is an empty token.
+
+            index:  The `PersonDepartmentIdx` of the last employee returned
+            scan:   The position of every Scan segment (see `encode_scan_positions()`)
+    """
+    if start_key is None or len(start_key) == 0:
+        return ''
+    data = json.dumps([CURSOR_VERSION, start_key['Mode'], start_key['Position'],], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(zlib.compress(data, 9)).decode('utf-8').rstrip('=')
+
+
+def _helper_is_valid_scan_position(encoded_position)->bool:
+    if isinstance(encoded_position, bool):
+        return False
+    if isinstance(encoded_position, int):
+        return encoded_position in (0, 1,)
+    if isinstance(encoded_position, list) and len(encoded_position) == 2:
+        return all(isinstance(key_value, str) for key_value in encoded_position)
+    return False
+
+
+def _helper_is_valid_cursor_position(mode: str, position)->bool:
+    if mode == 'index':
+        return isinstance(position, str)
+    if isinstance(position, list) is False or len(position) == 0:
+        return False
+    return all(_helper_is_valid_scan_position(encoded_position=encoded_position) for encoded_position in position)
+
+
+def decode_cursor(cursor: str)->dict:
+    """
+        Returns the `start_key` of a token created by `encode_cursor()` - raises an exception when the token is not
+        valid, including a position that does not have the structure `encode_cursor()` creates for the mode
+    """
+    padded_cursor = '{}{}'.format(cursor, '=' * (-len(cursor) % 4))
+    version, mode, position = json.loads(zlib.decompress(base64.urlsafe_b64decode(padded_cursor.encode('utf-8'))).decode('utf-8'))
+    if version != CURSOR_VERSION or mode not in EMPLOYEE_LISTING_MODES:
+        raise Exception('Unsupported cursor version {} or mode "{}"'.format(version, mode))
+    if _helper_is_valid_cursor_position(mode=mode, position=position) is False:
+        raise Exception('Invalid {} cursor position {}'.format(mode, position))
+    return {'Mode': mode, 'Position': position}
+
+
 def dynamodb_data_formatting(
     data: list,
     last_evaluation_key: dict=dict(),
@@ -149,7 +307,7 @@ def dynamodb_data_formatting(
     result = dict()
     result['Employees'] = list()
     result['RecordCount'] = 0
-    result['LastEvaluatedKey'] = dict()
+    result['LastEvaluatedKey'] = ""
     result['LastEvaluatedKeyAsString'] = ""
     result['QueryStatus'] = 'ERROR'
     result['Message'] = 'Functionality Not Yet Implemented'
@@ -161,9 +319,9 @@ def dynamodb_data_formatting(
                 if field_name not in EXCLUDE_FIELDS:
                     final_record[field_name] = field_value
             result['Employees'].append(final_record)
-        result['LastEvaluatedKey'] = last_evaluation_key
-        for k,v in last_evaluation_key.items():
-            result['LastEvaluatedKeyAsString'] = '{},{}'.format(k,v)
+        # Both fields hold the same opaque token - LastEvaluatedKeyAsString is kept for existing clients
+        result['LastEvaluatedKey'] = encode_cursor(start_key=last_evaluation_key)
+        result['LastEvaluatedKeyAsString'] = result['LastEvaluatedKey']
         qty = len(result['Employees'])
         result['RecordCount'] = qty
         result['QueryStatus'] = 'Ok'
@@ -218,103 +376,413 @@ def dynamodb_data_formatting(
 ###############################################################################
 
 
-def query_employees(
-    attributes_to_get: list,
+def _helper_item_to_record(item: dict)->dict:
+    record = dict()
+    for field_name, field_data in item.items():
+        for field_data_type, field_data_value in field_data.items():
+            record[field_name] = '{}'.format(field_data_value)
+    return record
+
+
+class ParallelScan:
+    """
+        Parallel Scan of a table: every one of the `total_segments` segments is scanned by its own worker thread and
+        the pages of all segments are merged, in the order they arrive, into the stream returned by `pages()`.
+
+        * The position of every segment is tracked separately - `None` (not started), the key to continue after, or
+          `SCAN_SEGMENT_DONE`. Consumers call `commit()` once they are done with the items up to a key, and
+          `positions()` returns the committed positions, which can be passed as `segment_positions` to continue the
+          Scan later without reading any committed item again.
+        * At most `max_queued_pages` pages are buffered, so workers pause while the consumer is busy.
+        * At most `max_workers` segments are scanned at the same time - the other segments start when a worker is done.
+        * `close()` stops the workers - pages already buffered are discarded and their items are read again when the
+          Scan is continued from the committed positions.
+    """
+
+    def __init__(
+        self,
+        client,
+        scan_parameters: dict,
+        total_segments: int=SCAN_SEGMENTS_DEFAULT,
+        segment_positions: list=None,
+        page_size: int=100,
+        max_queued_pages: int=None,
+        max_workers: int=SCAN_WORKERS_MAX,
+        logger=get_logger()
+    ):
+        self.client = client
+        self.scan_parameters = scan_parameters
+        self.total_segments = total_segments
+        self.page_size = page_size
+        self.max_workers = max(1, max_workers)
+        self.logger = logger
+        if segment_positions is None:
+            segment_positions = [None for segment in range(0, total_segments)]
+        if len(segment_positions) != total_segments:
+            raise Exception('Expected {} segment positions but got {}'.format(total_segments, len(segment_positions)))
+        self.committed_positions = list(segment_positions)
+        self.page_queue = queue.Queue(maxsize=max_queued_pages if max_queued_pages is not None else total_segments * 2)
+        self.stop_event = threading.Event()
+        self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+        return False
+
+    def _put(self, message: tuple)->bool:
+        while self.stop_event.is_set() is False:
+            try:
+                self.page_queue.put(message, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _scan_segment(self, segment: int):
+        parameters = dict(self.scan_parameters)
+        parameters['Segment'] = segment
+        parameters['TotalSegments'] = self.total_segments
+        parameters['Limit'] = self.page_size
+        if self.committed_positions[segment] is not None:
+            parameters['ExclusiveStartKey'] = self.committed_positions[segment]
+        try:
+            while self.stop_event.is_set() is False:
+                response = self.client.scan(**parameters)
+                last_evaluated_key = response.get('LastEvaluatedKey', None)
+                if self._put(message=(segment, response.get('Items', list()), last_evaluated_key, None,)) is False:
+                    return
+                if last_evaluated_key is None:
+                    return
+                parameters['ExclusiveStartKey'] = last_evaluated_key
+        except Exception as e:
+            self.logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+            self._put(message=(segment, list(), None, e,))
+
+    def pages(self):
+        """
+            Generator that yields `(segment, items, last_evaluated_key)` for every page of every segment that is not
+            done yet. The `last_evaluated_key` is None on the last page of a segment.
+        """
+        pending_segments = [segment for segment in range(0, self.total_segments) if self.committed_positions[segment] != SCAN_SEGMENT_DONE]
+        if len(pending_segments) == 0:
+            return
+        self.executor = ThreadPoolExecutor(max_workers=min(len(pending_segments), self.max_workers))
+        for segment in pending_segments:
+            self.executor.submit(self._scan_segment, segment)
+        while len(pending_segments) > 0:
+            segment, items, last_evaluated_key, exception = self.page_queue.get()
+            if exception is not None:
+                raise exception
+            if last_evaluated_key is None:
+                pending_segments.remove(segment)
+            yield (segment, items, last_evaluated_key,)
+
+    def commit(self, segment: int, position):
+        self.committed_positions[segment] = position
+
+    def positions(self)->list:
+        return list(self.committed_positions)
+
+    def close(self):
+        self.stop_event.set()
+        if self.executor is not None:
+            while True:
+                try:
+                    self.page_queue.get_nowait()
+                except queue.Empty:
+                    break
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+
+def stream_employees(
+    scan: ParallelScan,
+    fields_to_retrieve: list,
+    status_filter: list=['active', 'onboarding'],
+    logger=get_logger()
+):
+    """
+        Generator that groups the `PERSON#PERSONAL_DATA...` items of a `ParallelScan` by employee and yields one record
+        per employee with the `fields_to_retrieve`. Employees with a `PersonStatus` that is not in `status_filter` are
+        skipped (an empty `status_filter` includes all employees).
+
+        The items of an employee are next to each other in their segment, but can be split over pages, so an employee
+        is only complete once an item of the next employee (or the end of the segment) is read. The Scan position of
+        the segment is committed just before the employee is yielded, so a consumer that stops at any point can
+        continue from `scan.positions()` without skipping or repeating an employee.
+    """
+    pending_employees = dict()
+
+    def finish_employee(segment: int):
+        pending_employee = pending_employees.pop(segment)
+        scan.commit(segment=segment, position=pending_employee['LastKey'])
+        if pending_employee['Excluded'] is True:
+            logger.info('Excluding employee id "{}" based on current employee status'.format(pending_employee['Record']['EmployeeId']))
+            return None
+        return pending_employee['Record']
+
+    for segment, items, last_evaluated_key in scan.pages():
+        for item in items:
+            record = _helper_item_to_record(item=item)
+            if record['PK'].startswith('EMP#') is False:
+                continue
+            if segment in pending_employees and pending_employees[segment]['PK'] != record['PK']:
+                employee_record = finish_employee(segment=segment)
+                if employee_record is not None:
+                    yield employee_record
+            if segment not in pending_employees:
+                pending_employees[segment] = {
+                    'PK': record['PK'],
+                    'Record': {'EmployeeId': record['PK'].split('#')[1]},
+                    'Excluded': False,
+                }
+            pending_employee = pending_employees[segment]
+            pending_employee['LastKey'] = {'PK': item['PK'], 'SK': item['SK']}
+            if 'PersonStatus' in record and len(status_filter) > 0 and record['PersonStatus'] not in status_filter:
+                pending_employee['Excluded'] = True
+            for field_name in fields_to_retrieve:
+                if field_name in record:
+                    pending_employee['Record'][field_name] = record[field_name]
+        if last_evaluated_key is None:
+            if segment in pending_employees:
+                employee_record = finish_employee(segment=segment)
+                if employee_record is not None:
+                    yield employee_record
+            scan.commit(segment=segment, position=SCAN_SEGMENT_DONE)
+        elif segment not in pending_employees:
+            scan.commit(segment=segment, position=last_evaluated_key)
+
+
+def scan_employees(
+    fields_to_retrieve: list,
     max_items: int=25,
     start_key: dict=dict(),
+    status_filter: list=['active', 'onboarding'],
     boto3_clazz=boto3,
     logger=get_logger()
 )->tuple:
+    """
+        List the employees with a parallel Scan of the table (`SCAN_SEGMENTS` segments), for tables without the
+        `PersonStatusIdx` index.
+
+        The `start_key` is `{"Mode": "scan", "Position": <<encoded segment positions>>}` as returned by the previous
+        page: every segment continues after the last item that was consumed, so no item is read twice and no item is
+        skipped, even when a page ended in the middle of a DynamoDB page. When `SCAN_MAX_SECONDS` pass before the page
+        is full, the employees found so far are returned with a start key for the rest. Returns `(records, start_key)`
+        with an empty `start_key` once all segments are done.
+    """
+    total_segments = cache['Environment']['Data']['SCAN_SEGMENTS']
+    segment_positions = None
+    if start_key is not None and start_key.get('Mode', None) == 'scan':
+        segment_positions = decode_scan_positions(encoded_positions=start_key['Position'])
+        if len(segment_positions) != total_segments:
+            # The number of segments comes from the configuration and never from the client
+            logger.warning('Ignoring start key with {} segment positions - expected {}'.format(len(segment_positions), total_segments))
+            segment_positions = None
+    elif start_key is not None and len(start_key) > 0:
+        logger.warning('Ignoring start key {} that was not created by the scan listing'.format(start_key))
+
     result = list()
-    final_result = list()
-    if max_items > 100:
-        logger.warning('max_items was {} which is more than the absolute max. of 100.'.format(max_items))
-        max_items = 100
-    final_start_key = dict()
-    if 'PK' not in attributes_to_get:
-        attributes_to_get.append('PK')
-    if 'SK' not in attributes_to_get:
-        attributes_to_get.append('SK')
-    logger.info('initial start_key={}'.format(start_key))
-    logger.info('final  max_items={}'.format(max_items))
-    logger.info('final  attributes_to_get={}'.format(attributes_to_get))
-    if start_key is not None:
-        if isinstance(start_key, dict):
-            for k,v in start_key.items():
-                final_start_key = {
-                    "PK": {
-                        "S": k
-                    },
-                    "SK": {
-                        "S": v
-                    }
+    deadline = time.time() + cache['Environment']['Data']['SCAN_MAX_SECONDS']
+    with ParallelScan(
+        client=get_client('dynamodb', boto3_clazz=boto3_clazz),
+        scan_parameters={
+            'TableName': 'lab3-access-card-app',
+            'AttributesToGet': list(set(DEFAULT_FIELDS_TO_RETRIEVE + ['PK', 'SK',])),
+            'Select': 'SPECIFIC_ATTRIBUTES',
+            'ScanFilter': {
+                'SK': {
+                    'AttributeValueList': [{'S': 'PERSON#PERSONAL_DATA'},],
+                    'ComparisonOperator': 'BEGINS_WITH'
                 }
-    logger.info('final start_key={}'.format(start_key))
-    try:
-        client = get_client('dynamodb', boto3_clazz=boto3_clazz)
-        response = dict()
-        if len(final_start_key) == 0:
-            response = client.scan(
-                TableName='lab3-access-card-app',
-                AttributesToGet=attributes_to_get,
-                Limit=max_items,
-                Select='SPECIFIC_ATTRIBUTES',
-                ScanFilter={
-                    'SK': {
-                        'AttributeValueList': [{'S': 'PERSON#PERSONAL_DATA'},],
-                        'ComparisonOperator': 'BEGINS_WITH'
-                    }
-                },
-                ReturnConsumedCapacity='TOTAL',
-                ConsistentRead=False
-            )
-        else:
-            response = client.scan(
-                TableName='lab3-access-card-app',
-                AttributesToGet=attributes_to_get,
-                Limit=max_items,
-                ExclusiveStartKey=final_start_key,
-                Select='SPECIFIC_ATTRIBUTES',
-                ScanFilter={
-                    'SK': {
-                        'AttributeValueList': [{'S': 'PERSON#PERSONAL_DATA'},],
-                        'ComparisonOperator': 'BEGINS_WITH'
-                    }
-                },
-                ReturnConsumedCapacity='TOTAL',
-                ConsistentRead=False
-            )
-        # debug_log(message='response={}', variable_as_list=[response,], logger=logger)
-        if 'Items' in response:
-            for item in response['Items']:
-                debug_log(message='DynamoDB Item: item={}', variable_as_list=[item,], logger=logger)
-                record = dict()
-                for field_name, field_data in item.items():
-                    for field_data_type, field_data_value in field_data.items():
-                        record[field_name] = '{}'.format(field_data_value) 
-                result.append(record)
-                debug_log(message='record length now {} - Added record {}', variable_as_list=[len(result), record,], logger=logger)
-        if 'LastEvaluatedKey' in response:
-            start_key = {
-                response['LastEvaluatedKey']['PK']['S']: response['LastEvaluatedKey']['SK']['S'] 
-            }
-            final_result = (
-                {
-                    'result': result,
-                }, 
-                start_key
-            )
+            },
+            'ReturnConsumedCapacity': 'TOTAL',
+            'ConsistentRead': False,
+        },
+        total_segments=total_segments,
+        segment_positions=segment_positions,
+        page_size=max_items,
+        logger=logger
+    ) as scan:
+        for employee_record in stream_employees(scan=scan, fields_to_retrieve=fields_to_retrieve, status_filter=status_filter, logger=logger):
+            result.append(employee_record)
+            if len(result) >= max_items:
+                break
+            if time.time() > deadline:
+                logger.warning('Maximum Query Time Reached - returning {} employees'.format(len(result)))
+                break
+        segment_positions = scan.positions()
+
+    new_start_key = dict()
+    if len([position for position in segment_positions if position != SCAN_SEGMENT_DONE]) > 0:
+        new_start_key['Mode'] = 'scan'
+        new_start_key['Position'] = encode_scan_positions(segment_positions=segment_positions)
+    logger.info('Listed {} employees with a {} segment Scan'.format(len(result), total_segments))
+    debug_log(message='result={}', variable_as_list=(result,), logger=logger)
+    return (result, new_start_key)
+
+
+def query_person_status_partition(
+    status: str,
+    department: str=None,
+    start_after: str=None,
+    max_items: int=25,
+    boto3_clazz=boto3,
+    logger=get_logger()
+)->tuple:
+    """
+        Query one `PersonStatusIdx` partition for the persons with the `status`, in `PersonDepartmentIdx` order
+        (department, then employee ID), starting after the `PersonDepartmentIdx` value `start_after`. With a
+        `department` only the range of that department is read.
+
+        Returns `(records, more_records_available)` with at most `max_items + 1` records.
+    """
+    sort_key_condition = None
+    if department is None:
+        if start_after is not None:
+            sort_key_condition = {'AttributeValueList': [{'S': start_after},], 'ComparisonOperator': 'GT'}
+    else:
+        department_prefix = '{}#'.format(department)
+        department_end = '{}\uffff'.format(department_prefix)
+        if start_after is None or start_after < department_prefix:
+            sort_key_condition = {'AttributeValueList': [{'S': department_prefix},], 'ComparisonOperator': 'BEGINS_WITH'}
+        elif start_after >= department_end:
+            return (list(), False)
         else:
-            final_result = (
-                {
-                    'result': result,
-                }, 
-                dict()
-            )
-    except:
-        logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
-    debug_log(message='final_result={}', variable_as_list=(final_result,), logger=logger)
-    return tuple(final_result)
+            # BETWEEN includes the start, which is removed from the result below
+            sort_key_condition = {'AttributeValueList': [{'S': start_after}, {'S': department_end},], 'ComparisonOperator': 'BETWEEN'}
+    key_conditions = {
+        'PersonStatusIdx': {'AttributeValueList': [{'S': status},], 'ComparisonOperator': 'EQ'},
+    }
+    if sort_key_condition is not None:
+        key_conditions[PERSON_STATUS_INDEX_SORT_KEY] = sort_key_condition
+    client = get_client('dynamodb', boto3_clazz=boto3_clazz)
+    response = client.query(
+        TableName='lab3-access-card-app',
+        IndexName=PERSON_STATUS_INDEX_NAME,
+        Select='ALL_PROJECTED_ATTRIBUTES',
+        KeyConditions=key_conditions,
+        Limit=max_items + 1,
+        ReturnConsumedCapacity='TOTAL'
+    )
+    debug_log(message='status={} response={}', variable_as_list=[status, response,], logger=logger)
+    records = list()
+    for item in response.get('Items', list()):
+        record = _helper_item_to_record(item=item)
+        if record[PERSON_STATUS_INDEX_SORT_KEY] != start_after:
+            records.append(record)
+    return (records[0:max_items + 1], 'LastEvaluatedKey' in response)
+
+
+def get_access_card_records(
+    employee_ids: list,
+    attributes_to_get: list,
+    boto3_clazz=boto3,
+    logger=get_logger()
+)->dict:
+    """
+        The `PERSON#PERSONAL_DATA#ACCESS_CARD` records of the employees, read with a single BatchGetItem call (at most
+        100 employees). Returns the records by employee ID - employees without an access card are not included.
+    """
+    access_cards = dict()
+    if len(employee_ids) == 0:
+        return access_cards
+    request_items = {
+        'lab3-access-card-app': {
+            'Keys': [{'PK': {'S': 'EMP#{}'.format(employee_id)}, 'SK': {'S': 'PERSON#PERSONAL_DATA#ACCESS_CARD'}} for employee_id in employee_ids],
+            'AttributesToGet': list(set(attributes_to_get + ['PK',])),
+        }
+    }
+    client = get_client('dynamodb', boto3_clazz=boto3_clazz)
+    for attempt in range(0, BATCH_GET_MAX_ATTEMPTS):
+        response = client.batch_get_item(RequestItems=request_items, ReturnConsumedCapacity='TOTAL')
+        debug_log(message='response={}', variable_as_list=[response,], logger=logger)
+        for item in response.get('Responses', dict()).get('lab3-access-card-app', list()):
+            record = _helper_item_to_record(item=item)
+            access_cards[record['PK'].replace('EMP#', '')] = record
+        request_items = response.get('UnprocessedKeys', dict())
+        if len(request_items) == 0:
+            return access_cards
+        time.sleep(0.05 * (2 ** attempt))
+    logger.warning('Access card records of {} employees could not be read'.format(len(request_items['lab3-access-card-app']['Keys'])))
+    return access_cards
+
+
+def query_employees_by_status(
+    fields_to_retrieve: list,
+    max_items: int=25,
+    start_key: dict=dict(),
+    status_filter: list=['active', 'onboarding'],
+    department: str=None,
+    boto3_clazz=boto3,
+    logger=get_logger()
+)->tuple:
+    """
+        List the employees with one of the statuses in `status_filter` from the sparse `PersonStatusIdx` index. Only
+        the partitions of the requested statuses are queried, at most `max_items + 1` persons each, and merged in
+        `PersonDepartmentIdx` order. The access card fields of the selected employees are added with one BatchGetItem
+        call, so the cost of a page depends on the page size and not on the size of the table.
+
+        The `start_key` is `{"Mode": "index", "Position": "<<department>>#<<employee ID>>"}` with the
+        `PersonDepartmentIdx` of the last employee of the previous page. Returns `(records, start_key)` with an empty
+        `start_key` on the last page.
+    """
+    start_after = None
+    if start_key is not None and start_key.get('Mode', None) == 'index':
+        start_after = start_key['Position']
+    elif start_key is not None and len(start_key) > 0:
+        logger.warning('Ignoring start key {} that was not created by the index listing'.format(start_key))
+
+    partitions = list()
+    more_records_available = False
+    for status in sorted(set(status_filter)):
+        records, partition_has_more_records = query_person_status_partition(
+            status=status,
+            department=department,
+            start_after=start_after,
+            max_items=max_items,
+            boto3_clazz=boto3_clazz,
+            logger=logger
+        )
+        partitions.append(records)
+        more_records_available = more_records_available or partition_has_more_records
+    merged_records = list(heapq.merge(*partitions, key=lambda record: record[PERSON_STATUS_INDEX_SORT_KEY]))
+    if len(merged_records) > max_items:
+        more_records_available = True
+    person_records = merged_records[0:max_items]
+
+    card_fields = [field_name for field_name in fields_to_retrieve if field_name.startswith('Person') is False]
+    access_cards = dict()
+    if len(card_fields) > 0:
+        access_cards = get_access_card_records(
+            employee_ids=[person_record['PK'].replace('EMP#', '') for person_record in person_records],
+            attributes_to_get=card_fields,
+            boto3_clazz=boto3_clazz,
+            logger=logger
+        )
+
+    result = list()
+    for person_record in person_records:
+        employee_id = person_record['PK'].replace('EMP#', '')
+        new_record = dict()
+        new_record['EmployeeId'] = employee_id
+        for field_name in fields_to_retrieve:
+            if field_name in person_record:
+                new_record[field_name] = person_record[field_name]
+            elif field_name in access_cards.get(employee_id, dict()):
+                new_record[field_name] = access_cards[employee_id][field_name]
+        result.append(new_record)
+
+    new_start_key = dict()
+    if more_records_available is True and len(person_records) > 0:
+        new_start_key['Mode'] = 'index'
+        new_start_key['Position'] = person_records[-1][PERSON_STATUS_INDEX_SORT_KEY]
+    logger.info('Listed {} employees from {} status partitions'.format(len(result), len(partitions)))
+    debug_log(message='result={}', variable_as_list=(result,), logger=logger)
+    return (result, new_start_key)
 
 
 def query_employees_helper(
@@ -322,100 +790,43 @@ def query_employees_helper(
     max_items: int=25,
     start_key: dict=dict(),
     status_filter: list=['active', 'onboarding'],
+    department: str=None,
     boto3_clazz=boto3,
     logger=get_logger()
 )->tuple:
-    start_time = get_utc_timestamp(with_decimal=False)
     if max_items > 100:
         max_items = 100
     if max_items < 10:
         max_items = 10
     
-    person_records = dict()
     if 'EmployeeId' in fields_to_retrieve:
         fields_to_retrieve.remove('EmployeeId')
     logger.info('fields_to_retrieve={}'.format(fields_to_retrieve))
 
-    excluded_employee_ids = list()
-
-
-    result = list()
-    run = True
-    rounds = 0
-    attributes_to_get = DEFAULT_FIELDS_TO_RETRIEVE
-    # attributes_to_get = compile_final_attributes_to_get_list(fields_to_retrieve=fields_to_retrieve, logger=logger)
-    while run:
-        debug_log(message='rounds={}', variable_as_list=(rounds,), logger=logger)
-
-        query_result_records, new_start_key = query_employees(
-            attributes_to_get=attributes_to_get,
+    try:
+        if cache['Environment']['Data']['EMPLOYEE_LISTING_MODE'] == 'index':
+            return query_employees_by_status(
+                fields_to_retrieve=fields_to_retrieve,
+                max_items=max_items,
+                start_key=start_key,
+                status_filter=status_filter,
+                department=department,
+                boto3_clazz=boto3_clazz,
+                logger=logger
+            )
+        if department is not None:
+            logger.warning('The department filter is only supported by the index listing - ignoring department "{}"'.format(department))
+        return scan_employees(
+            fields_to_retrieve=fields_to_retrieve,
             max_items=max_items,
             start_key=start_key,
+            status_filter=status_filter,
             boto3_clazz=boto3_clazz,
             logger=logger
         )
-
-        debug_log(message='query_result_records={}', variable_as_list=(query_result_records,), logger=logger)
-        debug_log(message='len(query_result_records[result])={}', variable_as_list=(len(query_result_records['result']),), logger=logger)
-
-        for query_result_record in query_result_records['result']:
-            debug_log(message='query_result_record={}', variable_as_list=(query_result_record,), logger=logger)
-            include_record = True
-            if 'PK' in query_result_record:
-                if query_result_record['PK'].startswith('EMP#'):
-                    employee_id = query_result_record['PK'].split('#')[1]
-                    if employee_id not in person_records:
-                        person_records[employee_id] = dict()
-
-                    if len(person_records) >= max_items and employee_id not in person_records:
-                        logger.warning('Maximum person records reached - ignoring record for employee ID "{}"'.format(employee_id))
-                        include_record = False
-
-                    if 'PersonStatus' in fields_to_retrieve and 'PersonStatus' in query_result_record:
-                        if len(status_filter) > 0:
-                            if query_result_record['PersonStatus'] not in status_filter:
-                                if employee_id not in excluded_employee_ids:
-                                    excluded_employee_ids.append(employee_id)
-                                if employee_id in person_records:
-                                    person_records.pop(employee_id)
-                                include_record = False
-                                logger.warning('Excluding employee id "{}" based on current employee status "{}"'.format(employee_id, query_result_record['PersonStatus']))
-
-                    if employee_id in excluded_employee_ids and include_record is True:
-                        include_record = False
-                        logger.warning('Excluding employee ID "{}" based on exclude criteria'.format(employee_id))
-
-                    if include_record is True:
-                        for k,v in query_result_record.items():
-                            if k in fields_to_retrieve:
-                                person_records[employee_id][k] = v
-
-        start_key = new_start_key
-        if len(person_records) >= max_items + 1:
-            logger.info('Maximum records reached. Returning collected data')
-            run = False
-
-        rounds += 1
-        current_time = get_utc_timestamp(with_decimal=False)
-        duration = current_time - start_time
-        if duration > 20:
-            logger.warning('Maximum Query Time Reached - breaking loop. Rounds={}'.format(rounds))
-            run = False
-        elif rounds > 1 and len(person_records) == 0:
-            logger.warning('Looping without adding records - breaking loop')
-            run = False
-
-    debug_log(message='person_records={}', variable_as_list=(person_records,), logger=logger)
-    for employee_id, employee_record in person_records.items():
-        new_record = dict()
-        new_record['EmployeeId'] = employee_id
-        if len(result) < max_items:
-            result.append({**new_record, **employee_record})
-
-    logger.info('rounds={}'.format(rounds))
-    debug_log(message='result={}', variable_as_list=(result,), logger=logger)
-    debug_log(message='start_key={}', variable_as_list=(start_key,), logger=logger)
-    return (result, start_key)
+    except:
+        logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+    return (list(), dict())
 
 
 ###############################################################################
@@ -433,6 +844,7 @@ def query_string_parser(
     query_parameters['StartKey'] = dict()
     query_parameters['Limit'] = 25
     query_parameters['StatusFields'] = ['active', 'onboarding',]
+    query_parameters['Department'] = None
 
     # PersonStatus (onboarding|active|inactive) 
     ALLOWED_PERSON_STATUS_FIELD_VALUES = [
@@ -458,12 +870,14 @@ def query_string_parser(
             query_parameters['Limit'] = 100
         logger.info('Limit={}'.format(query_parameters['Limit']))
 
-        # Parse the start key
+        # Parse the start key - the opaque token of a previous page
         if 'start_key' in event['queryStringParameters']:
             if isinstance(event['queryStringParameters']['start_key'], str):
-                if len(event['queryStringParameters']['start_key']) > 0 and ',' in event['queryStringParameters']['start_key']:
-                    items = event['queryStringParameters']['start_key'].split(',')
-                    query_parameters['StartKey'][items[0]] = items[1]
+                if len(event['queryStringParameters']['start_key']) > 0:
+                    try:
+                        query_parameters['StartKey'] = decode_cursor(cursor=event['queryStringParameters']['start_key'])
+                    except:
+                        logger.warning('Ignoring invalid start_key "{}"'.format(event['queryStringParameters']['start_key']))
         logger.info('StartKey={}'.format(query_parameters['StartKey']))
 
         # Parse Status fields
@@ -476,6 +890,13 @@ def query_string_parser(
                             query_parameters['StatusFields'].append(requested_status)
         logger.info('StatusFields={}'.format(query_parameters['StatusFields']))
 
+        # Parse the department
+        if 'department' in event['queryStringParameters']:
+            if isinstance(event['queryStringParameters']['department'], str):
+                if len(event['queryStringParameters']['department']) > 0:
+                    query_parameters['Department'] = event['queryStringParameters']['department']
+        logger.info('Department={}'.format(query_parameters['Department']))
+
     except:
         logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
     
@@ -492,7 +913,8 @@ def handler(
     number_of_records: int=25,
     fields_to_retrieve: list=DEFAULT_FIELDS_TO_RETRIEVE,
     start_key: dict=dict(),
-    status_filter: list=['active', 'onboarding']
+    status_filter: list=['active', 'onboarding'],
+    department: str=None
 ):
     result = dict()
     return_object = {
@@ -520,16 +942,20 @@ def handler(
         number_of_records = parsed_query_string_values['Limit']
     if len(parsed_query_string_values['StatusFields']) == 1:
         status_filter = parsed_query_string_values['StatusFields']
+    if department is None and parsed_query_string_values['Department'] is not None:
+        department = parsed_query_string_values['Department']
 
     logger.info('Query Parameter: start_key         = {}'.format(start_key))
     logger.info('Query Parameter: number_of_records = {}'.format(number_of_records))
     logger.info('Query Parameter: status_filter     = {}'.format(status_filter))
+    logger.info('Query Parameter: department        = {}'.format(department))
 
     dynamodb_result, last_evaluation_key = query_employees_helper(
         fields_to_retrieve=fields_to_retrieve,
         max_items=number_of_records,
         start_key=start_key,
         status_filter=status_filter,
+        department=department,
         boto3_clazz=boto3_clazz,
         logger=logger
     )
@@ -601,7 +1027,7 @@ if __name__ == '__main__':
         'queryStringParameters': {
             'qty': '8',
             'status': 'onboarding',
-            'start_key': 'CARD#100000000087,CARD#STATUS#issued'
+            'start_key': 'eNqLNtRRysxLSa1Q0lFKzUvPzEtNLcrMS1c2NIABC3OlWADkHQrg'    # encode_cursor(start_key={'Mode': 'index', 'Position': 'engineering#100000000087'})
         }, 
         'requestContext': {
             'accountId': '000000000000', 
@@ -1,11 +1,12 @@
 import boto3
+from botocore.config import Config
+import threading
 import traceback
 import os
 import json
 import logging
 from datetime import datetime
 import sys
-from inspect import getframeinfo, stack
 # Other imports here...
 
 
@@ -33,8 +34,26 @@ def read_config(file_path: str="events.json", logger=get_logger())->dict:
     return config
 
 
-def get_client(client_name: str, region: str='eu-central-1', boto3_clazz=boto3):
-    return boto3_clazz.client(client_name, region_name=region)
+CLIENT_REGISTRY = dict()
+CLIENT_REGISTRY_LOCK = threading.Lock()
+try:
+    CLIENT_CONFIG = Config(max_pool_connections=25, connect_timeout=5, read_timeout=30, retries={'max_attempts': 5, 'mode': 'standard'}, tcp_keepalive=True)
+except TypeError:   # tcp_keepalive requires botocore 1.27.84 or later
+    CLIENT_CONFIG = Config(max_pool_connections=25, connect_timeout=5, read_timeout=30, retries={'max_attempts': 5, 'mode': 'standard'})
+
+
+def get_client(client_name: str, region: str='eu-central-1', boto3_clazz=boto3, endpoint_url: str=None):
+    """
+        Clients are created on first use and kept in CLIENT_REGISTRY for the lifetime of the execution environment, so
+        warm invocations re-use the client and its pool of keep-alive connections. Only the services actually used by
+        the function are ever created.
+    """
+    registry_key = (client_name, region, endpoint_url, id(boto3_clazz))
+    if registry_key not in CLIENT_REGISTRY:
+        with CLIENT_REGISTRY_LOCK:
+            if registry_key not in CLIENT_REGISTRY:
+                CLIENT_REGISTRY[registry_key] = boto3_clazz.client(client_name, region_name=region, endpoint_url=endpoint_url, config=CLIENT_CONFIG)
+    return CLIENT_REGISTRY[registry_key]
 
 
 CACHE_TTL_DEFAULT = 600
@@ -80,9 +99,30 @@ def refresh_environment_cache(config_file_path: str="events.json", logger=get_lo
             # Other ENVIRONMENT variables can be added here... The environment will be re-read after the CACHE_TTL 
         }
     }
+    cache['Environment']['Data']['ROUTER'] = compile_event_router(config=cache['Environment']['Data']['CONFIG'], logger=logger)
     logger.debug('cache: {}'.format((json.dumps(cache))))
 
 
+class DebugMessage:
+    """
+        Defers the `str.format()` of a debug message until a handler actually emits the log record
+    """
+    __slots__ = ('message', 'variables_as_dict', 'variable_as_list')
+
+    def __init__(self, message: str, variables_as_dict: dict, variable_as_list: list):
+        self.message = message
+        self.variables_as_dict = variables_as_dict
+        self.variable_as_list = variable_as_list
+
+    def __str__(self):
+        try:
+            if len(self.variables_as_dict) > 0:
+                return self.message.format(**self.variables_as_dict)
+            return self.message.format(*self.variable_as_list)
+        except:
+            return self.message
+
+
 def debug_log(message: str, variables_as_dict: dict=dict(), variable_as_list: list=list(), logger=get_logger(level=logging.INFO)):
     """
         See:
@@ -105,16 +145,9 @@ def debug_log(message: str, variables_as_dict: dict=dict(), variable_as_list: li
 
     """
     if cache['Environment']['Data']['DEBUG'] is True:
-        try:
-            caller = getframeinfo(stack()[1][0])
-            caller_str = '{}():{}'.format(caller.function, caller.lineno)
-            message = '[{}]  {}'.format(caller_str, message)
-            if len(variables_as_dict) > 0:
-                logger.debug(message.format(**variables_as_dict))
-            else:
-                logger.debug(message.format(*variable_as_list))
-        except:
-            pass
+        if logger.isEnabledFor(logging.DEBUG) is True:
+            # stacklevel=2 attributes the record (funcName/lineno) to the caller without inspecting the stack
+            logger.debug(DebugMessage(message=message, variables_as_dict=variables_as_dict, variable_as_list=variable_as_list), stacklevel=2)
 
 
 ###############################################################################
@@ -182,32 +215,81 @@ def publish_event_to_sns(
 ###############################################################################
 
 
-def get_routable_event(s3_key: str, config: dict, logger=get_logger())->dict:
+def compile_event_router(config: dict, logger=get_logger())->dict:
+    """
+        Compile the event configuration (events.json) into a router that resolves a key with one dictionary lookup
+        per distinct `StartsWith` length, regardless of the number of configured event types.
+
+        An event type matches when every configured attribute matches. When more than one event type matches a key,
+        the first one in the configuration wins.
+    """
+    router = {
+        'Routes': dict(),           # StartsWith value -> list of routes
+        'Unprefixed': list(),       # Routes without a StartsWith attribute
+        'PrefixLengths': tuple(),
+    }
+    try:
+        for order, (event_type, event_process_data) in enumerate(config.items()):
+            if 'S3KeyAttributes' not in event_process_data or 'Routing' not in event_process_data:
+                logger.warning('Event type "{}" has no S3KeyAttributes and/or Routing - ignored'.format(event_type))
+                continue
+            route = {
+                'Order': order,
+                'EventType': event_type,
+                'Extension': None,
+                'RoutingData': event_process_data['Routing'],
+            }
+            if 'Extension' in event_process_data['S3KeyAttributes']:
+                route['Extension'] = '.{}'.format(event_process_data['S3KeyAttributes']['Extension'])
+            if 'StartsWith' in event_process_data['S3KeyAttributes']:
+                starts_with = event_process_data['S3KeyAttributes']['StartsWith']
+                if starts_with not in router['Routes']:
+                    router['Routes'][starts_with] = list()
+                router['Routes'][starts_with].append(route)
+            else:
+                router['Unprefixed'].append(route)
+        router['PrefixLengths'] = tuple(sorted(set([len(starts_with) for starts_with in router['Routes'].keys()])))
+    except:
+        logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+    return router
+
+
+def get_event_router(config: dict, logger=get_logger())->dict:
+    """
+        Return the router compiled when `config` was loaded into the environment cache, or compile one for any other
+        configuration.
+    """
+    if 'Environment' in cache:
+        if cache['Environment']['Data']['CONFIG'] is config and 'ROUTER' in cache['Environment']['Data']:
+            return cache['Environment']['Data']['ROUTER']
+    return compile_event_router(config=config, logger=logger)
+
+
+def get_routable_event(s3_key: str, config: dict, logger=get_logger(), router: dict=None)->dict:
     routable_event = dict()
     routable_event['MatchingEvent'] = False
     routable_event['RoutingData'] = dict()
     routable_event['EventType'] = ''
-    matching_event = True
-    matching_attributes = dict()
-    for event_type, event_process_data in config.items():
-        if 'S3KeyAttributes' in event_process_data and 'Routing' in event_process_data:
-            if 'StartsWith' in event_process_data['S3KeyAttributes']:
-                matching_attributes['S3KeyAttributes_StartsWith'] = False
-                if s3_key.startswith(event_process_data['S3KeyAttributes']['StartsWith']) is True:
-                    matching_attributes['S3KeyAttributes_StartsWith'] = True
-        if 'Extension' in event_process_data['S3KeyAttributes']:
-                matching_attributes['S3KeyAttributes_Extension'] = False
-                if s3_key.endswith('.{}'.format(event_process_data['S3KeyAttributes']['Extension'])) is True:
-                    matching_attributes['S3KeyAttributes_Extension'] = True
-        for att_name, att_matched in matching_attributes.items():
-            logger.info('Key "{}" matching: {} --> {}'.format(s3_key, att_name, att_matched))
-            if att_matched is False:
-                matching_event = False
-        if matching_event is True:
-            routable_event['MatchingEvent'] = True
-            routable_event['RoutingData'] = event_process_data['Routing']
-            routable_event['EventType'] = event_type
+    if router is None:
+        router = get_event_router(config=config, logger=logger)
+    matched_route = None
+    candidate_routes = list(router['Unprefixed'])
+    for prefix_length in router['PrefixLengths']:
+        if prefix_length > len(s3_key):
             break
+        candidate_routes += router['Routes'].get(s3_key[:prefix_length], list())
+    for route in candidate_routes:
+        if route['Extension'] is not None and s3_key.endswith(route['Extension']) is False:
+            continue
+        if matched_route is None or route['Order'] < matched_route['Order']:
+            matched_route = route
+    if matched_route is not None:
+        routable_event['MatchingEvent'] = True
+        routable_event['RoutingData'] = matched_route['RoutingData']
+        routable_event['EventType'] = matched_route['EventType']
+        logger.info('Key "{}" matched event type "{}"'.format(s3_key, matched_route['EventType']))
+    else:
+        logger.info('Key "{}" did not match any event type'.format(s3_key))
     debug_log(message='routable_event={}', variable_as_list=[routable_event,], logger=logger)
     return routable_event
 
@@ -5,6 +5,9 @@ import time
 import random
 import copy
 import json
+import sys
+import traceback
+from collections import OrderedDict
 
 
 DEPARTMENTS = dict()
@@ -15,6 +18,158 @@ access_cards_ids = dict()
 TABLE_NAME = 'lab3-access-card-app'
 
 
+BATCH_WRITE_MAX_ITEMS = 25
+BATCH_WRITE_THROTTLING_ERROR_CODES = (
+    'ProvisionedThroughputExceededException',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'InternalServerError',
+)
+
+
+class BatchWriter:
+    """
+        Buffered DynamoDB writer. Puts and deletes are accumulated and written with BatchWriteItem, at most 25 write
+        requests per call (the DynamoDB maximum).
+
+        * A write to a key that is already buffered replaces the buffered write, so the last write wins exactly like
+          a sequence of put_item/delete_item calls would. This also keeps duplicate keys out of a single request,
+          which DynamoDB rejects.
+        * UnprocessedItems are retried with full jitter exponential back-off (a random delay between 0 and
+          `base_delay * 2^attempt` seconds, capped at `max_delay`) up to `max_retries` times.
+        * Back-pressure: every call that returns UnprocessedItems halves the number of writes sent per call (down to
+          1) and every fully processed call grows it again by one. When `capacity_units_per_second` is set, calls are
+          also paced so that the consumed write capacity stays at or below that rate.
+        * The buffer is flushed automatically once it holds `flush_size` writes. Call `flush()` or `close()` (or use
+          the writer as a context manager) to write the remainder, for example at the end of an SQS batch.
+
+        A writer is not thread safe - use one writer per thread. Writes that could not be completed are kept in
+        `failed` as `(table_name, write_request)` tuples and make `flush()` and `close()` return False.
+    """
+
+    def __init__(
+        self,
+        client,
+        key_attributes: tuple=('PK', 'SK',),
+        flush_size: int=BATCH_WRITE_MAX_ITEMS,
+        max_retries: int=8,
+        base_delay: float=0.05,
+        max_delay: float=5.0,
+        capacity_units_per_second: float=None
+    ):
+        self.client = client
+        self.key_attributes = key_attributes
+        self.flush_size = max(1, flush_size)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.capacity_units_per_second = capacity_units_per_second
+        self.request_size = BATCH_WRITE_MAX_ITEMS
+        self.pending = OrderedDict()
+        self.failed = list()
+        self.closed = False
+        self.stats = {'Calls': 0, 'Writes': 0, 'Retries': 0, 'ConsumedCapacity': 0.0}
+        self._last_call_timestamp = None
+        self._last_call_capacity = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+        return False
+
+    def put(self, table_name: str, record_data: dict)->bool:
+        return self._buffer(table_name=table_name, item=record_data, write_request={'PutRequest': {'Item': record_data}})
+
+    def delete(self, table_name: str, key: dict)->bool:
+        return self._buffer(table_name=table_name, item=key, write_request={'DeleteRequest': {'Key': key}})
+
+    def flush(self)->bool:
+        write_requests = list(self.pending.values())
+        self.pending = OrderedDict()
+        while len(write_requests) > 0:
+            chunk = write_requests[:self.request_size]
+            write_requests = write_requests[self.request_size:]
+            self.failed += self._write(write_requests=chunk)
+        return len(self.failed) == 0
+
+    def close(self)->bool:
+        result = self.flush()
+        self.closed = True
+        print('BatchWriter closed. stats={}'.format(self.stats))
+        if result is False:
+            print('BatchWriter failed to write {} items'.format(len(self.failed)))
+        return result
+
+    def _buffer(self, table_name: str, item: dict, write_request: dict)->bool:
+        if self.closed is True:
+            raise Exception('BatchWriter is closed')
+        pending_key = (table_name,) + tuple(tuple(item[attribute].items()) for attribute in self.key_attributes if attribute in item)
+        self.pending.pop(pending_key, None)
+        self.pending[pending_key] = (table_name, write_request,)
+        if len(self.pending) >= self.flush_size:
+            return self.flush()
+        return True
+
+    def _pace(self):
+        if self.capacity_units_per_second is None or self._last_call_timestamp is None:
+            return
+        delay = self._last_call_capacity / self.capacity_units_per_second - (time.time() - self._last_call_timestamp)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _write(self, write_requests: list)->list:
+        """
+            Write up to 25 `(table_name, write_request)` tuples and return the tuples that could not be written
+        """
+        request_items = dict()
+        for table_name, write_request in write_requests:
+            if table_name not in request_items:
+                request_items[table_name] = list()
+            request_items[table_name].append(write_request)
+        attempt = 0
+        while len(request_items) > 0:
+            self._pace()
+            unprocessed_items = dict()
+            try:
+                response = self.client.batch_write_item(
+                    RequestItems=request_items,
+                    ReturnConsumedCapacity='TOTAL'
+                )
+                self._last_call_capacity = 0.0
+                for consumed_capacity in response.get('ConsumedCapacity', list()):
+                    self._last_call_capacity += float(consumed_capacity.get('CapacityUnits', 0))
+                self.stats['ConsumedCapacity'] += self._last_call_capacity
+                if 'UnprocessedItems' in response:
+                    unprocessed_items = response['UnprocessedItems']
+            except Exception as e:
+                error_response = dict()
+                if hasattr(e, 'response') is True:
+                    error_response = e.response
+                if error_response.get('Error', dict()).get('Code') not in BATCH_WRITE_THROTTLING_ERROR_CODES:
+                    print('EXCEPTION: {}'.format(traceback.format_exc()))
+                    return [(table_name, write_request,) for table_name, table_requests in request_items.items() for write_request in table_requests]
+                print('BatchWriteItem throttled: {}'.format(error_response['Error']['Code']))
+                unprocessed_items = request_items
+            self._last_call_timestamp = time.time()
+            self.stats['Calls'] += 1
+            unprocessed_qty = sum([len(table_requests) for table_requests in unprocessed_items.values()])
+            self.stats['Writes'] += sum([len(table_requests) for table_requests in request_items.values()]) - unprocessed_qty
+            if unprocessed_qty > 0:
+                self.request_size = max(1, self.request_size // 2)
+                attempt += 1
+                if attempt > self.max_retries:
+                    print('Unprocessed items remain after {} retries: {}'.format(self.max_retries, unprocessed_items))
+                    return [(table_name, write_request,) for table_name, table_requests in unprocessed_items.items() for write_request in table_requests]
+                self.stats['Retries'] += 1
+                time.sleep(random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt))))
+            else:
+                self.request_size = min(BATCH_WRITE_MAX_ITEMS, self.request_size + 1)
+            request_items = unprocessed_items
+        return list()
+
+
 def get_utc_timestamp(with_decimal: bool = False):
     epoch = datetime(1970, 1, 1, 0, 0, 0)
     now = datetime.utcnow()
@@ -259,26 +414,26 @@ def create_access_cards(qty_cards: int=300)->dict:
 
 def populate_v2(employees: dict, access_cards: dict):
     client = boto3.client('dynamodb', region_name='eu-central-1')
+    writer = BatchWriter(client=client)
     now = get_utc_timestamp(with_decimal=False)
     for employee_id, employee_data in employees.items():
         PK = 'EMP#{}'.format(employee_id)
         
         # Personal Data
         SK = 'PERSON#PERSONAL_DATA'
-        client.put_item(
-            TableName=TABLE_NAME,
-            Item={
+        writer.put(
+            table_name=TABLE_NAME,
+            record_data={
                 'PK'                : { 'S': PK},
                 'SK'                : { 'S': SK},
                 'PersonName'        : { 'S': employee_data['PersonName']},
                 'PersonSurname'     : { 'S': employee_data['PersonSurname']},
                 'PersonDepartment'  : { 'S': employee_data['PersonDepartment']},
                 'PersonStatus'      : { 'S': employee_data['PersonStatus']},
-                'CognitoSubjectId'  : { 'S': 'no-login-{}'.format(PK)}
-            },
-            ReturnValues='NONE',
-            ReturnConsumedCapacity='TOTAL',
-            ReturnItemCollectionMetrics='SIZE'
+                'CognitoSubjectId'  : { 'S': 'no-login-{}'.format(PK)},
+                'PersonStatusIdx'   : { 'S': employee_data['PersonStatus']},
+                'PersonDepartmentIdx': { 'S': '{}#{}'.format(employee_data['PersonDepartment'], employee_id)}
+            }
         )
         print('Created person {}'.format(employee_id))
 
@@ -286,9 +441,9 @@ def populate_v2(employees: dict, access_cards: dict):
         if employee_data['PersonStatus'] == 'active':
             SK = 'PERSON#PERSONAL_DATA#ACCESS_CARD'
             selected_card_idx = employee_data['CardIdx']
-            client.put_item(
-                TableName=TABLE_NAME,
-                Item={
+            writer.put(
+                table_name=TABLE_NAME,
+                record_data={
                     'PK'                    : { 'S': PK},
                     'SK'                    : { 'S': SK},
                     'CardIssuedTimestamp'   : { 'N': '{}'.format(access_cards[selected_card_idx]['CardIssuedTimestamp'])},
@@ -304,18 +459,15 @@ def populate_v2(employees: dict, access_cards: dict):
                     'ScannedBuildingIdx'    : { 'S': 'null'},
                     'ScannedStatus'         : { 'S': 'scanned-out'},
                     'CognitoSubjectId'      : { 'S': 'no-login-{}'.format(PK)}
-                },
-                ReturnValues='NONE',
-                ReturnConsumedCapacity='TOTAL',
-                ReturnItemCollectionMetrics='SIZE'
+                }
             )
             print('   Person {} is now ACTIVE'.format(employee_id))
 
         if 'CardIdx' in employee_data and employee_data['PersonStatus'] == 'active':
             SK = 'PERSON#PERSONAL_DATA#PERMISSIONS#{}'.format(now)
-            client.put_item(
-                TableName=TABLE_NAME,
-                Item={
+            writer.put(
+                table_name=TABLE_NAME,
+                record_data={
                     'PK'                    : { 'S': PK},
                     'SK'                    : { 'S': SK},
                     'CardIdx'               : { 'S': employee_data['CardIdx']},
@@ -324,10 +476,7 @@ def populate_v2(employees: dict, access_cards: dict):
                     'SystemPermissions'     : { 'S': 'basic,public'},
                     'StartTimestamp'        : { 'N': '{}'.format(now)},
                     'EndTimestamp'          : { 'N': '-1'}
-                },
-                ReturnValues='NONE',
-                ReturnConsumedCapacity='TOTAL',
-                ReturnItemCollectionMetrics='SIZE'
+                }
             )
             print('   Created permissions for person {}'.format(employee_id))
             
@@ -337,9 +486,9 @@ def populate_v2(employees: dict, access_cards: dict):
         PK = 'CARD#{}'.format(access_card_id)
         if access_card_data['CardIssuedTo'] == 'not-issued':
             SK = 'CARD#STATUS'
-            client.put_item(
-                TableName=TABLE_NAME,
-                Item={
+            writer.put(
+                table_name=TABLE_NAME,
+                record_data={
                     'PK'                    : { 'S': PK                             },
                     'SK'                    : { 'S': SK                             },
                     'CardIdx'               : { 'S': '{}'.format(access_card_id)    },
@@ -348,17 +497,14 @@ def populate_v2(employees: dict, access_cards: dict):
                     'CardIssuedTo'          : { 'S': 'no-one'                       },
                     'CardIssuedBy'          : { 'S': 'not-issued'                   },
                     'CardIssuedTimestamp'   : { 'N': '-1'                           }
-                },
-                ReturnValues='NONE',
-                ReturnConsumedCapacity='TOTAL',
-                ReturnItemCollectionMetrics='SIZE'
+                }
             )
             print('Updated status for card {} to not-issued'.format(access_card_id))
             SK = 'CARD#EVENT#{}'.format(now)
             lock_id = '{}'.format(hashlib.sha256('{}'.format(access_card_id).encode('utf-8')).hexdigest())
-            client.put_item(
-                TableName=TABLE_NAME,
-                Item={
+            writer.put(
+                table_name=TABLE_NAME,
+                record_data={
                     'PK'                                : { 'S': PK                             },
                     'SK'                                : { 'S': SK                             },
                     'CardIdx'                           : { 'S': '{}'.format(access_card_id)    },
@@ -379,17 +525,14 @@ def populate_v2(employees: dict, access_cards: dict):
                     'EventSqsReject'                    : { 'BOOL': False                       },
                     'EventSqsId'                        : { 'S': 'n/a'                          },
                     'EventSqsOriginalPayloadJson'       : { 'S': '{{}}'                         }
-                },
-                ReturnValues='NONE',
-                ReturnConsumedCapacity='TOTAL',
-                ReturnItemCollectionMetrics='SIZE'
+                }
             )
             print('   Created event for card {}'.format(access_card_id))
         else:
             SK = 'CARD#STATUS'
-            client.put_item(
-                TableName=TABLE_NAME,
-                Item={
+            writer.put(
+                table_name=TABLE_NAME,
+                record_data={
                     'PK'                    : { 'S': PK                                                     },
                     'SK'                    : { 'S': SK                                                     },
                     'CardIdx'               : { 'S': '{}'.format(access_card_id)                            },
@@ -398,18 +541,15 @@ def populate_v2(employees: dict, access_cards: dict):
                     'CardIssuedTimestamp'   : { 'N': '{}'.format(access_card_data['CardIssuedTimestamp'])   },
                     'LockIdentifier'        : { 'S': 'null'                                                 },
                     'IsAvailableForIssue'   : { 'BOOL': False                                               }
-                },
-                ReturnValues='NONE',
-                ReturnConsumedCapacity='TOTAL',
-                ReturnItemCollectionMetrics='SIZE'
+                }
             )
             print('Updated status for card {} to issued'.format(access_card_id))
             SK = 'CARD#EVENT#{}'.format(now)
             lock_id = '{}'.format(hashlib.sha256('{}'.format(access_card_id).encode('utf-8')).hexdigest())
             description = 'Physical Card Added to Pool and Issued to {}'.format(access_card_data['CardIssuedTo'])
-            client.put_item(
-                TableName=TABLE_NAME,
-                Item={
+            writer.put(
+                table_name=TABLE_NAME,
+                record_data={
                     'PK'                                : { 'S': PK                             },
                     'SK'                                : { 'S': SK                             },
                     'CardIdx'                           : { 'S': '{}'.format(access_card_id)    },
@@ -430,13 +570,54 @@ def populate_v2(employees: dict, access_cards: dict):
                     'EventSqsReject'                    : { 'BOOL': False                       },
                     'EventSqsId'                        : { 'S': 'n/a'                          },
                     'EventSqsOriginalPayloadJson'       : { 'S': '{{}}'                         }
-                },
-                ReturnValues='NONE',
-                ReturnConsumedCapacity='TOTAL',
-                ReturnItemCollectionMetrics='SIZE'
+                }
             )
             print('   Created event for card {}'.format(access_card_id))
 
+    if writer.close() is False:
+        print('Failed to write {} items'.format(len(writer.failed)))
+
+
+def backfill_person_status_index():
+    """
+        Add the `PersonStatusIdx` and `PersonDepartmentIdx` attributes to `PERSON#PERSONAL_DATA` records that were
+        created before the `PersonStatusIdx` index existed. Records that changed since they were read are left alone -
+        the event processor sets the attributes with every status update.
+    """
+    client = boto3.client('dynamodb', region_name='eu-central-1')
+    parameters = {
+        'TableName': TABLE_NAME,
+        'ScanFilter': {
+            'SK': {'AttributeValueList': [{'S': 'PERSON#PERSONAL_DATA'},], 'ComparisonOperator': 'EQ'},
+        },
+    }
+    updated = 0
+    while True:
+        response = client.scan(**parameters)
+        for item in response.get('Items', list()):
+            if 'PersonStatusIdx' in item:
+                continue
+            employee_id = item['PK']['S'].replace('EMP#', '')
+            try:
+                client.update_item(
+                    TableName=TABLE_NAME,
+                    Key={'PK': item['PK'], 'SK': item['SK']},
+                    UpdateExpression='SET PersonStatusIdx = :status, PersonDepartmentIdx = :department_idx',
+                    ConditionExpression='PersonStatus = :status AND PersonDepartment = :department',
+                    ExpressionAttributeValues={
+                        ':status': item['PersonStatus'],
+                        ':department': item['PersonDepartment'],
+                        ':department_idx': {'S': '{}#{}'.format(item['PersonDepartment']['S'], employee_id)},
+                    }
+                )
+                updated += 1
+            except client.exceptions.ConditionalCheckFailedException:
+                print('Person {} changed while the index was back filled - skipped'.format(employee_id))
+        if response.get('LastEvaluatedKey', None) is None:
+            break
+        parameters['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    print('Added the PersonStatusIdx attributes to {} persons'.format(updated))
+
 
 def create_employees(total_qty: int=200, active: int=100, access_cards: dict=copy.deepcopy(create_access_cards()))->tuple:
     now = get_utc_timestamp(with_decimal=False)
@@ -470,6 +651,9 @@ def create_employees(total_qty: int=200, active: int=100, access_cards: dict=cop
 
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'backfill-index':
+        backfill_person_status_index()
+        sys.exit(0)
     access_cards = create_access_cards(qty_cards=200)
     employees, access_cards = create_employees(total_qty=200, active=100, access_cards=copy.deepcopy(access_cards))   
     print('='*80)
@@ -0,0 +1,112 @@
+"""
+Export of the employee directory from the `lab3-access-card-app` table, with the parallel Scan of the
+`list_employee_ids` Lambda function:
+
+    ParallelScan (one worker thread per segment) -> stream_employees() (grouped by employee, status filter)
+        -> JSON lines or CSV file
+
+Every employee is written as one line with the `EmployeeId` and the fields of `DEFAULT_FIELDS_TO_RETRIEVE` that the
+employee has. The time of the export depends on the number of segments, up to the read throughput of the table.
+
+Examples:
+
+    # All employees, as JSON lines
+    python3 employee_export.py --output employees.jsonl
+
+    # Only the active employees, as CSV, with 32 segments
+    python3 employee_export.py --status active --format csv --segments 32 --output active_employees.csv
+
+The Lambda function module is loaded from `../../lambda_functions`, so this script must be run from a checkout of
+the repository.
+"""
+import argparse
+import csv
+import importlib.util
+import json
+import logging
+import os
+import time
+
+import boto3
+
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_FUNCTIONS_DIR = os.path.join(SCRIPT_DIR, '..', '..', 'lambda_functions')
+
+
+def load_lambda_module(module_name: str):
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(LAMBDA_FUNCTIONS_DIR, module_name, '{}.py'.format(module_name)))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run(args, boto3_clazz=boto3)->dict:
+    list_employee_ids = load_lambda_module(module_name='list_employee_ids')
+    logger = list_employee_ids.get_logger(level=getattr(logging, args.log_level))
+    list_employee_ids.refresh_environment_cache(logger=logger)
+    fields = [field_name for field_name in list_employee_ids.DEFAULT_FIELDS_TO_RETRIEVE]
+    status_filter = [status for status in args.status.split(',') if len(status) > 0]
+
+    start = time.time()
+    exported = 0
+    with open(args.output, 'w', newline='') as f:
+        csv_writer = None
+        if args.format == 'csv':
+            csv_writer = csv.DictWriter(f, fieldnames=['EmployeeId',] + fields, extrasaction='ignore')
+            csv_writer.writeheader()
+        with list_employee_ids.ParallelScan(
+            client=boto3_clazz.client('dynamodb', region_name=args.region),
+            scan_parameters={
+                'TableName': args.table,
+                'AttributesToGet': fields + ['PK', 'SK',],
+                'Select': 'SPECIFIC_ATTRIBUTES',
+                'ScanFilter': {
+                    'SK': {
+                        'AttributeValueList': [{'S': 'PERSON#PERSONAL_DATA'},],
+                        'ComparisonOperator': 'BEGINS_WITH'
+                    }
+                },
+            },
+            total_segments=args.segments,
+            page_size=args.page_size,
+            logger=logger
+        ) as scan:
+            for employee_record in list_employee_ids.stream_employees(scan=scan, fields_to_retrieve=fields, status_filter=status_filter, logger=logger):
+                if csv_writer is not None:
+                    csv_writer.writerow(employee_record)
+                else:
+                    f.write('{}\n'.format(json.dumps(employee_record)))
+                exported += 1
+    duration = time.time() - start
+
+    return {
+        'Table': args.table,
+        'StatusFilter': status_filter,
+        'Segments': args.segments,
+        'Employees': exported,
+        'DurationSeconds': round(duration, 3),
+        'EmployeesPerSecond': round(exported / duration, 1) if duration > 0 else 0.0,
+        'Output': args.output,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Lab3 export of the employee directory with a parallel Scan')
+    parser.add_argument('--table', type=str, default='lab3-access-card-app')
+    parser.add_argument('--region', type=str, default=os.getenv('AWS_REGION', 'eu-central-1'))
+    parser.add_argument('--status', type=str, default='', help='Comma separated statuses to export (active, onboarding, inactive) - default is all employees')
+    parser.add_argument('--segments', type=int, default=16, help='Number of parallel Scan segments (and threads)')
+    parser.add_argument('--page-size', type=int, default=1000, help='Maximum number of items per Scan request')
+    parser.add_argument('--format', type=str, default='jsonl', choices=('jsonl', 'csv',))
+    parser.add_argument('--output', type=str, default='employees.jsonl')
+    parser.add_argument('--log-level', type=str, default='WARNING', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR',))
+    args = parser.parse_args()
+    if args.segments < 1:
+        parser.error('--segments must be at least 1')
+
+    print(json.dumps(run(args=args), indent=4))
+
+
+if __name__ == '__main__':
+    main()
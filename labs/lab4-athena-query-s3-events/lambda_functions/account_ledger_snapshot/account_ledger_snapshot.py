@@ -0,0 +1,1446 @@
+import boto3
+from botocore.config import Config
+import threading
+import traceback
+import os
+import json
+import logging
+from datetime import datetime
+import sys
+from decimal import Decimal
+# Other imports here...
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+def get_logger(level=logging.INFO):
+    logger = logging.getLogger()
+    for h in logger.handlers:
+        logger.removeHandler(h)
+    formatter = logging.Formatter('%(funcName)s:%(lineno)d -  %(levelname)s - %(message)s')
+    ch = logging.StreamHandler(sys.stdout)
+    ch.setLevel(level)    
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+    logger.setLevel(level)
+
+    # Disable Boto3 Debug Logging - see https://stackoverflow.com/questions/1661275/disable-boto-logging-without-modifying-the-boto-files
+    logging.getLogger('boto3').setLevel(logging.INFO)
+    logging.getLogger('botocore').setLevel(logging.INFO)
+    logging.getLogger('s3transfer').setLevel(logging.INFO)
+    logging.getLogger('urllib3').setLevel(logging.INFO)
+
+    return logger
+
+
+CLIENT_REGISTRY = dict()
+CLIENT_REGISTRY_LOCK = threading.Lock()
+try:
+    CLIENT_CONFIG = Config(max_pool_connections=25, connect_timeout=5, read_timeout=30, retries={'max_attempts': 5, 'mode': 'standard'}, tcp_keepalive=True)
+except TypeError:   # tcp_keepalive requires botocore 1.27.84 or later
+    CLIENT_CONFIG = Config(max_pool_connections=25, connect_timeout=5, read_timeout=30, retries={'max_attempts': 5, 'mode': 'standard'})
+
+
+def get_client(client_name: str, region: str='eu-central-1', boto3_clazz=boto3, endpoint_url: str=None):
+    """
+        Clients are created on first use and kept in CLIENT_REGISTRY for the lifetime of the execution environment, so
+        warm invocations re-use the client and its pool of keep-alive connections. Only the services actually used by
+        the function are ever created.
+    """
+    registry_key = (client_name, region, endpoint_url, id(boto3_clazz))
+    if registry_key not in CLIENT_REGISTRY:
+        with CLIENT_REGISTRY_LOCK:
+            if registry_key not in CLIENT_REGISTRY:
+                CLIENT_REGISTRY[registry_key] = boto3_clazz.client(client_name, region_name=region, endpoint_url=endpoint_url, config=CLIENT_CONFIG)
+    return CLIENT_REGISTRY[registry_key]
+
+
+# ADD the header as per section ``Module header functions``
+
+CACHE_TTL_DEFAULT = 600
+LEDGER_SETTLEMENT_SECONDS_DEFAULT = 300
+LEDGER_SNAPSHOT_RETENTION_DEFAULT = 7
+cache = dict()
+
+def get_utc_timestamp(with_decimal: bool = False):
+    epoch = datetime(1970, 1, 1, 0, 0, 0)
+    now = datetime.utcnow()
+    timestamp = (now - epoch).total_seconds()
+    if with_decimal:
+        return timestamp
+    return int(timestamp)
+    
+    
+def get_debug()->bool:
+    try:
+        return bool(int(os.getenv('DEBUG', '0')))
+    except:
+        pass
+    return False
+    
+
+def get_max_workers()->int:
+    try:
+        return max(1, int(os.getenv('MAX_WORKERS', '1')))
+    except:
+        pass
+    return 1
+
+
+def get_cache_ttl(logger=get_logger())->int:
+    try:
+        return int(os.getenv('CACHE_TTL', '{}'.format(CACHE_TTL_DEFAULT)))
+    except:
+        logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+    return CACHE_TTL_DEFAULT
+
+
+def get_settlement_seconds()->int:
+    try:
+        return max(0, int(os.getenv('LEDGER_SETTLEMENT_SECONDS', '{}'.format(LEDGER_SETTLEMENT_SECONDS_DEFAULT))))
+    except:
+        pass
+    return LEDGER_SETTLEMENT_SECONDS_DEFAULT
+
+
+def get_snapshot_retention()->int:
+    try:
+        return max(1, int(os.getenv('LEDGER_SNAPSHOT_RETENTION', '{}'.format(LEDGER_SNAPSHOT_RETENTION_DEFAULT))))
+    except:
+        pass
+    return LEDGER_SNAPSHOT_RETENTION_DEFAULT
+
+
+def refresh_environment_cache(logger=get_logger()):
+    global cache
+    now = get_utc_timestamp(with_decimal=False)
+    if 'Environment' in cache:
+        if cache['Environment']['Expiry'] > now:
+            return
+    cache['Environment'] = {
+        'Expiry': get_utc_timestamp() + get_cache_ttl(logger=logger),
+        'Data': {
+            'CACHE_TTL': get_cache_ttl(logger=logger),
+            'DEBUG': get_debug(),
+            'METRICS_ENABLED': get_metrics_enabled(),
+            'METRICS_NAMESPACE': get_metrics_namespace(),
+            'MAX_WORKERS': get_max_workers(),
+            'LEDGER_SETTLEMENT_SECONDS': get_settlement_seconds(),
+            'LEDGER_SNAPSHOT_RETENTION': get_snapshot_retention(),
+            # Other ENVIRONMENT variables can be added here... The environment will be re-read after the CACHE_TTL 
+        }
+    }
+    logger.debug('cache: {}'.format((json.dumps(cache))))
+
+
+class DebugMessage:
+    """
+        Defers the `str.format()` of a debug message until a handler actually emits the log record
+    """
+    __slots__ = ('message', 'variables_as_dict', 'variable_as_list')
+
+    def __init__(self, message: str, variables_as_dict: dict, variable_as_list: list):
+        self.message = message
+        self.variables_as_dict = variables_as_dict
+        self.variable_as_list = variable_as_list
+
+    def __str__(self):
+        try:
+            if len(self.variables_as_dict) > 0:
+                return self.message.format(**self.variables_as_dict)
+            return self.message.format(*self.variable_as_list)
+        except:
+            return self.message
+
+
+def debug_log(message: str, variables_as_dict: dict=dict(), variable_as_list: list=list(), logger=get_logger(level=logging.INFO)):
+    """
+        See:
+            https://docs.python.org/3/library/stdtypes.html#str.format
+            https://docs.python.org/3/library/string.html#formatstrings
+
+        For this function, the `message` is expected to contain key word variable place holders and the `variables` dict must hold a dictionary with the values matched to the keywords
+
+        Example:
+
+            >>> d = {'one': 1, 'number-two': 'two', 'SomeBool': True}
+            >>> message = 'one = {one} and the number {number-two}. Yes, it is {SomeBool}'
+            >>> message.format(**d)
+            'one = 1 and the number two. Yes, it is True'
+
+            >>> l = ('one', 2, True)
+            >>> message = '{} and {}'
+            >>> message.format(*l)
+            'one and 2'
+
+    """
+    if cache['Environment']['Data']['DEBUG'] is True:
+        if logger.isEnabledFor(logging.DEBUG) is True:
+            # stacklevel=2 attributes the record (funcName/lineno) to the caller without inspecting the stack
+            logger.debug(DebugMessage(message=message, variables_as_dict=variables_as_dict, variable_as_list=variable_as_list), stacklevel=2)
+
+
+
+###############################################################################
+###                                                                         ###
+###                  D Y N A M O D B    A T T R I B U T E S                 ###
+###                                                                         ###
+###############################################################################
+
+
+def _decode_list(value: list)->list:
+    return [decode_attribute_value(attribute_value=element) for element in value]
+
+
+def _decode_map(value: dict)->dict:
+    return decode_item(item=value)
+
+
+# Types mapped to None are already returned by the client as the correct Python type and need no conversion
+ATTRIBUTE_VALUE_DECODERS = {
+    'S': None,
+    'N': Decimal,
+    'BOOL': None,
+    'NULL': lambda value: None,
+    'B': None,
+    'SS': set,
+    'NS': lambda value: set(Decimal(element) for element in value),
+    'BS': set,
+    'L': _decode_list,
+    'M': _decode_map,
+}
+
+
+def decode_attribute_value(attribute_value: dict):
+    """
+        Convert a single DynamoDB AttributeValue, for example `{'N': '10.5'}`, to the Python value (`Decimal('10.5')`)
+
+        Numbers are always returned as `Decimal`, `L` and `M` values are decoded recursively and sets are returned as
+        Python `set` objects. Unknown types raise a `KeyError`.
+    """
+    for data_type, data_value in attribute_value.items():
+        decoder = ATTRIBUTE_VALUE_DECODERS[data_type]
+        if decoder is None:
+            return data_value
+        return decoder(data_value)
+
+
+def decode_item(item: dict)->dict:
+    """
+        Convert a DynamoDB item (as returned by the low level client) to a plain Python dict
+    """
+    decoders = ATTRIBUTE_VALUE_DECODERS
+    record = dict()
+    for field_name, field_data in item.items():
+        for data_type, data_value in field_data.items():
+            decoder = decoders[data_type]
+            if decoder is None:
+                record[field_name] = data_value
+            else:
+                record[field_name] = decoder(data_value)
+    return record
+
+
+def decode_items(items: list)->list:
+    """
+        Convert a complete `Items` list from a Query or Scan response
+    """
+    return [decode_item(item=item) for item in items]
+
+
+###############################################################################
+###                                                                         ###
+###                               M E T R I C S                             ###
+###                                                                         ###
+###############################################################################
+
+
+METRICS_NAMESPACE_DEFAULT = 'Lab4/EventPipeline'
+EMF_MAX_METRICS_PER_DOCUMENT = 100
+EMF_MAX_VALUES_PER_METRIC = 100
+
+
+def get_metrics_enabled()->bool:
+    try:
+        return bool(int(os.getenv('METRICS_ENABLED', '1')))
+    except:
+        pass
+    return True
+
+
+def get_metrics_namespace()->str:
+    return os.getenv('METRICS_NAMESPACE', METRICS_NAMESPACE_DEFAULT)
+
+
+def consumed_capacity_units(response: dict)->float:
+    """
+        Total capacity units in a DynamoDB response requested with `ReturnConsumedCapacity='TOTAL'`. BatchWriteItem
+        and TransactWriteItems return a list (one entry per table), the other operations a single dict.
+    """
+    if isinstance(response, dict) is False:
+        return 0.0
+    consumed_capacity = response.get('ConsumedCapacity', list())
+    if isinstance(consumed_capacity, dict) is True:
+        consumed_capacity = [consumed_capacity,]
+    return sum([float(table_capacity.get('CapacityUnits', 0)) for table_capacity in consumed_capacity])
+
+
+class MetricsCollector:
+    """
+        Collects step durations and AWS API call counters during an invocation and writes them as CloudWatch Embedded
+        Metric Format (EMF) log lines when `flush()` is called at the end of the invocation. Recording a value is only
+        a list append under a lock - the JSON documents are built in `flush()`, one per set of dimension values (split
+        when the EMF limits of 100 metrics per document or 100 values per metric are reached).
+
+            StepDuration        Milliseconds    Step
+            AwsCallDuration     Milliseconds    Service, Operation
+            AwsCalls            Count           Service, Operation
+            AwsCallErrors       Count           Service, Operation
+            ConsumedCapacity    Count           Service, Operation (DynamoDB capacity units)
+
+        All metrics also have the `FunctionName` dimension, plus the dimensions set with `set_dimensions()` by the
+        thread that recorded the value (for example the `TransactionType`).
+
+        See https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+    """
+
+    def __init__(self, function_name: str, namespace: str=METRICS_NAMESPACE_DEFAULT, writer=None):
+        self.function_name = function_name
+        self.namespace = namespace
+        self.writer = writer
+        self.enabled = True
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.metrics = dict()
+
+    def set_dimensions(self, **dimensions):
+        self.local.dimensions = dimensions
+
+    def clear_dimensions(self):
+        self.local.dimensions = dict()
+
+    def put_metric(self, name: str, value: float, unit: str='Count', dimensions: dict=None, aggregate: bool=False):
+        """
+            With `aggregate` the value is added to the current value instead of being recorded as another sample
+        """
+        if self.enabled is False:
+            return
+        metric_dimensions = dict(getattr(self.local, 'dimensions', dict()))
+        if dimensions is not None:
+            metric_dimensions.update(dimensions)
+        dimensions_key = tuple(sorted(metric_dimensions.items()))
+        with self.lock:
+            if dimensions_key not in self.metrics:
+                self.metrics[dimensions_key] = dict()
+            if name not in self.metrics[dimensions_key]:
+                self.metrics[dimensions_key][name] = {'Unit': unit, 'Values': list()}
+            values = self.metrics[dimensions_key][name]['Values']
+            if aggregate is True and len(values) > 0:
+                values[0] += value
+            else:
+                values.append(value)
+
+    def increment(self, name: str, value: float=1, dimensions: dict=None):
+        self.put_metric(name=name, value=value, unit='Count', dimensions=dimensions, aggregate=True)
+
+    @contextmanager
+    def timer(self, step: str):
+        """
+            Record the duration of a named step. Can also be used as a function decorator.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.put_metric(name='StepDuration', value=round((time.perf_counter() - start) * 1000, 3), unit='Milliseconds', dimensions={'Step': step})
+
+    @contextmanager
+    def aws_call(self, service: str, operation: str):
+        """
+            Time and count an AWS API call. Store the response in the yielded dict under `Response` to also record
+            the DynamoDB consumed capacity:
+
+                with METRICS.aws_call(service='DynamoDB', operation='PutItem') as call:
+                    call['Response'] = client.put_item(...)
+        """
+        call = dict()
+        dimensions = {'Service': service, 'Operation': operation}
+        start = time.perf_counter()
+        try:
+            yield call
+        except:
+            self.increment(name='AwsCallErrors', dimensions=dimensions)
+            raise
+        finally:
+            self.put_metric(name='AwsCallDuration', value=round((time.perf_counter() - start) * 1000, 3), unit='Milliseconds', dimensions=dimensions)
+            self.increment(name='AwsCalls', dimensions=dimensions)
+            capacity_units = consumed_capacity_units(response=call.get('Response'))
+            if capacity_units > 0:
+                self.increment(name='ConsumedCapacity', value=capacity_units, dimensions=dimensions)
+
+    def _write(self, document: dict):
+        # EMF documents must be written as is - the log formatter prefix would stop CloudWatch from extracting them
+        if self.writer is not None:
+            self.writer(document)
+            return
+        sys.stdout.write('{}\n'.format(json.dumps(document)))
+
+    def flush(self)->int:
+        """
+            Write all recorded metrics as EMF documents and return the number of documents written
+        """
+        with self.lock:
+            metrics = self.metrics
+            self.metrics = dict()
+        documents_qty = 0
+        timestamp = int(time.time() * 1000)
+        for dimensions_key, dimension_metrics in metrics.items():
+            dimension_values = {'FunctionName': self.function_name}
+            dimension_values.update(dict(dimensions_key))
+            metric_names = list(dimension_metrics.keys())
+            for name_offset in range(0, len(metric_names), EMF_MAX_METRICS_PER_DOCUMENT):
+                document_metric_names = metric_names[name_offset:name_offset+EMF_MAX_METRICS_PER_DOCUMENT]
+                value_offset = 0
+                while True:
+                    metric_definitions = list()
+                    document = dict(dimension_values)
+                    for metric_name in document_metric_names:
+                        values = dimension_metrics[metric_name]['Values'][value_offset:value_offset+EMF_MAX_VALUES_PER_METRIC]
+                        if len(values) == 0:
+                            continue
+                        metric_definitions.append({'Name': metric_name, 'Unit': dimension_metrics[metric_name]['Unit']})
+                        document[metric_name] = values if len(values) > 1 else values[0]
+                    if len(metric_definitions) == 0:
+                        break
+                    document['_aws'] = {
+                        'Timestamp': timestamp,
+                        'CloudWatchMetrics': [
+                            {
+                                'Namespace': self.namespace,
+                                'Dimensions': [sorted(dimension_values.keys()),],
+                                'Metrics': metric_definitions,
+                            }
+                        ],
+                    }
+                    self._write(document=document)
+                    documents_qty += 1
+                    value_offset += EMF_MAX_VALUES_PER_METRIC
+        return documents_qty
+
+
+METRICS = MetricsCollector(function_name=os.getenv('AWS_LAMBDA_FUNCTION_NAME', 'account_ledger_snapshot'))
+
+
+###############################################################################
+###                                                                         ###
+###                      A W S    I N T E G R A T I O N                     ###
+###                                                                         ###
+###############################################################################
+
+
+BATCH_WRITE_MAX_ITEMS = 25
+BATCH_WRITE_THROTTLING_ERROR_CODES = (
+    'ProvisionedThroughputExceededException',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'InternalServerError',
+)
+
+
+class BatchWriter:
+    """
+        Buffered DynamoDB writer. Puts and deletes are accumulated and written with BatchWriteItem, at most 25 write
+        requests per call (the DynamoDB maximum).
+
+        * A write to a key that is already buffered replaces the buffered write, so the last write wins exactly like
+          a sequence of put_item/delete_item calls would. This also keeps duplicate keys out of a single request,
+          which DynamoDB rejects.
+        * UnprocessedItems are retried with full jitter exponential back-off (a random delay between 0 and
+          `base_delay * 2^attempt` seconds, capped at `max_delay`) up to `max_retries` times.
+        * Back-pressure: every call that returns UnprocessedItems halves the number of writes sent per call (down to
+          1) and every fully processed call grows it again by one. When `capacity_units_per_second` is set, calls are
+          also paced so that the consumed write capacity stays at or below that rate.
+        * The buffer is flushed automatically once it holds `flush_size` writes. Call `flush()` or `close()` (or use
+          the writer as a context manager) to write the remainder, for example at the end of an SQS batch.
+
+        A writer is not thread safe - use one writer per thread. Writes that could not be completed are kept in
+        `failed` as `(table_name, write_request)` tuples and make `flush()` and `close()` return False.
+    """
+
+    def __init__(
+        self,
+        boto3_clazz=boto3,
+        logger=get_logger(),
+        key_attributes: tuple=('PK', 'SK',),
+        flush_size: int=BATCH_WRITE_MAX_ITEMS,
+        max_retries: int=8,
+        base_delay: float=0.05,
+        max_delay: float=5.0,
+        capacity_units_per_second: float=None
+    ):
+        self.boto3_clazz = boto3_clazz
+        self.logger = logger
+        self.key_attributes = key_attributes
+        self.flush_size = max(1, flush_size)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.capacity_units_per_second = capacity_units_per_second
+        self.request_size = BATCH_WRITE_MAX_ITEMS
+        self.pending = OrderedDict()
+        self.failed = list()
+        self.closed = False
+        self.stats = {'Calls': 0, 'Writes': 0, 'Retries': 0, 'ConsumedCapacity': 0.0}
+        self._last_call_timestamp = None
+        self._last_call_capacity = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+        return False
+
+    def put(self, table_name: str, record_data: dict)->bool:
+        return self._buffer(table_name=table_name, item=record_data, write_request={'PutRequest': {'Item': record_data}})
+
+    def delete(self, table_name: str, key: dict)->bool:
+        return self._buffer(table_name=table_name, item=key, write_request={'DeleteRequest': {'Key': key}})
+
+    def flush(self)->bool:
+        write_requests = list(self.pending.values())
+        self.pending = OrderedDict()
+        while len(write_requests) > 0:
+            chunk = write_requests[:self.request_size]
+            write_requests = write_requests[self.request_size:]
+            self.failed += self._write(write_requests=chunk)
+        return len(self.failed) == 0
+
+    def close(self)->bool:
+        result = self.flush()
+        self.closed = True
+        self.logger.info('BatchWriter closed. stats={}'.format(self.stats))
+        if result is False:
+            self.logger.error('BatchWriter failed to write {} items'.format(len(self.failed)))
+        return result
+
+    def _buffer(self, table_name: str, item: dict, write_request: dict)->bool:
+        if self.closed is True:
+            raise Exception('BatchWriter is closed')
+        pending_key = (table_name,) + tuple(tuple(item[attribute].items()) for attribute in self.key_attributes if attribute in item)
+        self.pending.pop(pending_key, None)
+        self.pending[pending_key] = (table_name, write_request,)
+        if len(self.pending) >= self.flush_size:
+            return self.flush()
+        return True
+
+    def _pace(self):
+        if self.capacity_units_per_second is None or self._last_call_timestamp is None:
+            return
+        delay = self._last_call_capacity / self.capacity_units_per_second - (time.time() - self._last_call_timestamp)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _write(self, write_requests: list)->list:
+        """
+            Write up to 25 `(table_name, write_request)` tuples and return the tuples that could not be written
+        """
+        request_items = dict()
+        for table_name, write_request in write_requests:
+            if table_name not in request_items:
+                request_items[table_name] = list()
+            request_items[table_name].append(write_request)
+        attempt = 0
+        while len(request_items) > 0:
+            self._pace()
+            unprocessed_items = dict()
+            try:
+                client=get_client(client_name='dynamodb', region='eu-central-1', boto3_clazz=self.boto3_clazz)
+                with METRICS.aws_call(service='DynamoDB', operation='BatchWriteItem') as call:
+                    response = client.batch_write_item(
+                        RequestItems=request_items,
+                        ReturnConsumedCapacity='TOTAL'
+                    )
+                    call['Response'] = response
+                debug_log(message='response={}', variable_as_list=[response,], logger=self.logger)
+                self._last_call_capacity = 0.0
+                for consumed_capacity in response.get('ConsumedCapacity', list()):
+                    self._last_call_capacity += float(consumed_capacity.get('CapacityUnits', 0))
+                self.stats['ConsumedCapacity'] += self._last_call_capacity
+                if 'UnprocessedItems' in response:
+                    unprocessed_items = response['UnprocessedItems']
+            except Exception as e:
+                error_response = dict()
+                if hasattr(e, 'response') is True:
+                    error_response = e.response
+                if error_response.get('Error', dict()).get('Code') not in BATCH_WRITE_THROTTLING_ERROR_CODES:
+                    self.logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+                    return [(table_name, write_request,) for table_name, table_requests in request_items.items() for write_request in table_requests]
+                self.logger.warning('BatchWriteItem throttled: {}'.format(error_response['Error']['Code']))
+                unprocessed_items = request_items
+            self._last_call_timestamp = time.time()
+            self.stats['Calls'] += 1
+            unprocessed_qty = sum([len(table_requests) for table_requests in unprocessed_items.values()])
+            self.stats['Writes'] += sum([len(table_requests) for table_requests in request_items.values()]) - unprocessed_qty
+            if unprocessed_qty > 0:
+                self.request_size = max(1, self.request_size // 2)
+                attempt += 1
+                if attempt > self.max_retries:
+                    self.logger.error('Unprocessed items remain after {} retries: {}'.format(self.max_retries, unprocessed_items))
+                    return [(table_name, write_request,) for table_name, table_requests in unprocessed_items.items() for write_request in table_requests]
+                self.stats['Retries'] += 1
+                time.sleep(random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt))))
+            else:
+                self.request_size = min(BATCH_WRITE_MAX_ITEMS, self.request_size + 1)
+            request_items = unprocessed_items
+        return list()
+
+
+def create_dynamodb_record(
+    table_name: str,
+    record_data: dict,
+    boto3_clazz=boto3,
+    logger=get_logger()
+)->bool:
+    try:
+        client=get_client(client_name='dynamodb', region='eu-central-1', boto3_clazz=boto3_clazz)
+        with METRICS.aws_call(service='DynamoDB', operation='PutItem') as call:
+            response = client.put_item(
+                TableName=table_name,
+                Item=record_data,
+                ReturnValues='NONE',
+                ReturnConsumedCapacity='TOTAL',
+                ReturnItemCollectionMetrics='SIZE'
+            )
+            call['Response'] = response
+        debug_log(message='response={}', variable_as_list=[response,], logger=logger)
+        return True
+    except:
+        logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+    return False
+
+
+def get_dynamodb_record_by_key(
+    key: dict,
+    boto3_clazz=boto3,
+    logger=get_logger()
+)->dict:
+    record = dict()
+    try:
+        client=get_client(client_name='dynamodb', region='eu-central-1', boto3_clazz=boto3_clazz)
+        with METRICS.aws_call(service='DynamoDB', operation='GetItem') as call:
+            response = client.get_item(
+                TableName=os.getenv('DYNAMODB_ACCOUNTS_TABLE_NAME'),
+                Key=key,
+                ConsistentRead=True,
+                ReturnConsumedCapacity='TOTAL'
+            )
+            call['Response'] = response
+        debug_log(message='response={}', variable_as_list=[response,], logger=logger)
+        if 'Item' in response:
+            record = decode_item(item=response['Item'])
+    except:
+        logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+    if 'Balance' not in record:
+            record['Balance'] = Decimal('0')
+    debug_log(message='record={}', variable_as_list=[record,], logger=logger)
+    return record
+
+
+QUERY_PAGE_SIZE_DEFAULT = 100
+
+
+def paginate_dynamodb_query(
+    query_parameters: dict,
+    page_size: int=QUERY_PAGE_SIZE_DEFAULT,
+    max_items: int=None,
+    start_key: dict=None,
+    boto3_clazz=boto3,
+    logger=get_logger()
+):
+    """
+        Generator that yields decoded records from a DynamoDB Query, fetching the next page only when the caller
+        asks for more records.
+
+        The `query_parameters` are passed to `client.query()` as is, with `Limit` and `ExclusiveStartKey` managed by
+        this function. Iteration ends when the last page is read or after `max_items` records were yielded. The
+        caller can also simply stop iterating at any time to prevent further round trips.
+
+        Note that when a `QueryFilter` is used, DynamoDB applies the `Limit` before the filter, so a page may contain
+        fewer than `page_size` records.
+    """
+    client = get_client(client_name='dynamodb', region='eu-central-1', boto3_clazz=boto3_clazz)
+    parameters = dict(query_parameters)
+    items_yielded = 0
+    next_key = start_key
+    while True:
+        parameters['Limit'] = page_size
+        if max_items is not None and 'QueryFilter' not in parameters and 'FilterExpression' not in parameters:
+            parameters['Limit'] = max(1, min(page_size, max_items - items_yielded))
+        if next_key is not None:
+            parameters['ExclusiveStartKey'] = next_key
+        with METRICS.aws_call(service='DynamoDB', operation='Query') as call:
+            response = client.query(**parameters)
+            call['Response'] = response
+        debug_log(message='response={}', variable_as_list=[response,], logger=logger)
+        for record in decode_items(items=response.get('Items', list())):
+            yield record
+            items_yielded += 1
+            if max_items is not None and items_yielded >= max_items:
+                return
+        next_key = response.get('LastEvaluatedKey', None)
+        if next_key is None:
+            return
+
+
+
+def paginate_dynamodb_scan(
+    scan_parameters: dict,
+    page_size: int=QUERY_PAGE_SIZE_DEFAULT,
+    boto3_clazz=boto3,
+    logger=get_logger()
+):
+    """
+        Generator that yields decoded records from a DynamoDB Scan, fetching the next page only when the caller asks
+        for more records. The `scan_parameters` are passed to `client.scan()` as is, with `Limit` and
+        `ExclusiveStartKey` managed by this function.
+    """
+    client = get_client(client_name='dynamodb', region='eu-central-1', boto3_clazz=boto3_clazz)
+    parameters = dict(scan_parameters)
+    parameters['Limit'] = page_size
+    while True:
+        with METRICS.aws_call(service='DynamoDB', operation='Scan') as call:
+            response = client.scan(**parameters)
+            call['Response'] = response
+        debug_log(message='response={}', variable_as_list=[response,], logger=logger)
+        for record in decode_items(items=response.get('Items', list())):
+            yield record
+        if response.get('LastEvaluatedKey', None) is None:
+            return
+        parameters['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def transact_write_dynamodb_records(
+    transact_items: list,
+    boto3_clazz=boto3,
+    logger=get_logger()
+)->str:
+    """
+        Commit all `transact_items` (TransactWriteItems format) in a single all-or-nothing transaction.
+
+        Returns one of:
+
+            COMMITTED   - all items were written
+            CONFLICT    - a condition check failed or another transaction touched the same items - safe to retry
+            FAILED      - any other error
+    """
+    try:
+        client=get_client(client_name='dynamodb', region='eu-central-1', boto3_clazz=boto3_clazz)
+        with METRICS.aws_call(service='DynamoDB', operation='TransactWriteItems') as call:
+            response = client.transact_write_items(
+                TransactItems=transact_items,
+                ReturnConsumedCapacity='TOTAL',
+                ReturnItemCollectionMetrics='SIZE'
+            )
+            call['Response'] = response
+        debug_log(message='response={}', variable_as_list=[response,], logger=logger)
+        return 'COMMITTED'
+    except Exception as e:
+        error_response = dict()
+        if hasattr(e, 'response') is True:
+            error_response = e.response
+        if 'Error' in error_response:
+            if error_response['Error']['Code'] == 'TransactionCanceledException' and 'CancellationReasons' in error_response:
+                for reason in error_response['CancellationReasons']:
+                    if reason['Code'] in ('ConditionalCheckFailed', 'TransactionConflict'):
+                        logger.warning('Transaction cancelled: {}'.format(error_response['CancellationReasons']))
+                        return 'CONFLICT'
+        logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+    return 'FAILED'
+
+
+
+###############################################################################
+###                                                                         ###
+###                               L E D G E R                               ###
+###                                                                         ###
+###############################################################################
+
+
+SNAPSHOT_SK_PREFIX = 'SAVINGS#SNAPSHOT#'
+TRANSACTION_SK_PREFIX = 'TRANSACTIONS#'
+COMMIT_TIMESTAMP_INDEX_NAME = 'CommitTimestampIdx'
+BALANCE_TYPES = ('Available', 'Actual',)
+LEDGER_ACTIONS = ('snapshot', 'verify', 'rebuild',)
+RECONCILE_MAX_ATTEMPTS = 3
+
+
+def snapshot_sort_key(snapshot_timestamp: int)->str:
+    # Zero padded, so that the snapshots of an account sort in time order
+    return '{}{:010d}'.format(SNAPSHOT_SK_PREFIX, int(snapshot_timestamp))
+
+
+def transaction_timestamp(record: dict)->int:
+    """
+        The event time of a transaction record in seconds since the epoch (UTC). Records written before the
+        `TransactionTimestamp` attribute was introduced fall back to the `TransactionDate` and `TransactionTime`.
+    """
+    if 'TransactionTimestamp' in record:
+        return int(record['TransactionTimestamp'])
+    date_time = datetime.strptime('{:08d}{:06d}'.format(int(record['TransactionDate']), int(record['TransactionTime'])), '%Y%m%d%H%M%S')
+    return int((date_time - datetime(1970, 1, 1, 0, 0, 0)).total_seconds())
+
+
+def commit_timestamp(record: dict)->int:
+    """
+        The time the transaction processing committed a transaction record. Events can be processed long after their
+        event time, so snapshots are taken as at a commit time. Records written before the `CommitTimestamp`
+        attribute was introduced fall back to their event time.
+    """
+    if 'CommitTimestamp' in record:
+        return int(record['CommitTimestamp'])
+    return transaction_timestamp(record=record)
+
+
+def new_ledger_balances(snapshot: dict=None)->dict:
+    """
+        The ledger balances of an account, starting from `snapshot` or from zero when there is no snapshot:
+
+            Available:              Decimal
+            Actual:                 Decimal
+            SnapshotTimestamp:      Commit time of the snapshot the replay started from (None without a snapshot)
+            TransactionCount:       Number of transactions included since the account was opened
+            ReplayedTransactions:   Number of transactions replayed on top of the snapshot
+    """
+    balances = {
+        'Available': Decimal('0'),
+        'Actual': Decimal('0'),
+        'SnapshotTimestamp': None,
+        'TransactionCount': 0,
+        'ReplayedTransactions': 0,
+    }
+    if snapshot is not None:
+        balances['Available'] = snapshot['BalanceAvailable']
+        balances['Actual'] = snapshot['BalanceActual']
+        balances['SnapshotTimestamp'] = int(snapshot['SnapshotTimestamp'])
+        balances['TransactionCount'] = int(snapshot['TransactionCount'])
+    return balances
+
+
+def apply_transaction(balances: dict, record: dict, original_amount: Decimal=None)->dict:
+    """
+        Apply the balance effects of a `TRANSACTIONS#...` record, the same way the transaction processing did. An
+        `Adjusted` effect (a verified cash deposit with a different amount than the pending deposit) replaces the
+        `original_amount` of the pending transaction with the `Amount` of the record.
+    """
+    amount = Decimal(record['Amount'])
+    for balance_type in BALANCE_TYPES:
+        effect = record.get('EffectOn{}Balance'.format(balance_type), 'None')
+        if effect == 'Increase':
+            balances[balance_type] += amount
+        elif effect == 'Decrease':
+            balances[balance_type] -= amount
+        elif effect == 'Adjusted':
+            balances[balance_type] += amount - original_amount
+    balances['TransactionCount'] += 1
+    balances['ReplayedTransactions'] += 1
+    return balances
+
+
+def _helper_is_adjustment(record: dict)->bool:
+    for balance_type in BALANCE_TYPES:
+        if record.get('EffectOn{}Balance'.format(balance_type), 'None') == 'Adjusted':
+            return True
+    return False
+
+
+def get_transaction_amount_by_request_id(
+    account_ref: str,
+    request_id: str,
+    boto3_clazz=boto3,
+    logger=get_logger()
+)->Decimal:
+    """
+        The `Amount` of the transaction with the `RequestId`, for example the pending transaction of a verification
+    """
+    for record in paginate_dynamodb_query(
+        query_parameters={
+            'TableName': os.getenv('DYNAMODB_ACCOUNTS_TABLE_NAME'),
+            'Select': 'ALL_ATTRIBUTES',
+            'ConsistentRead': True,
+            'KeyConditions': {
+                'PK': {'AttributeValueList': [{'S': account_ref},], 'ComparisonOperator': 'EQ'},
+                'SK': {'AttributeValueList': [{'S': TRANSACTION_SK_PREFIX},], 'ComparisonOperator': 'BEGINS_WITH'},
+            },
+            'QueryFilter': {
+                'RequestId': {'AttributeValueList': [{'S': '{}'.format(request_id)},], 'ComparisonOperator': 'EQ'},
+            },
+            'ReturnConsumedCapacity': 'TOTAL',
+        },
+        max_items=1,
+        boto3_clazz=boto3_clazz,
+        logger=logger
+    ):
+        return Decimal(record['Amount'])
+    raise Exception('[account_reference={}] Transaction with RequestId {} not found'.format(account_ref, request_id))
+
+
+def get_latest_snapshot(
+    account_ref: str,
+    up_to_timestamp: int=None,
+    boto3_clazz=boto3,
+    logger=get_logger()
+)->dict:
+    """
+        The most recent snapshot of the account, or with `up_to_timestamp` the most recent snapshot taken at or
+        before that time. Returns None when there is no such snapshot.
+    """
+    sk_condition = {'AttributeValueList': [{'S': SNAPSHOT_SK_PREFIX},], 'ComparisonOperator': 'BEGINS_WITH'}
+    if up_to_timestamp is not None:
+        sk_condition = {'AttributeValueList': [{'S': SNAPSHOT_SK_PREFIX}, {'S': snapshot_sort_key(snapshot_timestamp=up_to_timestamp)},], 'ComparisonOperator': 'BETWEEN'}
+    for record in paginate_dynamodb_query(
+        query_parameters={
+            'TableName': os.getenv('DYNAMODB_ACCOUNTS_TABLE_NAME'),
+            'Select': 'ALL_ATTRIBUTES',
+            'ConsistentRead': True,
+            'KeyConditions': {
+                'PK': {'AttributeValueList': [{'S': account_ref},], 'ComparisonOperator': 'EQ'},
+                'SK': sk_condition,
+            },
+            'ScanIndexForward': False,
+            'ReturnConsumedCapacity': 'TOTAL',
+        },
+        max_items=1,
+        boto3_clazz=boto3_clazz,
+        logger=logger
+    ):
+        return record
+    return None
+
+
+def get_transactions(
+    account_ref: str,
+    after_timestamp: int=None,
+    up_to_timestamp: int=None,
+    boto3_clazz=boto3,
+    logger=get_logger()
+):
+    """
+        Generator that yields the transaction records of an account committed after `after_timestamp` and up to and
+        including `up_to_timestamp` (see `commit_timestamp()`).
+
+        With an `after_timestamp` only that range of the sparse `CommitTimestampIdx` index is read, so the cost
+        depends on the number of transactions since the snapshot and not on the age of the account. Without it, the
+        full history is read from the table, which also includes records written before the index existed.
+    """
+    if after_timestamp is None:
+        query_parameters = {
+            'TableName': os.getenv('DYNAMODB_ACCOUNTS_TABLE_NAME'),
+            'Select': 'ALL_ATTRIBUTES',
+            'ConsistentRead': True,
+            'KeyConditions': {
+                'PK': {'AttributeValueList': [{'S': account_ref},], 'ComparisonOperator': 'EQ'},
+                'SK': {'AttributeValueList': [{'S': TRANSACTION_SK_PREFIX},], 'ComparisonOperator': 'BEGINS_WITH'},
+            },
+            'ReturnConsumedCapacity': 'TOTAL',
+        }
+    else:
+        timestamp_condition = {'AttributeValueList': [{'N': '{}'.format(after_timestamp)},], 'ComparisonOperator': 'GT'}
+        if up_to_timestamp is not None:
+            if up_to_timestamp <= after_timestamp:
+                return
+            timestamp_condition = {'AttributeValueList': [{'N': '{}'.format(after_timestamp + 1)}, {'N': '{}'.format(up_to_timestamp)},], 'ComparisonOperator': 'BETWEEN'}
+        query_parameters = {
+            'TableName': os.getenv('DYNAMODB_ACCOUNTS_TABLE_NAME'),
+            'IndexName': COMMIT_TIMESTAMP_INDEX_NAME,
+            'Select': 'ALL_PROJECTED_ATTRIBUTES',
+            'KeyConditions': {
+                'PK': {'AttributeValueList': [{'S': account_ref},], 'ComparisonOperator': 'EQ'},
+                'CommitTimestamp': timestamp_condition,
+            },
+            'ReturnConsumedCapacity': 'TOTAL',
+        }
+    for record in paginate_dynamodb_query(query_parameters=query_parameters, boto3_clazz=boto3_clazz, logger=logger):
+        if up_to_timestamp is not None:
+            if commit_timestamp(record=record) > up_to_timestamp:
+                continue
+        yield record
+
+
+@METRICS.timer(step='ReplayAccount')
+def replay_account(
+    account_ref: str,
+    up_to_timestamp: int=None,
+    boto3_clazz=boto3,
+    logger=get_logger()
+)->dict:
+    """
+        Reconstruct the balances of an account from the latest snapshot (at or before `up_to_timestamp`) plus the
+        transactions committed since that snapshot. Without `up_to_timestamp` all transactions up to now are included.
+    """
+    balances = new_ledger_balances(snapshot=get_latest_snapshot(account_ref=account_ref, up_to_timestamp=up_to_timestamp, boto3_clazz=boto3_clazz, logger=logger))
+    records = list(
+        get_transactions(
+            account_ref=account_ref,
+            after_timestamp=balances['SnapshotTimestamp'],
+            up_to_timestamp=up_to_timestamp,
+            boto3_clazz=boto3_clazz,
+            logger=logger
+        )
+    )
+    amounts_by_request_id = dict()
+    for record in records:
+        if 'RequestId' in record:
+            amounts_by_request_id.setdefault(record['RequestId'], Decimal(record['Amount']))
+    for record in records:
+        original_amount = None
+        if _helper_is_adjustment(record=record) is True:
+            original_amount = amounts_by_request_id.get(record['PreviousRequestIdReference'], None)
+            if original_amount is None:
+                # The pending transaction is older than the snapshot
+                original_amount = get_transaction_amount_by_request_id(account_ref=account_ref, request_id=record['PreviousRequestIdReference'], boto3_clazz=boto3_clazz, logger=logger)
+        apply_transaction(balances=balances, record=record, original_amount=original_amount)
+    logger.info('[account_reference={}] Replayed {} transactions on top of snapshot {}: {}'.format(account_ref, balances['ReplayedTransactions'], balances['SnapshotTimestamp'], balances))
+    return balances
+
+
+def build_snapshot_record(account_ref: str, balances: dict, snapshot_timestamp: int)->dict:
+    return {
+        'PK'                        : { 'S': account_ref                                                },
+        'SK'                        : { 'S': snapshot_sort_key(snapshot_timestamp=snapshot_timestamp)   },
+        'SnapshotTimestamp'         : { 'N': '{}'.format(snapshot_timestamp)                            },
+        'CreatedTimestamp'          : { 'N': '{}'.format(get_utc_timestamp(with_decimal=False))         },
+        'BalanceAvailable'          : { 'N': '{}'.format(balances['Available'])                         },
+        'BalanceActual'             : { 'N': '{}'.format(balances['Actual'])                            },
+        'TransactionCount'          : { 'N': '{}'.format(balances['TransactionCount'])                  },
+        'ReplayedTransactions'      : { 'N': '{}'.format(balances['ReplayedTransactions'])              },
+    }
+
+
+def get_obsolete_snapshot_keys(
+    account_ref: str,
+    retention: int,
+    boto3_clazz=boto3,
+    logger=get_logger()
+)->list:
+    """
+        The keys of all the snapshots of the account except the `retention` most recent ones
+    """
+    keys = list()
+    snapshot_qty = 0
+    for record in paginate_dynamodb_query(
+        query_parameters={
+            'TableName': os.getenv('DYNAMODB_ACCOUNTS_TABLE_NAME'),
+            'Select': 'SPECIFIC_ATTRIBUTES',
+            'AttributesToGet': ['PK', 'SK',],
+            'ConsistentRead': True,
+            'KeyConditions': {
+                'PK': {'AttributeValueList': [{'S': account_ref},], 'ComparisonOperator': 'EQ'},
+                'SK': {'AttributeValueList': [{'S': SNAPSHOT_SK_PREFIX},], 'ComparisonOperator': 'BEGINS_WITH'},
+            },
+            'ScanIndexForward': False,
+            'ReturnConsumedCapacity': 'TOTAL',
+        },
+        boto3_clazz=boto3_clazz,
+        logger=logger
+    ):
+        snapshot_qty += 1
+        if snapshot_qty > retention:
+            keys.append({'PK': {'S': record['PK']}, 'SK': {'S': record['SK']}})
+    return keys
+
+
+def snapshot_account(
+    account_ref: str,
+    snapshot_timestamp: int,
+    retention: int=LEDGER_SNAPSHOT_RETENTION_DEFAULT,
+    boto3_clazz=boto3,
+    logger=get_logger()
+)->dict:
+    """
+        Write a snapshot of the account balances as at the commit time `snapshot_timestamp`, built from the previous
+        snapshot and the transactions committed since then. No snapshot is written when there were no transactions
+        since the previous snapshot.
+
+        The keys of snapshots beyond the `retention` most recent ones are returned in `ObsoleteSnapshots`, to be
+        deleted by the caller.
+    """
+    result = {
+        'Account': account_ref,
+        'Action': 'snapshot',
+        'Result': 'UNCHANGED',
+        'ObsoleteSnapshots': list(),
+    }
+    balances = replay_account(account_ref=account_ref, up_to_timestamp=snapshot_timestamp, boto3_clazz=boto3_clazz, logger=logger)
+    result['ReplayedTransactions'] = balances['ReplayedTransactions']
+    if balances['ReplayedTransactions'] == 0:
+        return result
+    with METRICS.timer(step='WriteSnapshot'):
+        if create_dynamodb_record(
+            table_name=os.getenv('DYNAMODB_ACCOUNTS_TABLE_NAME'),
+            record_data=build_snapshot_record(account_ref=account_ref, balances=balances, snapshot_timestamp=snapshot_timestamp),
+            boto3_clazz=boto3_clazz,
+            logger=logger
+        ) is False:
+            result['Result'] = 'ERROR'
+            return result
+    result['Result'] = 'CREATED'
+    result['ObsoleteSnapshots'] = get_obsolete_snapshot_keys(account_ref=account_ref, retention=retention, boto3_clazz=boto3_clazz, logger=logger)
+    return result
+
+
+def get_balance_records(
+    account_ref: str,
+    boto3_clazz=boto3,
+    logger=get_logger()
+)->dict:
+    balance_records = dict()
+    for balance_type in BALANCE_TYPES:
+        key = {
+            'PK'        : { 'S': '{}'.format(account_ref)                           },
+            'SK'        : { 'S': 'SAVINGS#BALANCE#{}'.format(balance_type.upper())  },
+        }
+        balance_records[balance_type] = get_dynamodb_record_by_key(key=key, boto3_clazz=boto3_clazz, logger=logger)
+    return balance_records
+
+
+def _helper_balance_versions(balance_records: dict)->tuple:
+    return tuple(balance_records[balance_type].get('Version', Decimal('0')) for balance_type in BALANCE_TYPES)
+
+
+def reconcile_account(
+    account_ref: str,
+    boto3_clazz=boto3,
+    logger=get_logger()
+)->tuple:
+    """
+        Replay the ledger of the account and read the balance records. The balance records are read before and after
+        the replay and the replay is repeated when a transaction was processed in between, so that the two are
+        compared at the same point in time.
+
+        Returns `(ledger_balances, balance_records)`, or `(None, None)` when the account kept changing.
+    """
+    for attempt in range(0, RECONCILE_MAX_ATTEMPTS):
+        balance_records = get_balance_records(account_ref=account_ref, boto3_clazz=boto3_clazz, logger=logger)
+        ledger_balances = replay_account(account_ref=account_ref, boto3_clazz=boto3_clazz, logger=logger)
+        if _helper_balance_versions(balance_records=get_balance_records(account_ref=account_ref, boto3_clazz=boto3_clazz, logger=logger)) == _helper_balance_versions(balance_records=balance_records):
+            return (ledger_balances, balance_records,)
+        logger.warning('[account_reference={}] Balances changed during the replay (attempt {} of {})'.format(account_ref, attempt + 1, RECONCILE_MAX_ATTEMPTS))
+    return (None, None,)
+
+
+def _helper_reconcile_result(account_ref: str, action: str, ledger_balances: dict, balance_records: dict)->dict:
+    result = {
+        'Account': account_ref,
+        'Action': action,
+        'Result': 'CHANGED',
+    }
+    if ledger_balances is None:
+        return result
+    result['Result'] = 'OK'
+    result['SnapshotTimestamp'] = ledger_balances['SnapshotTimestamp']
+    result['ReplayedTransactions'] = ledger_balances['ReplayedTransactions']
+    result['Ledger'] = dict()
+    result['Balances'] = dict()
+    for balance_type in BALANCE_TYPES:
+        result['Ledger'][balance_type] = '{}'.format(ledger_balances[balance_type])
+        result['Balances'][balance_type] = '{}'.format(balance_records[balance_type]['Balance'])
+        if ledger_balances[balance_type].compare(balance_records[balance_type]['Balance']) != Decimal('0'):
+            result['Result'] = 'MISMATCH'
+    return result
+
+
+def verify_account(
+    account_ref: str,
+    boto3_clazz=boto3,
+    logger=get_logger()
+)->dict:
+    """
+        Compare the balances reconstructed from the ledger with the `SAVINGS#BALANCE#...` records:
+
+            OK:         The balances match
+            MISMATCH:   At least one balance differs from the ledger
+            CHANGED:    Transactions kept being processed for the account while it was verified - try again later
+    """
+    ledger_balances, balance_records = reconcile_account(account_ref=account_ref, boto3_clazz=boto3_clazz, logger=logger)
+    result = _helper_reconcile_result(account_ref=account_ref, action='verify', ledger_balances=ledger_balances, balance_records=balance_records)
+    if result['Result'] == 'MISMATCH':
+        logger.warning('[account_reference={}] Balances do not match the ledger: {}'.format(account_ref, result))
+    return result
+
+
+def build_rebuilt_balance_put_items(account_ref: str, ledger_balances: dict, balance_records: dict)->list:
+    """
+        Balance puts with the ledger balances that only succeed if the balance record still has the version that was
+        read, so that a transaction processed in the mean time is never overwritten. The version is incremented, which
+        also makes the transaction processing discard any balance it cached for the account.
+    """
+    put_items = list()
+    for balance_type in BALANCE_TYPES:
+        balance_record = balance_records[balance_type]
+        version = balance_record.get('Version', Decimal('0'))
+        item = {
+            'PK'                        : { 'S': account_ref                                                },
+            'SK'                        : { 'S': 'SAVINGS#BALANCE#{}'.format(balance_type.upper())          },
+            'Balance'                   : { 'N': '{}'.format(ledger_balances[balance_type])                 },
+            'Version'                   : { 'N': '{}'.format(version + 1)                                   },
+        }
+        for field_name in ('LastTransactionDate', 'LastTransactionTime',):
+            if field_name in balance_record:
+                item[field_name] = { 'N': '{}'.format(balance_record[field_name]) }
+        if 'EventKey' in balance_record:
+            item['EventKey'] = { 'S': '{}'.format(balance_record['EventKey']) }
+        put = {
+            'TableName': os.getenv('DYNAMODB_ACCOUNTS_TABLE_NAME'),
+            'Item': item,
+            'ConditionExpression': 'attribute_not_exists(Version)',
+        }
+        if version.compare(Decimal('0')) != Decimal('0'):
+            put['ConditionExpression'] = 'Version = :version'
+            put['ExpressionAttributeValues'] = { ':version': { 'N': '{}'.format(version) } }
+        put_items.append({'Put': put})
+    return put_items
+
+
+def rebuild_account(
+    account_ref: str,
+    boto3_clazz=boto3,
+    logger=get_logger()
+)->dict:
+    """
+        Verify the account and, when the balances do not match the ledger, replace both balances with the ledger
+        balances. Results are the same as for `verify_account()`, except that a repaired account has the result
+        REBUILT (or CHANGED when a transaction was processed before the repair could be committed).
+
+        Only rebuild accounts while their transactions are not being processed, for example during a restore.
+    """
+    ledger_balances, balance_records = reconcile_account(account_ref=account_ref, boto3_clazz=boto3_clazz, logger=logger)
+    result = _helper_reconcile_result(account_ref=account_ref, action='rebuild', ledger_balances=ledger_balances, balance_records=balance_records)
+    if result['Result'] != 'MISMATCH':
+        return result
+    logger.warning('[account_reference={}] Rebuilding balances from the ledger: {}'.format(account_ref, result))
+    commit_status = transact_write_dynamodb_records(
+        transact_items=build_rebuilt_balance_put_items(account_ref=account_ref, ledger_balances=ledger_balances, balance_records=balance_records),
+        boto3_clazz=boto3_clazz,
+        logger=logger
+    )
+    if commit_status == 'COMMITTED':
+        result['Result'] = 'REBUILT'
+    elif commit_status == 'CONFLICT':
+        result['Result'] = 'CHANGED'
+    else:
+        result['Result'] = 'ERROR'
+    return result
+
+
+def list_accounts(boto3_clazz=boto3, logger=get_logger())->list:
+    """
+        All accounts with a balance, found with a Scan of the accounts table - only used when the event does not list
+        the accounts
+    """
+    accounts = set()
+    for record in paginate_dynamodb_scan(
+        scan_parameters={
+            'TableName': os.getenv('DYNAMODB_ACCOUNTS_TABLE_NAME'),
+            'Select': 'SPECIFIC_ATTRIBUTES',
+            'AttributesToGet': ['PK',],
+            'ScanFilter': {
+                'SK': {'AttributeValueList': [{'S': 'SAVINGS#BALANCE#ACTUAL'},], 'ComparisonOperator': 'EQ'},
+            },
+            'ReturnConsumedCapacity': 'TOTAL',
+        },
+        boto3_clazz=boto3_clazz,
+        logger=logger
+    ):
+        accounts.add(record['PK'])
+    logger.info('Found {} accounts'.format(len(accounts)))
+    return sorted(accounts)
+
+
+def process_account(
+    account_ref: str,
+    action: str,
+    snapshot_timestamp: int=None,
+    retention: int=LEDGER_SNAPSHOT_RETENTION_DEFAULT,
+    boto3_clazz=boto3,
+    logger=get_logger()
+)->dict:
+    result = {
+        'Account': account_ref,
+        'Action': action,
+        'Result': 'ERROR',
+    }
+    try:
+        if action == 'snapshot':
+            result = snapshot_account(account_ref=account_ref, snapshot_timestamp=snapshot_timestamp, retention=retention, boto3_clazz=boto3_clazz, logger=logger)
+        elif action == 'verify':
+            result = verify_account(account_ref=account_ref, boto3_clazz=boto3_clazz, logger=logger)
+        elif action == 'rebuild':
+            result = rebuild_account(account_ref=account_ref, boto3_clazz=boto3_clazz, logger=logger)
+    except:
+        logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+    METRICS.increment(name='Accounts', dimensions={'Action': action, 'Result': result['Result']})
+    return result
+
+
+def process_accounts(
+    accounts: list,
+    action: str,
+    snapshot_timestamp: int=None,
+    retention: int=LEDGER_SNAPSHOT_RETENTION_DEFAULT,
+    max_workers: int=1,
+    boto3_clazz=boto3,
+    logger=get_logger()
+)->list:
+    """
+        Process every account on its own. Accounts are independent, so with `max_workers` greater than 1 they are
+        processed concurrently on a bounded thread pool.
+    """
+    parameters = {
+        'action': action,
+        'snapshot_timestamp': snapshot_timestamp,
+        'retention': retention,
+        'boto3_clazz': boto3_clazz,
+        'logger': logger,
+    }
+    if max_workers > 1 and len(accounts) > 1:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(accounts))) as executor:
+            return list(executor.map(lambda account_ref: process_account(account_ref=account_ref, **parameters), accounts))
+    return [process_account(account_ref=account_ref, **parameters) for account_ref in accounts]
+
+
+def delete_obsolete_snapshots(
+    results: list,
+    boto3_clazz=boto3,
+    logger=get_logger()
+)->bool:
+    """
+        Compaction: delete the snapshots beyond the retention that were found while taking the new snapshots
+    """
+    writer = BatchWriter(boto3_clazz=boto3_clazz, logger=logger)
+    try:
+        for result in results:
+            for key in result.pop('ObsoleteSnapshots', list()):
+                writer.delete(table_name=os.getenv('DYNAMODB_ACCOUNTS_TABLE_NAME'), key=key)
+    except:
+        logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+    result = writer.close()
+    logger.info('Deleted {} obsolete snapshots'.format(writer.stats['Writes']))
+    METRICS.increment(name='SnapshotsDeleted', value=writer.stats['Writes'])
+    return result
+
+
+###############################################################################
+###                                                                         ###
+###                         M A I N    H A N D L E R                        ###
+###                                                                         ###
+###############################################################################
+
+
+def handler(
+    event,
+    context,
+    logger=get_logger(level=logging.INFO),
+    boto3_clazz=boto3,
+    run_from_main: bool=False
+):
+    refresh_environment_cache(logger=logger)
+    if cache['Environment']['Data']['DEBUG'] is True and run_from_main is False:
+        logger  = get_logger(level=logging.DEBUG)
+    METRICS.enabled = cache['Environment']['Data']['METRICS_ENABLED']
+    METRICS.namespace = cache['Environment']['Data']['METRICS_NAMESPACE']
+    handler_start = time.perf_counter()
+
+    debug_log('event={}', variable_as_list=[event], logger=logger)
+    """
+        Scheduled (EventBridge) events have no "Action" and take a snapshot of all accounts. To verify or rebuild
+        balances, or to snapshot only some accounts, invoke the function with:
+
+            {
+                "Action": "verify",                     <==> One of "snapshot" (default), "verify" or "rebuild"
+                "Accounts": ["1234567890"]              <==> Optional - all accounts with a balance when omitted
+            }
+    """
+    action = 'snapshot'
+    accounts = None
+    if isinstance(event, dict) is True:
+        action = '{}'.format(event.get('Action', action)).lower()
+        if 'Accounts' in event:
+            accounts = ['{}'.format(account_ref) for account_ref in event['Accounts']]
+    if action not in LEDGER_ACTIONS:
+        logger.error('Unsupported action "{}". Expected one of {}'.format(action, LEDGER_ACTIONS))
+        return {'Result': 'Error', 'Message': 'Unsupported action "{}"'.format(action)}
+    if action == 'snapshot' and os.getenv('DYNAMODB_RESTORE_IN_PROGRESS', '0') != '0':
+        logger.error('ABANDON PROCESSING - DynamoDB Restore in Progress')
+        raise Exception('Processing Abandoned due to DB Restore in progress.')
+
+    response = {
+        'Result': 'Ok',
+        'Message': None,
+        'Action': action,
+    }
+    snapshot_timestamp = None
+    if action == 'snapshot':
+        # Only transactions committed before the settlement period are included, allowing for commits in progress
+        snapshot_timestamp = get_utc_timestamp(with_decimal=False) - cache['Environment']['Data']['LEDGER_SETTLEMENT_SECONDS']
+        response['SnapshotTimestamp'] = snapshot_timestamp
+    try:
+        if accounts is None:
+            accounts = list_accounts(boto3_clazz=boto3_clazz, logger=logger)
+        results = process_accounts(
+            accounts=accounts,
+            action=action,
+            snapshot_timestamp=snapshot_timestamp,
+            retention=cache['Environment']['Data']['LEDGER_SNAPSHOT_RETENTION'],
+            max_workers=cache['Environment']['Data']['MAX_WORKERS'],
+            boto3_clazz=boto3_clazz,
+            logger=logger
+        )
+        if action == 'snapshot':
+            if delete_obsolete_snapshots(results=results, boto3_clazz=boto3_clazz, logger=logger) is False:
+                response['Result'] = 'PartialFailure'
+        summary = dict()
+        for result in results:
+            summary[result['Result']] = summary.get(result['Result'], 0) + 1
+            if result['Result'] in ('ERROR', 'MISMATCH', 'CHANGED',):
+                response['Result'] = 'PartialFailure'
+        logger.info('Processed {} accounts: {}'.format(len(results), summary))
+        response['Summary'] = summary
+        response['Accounts'] = results
+    except:
+        logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+        response['Result'] = 'Error'
+        response['Message'] = 'Ledger processing failed'
+
+    METRICS.put_metric(name='StepDuration', value=round((time.perf_counter() - handler_start) * 1000, 3), unit='Milliseconds', dimensions={'Step': 'Handler'})
+    METRICS.flush()
+    return response
+
+
+###############################################################################
+###                                                                         ###
+###                        M A I N    F U N C T I O N                       ###
+###                                                                         ###
+###############################################################################
+
+
+if __name__ == '__main__':
+    logger = logging.getLogger("my_lambda")
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(funcName)s:%(lineno)d -  %(levelname)s - %(message)s')
+
+    ch = logging.StreamHandler()
+    if get_debug() is True:
+        ch.setLevel(logging.DEBUG)    
+    else:
+        ch.setLevel(logging.INFO)
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+    
+    if get_debug() is True:
+        logger.setLevel(logging.DEBUG)
+    else:    
+        logger.setLevel(logging.INFO)
+    handler(event={'Action': 'verify'}, context=None, logger=logger, run_from_main=True)
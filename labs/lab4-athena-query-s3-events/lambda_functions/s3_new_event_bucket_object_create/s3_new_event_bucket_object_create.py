@@ -1,15 +1,20 @@
 import boto3
+from botocore.config import Config
+import threading
 import traceback
 import os
 import json
 import logging
 from datetime import datetime
 import sys
-from inspect import getframeinfo, stack
 from decimal import Decimal
-import copy
+import time
+import random
 # Other imports here...
 import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from contextlib import contextmanager
 
 
 def get_logger(level=logging.INFO):
@@ -32,12 +37,40 @@ def get_logger(level=logging.INFO):
     return logger
 
 
-def get_client(client_name: str, region: str='eu-central-1', boto3_clazz=boto3):
-    return boto3_clazz.client(client_name, region_name=region)
+CLIENT_REGISTRY = dict()
+CLIENT_REGISTRY_LOCK = threading.Lock()
+try:
+    CLIENT_CONFIG = Config(max_pool_connections=25, connect_timeout=5, read_timeout=30, retries={'max_attempts': 5, 'mode': 'standard'}, tcp_keepalive=True)
+except TypeError:   # tcp_keepalive requires botocore 1.27.84 or later
+    CLIENT_CONFIG = Config(max_pool_connections=25, connect_timeout=5, read_timeout=30, retries={'max_attempts': 5, 'mode': 'standard'})
 
 
-def get_session(region: str='eu-central-1', boto3_clazz=boto3):
-    return boto3_clazz.Session(region_name=region)
+def get_client(client_name: str, region: str='eu-central-1', boto3_clazz=boto3, endpoint_url: str=None):
+    """
+        Clients are created on first use and kept in CLIENT_REGISTRY for the lifetime of the execution environment, so
+        warm invocations re-use the client and its pool of keep-alive connections. Only the services actually used by
+        the function are ever created.
+    """
+    registry_key = (client_name, region, endpoint_url, id(boto3_clazz))
+    if registry_key not in CLIENT_REGISTRY:
+        with CLIENT_REGISTRY_LOCK:
+            if registry_key not in CLIENT_REGISTRY:
+                CLIENT_REGISTRY[registry_key] = boto3_clazz.client(client_name, region_name=region, endpoint_url=endpoint_url, config=CLIENT_CONFIG)
+    return CLIENT_REGISTRY[registry_key]
+
+
+QUEUE_URL_CACHE = dict()
+
+
+def get_queue_url(queue_name: str, boto3_clazz=boto3)->str:
+    """
+        Queue URL's never change for the lifetime of a queue, so the GetQueueUrl round trip is only done once
+    """
+    if queue_name not in QUEUE_URL_CACHE:
+        client = get_client(client_name='sqs', boto3_clazz=boto3_clazz)
+        with METRICS.aws_call(service='SQS', operation='GetQueueUrl'):
+            QUEUE_URL_CACHE[queue_name] = client.get_queue_url(QueueName=queue_name)['QueueUrl']
+    return QUEUE_URL_CACHE[queue_name]
 
 
 CACHE_TTL_DEFAULT = 600
@@ -60,6 +93,14 @@ def get_debug()->bool:
     return False
     
 
+def get_prefetch_workers()->int:
+    try:
+        return max(1, int(os.getenv('PREFETCH_WORKERS', '10')))
+    except:
+        pass
+    return 10
+
+
 def get_cache_ttl(logger=get_logger())->int:
     try:
         return int(os.getenv('CACHE_TTL', '{}'.format(CACHE_TTL_DEFAULT)))
@@ -79,12 +120,35 @@ def refresh_environment_cache(logger=get_logger()):
         'Data': {
             'CACHE_TTL': get_cache_ttl(logger=logger),
             'DEBUG': get_debug(),
+            'METRICS_ENABLED': get_metrics_enabled(),
+            'METRICS_NAMESPACE': get_metrics_namespace(),
+            'PREFETCH_WORKERS': get_prefetch_workers(),
             # Other ENVIRONMENT variables can be added here... The environment will be re-read after the CACHE_TTL 
         }
     }
     logger.debug('cache: {}'.format((json.dumps(cache))))
 
 
+class DebugMessage:
+    """
+        Defers the `str.format()` of a debug message until a handler actually emits the log record
+    """
+    __slots__ = ('message', 'variables_as_dict', 'variable_as_list')
+
+    def __init__(self, message: str, variables_as_dict: dict, variable_as_list: list):
+        self.message = message
+        self.variables_as_dict = variables_as_dict
+        self.variable_as_list = variable_as_list
+
+    def __str__(self):
+        try:
+            if len(self.variables_as_dict) > 0:
+                return self.message.format(**self.variables_as_dict)
+            return self.message.format(*self.variable_as_list)
+        except:
+            return self.message
+
+
 def debug_log(message: str, variables_as_dict: dict=dict(), variable_as_list: list=list(), logger=get_logger(level=logging.INFO)):
     """
         See:
@@ -107,16 +171,192 @@ def debug_log(message: str, variables_as_dict: dict=dict(), variable_as_list: li
 
     """
     if cache['Environment']['Data']['DEBUG'] is True:
-        try:
-            caller = getframeinfo(stack()[1][0])
-            caller_str = '{}():{}'.format(caller.function, caller.lineno)
-            message = '[{}]  {}'.format(caller_str, message)
-            if len(variables_as_dict) > 0:
-                logger.debug(message.format(**variables_as_dict))
+        if logger.isEnabledFor(logging.DEBUG) is True:
+            # stacklevel=2 attributes the record (funcName/lineno) to the caller without inspecting the stack
+            logger.debug(DebugMessage(message=message, variables_as_dict=variables_as_dict, variable_as_list=variable_as_list), stacklevel=2)
+
+
+###############################################################################
+###                                                                         ###
+###                               M E T R I C S                             ###
+###                                                                         ###
+###############################################################################
+
+
+METRICS_NAMESPACE_DEFAULT = 'Lab4/EventPipeline'
+EMF_MAX_METRICS_PER_DOCUMENT = 100
+EMF_MAX_VALUES_PER_METRIC = 100
+
+
+def get_metrics_enabled()->bool:
+    try:
+        return bool(int(os.getenv('METRICS_ENABLED', '1')))
+    except:
+        pass
+    return True
+
+
+def get_metrics_namespace()->str:
+    return os.getenv('METRICS_NAMESPACE', METRICS_NAMESPACE_DEFAULT)
+
+
+def consumed_capacity_units(response: dict)->float:
+    """
+        Total capacity units in a DynamoDB response requested with `ReturnConsumedCapacity='TOTAL'`. BatchWriteItem
+        and TransactWriteItems return a list (one entry per table), the other operations a single dict.
+    """
+    if isinstance(response, dict) is False:
+        return 0.0
+    consumed_capacity = response.get('ConsumedCapacity', list())
+    if isinstance(consumed_capacity, dict) is True:
+        consumed_capacity = [consumed_capacity,]
+    return sum([float(table_capacity.get('CapacityUnits', 0)) for table_capacity in consumed_capacity])
+
+
+class MetricsCollector:
+    """
+        Collects step durations and AWS API call counters during an invocation and writes them as CloudWatch Embedded
+        Metric Format (EMF) log lines when `flush()` is called at the end of the invocation. Recording a value is only
+        a list append under a lock - the JSON documents are built in `flush()`, one per set of dimension values (split
+        when the EMF limits of 100 metrics per document or 100 values per metric are reached).
+
+            StepDuration        Milliseconds    Step
+            AwsCallDuration     Milliseconds    Service, Operation
+            AwsCalls            Count           Service, Operation
+            AwsCallErrors       Count           Service, Operation
+            ConsumedCapacity    Count           Service, Operation (DynamoDB capacity units)
+
+        All metrics also have the `FunctionName` dimension, plus the dimensions set with `set_dimensions()` by the
+        thread that recorded the value (for example the `TransactionType`).
+
+        See https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+    """
+
+    def __init__(self, function_name: str, namespace: str=METRICS_NAMESPACE_DEFAULT, writer=None):
+        self.function_name = function_name
+        self.namespace = namespace
+        self.writer = writer
+        self.enabled = True
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.metrics = dict()
+
+    def set_dimensions(self, **dimensions):
+        self.local.dimensions = dimensions
+
+    def clear_dimensions(self):
+        self.local.dimensions = dict()
+
+    def put_metric(self, name: str, value: float, unit: str='Count', dimensions: dict=None, aggregate: bool=False):
+        """
+            With `aggregate` the value is added to the current value instead of being recorded as another sample
+        """
+        if self.enabled is False:
+            return
+        metric_dimensions = dict(getattr(self.local, 'dimensions', dict()))
+        if dimensions is not None:
+            metric_dimensions.update(dimensions)
+        dimensions_key = tuple(sorted(metric_dimensions.items()))
+        with self.lock:
+            if dimensions_key not in self.metrics:
+                self.metrics[dimensions_key] = dict()
+            if name not in self.metrics[dimensions_key]:
+                self.metrics[dimensions_key][name] = {'Unit': unit, 'Values': list()}
+            values = self.metrics[dimensions_key][name]['Values']
+            if aggregate is True and len(values) > 0:
+                values[0] += value
             else:
-                logger.debug(message.format(*variable_as_list))
+                values.append(value)
+
+    def increment(self, name: str, value: float=1, dimensions: dict=None):
+        self.put_metric(name=name, value=value, unit='Count', dimensions=dimensions, aggregate=True)
+
+    @contextmanager
+    def timer(self, step: str):
+        """
+            Record the duration of a named step. Can also be used as a function decorator.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.put_metric(name='StepDuration', value=round((time.perf_counter() - start) * 1000, 3), unit='Milliseconds', dimensions={'Step': step})
+
+    @contextmanager
+    def aws_call(self, service: str, operation: str):
+        """
+            Time and count an AWS API call. Store the response in the yielded dict under `Response` to also record
+            the DynamoDB consumed capacity:
+
+                with METRICS.aws_call(service='DynamoDB', operation='PutItem') as call:
+                    call['Response'] = client.put_item(...)
+        """
+        call = dict()
+        dimensions = {'Service': service, 'Operation': operation}
+        start = time.perf_counter()
+        try:
+            yield call
         except:
-            pass
+            self.increment(name='AwsCallErrors', dimensions=dimensions)
+            raise
+        finally:
+            self.put_metric(name='AwsCallDuration', value=round((time.perf_counter() - start) * 1000, 3), unit='Milliseconds', dimensions=dimensions)
+            self.increment(name='AwsCalls', dimensions=dimensions)
+            capacity_units = consumed_capacity_units(response=call.get('Response'))
+            if capacity_units > 0:
+                self.increment(name='ConsumedCapacity', value=capacity_units, dimensions=dimensions)
+
+    def _write(self, document: dict):
+        # EMF documents must be written as is - the log formatter prefix would stop CloudWatch from extracting them
+        if self.writer is not None:
+            self.writer(document)
+            return
+        sys.stdout.write('{}\n'.format(json.dumps(document)))
+
+    def flush(self)->int:
+        """
+            Write all recorded metrics as EMF documents and return the number of documents written
+        """
+        with self.lock:
+            metrics = self.metrics
+            self.metrics = dict()
+        documents_qty = 0
+        timestamp = int(time.time() * 1000)
+        for dimensions_key, dimension_metrics in metrics.items():
+            dimension_values = {'FunctionName': self.function_name}
+            dimension_values.update(dict(dimensions_key))
+            metric_names = list(dimension_metrics.keys())
+            for name_offset in range(0, len(metric_names), EMF_MAX_METRICS_PER_DOCUMENT):
+                document_metric_names = metric_names[name_offset:name_offset+EMF_MAX_METRICS_PER_DOCUMENT]
+                value_offset = 0
+                while True:
+                    metric_definitions = list()
+                    document = dict(dimension_values)
+                    for metric_name in document_metric_names:
+                        values = dimension_metrics[metric_name]['Values'][value_offset:value_offset+EMF_MAX_VALUES_PER_METRIC]
+                        if len(values) == 0:
+                            continue
+                        metric_definitions.append({'Name': metric_name, 'Unit': dimension_metrics[metric_name]['Unit']})
+                        document[metric_name] = values if len(values) > 1 else values[0]
+                    if len(metric_definitions) == 0:
+                        break
+                    document['_aws'] = {
+                        'Timestamp': timestamp,
+                        'CloudWatchMetrics': [
+                            {
+                                'Namespace': self.namespace,
+                                'Dimensions': [sorted(dimension_values.keys()),],
+                                'Metrics': metric_definitions,
+                            }
+                        ],
+                    }
+                    self._write(document=document)
+                    documents_qty += 1
+                    value_offset += EMF_MAX_VALUES_PER_METRIC
+        return documents_qty
+
+
+METRICS = MetricsCollector(function_name=os.getenv('AWS_LAMBDA_FUNCTION_NAME', 's3_new_event_bucket_object_create'))
 
 
 ###############################################################################
@@ -135,33 +375,230 @@ def get_s3_object_payload(
     key_json_data = ''
     try:
         client=get_client(client_name="s3", boto3_clazz=boto3_clazz)
-        response = client.get_object(
-            Bucket=s3_bucket,
-            Key=s3_key
-        )
-        debug_log('response={}', variable_as_list=[response,], logger=logger)
-        if 'Body' in response:
-            key_json_data = response['Body'].read().decode('utf-8')
+        with METRICS.aws_call(service='S3', operation='GetObject'):
+            response = client.get_object(
+                Bucket=s3_bucket,
+                Key=s3_key
+            )
+            debug_log('response={}', variable_as_list=[response,], logger=logger)
+            if 'Body' in response:
+                key_json_data = response['Body'].read().decode('utf-8')
     except:
         logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
     debug_log('key_json_data={}', variable_as_list=[key_json_data,], logger=logger)
     return key_json_data
 
 
+def prefetch_s3_object_payloads(
+    s3_records: list,
+    executor: ThreadPoolExecutor,
+    boto3_clazz=boto3,
+    logger=get_logger()
+)->dict:
+    """
+        Start the GetObject calls for all S3 records of the batch on the `executor` and return a dict with the
+        `(bucket, key)` as key and the `Future` of the payload as value.
+
+        Records are still processed one by one and in order, each one waiting only for its own payload, while the
+        remaining payloads are downloaded in the background. Objects larger than the accepted maximum are not fetched.
+    """
+    futures = dict()
+    for record in s3_records:
+        try:
+            if int(record['object']['size']) > 1024:
+                continue
+            fetch_key = (record['bucket']['name'], record['object']['key'])
+            if fetch_key not in futures:
+                futures[fetch_key] = executor.submit(
+                    get_s3_object_payload,
+                    s3_bucket=record['bucket']['name'],
+                    s3_key=record['object']['key'],
+                    boto3_clazz=boto3_clazz,
+                    logger=logger
+                )
+        except:
+            logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+    logger.info('PREFETCHING S3 OBJECTS QTY: {}'.format(len(futures)))
+    return futures
+
+
+BATCH_WRITE_MAX_ITEMS = 25
+BATCH_WRITE_THROTTLING_ERROR_CODES = (
+    'ProvisionedThroughputExceededException',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'InternalServerError',
+)
+
+
+class BatchWriter:
+    """
+        Buffered DynamoDB writer. Puts and deletes are accumulated and written with BatchWriteItem, at most 25 write
+        requests per call (the DynamoDB maximum).
+
+        * A write to a key that is already buffered replaces the buffered write, so the last write wins exactly like
+          a sequence of put_item/delete_item calls would. This also keeps duplicate keys out of a single request,
+          which DynamoDB rejects.
+        * UnprocessedItems are retried with full jitter exponential back-off (a random delay between 0 and
+          `base_delay * 2^attempt` seconds, capped at `max_delay`) up to `max_retries` times.
+        * Back-pressure: every call that returns UnprocessedItems halves the number of writes sent per call (down to
+          1) and every fully processed call grows it again by one. When `capacity_units_per_second` is set, calls are
+          also paced so that the consumed write capacity stays at or below that rate.
+        * The buffer is flushed automatically once it holds `flush_size` writes. Call `flush()` or `close()` (or use
+          the writer as a context manager) to write the remainder, for example at the end of an SQS batch.
+
+        A writer is not thread safe - use one writer per thread. Writes that could not be completed are kept in
+        `failed` as `(table_name, write_request)` tuples and make `flush()` and `close()` return False.
+    """
+
+    def __init__(
+        self,
+        boto3_clazz=boto3,
+        logger=get_logger(),
+        key_attributes: tuple=('PK', 'SK',),
+        flush_size: int=BATCH_WRITE_MAX_ITEMS,
+        max_retries: int=8,
+        base_delay: float=0.05,
+        max_delay: float=5.0,
+        capacity_units_per_second: float=None
+    ):
+        self.boto3_clazz = boto3_clazz
+        self.logger = logger
+        self.key_attributes = key_attributes
+        self.flush_size = max(1, flush_size)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.capacity_units_per_second = capacity_units_per_second
+        self.request_size = BATCH_WRITE_MAX_ITEMS
+        self.pending = OrderedDict()
+        self.failed = list()
+        self.closed = False
+        self.stats = {'Calls': 0, 'Writes': 0, 'Retries': 0, 'ConsumedCapacity': 0.0}
+        self._last_call_timestamp = None
+        self._last_call_capacity = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+        return False
+
+    def put(self, table_name: str, record_data: dict)->bool:
+        return self._buffer(table_name=table_name, item=record_data, write_request={'PutRequest': {'Item': record_data}})
+
+    def delete(self, table_name: str, key: dict)->bool:
+        return self._buffer(table_name=table_name, item=key, write_request={'DeleteRequest': {'Key': key}})
+
+    def flush(self)->bool:
+        write_requests = list(self.pending.values())
+        self.pending = OrderedDict()
+        while len(write_requests) > 0:
+            chunk = write_requests[:self.request_size]
+            write_requests = write_requests[self.request_size:]
+            self.failed += self._write(write_requests=chunk)
+        return len(self.failed) == 0
+
+    def close(self)->bool:
+        result = self.flush()
+        self.closed = True
+        self.logger.info('BatchWriter closed. stats={}'.format(self.stats))
+        if result is False:
+            self.logger.error('BatchWriter failed to write {} items'.format(len(self.failed)))
+        return result
+
+    def _buffer(self, table_name: str, item: dict, write_request: dict)->bool:
+        if self.closed is True:
+            raise Exception('BatchWriter is closed')
+        pending_key = (table_name,) + tuple(tuple(item[attribute].items()) for attribute in self.key_attributes if attribute in item)
+        self.pending.pop(pending_key, None)
+        self.pending[pending_key] = (table_name, write_request,)
+        if len(self.pending) >= self.flush_size:
+            return self.flush()
+        return True
+
+    def _pace(self):
+        if self.capacity_units_per_second is None or self._last_call_timestamp is None:
+            return
+        delay = self._last_call_capacity / self.capacity_units_per_second - (time.time() - self._last_call_timestamp)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _write(self, write_requests: list)->list:
+        """
+            Write up to 25 `(table_name, write_request)` tuples and return the tuples that could not be written
+        """
+        request_items = dict()
+        for table_name, write_request in write_requests:
+            if table_name not in request_items:
+                request_items[table_name] = list()
+            request_items[table_name].append(write_request)
+        attempt = 0
+        while len(request_items) > 0:
+            self._pace()
+            unprocessed_items = dict()
+            try:
+                client=get_client(client_name='dynamodb', region='eu-central-1', boto3_clazz=self.boto3_clazz)
+                with METRICS.aws_call(service='DynamoDB', operation='BatchWriteItem') as call:
+                    response = client.batch_write_item(
+                        RequestItems=request_items,
+                        ReturnConsumedCapacity='TOTAL'
+                    )
+                    call['Response'] = response
+                debug_log(message='response={}', variable_as_list=[response,], logger=self.logger)
+                self._last_call_capacity = 0.0
+                for consumed_capacity in response.get('ConsumedCapacity', list()):
+                    self._last_call_capacity += float(consumed_capacity.get('CapacityUnits', 0))
+                self.stats['ConsumedCapacity'] += self._last_call_capacity
+                if 'UnprocessedItems' in response:
+                    unprocessed_items = response['UnprocessedItems']
+            except Exception as e:
+                error_response = dict()
+                if hasattr(e, 'response') is True:
+                    error_response = e.response
+                if error_response.get('Error', dict()).get('Code') not in BATCH_WRITE_THROTTLING_ERROR_CODES:
+                    self.logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+                    return [(table_name, write_request,) for table_name, table_requests in request_items.items() for write_request in table_requests]
+                self.logger.warning('BatchWriteItem throttled: {}'.format(error_response['Error']['Code']))
+                unprocessed_items = request_items
+            self._last_call_timestamp = time.time()
+            self.stats['Calls'] += 1
+            unprocessed_qty = sum([len(table_requests) for table_requests in unprocessed_items.values()])
+            self.stats['Writes'] += sum([len(table_requests) for table_requests in request_items.values()]) - unprocessed_qty
+            if unprocessed_qty > 0:
+                self.request_size = max(1, self.request_size // 2)
+                attempt += 1
+                if attempt > self.max_retries:
+                    self.logger.error('Unprocessed items remain after {} retries: {}'.format(self.max_retries, unprocessed_items))
+                    return [(table_name, write_request,) for table_name, table_requests in unprocessed_items.items() for write_request in table_requests]
+                self.stats['Retries'] += 1
+                time.sleep(random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt))))
+            else:
+                self.request_size = min(BATCH_WRITE_MAX_ITEMS, self.request_size + 1)
+            request_items = unprocessed_items
+        return list()
+
+
 def create_dynamodb_record(
     record_data: dict,
     boto3_clazz=boto3,
-    logger=get_logger()
+    logger=get_logger(),
+    writer: BatchWriter=None
 )->bool:
+    if writer is not None:
+        return writer.put(table_name=os.getenv('DYNAMODB_OBJECT_TABLE_NAME'), record_data=record_data)
     try:
         client=get_client(client_name='dynamodb', region='eu-central-1', boto3_clazz=boto3_clazz)
-        response = client.put_item(
-            TableName=os.getenv('DYNAMODB_OBJECT_TABLE_NAME'),
-            Item=record_data,
-            ReturnValues='NONE',
-            ReturnConsumedCapacity='TOTAL',
-            ReturnItemCollectionMetrics='SIZE'
-        )
+        with METRICS.aws_call(service='DynamoDB', operation='PutItem') as call:
+            response = client.put_item(
+                TableName=os.getenv('DYNAMODB_OBJECT_TABLE_NAME'),
+                Item=record_data,
+                ReturnValues='NONE',
+                ReturnConsumedCapacity='TOTAL',
+                ReturnItemCollectionMetrics='SIZE'
+            )
+            call['Response'] = response
         debug_log(message='response={}', variable_as_list=[response,], logger=logger)
         return True
     except:
@@ -179,20 +616,21 @@ def send_sqs_fifo_message(
     try:
         json_body = json.dumps(body)
         json_body_checksum = hashlib.sha256(json_body.encode('utf-8')).hexdigest()
-        session = get_session(boto3_clazz=boto3_clazz)
-        sqs = session.resource('sqs')
-        queue = sqs.get_queue_by_name(QueueName='AccountTransactionQueue.fifo')
-        response = queue.send_message(
-            MessageBody=json_body,
-            MessageGroupId=message_group_id,
-            MessageDeduplicationId=json_body_checksum,
-            MessageAttributes={
-                'TransactionType': {
-                    'StringValue': transaction_type,
-                    'DataType': 'String'
+        client = get_client(client_name='sqs', boto3_clazz=boto3_clazz)
+        queue_url = get_queue_url(queue_name='AccountTransactionQueue.fifo', boto3_clazz=boto3_clazz)
+        with METRICS.aws_call(service='SQS', operation='SendMessage'):
+            response = client.send_message(
+                QueueUrl=queue_url,
+                MessageBody=json_body,
+                MessageGroupId=message_group_id,
+                MessageDeduplicationId=json_body_checksum,
+                MessageAttributes={
+                    'TransactionType': {
+                        'StringValue': transaction_type,
+                        'DataType': 'String'
+                    }
                 }
-            }
-        )
+            )
         debug_log(message='response={}', variable_as_list=[response,], logger=logger)
         return True
     except:
@@ -246,6 +684,53 @@ TX_ACCOUNT_TYPE_ID_MAP = {
     'inter_account_transfer_'       : 'InterAccountTransfer',
 }
 
+EVENT_KEY_EXTENSION = '.event'
+
+
+def compile_event_key_router(
+    key_prefixes: tuple=ACCEPTABLE_KEY_PREFIXES,
+    account_field_names: dict=ACCOUNT_FIELD_NAME_BASED_ON_TRANSACTION_TYPE,
+    tx_type_ids: dict=TX_ACCOUNT_TYPE_ID_MAP,
+    key_extension: str=EVENT_KEY_EXTENSION
+)->dict:
+    """
+        Combine the key prefix, account field and transaction type configuration into a single lookup structure.
+
+        Routes are indexed by their key prefix and the distinct prefix lengths are kept longest first, so resolving a
+        key costs one dictionary lookup per distinct prefix length, regardless of the number of event types. When
+        more than one prefix matches a key, the longest (most specific) prefix wins.
+    """
+    routes = dict()
+    for key_prefix in key_prefixes:
+        routes[key_prefix] = {
+            'Prefix': key_prefix,
+            'Extension': key_extension,
+            'TxType': tx_type_ids.get(key_prefix, 'unknown'),
+            'AccountFieldName': account_field_names.get(key_prefix),
+        }
+    return {
+        'Extension': key_extension,
+        'Routes': routes,
+        'PrefixLengths': tuple(sorted(set([len(key_prefix) for key_prefix in routes.keys()]), reverse=True)),
+    }
+
+
+EVENT_KEY_ROUTER = compile_event_key_router()
+
+
+def resolve_event_key(key: str, router: dict=EVENT_KEY_ROUTER)->dict:
+    """
+        Return the route of an event key, or None when the extension or prefix is not recognized
+    """
+    if isinstance(key, str) is False or key.endswith(router['Extension']) is False:
+        return None
+    routes = router['Routes']
+    for prefix_length in router['PrefixLengths']:
+        route = routes.get(key[:prefix_length])
+        if route is not None:
+            return route
+    return None
+
 
 def extract_body_messages_from_event_record(event_record: dict, logger=get_logger())->dict:
     event_body_messages = dict()
@@ -299,28 +784,27 @@ def validate_key_is_recognized(key: str, logger=get_logger())->bool:
     if isinstance(key, str) is False:
         logger.error('Key must be a string')
         return False
-    if key.endswith('.event') is False:
+    if key.endswith(EVENT_KEY_ROUTER['Extension']) is False:
         logger.error('Key has invalid extension')
         return False
-    for acceptable_key_prefix in ACCEPTABLE_KEY_PREFIXES:
-        if key.startswith(acceptable_key_prefix):
-            return True
+    if resolve_event_key(key=key) is not None:
+        return True
     logger.error('Key unrecognized')
     return False
 
 
-def determine_tx_type_and_reference_account(data: dict, logger=get_logger())->dict:
+def determine_tx_type_and_reference_account(data: dict, logger=get_logger(), route: dict=None)->dict:
     debug_log('data={}', variable_as_list=[data,], logger=logger)
     result = dict()
     result['TxType'] = 'unknown'
     result['ReferenceAccount'] = 'unknown'
     try:
-        for key_starts_with_value, account_reference_field_name in ACCOUNT_FIELD_NAME_BASED_ON_TRANSACTION_TYPE.items():
-            if data['EventSourceDataResource']['S3Key'].startswith(key_starts_with_value):
-                logger.info('Transaction Type Match: "{}"   Reference Field Name: "{}"'.format(key_starts_with_value, account_reference_field_name))
-                result['TxType'] = TX_ACCOUNT_TYPE_ID_MAP[key_starts_with_value]
-                result['ReferenceAccount'] = data[account_reference_field_name]
-
+        if route is None:
+            route = resolve_event_key(key=data['EventSourceDataResource']['S3Key'])
+        if route is not None and route['AccountFieldName'] is not None:
+            logger.info('Transaction Type Match: "{}"   Reference Field Name: "{}"'.format(route['Prefix'], route['AccountFieldName']))
+            result['TxType'] = route['TxType']
+            result['ReferenceAccount'] = data[route['AccountFieldName']]
     except:
         logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
     debug_log('result={}', variable_as_list=[result,], logger=logger)
@@ -333,7 +817,8 @@ def update_object_table(
     tx_type_and_reference_account: dict,
     event_type: str='InitialEvent',
     boto3_clazz=boto3,
-    logger=get_logger()
+    logger=get_logger(),
+    writer: BatchWriter=None
 ):
     try:
         reference_account_number = tx_type_and_reference_account['ReferenceAccount']
@@ -388,13 +873,15 @@ def update_object_table(
         create_dynamodb_record(
             record_data=object_state,
             boto3_clazz=boto3_clazz,
-            logger=logger
+            logger=logger,
+            writer=writer
         )
         logger.info('OBJECT STATE RECORD CREATED')
         create_dynamodb_record(
             record_data=object_event,
             boto3_clazz=boto3_clazz,
-            logger=logger
+            logger=logger,
+            writer=writer
         )
         logger.info('OBJECT STATE EVENT RECORD CREATED')
 
@@ -410,7 +897,8 @@ def update_object_table_add_event(
     is_error: bool=False,
     error_message: str='no-error',
     boto3_clazz=boto3,
-    logger=get_logger()
+    logger=get_logger(),
+    writer: BatchWriter=None
 ):
     try:
         reference_account_number = tx_type_and_reference_account['ReferenceAccount']
@@ -449,7 +937,8 @@ def update_object_table_add_event(
         create_dynamodb_record(
             record_data=object_event,
             boto3_clazz=boto3_clazz,
-            logger=logger
+            logger=logger,
+            writer=writer
         )
         logger.info('OBJECT STATE EVENT RECORD CREATED')
 
@@ -457,14 +946,13 @@ def update_object_table_add_event(
         logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
 
 
-def extract_request_id(key: str, logger=get_logger())->str:
+def extract_request_id(key: str, logger=get_logger(), route: dict=None)->str:
     request_id = None
     try:
-        for key_prefix in ACCEPTABLE_KEY_PREFIXES:
-            if key.startswith(key_prefix):
-                request_id = copy.deepcopy(key)
-                request_id = request_id.replace(key_prefix, '')
-                request_id = request_id.replace('.event', '')
+        if route is None:
+            route = resolve_event_key(key=key)
+        if route is not None:
+            request_id = key[len(route['Prefix']):-len(route['Extension'])]
     except:
         logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
     return request_id
@@ -473,28 +961,44 @@ def extract_request_id(key: str, logger=get_logger())->str:
 def process_s3_record(
     record: dict,
     logger=get_logger(),
-    boto3_clazz=boto3
-)->bool:
+    boto3_clazz=boto3,
+    prefetched_payloads: dict=None
+)->str:
+    """
+        Process a single S3 record and return the outcome:
+
+            OK:         The event was recorded and sent to the transaction queue (or skipped as not being an event)
+            REJECTED:   The event is invalid and was not sent for processing - retrying will not change the outcome
+            ERROR:      Processing failed (for example an AWS API error) and the message should be retried
+    """
     logger.info('PROCESSING RECORD: {}'.format(record))
+    # The object table records of an event are written together with BatchWriteItem calls
+    writer = BatchWriter(boto3_clazz=boto3_clazz, logger=logger, max_retries=5)
     try:
         if int(record['object']['size']) > 1024:
             logger.warning('Skipping S3 record as it is larger than the acceptable maximum size of 1KiB')
-            return False
+            return 'REJECTED'
         if validate_key_is_recognized(key=record['object']['key'], logger=logger) is True:
-            s3_payload_json = get_s3_object_payload(
-                s3_bucket=record['bucket']['name'],
-                s3_key=record['object']['key'],
-                boto3_clazz=boto3_clazz,
-                logger=logger
-            )
-            s3_payload_dict = json.loads(s3_payload_json)
+            route = resolve_event_key(key=record['object']['key'])
+            fetch_key = (record['bucket']['name'], record['object']['key'])
+            with METRICS.timer(step='RetrievePayload'):
+                if prefetched_payloads is not None and fetch_key in prefetched_payloads:
+                    s3_payload_json = prefetched_payloads[fetch_key].result()
+                else:
+                    s3_payload_json = get_s3_object_payload(
+                        s3_bucket=record['bucket']['name'],
+                        s3_key=record['object']['key'],
+                        boto3_clazz=boto3_clazz,
+                        logger=logger
+                    )
+                s3_payload_dict = json.loads(s3_payload_json)
             debug_log('s3_payload_dict={}', variable_as_list=[s3_payload_dict,], logger=logger)
             logger.info('STEP COMPLETE: S3 Payload Retrieved and Converted')
 
-            request_id = extract_request_id(key=record['object']['key'], logger=logger)
+            request_id = extract_request_id(key=record['object']['key'], logger=logger, route=route)
             if request_id is None:
                 logger.error('Unable to determine request ID - rejecting event.')
-                return False
+                return 'REJECTED'
             s3_payload_dict['RequestId'] = request_id
             logger.info('STEP COMPLETE: S3 Payload Enriched with Request ID')
             
@@ -505,7 +1009,7 @@ def process_s3_record(
             logger.info('STEP COMPLETE: S3 Payload Enriched with Event Source Data')
 
 
-            tx_type_and_reference_account = determine_tx_type_and_reference_account(data=s3_payload_dict, logger=logger)
+            tx_type_and_reference_account = determine_tx_type_and_reference_account(data=s3_payload_dict, logger=logger, route=route)
             s3_payload_dict['TransactionType'] = tx_type_and_reference_account['TxType']
             s3_payload_dict['ReferenceAccount'] = tx_type_and_reference_account['ReferenceAccount']
             logger.info(
@@ -516,14 +1020,16 @@ def process_s3_record(
             )
 
 
-            update_object_table(
-                record=record, 
-                transaction_data=s3_payload_dict,
-                tx_type_and_reference_account=tx_type_and_reference_account,
-                event_type='InitialEvent',
-                boto3_clazz=boto3_clazz,
-                logger=logger
-            )
+            with METRICS.timer(step='UpdateObjectTable'):
+                update_object_table(
+                    record=record, 
+                    transaction_data=s3_payload_dict,
+                    tx_type_and_reference_account=tx_type_and_reference_account,
+                    event_type='InitialEvent',
+                    boto3_clazz=boto3_clazz,
+                    logger=logger,
+                    writer=writer
+                )
             logger.info('STEP COMPLETE: Event Object Table Updated')
 
 
@@ -542,10 +1048,11 @@ def process_s3_record(
                     is_error=True,
                     error_message='Transaction Type Not Recognized',
                     boto3_clazz=boto3_clazz,
-                    logger=logger
+                    logger=logger,
+                    writer=writer
                 )
                 logger.info('STEP COMPLETE: Event Object Table Updated with Event')
-                return False
+                return 'REJECTED'
 
 
             if tx_type_and_reference_account['ReferenceAccount'] == 'unknown':
@@ -563,34 +1070,46 @@ def process_s3_record(
                     is_error=True,
                     error_message='Reference Account Number Not Recognized',
                     boto3_clazz=boto3_clazz,
-                    logger=logger
+                    logger=logger,
+                    writer=writer
                 )
                 logger.info('STEP COMPLETE: Event Object Table Updated with Event')
-                return False
-
-
-            update_object_table_add_event(
-                record=record, 
-                transaction_data=s3_payload_dict,
-                tx_type_and_reference_account=tx_type_and_reference_account,
-                event_type='InitialEvent',
-                is_error=False,
-                error_message='no-error',
-                boto3_clazz=boto3_clazz,
-                logger=logger
-            )
+                return 'REJECTED'
+
+
+            with METRICS.timer(step='UpdateObjectTableAddEvent'):
+                update_object_table_add_event(
+                    record=record, 
+                    transaction_data=s3_payload_dict,
+                    tx_type_and_reference_account=tx_type_and_reference_account,
+                    event_type='InitialEvent',
+                    is_error=False,
+                    error_message='no-error',
+                    boto3_clazz=boto3_clazz,
+                    logger=logger,
+                    writer=writer
+                )
             logger.info('STEP COMPLETE: Event Object Table Updated with Event')
 
 
-            if send_sqs_fifo_message(
-                body=s3_payload_dict,
-                message_group_id=tx_type_and_reference_account['ReferenceAccount'],
-                boto3_clazz=boto3_clazz,logger=logger
-            ) is True:
+            # The object table must be up to date before the transaction consumer can process the event
+            with METRICS.timer(step='FlushObjectTable'):
+                flushed = writer.flush()
+            if flushed is False:
+                logger.error('STEP FAILED: Event Object Table records could not all be written')
+                return 'ERROR'
+
+            with METRICS.timer(step='SendToTransactionQueue'):
+                sent = send_sqs_fifo_message(
+                    body=s3_payload_dict,
+                    message_group_id=tx_type_and_reference_account['ReferenceAccount'],
+                    boto3_clazz=boto3_clazz,logger=logger
+                )
+            if sent is True:
                 logger.info('STEP COMPLETE: S3 Payload Send to Transactional SQS FIFO Queue')
             else:
                 logger.error('STEP FAILED: S3 Payload Send to Transactional SQS FIFO Queue')
-                return False
+                return 'ERROR'
 
             logger.info('RECORD EVENT PREPARED AND READY FOR PROCESSING')
 
@@ -598,10 +1117,28 @@ def process_s3_record(
             logger.warning('Skipping S3 record as it is not recognized as a valid event (Key Name Validation Failed)')
     except:
         logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
-        return False
-    return True
+        return 'ERROR'
+    finally:
+        writer.close()
+    return 'OK'
+
+
+def build_batch_response(failed_message_ids: list, logger=get_logger())->dict:
+    """
+        Build the handler response in the shape expected by an SQS event source mapping with ReportBatchItemFailures
+        enabled. Only the listed messages are returned to the queue, all other messages in the batch are deleted.
+    """
+    result = 'Ok'
+    if len(failed_message_ids) > 0:
+        result = 'PartialFailure'
+        logger.warning('Messages reported as failed: {}'.format(failed_message_ids))
+    return {
+        'Result': result,
+        'Message': None,
+        'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed_message_ids],
+    }
+
 
-    
 def handler(
     event,
     context,
@@ -612,18 +1149,57 @@ def handler(
     refresh_environment_cache(logger=logger)
     if cache['Environment']['Data']['DEBUG'] is True and run_from_main is False:
         logger  = get_logger(level=logging.DEBUG)
+    METRICS.enabled = cache['Environment']['Data']['METRICS_ENABLED']
+    METRICS.namespace = cache['Environment']['Data']['METRICS_NAMESPACE']
+    handler_start = time.perf_counter()
     
     debug_log('event={}', variable_as_list=[event,], logger=logger)
-    s3_records = extract_s3_event_messages(event=event, logger=logger)
-    debug_log('s3_records={}', variable_as_list=[s3_records,], logger=logger)
-    for s3_record in s3_records:
-        if process_s3_record(record=s3_record, logger=logger, boto3_clazz=boto3_clazz) is True:
-            logger.info('SUCCESSFULLY PROCESSED S3 RECORD: {}'.format(s3_record))
-        else:
-            logger.info('FAILED TO PROCESS S3 RECORD: {}'.format(s3_record))
+    failed_message_ids = list()
+    message_s3_records = list()
+    for event_record in event.get('Records', list()):
+        message_id = event_record.get('messageId', 'unknown')
+        try:
+            s3_records = extract_s3_event_messages(event={'Records': [event_record,]}, logger=logger)
+            debug_log('s3_records={}', variable_as_list=[s3_records,], logger=logger)
+            message_s3_records.append((message_id, s3_records))
+        except:
+            logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+            failed_message_ids.append(message_id)
 
-    
-    return {"Result": "Ok", "Message": None}    # Adapt to suite the use case....
+    with ThreadPoolExecutor(max_workers=cache['Environment']['Data']['PREFETCH_WORKERS']) as executor:
+        prefetched_payloads = prefetch_s3_object_payloads(
+            s3_records=[s3_record for message_id, s3_records in message_s3_records for s3_record in s3_records],
+            executor=executor,
+            boto3_clazz=boto3_clazz,
+            logger=logger
+        )
+        for message_id, s3_records in message_s3_records:
+            try:
+                for s3_record in s3_records:
+                    route = resolve_event_key(key=s3_record['object']['key'])
+                    METRICS.set_dimensions(TransactionType=route['TxType'] if route is not None else 'unknown')
+                    with METRICS.timer(step='ProcessRecord'):
+                        result = process_s3_record(record=s3_record, logger=logger, boto3_clazz=boto3_clazz, prefetched_payloads=prefetched_payloads)
+                    METRICS.increment(name='Records', dimensions={'Result': result})
+                    if result == 'OK':
+                        logger.info('SUCCESSFULLY PROCESSED S3 RECORD: {}'.format(s3_record))
+                    elif result == 'REJECTED':
+                        logger.info('REJECTED S3 RECORD: {}'.format(s3_record))
+                    else:
+                        logger.info('FAILED TO PROCESS S3 RECORD: {}'.format(s3_record))
+                        if message_id not in failed_message_ids:
+                            failed_message_ids.append(message_id)
+            except:
+                logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+                failed_message_ids.append(message_id)
+            finally:
+                METRICS.clear_dimensions()
+
+    METRICS.put_metric(name='StepDuration', value=round((time.perf_counter() - handler_start) * 1000, 3), unit='Milliseconds', dimensions={'Step': 'Handler'})
+    METRICS.increment(name='Messages', value=len(event.get('Records', list())))
+    METRICS.increment(name='FailedMessages', value=len(failed_message_ids))
+    METRICS.flush()
+    return build_batch_response(failed_message_ids=failed_message_ids, logger=logger)
 
 
 ###############################################################################
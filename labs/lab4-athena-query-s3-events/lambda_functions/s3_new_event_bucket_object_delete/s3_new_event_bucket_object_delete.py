@@ -1,12 +1,15 @@
 import boto3
+from botocore.config import Config
+import threading
 import traceback
 import os
 import json
 import logging
 from datetime import datetime
 import sys
-from inspect import getframeinfo, stack
+import time
 # Other imports here...
+from contextlib import contextmanager
 
 
 def get_logger(level=logging.INFO):
@@ -29,8 +32,26 @@ def get_logger(level=logging.INFO):
     return logger
 
 
-def get_client(client_name: str, region: str='eu-central-1', boto3_clazz=boto3):
-    return boto3_clazz.client(client_name, region_name=region)
+CLIENT_REGISTRY = dict()
+CLIENT_REGISTRY_LOCK = threading.Lock()
+try:
+    CLIENT_CONFIG = Config(max_pool_connections=25, connect_timeout=5, read_timeout=30, retries={'max_attempts': 5, 'mode': 'standard'}, tcp_keepalive=True)
+except TypeError:   # tcp_keepalive requires botocore 1.27.84 or later
+    CLIENT_CONFIG = Config(max_pool_connections=25, connect_timeout=5, read_timeout=30, retries={'max_attempts': 5, 'mode': 'standard'})
+
+
+def get_client(client_name: str, region: str='eu-central-1', boto3_clazz=boto3, endpoint_url: str=None):
+    """
+        Clients are created on first use and kept in CLIENT_REGISTRY for the lifetime of the execution environment, so
+        warm invocations re-use the client and its pool of keep-alive connections. Only the services actually used by
+        the function are ever created.
+    """
+    registry_key = (client_name, region, endpoint_url, id(boto3_clazz))
+    if registry_key not in CLIENT_REGISTRY:
+        with CLIENT_REGISTRY_LOCK:
+            if registry_key not in CLIENT_REGISTRY:
+                CLIENT_REGISTRY[registry_key] = boto3_clazz.client(client_name, region_name=region, endpoint_url=endpoint_url, config=CLIENT_CONFIG)
+    return CLIENT_REGISTRY[registry_key]
 
 
 CACHE_TTL_DEFAULT = 600
@@ -72,12 +93,34 @@ def refresh_environment_cache(logger=get_logger()):
         'Data': {
             'CACHE_TTL': get_cache_ttl(logger=logger),
             'DEBUG': get_debug(),
+            'METRICS_ENABLED': get_metrics_enabled(),
+            'METRICS_NAMESPACE': get_metrics_namespace(),
             # Other ENVIRONMENT variables can be added here... The environment will be re-read after the CACHE_TTL 
         }
     }
     logger.debug('cache: {}'.format((json.dumps(cache))))
 
 
+class DebugMessage:
+    """
+        Defers the `str.format()` of a debug message until a handler actually emits the log record
+    """
+    __slots__ = ('message', 'variables_as_dict', 'variable_as_list')
+
+    def __init__(self, message: str, variables_as_dict: dict, variable_as_list: list):
+        self.message = message
+        self.variables_as_dict = variables_as_dict
+        self.variable_as_list = variable_as_list
+
+    def __str__(self):
+        try:
+            if len(self.variables_as_dict) > 0:
+                return self.message.format(**self.variables_as_dict)
+            return self.message.format(*self.variable_as_list)
+        except:
+            return self.message
+
+
 def debug_log(message: str, variables_as_dict: dict=dict(), variable_as_list: list=list(), logger=get_logger(level=logging.INFO)):
     """
         See:
@@ -100,16 +143,192 @@ def debug_log(message: str, variables_as_dict: dict=dict(), variable_as_list: li
 
     """
     if cache['Environment']['Data']['DEBUG'] is True:
-        try:
-            caller = getframeinfo(stack()[1][0])
-            caller_str = '{}():{}'.format(caller.function, caller.lineno)
-            message = '[{}]  {}'.format(caller_str, message)
-            if len(variables_as_dict) > 0:
-                logger.debug(message.format(**variables_as_dict))
+        if logger.isEnabledFor(logging.DEBUG) is True:
+            # stacklevel=2 attributes the record (funcName/lineno) to the caller without inspecting the stack
+            logger.debug(DebugMessage(message=message, variables_as_dict=variables_as_dict, variable_as_list=variable_as_list), stacklevel=2)
+
+
+###############################################################################
+###                                                                         ###
+###                               M E T R I C S                             ###
+###                                                                         ###
+###############################################################################
+
+
+METRICS_NAMESPACE_DEFAULT = 'Lab4/EventPipeline'
+EMF_MAX_METRICS_PER_DOCUMENT = 100
+EMF_MAX_VALUES_PER_METRIC = 100
+
+
+def get_metrics_enabled()->bool:
+    try:
+        return bool(int(os.getenv('METRICS_ENABLED', '1')))
+    except:
+        pass
+    return True
+
+
+def get_metrics_namespace()->str:
+    return os.getenv('METRICS_NAMESPACE', METRICS_NAMESPACE_DEFAULT)
+
+
+def consumed_capacity_units(response: dict)->float:
+    """
+        Total capacity units in a DynamoDB response requested with `ReturnConsumedCapacity='TOTAL'`. BatchWriteItem
+        and TransactWriteItems return a list (one entry per table), the other operations a single dict.
+    """
+    if isinstance(response, dict) is False:
+        return 0.0
+    consumed_capacity = response.get('ConsumedCapacity', list())
+    if isinstance(consumed_capacity, dict) is True:
+        consumed_capacity = [consumed_capacity,]
+    return sum([float(table_capacity.get('CapacityUnits', 0)) for table_capacity in consumed_capacity])
+
+
+class MetricsCollector:
+    """
+        Collects step durations and AWS API call counters during an invocation and writes them as CloudWatch Embedded
+        Metric Format (EMF) log lines when `flush()` is called at the end of the invocation. Recording a value is only
+        a list append under a lock - the JSON documents are built in `flush()`, one per set of dimension values (split
+        when the EMF limits of 100 metrics per document or 100 values per metric are reached).
+
+            StepDuration        Milliseconds    Step
+            AwsCallDuration     Milliseconds    Service, Operation
+            AwsCalls            Count           Service, Operation
+            AwsCallErrors       Count           Service, Operation
+            ConsumedCapacity    Count           Service, Operation (DynamoDB capacity units)
+
+        All metrics also have the `FunctionName` dimension, plus the dimensions set with `set_dimensions()` by the
+        thread that recorded the value (for example the `TransactionType`).
+
+        See https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+    """
+
+    def __init__(self, function_name: str, namespace: str=METRICS_NAMESPACE_DEFAULT, writer=None):
+        self.function_name = function_name
+        self.namespace = namespace
+        self.writer = writer
+        self.enabled = True
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.metrics = dict()
+
+    def set_dimensions(self, **dimensions):
+        self.local.dimensions = dimensions
+
+    def clear_dimensions(self):
+        self.local.dimensions = dict()
+
+    def put_metric(self, name: str, value: float, unit: str='Count', dimensions: dict=None, aggregate: bool=False):
+        """
+            With `aggregate` the value is added to the current value instead of being recorded as another sample
+        """
+        if self.enabled is False:
+            return
+        metric_dimensions = dict(getattr(self.local, 'dimensions', dict()))
+        if dimensions is not None:
+            metric_dimensions.update(dimensions)
+        dimensions_key = tuple(sorted(metric_dimensions.items()))
+        with self.lock:
+            if dimensions_key not in self.metrics:
+                self.metrics[dimensions_key] = dict()
+            if name not in self.metrics[dimensions_key]:
+                self.metrics[dimensions_key][name] = {'Unit': unit, 'Values': list()}
+            values = self.metrics[dimensions_key][name]['Values']
+            if aggregate is True and len(values) > 0:
+                values[0] += value
             else:
-                logger.debug(message.format(*variable_as_list))
+                values.append(value)
+
+    def increment(self, name: str, value: float=1, dimensions: dict=None):
+        self.put_metric(name=name, value=value, unit='Count', dimensions=dimensions, aggregate=True)
+
+    @contextmanager
+    def timer(self, step: str):
+        """
+            Record the duration of a named step. Can also be used as a function decorator.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.put_metric(name='StepDuration', value=round((time.perf_counter() - start) * 1000, 3), unit='Milliseconds', dimensions={'Step': step})
+
+    @contextmanager
+    def aws_call(self, service: str, operation: str):
+        """
+            Time and count an AWS API call. Store the response in the yielded dict under `Response` to also record
+            the DynamoDB consumed capacity:
+
+                with METRICS.aws_call(service='DynamoDB', operation='PutItem') as call:
+                    call['Response'] = client.put_item(...)
+        """
+        call = dict()
+        dimensions = {'Service': service, 'Operation': operation}
+        start = time.perf_counter()
+        try:
+            yield call
         except:
-            pass
+            self.increment(name='AwsCallErrors', dimensions=dimensions)
+            raise
+        finally:
+            self.put_metric(name='AwsCallDuration', value=round((time.perf_counter() - start) * 1000, 3), unit='Milliseconds', dimensions=dimensions)
+            self.increment(name='AwsCalls', dimensions=dimensions)
+            capacity_units = consumed_capacity_units(response=call.get('Response'))
+            if capacity_units > 0:
+                self.increment(name='ConsumedCapacity', value=capacity_units, dimensions=dimensions)
+
+    def _write(self, document: dict):
+        # EMF documents must be written as is - the log formatter prefix would stop CloudWatch from extracting them
+        if self.writer is not None:
+            self.writer(document)
+            return
+        sys.stdout.write('{}\n'.format(json.dumps(document)))
+
+    def flush(self)->int:
+        """
+            Write all recorded metrics as EMF documents and return the number of documents written
+        """
+        with self.lock:
+            metrics = self.metrics
+            self.metrics = dict()
+        documents_qty = 0
+        timestamp = int(time.time() * 1000)
+        for dimensions_key, dimension_metrics in metrics.items():
+            dimension_values = {'FunctionName': self.function_name}
+            dimension_values.update(dict(dimensions_key))
+            metric_names = list(dimension_metrics.keys())
+            for name_offset in range(0, len(metric_names), EMF_MAX_METRICS_PER_DOCUMENT):
+                document_metric_names = metric_names[name_offset:name_offset+EMF_MAX_METRICS_PER_DOCUMENT]
+                value_offset = 0
+                while True:
+                    metric_definitions = list()
+                    document = dict(dimension_values)
+                    for metric_name in document_metric_names:
+                        values = dimension_metrics[metric_name]['Values'][value_offset:value_offset+EMF_MAX_VALUES_PER_METRIC]
+                        if len(values) == 0:
+                            continue
+                        metric_definitions.append({'Name': metric_name, 'Unit': dimension_metrics[metric_name]['Unit']})
+                        document[metric_name] = values if len(values) > 1 else values[0]
+                    if len(metric_definitions) == 0:
+                        break
+                    document['_aws'] = {
+                        'Timestamp': timestamp,
+                        'CloudWatchMetrics': [
+                            {
+                                'Namespace': self.namespace,
+                                'Dimensions': [sorted(dimension_values.keys()),],
+                                'Metrics': metric_definitions,
+                            }
+                        ],
+                    }
+                    self._write(document=document)
+                    documents_qty += 1
+                    value_offset += EMF_MAX_VALUES_PER_METRIC
+        return documents_qty
+
+
+METRICS = MetricsCollector(function_name=os.getenv('AWS_LAMBDA_FUNCTION_NAME', 's3_new_event_bucket_object_delete'))
 
 
 ###############################################################################
@@ -179,10 +398,16 @@ def handler(
     refresh_environment_cache(logger=logger)
     if cache['Environment']['Data']['DEBUG'] is True and run_from_main is False:
         logger  = get_logger(level=logging.DEBUG)
+    METRICS.enabled = cache['Environment']['Data']['METRICS_ENABLED']
+    METRICS.namespace = cache['Environment']['Data']['METRICS_NAMESPACE']
     
     debug_log('event={}', variable_as_list=[event], logger=logger)
-    s3_records = extract_s3_event_messages(event=event, logger=logger)
-    debug_log('s3_records={}', variable_as_list=[s3_records,], logger=logger)
+    with METRICS.timer(step='Handler'):
+        s3_records = extract_s3_event_messages(event=event, logger=logger)
+        debug_log('s3_records={}', variable_as_list=[s3_records,], logger=logger)
+    METRICS.increment(name='Messages', value=len(event.get('Records', list())))
+    METRICS.increment(name='Records', value=len(s3_records))
+    METRICS.flush()
     
     return {"Result": "Ok", "Message": None}    # Adapt to suite the use case....
 
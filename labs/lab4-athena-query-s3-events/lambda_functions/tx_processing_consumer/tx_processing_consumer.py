@@ -1,14 +1,24 @@
 import boto3
+from botocore.config import Config
+import threading
 import traceback
 import os
 import json
 import logging
 from datetime import datetime
 import sys
-from inspect import getframeinfo, stack
 from decimal import Decimal
 # Other imports here...
 import copy
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from contextlib import contextmanager
+try:
+    import redis
+except ImportError:     # Redis is optional and only used as a shared balance cache when REDIS_HOST is set
+    redis = None
 
 
 def get_logger(level=logging.INFO):
@@ -31,12 +41,40 @@ def get_logger(level=logging.INFO):
     return logger
 
 
-def get_client(client_name: str, region: str='eu-central-1', boto3_clazz=boto3):
-    return boto3_clazz.client(client_name, region_name=region)
+CLIENT_REGISTRY = dict()
+CLIENT_REGISTRY_LOCK = threading.Lock()
+try:
+    CLIENT_CONFIG = Config(max_pool_connections=25, connect_timeout=5, read_timeout=30, retries={'max_attempts': 5, 'mode': 'standard'}, tcp_keepalive=True)
+except TypeError:   # tcp_keepalive requires botocore 1.27.84 or later
+    CLIENT_CONFIG = Config(max_pool_connections=25, connect_timeout=5, read_timeout=30, retries={'max_attempts': 5, 'mode': 'standard'})
 
 
-def get_session(region: str='eu-central-1', boto3_clazz=boto3):
-    return boto3_clazz.Session(region_name=region)
+def get_client(client_name: str, region: str='eu-central-1', boto3_clazz=boto3, endpoint_url: str=None):
+    """
+        Clients are created on first use and kept in CLIENT_REGISTRY for the lifetime of the execution environment, so
+        warm invocations re-use the client and its pool of keep-alive connections. Only the services actually used by
+        the function are ever created.
+    """
+    registry_key = (client_name, region, endpoint_url, id(boto3_clazz))
+    if registry_key not in CLIENT_REGISTRY:
+        with CLIENT_REGISTRY_LOCK:
+            if registry_key not in CLIENT_REGISTRY:
+                CLIENT_REGISTRY[registry_key] = boto3_clazz.client(client_name, region_name=region, endpoint_url=endpoint_url, config=CLIENT_CONFIG)
+    return CLIENT_REGISTRY[registry_key]
+
+
+QUEUE_URL_CACHE = dict()
+
+
+def get_queue_url(queue_name: str, boto3_clazz=boto3)->str:
+    """
+        Queue URL's never change for the lifetime of a queue, so the GetQueueUrl round trip is only done once
+    """
+    if queue_name not in QUEUE_URL_CACHE:
+        client = get_client(client_name='sqs', boto3_clazz=boto3_clazz)
+        with METRICS.aws_call(service='SQS', operation='GetQueueUrl'):
+            QUEUE_URL_CACHE[queue_name] = client.get_queue_url(QueueName=queue_name)['QueueUrl']
+    return QUEUE_URL_CACHE[queue_name]
 
 
 # ADD the header as per section ``Module header functions``
@@ -61,6 +99,38 @@ def get_debug()->bool:
     return False
     
 
+def get_batch_mode()->bool:
+    try:
+        return bool(int(os.getenv('BATCH_MODE', '0')))
+    except:
+        pass
+    return False
+
+
+def get_max_workers()->int:
+    try:
+        return max(1, int(os.getenv('MAX_WORKERS', '1')))
+    except:
+        pass
+    return 1
+
+
+def get_balance_cache_size()->int:
+    try:
+        return max(0, int(os.getenv('BALANCE_CACHE_SIZE', '0')))
+    except:
+        pass
+    return 0
+
+
+def get_balance_cache_ttl()->int:
+    try:
+        return max(1, int(os.getenv('BALANCE_CACHE_TTL', '300')))
+    except:
+        pass
+    return 300
+
+
 def get_cache_ttl(logger=get_logger())->int:
     try:
         return int(os.getenv('CACHE_TTL', '{}'.format(CACHE_TTL_DEFAULT)))
@@ -80,12 +150,40 @@ def refresh_environment_cache(logger=get_logger()):
         'Data': {
             'CACHE_TTL': get_cache_ttl(logger=logger),
             'DEBUG': get_debug(),
+            'METRICS_ENABLED': get_metrics_enabled(),
+            'METRICS_NAMESPACE': get_metrics_namespace(),
+            'BATCH_MODE': get_batch_mode(),
+            'MAX_WORKERS': get_max_workers(),
+            'BALANCE_CACHE_SIZE': get_balance_cache_size(),
+            'BALANCE_CACHE_TTL': get_balance_cache_ttl(),
+            'REDIS_HOST': '{}'.format(os.getenv('REDIS_HOST', '')),
+            'REDIS_PORT': int(os.getenv('REDIS_PORT', '6379')),
             # Other ENVIRONMENT variables can be added here... The environment will be re-read after the CACHE_TTL 
         }
     }
     logger.debug('cache: {}'.format((json.dumps(cache))))
 
 
+class DebugMessage:
+    """
+        Defers the `str.format()` of a debug message until a handler actually emits the log record
+    """
+    __slots__ = ('message', 'variables_as_dict', 'variable_as_list')
+
+    def __init__(self, message: str, variables_as_dict: dict, variable_as_list: list):
+        self.message = message
+        self.variables_as_dict = variables_as_dict
+        self.variable_as_list = variable_as_list
+
+    def __str__(self):
+        try:
+            if len(self.variables_as_dict) > 0:
+                return self.message.format(**self.variables_as_dict)
+            return self.message.format(*self.variable_as_list)
+        except:
+            return self.message
+
+
 def debug_log(message: str, variables_as_dict: dict=dict(), variable_as_list: list=list(), logger=get_logger(level=logging.INFO)):
     """
         See:
@@ -108,17 +206,336 @@ def debug_log(message: str, variables_as_dict: dict=dict(), variable_as_list: li
 
     """
     if cache['Environment']['Data']['DEBUG'] is True:
-        try:
-            caller = getframeinfo(stack()[1][0])
-            caller_str = '{}():{}'.format(caller.function, caller.lineno)
-            message = '[{}]  {}'.format(caller_str, message)
-            if len(variables_as_dict) > 0:
-                logger.debug(message.format(**variables_as_dict))
+        if logger.isEnabledFor(logging.DEBUG) is True:
+            # stacklevel=2 attributes the record (funcName/lineno) to the caller without inspecting the stack
+            logger.debug(DebugMessage(message=message, variables_as_dict=variables_as_dict, variable_as_list=variable_as_list), stacklevel=2)
+
+
+
+###############################################################################
+###                                                                         ###
+###                  D Y N A M O D B    A T T R I B U T E S                 ###
+###                                                                         ###
+###############################################################################
+
+
+def _decode_list(value: list)->list:
+    return [decode_attribute_value(attribute_value=element) for element in value]
+
+
+def _decode_map(value: dict)->dict:
+    return decode_item(item=value)
+
+
+# Types mapped to None are already returned by the client as the correct Python type and need no conversion
+ATTRIBUTE_VALUE_DECODERS = {
+    'S': None,
+    'N': Decimal,
+    'BOOL': None,
+    'NULL': lambda value: None,
+    'B': None,
+    'SS': set,
+    'NS': lambda value: set(Decimal(element) for element in value),
+    'BS': set,
+    'L': _decode_list,
+    'M': _decode_map,
+}
+
+
+def decode_attribute_value(attribute_value: dict):
+    """
+        Convert a single DynamoDB AttributeValue, for example `{'N': '10.5'}`, to the Python value (`Decimal('10.5')`)
+
+        Numbers are always returned as `Decimal`, `L` and `M` values are decoded recursively and sets are returned as
+        Python `set` objects. Unknown types raise a `KeyError`.
+    """
+    for data_type, data_value in attribute_value.items():
+        decoder = ATTRIBUTE_VALUE_DECODERS[data_type]
+        if decoder is None:
+            return data_value
+        return decoder(data_value)
+
+
+def decode_item(item: dict)->dict:
+    """
+        Convert a DynamoDB item (as returned by the low level client) to a plain Python dict
+    """
+    decoders = ATTRIBUTE_VALUE_DECODERS
+    record = dict()
+    for field_name, field_data in item.items():
+        for data_type, data_value in field_data.items():
+            decoder = decoders[data_type]
+            if decoder is None:
+                record[field_name] = data_value
             else:
-                logger.debug(message.format(*variable_as_list))
-        except:
-            pass
+                record[field_name] = decoder(data_value)
+    return record
+
+
+def decode_items(items: list)->list:
+    """
+        Convert a complete `Items` list from a Query or Scan response
+    """
+    return [decode_item(item=item) for item in items]
+
+
+def _encode_number(value)->dict:
+    return {'N': str(value)}
+
+
+def _encode_float(value: float)->dict:
+    # repr() gives the shortest string that round trips, which avoids binary floating point noise in the stored value
+    return {'N': repr(value)}
+
+
+def _encode_set(value)->dict:
+    if len(value) == 0:
+        raise ValueError('DynamoDB does not support empty sets')
+    elements = tuple(value)
+    if all(isinstance(element, str) for element in elements):
+        return {'SS': list(elements)}
+    if all(isinstance(element, (bytes, bytearray)) for element in elements):
+        return {'BS': [bytes(element) for element in elements]}
+    if all(isinstance(element, (int, float, Decimal)) and not isinstance(element, bool) for element in elements):
+        return {'NS': [_encode_number_value(element) for element in elements]}
+    raise ValueError('Sets must contain only strings, only numbers or only binary values')
+
+
+def _encode_number_value(value)->str:
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+ATTRIBUTE_VALUE_ENCODERS = {
+    str: lambda value: {'S': value},
+    bool: lambda value: {'BOOL': value},
+    int: _encode_number,
+    float: _encode_float,
+    Decimal: _encode_number,
+    type(None): lambda value: {'NULL': True},
+    bytes: lambda value: {'B': value},
+    bytearray: lambda value: {'B': bytes(value)},
+    set: _encode_set,
+    frozenset: _encode_set,
+    list: lambda value: {'L': [encode_attribute_value(value=element) for element in value]},
+    tuple: lambda value: {'L': [encode_attribute_value(value=element) for element in value]},
+    dict: lambda value: {'M': encode_item(record=value)},
+}
+
+
+def encode_attribute_value(value)->dict:
+    """
+        Convert a Python value to a DynamoDB AttributeValue. The exact type is looked up first and sub classes (for
+        example `OrderedDict`) fall back to an `isinstance()` check.
+    """
+    encoder = ATTRIBUTE_VALUE_ENCODERS.get(type(value))
+    if encoder is None:
+        for python_type, type_encoder in ATTRIBUTE_VALUE_ENCODERS.items():
+            if isinstance(value, python_type):
+                encoder = type_encoder
+                break
+    if encoder is None:
+        raise TypeError('Unsupported type for DynamoDB attribute: {}'.format(type(value)))
+    return encoder(value)
+
+
+def encode_item(record: dict)->dict:
+    """
+        Convert a plain Python dict to a DynamoDB item
+    """
+    encoders = ATTRIBUTE_VALUE_ENCODERS
+    item = dict()
+    for field_name, field_value in record.items():
+        encoder = encoders.get(type(field_value))
+        if encoder is not None:
+            item[field_name] = encoder(field_value)
+        else:
+            item[field_name] = encode_attribute_value(value=field_value)
+    return item
+
+
+###############################################################################
+###                                                                         ###
+###                               M E T R I C S                             ###
+###                                                                         ###
+###############################################################################
+
+
+METRICS_NAMESPACE_DEFAULT = 'Lab4/EventPipeline'
+EMF_MAX_METRICS_PER_DOCUMENT = 100
+EMF_MAX_VALUES_PER_METRIC = 100
+
+
+def get_metrics_enabled()->bool:
+    try:
+        return bool(int(os.getenv('METRICS_ENABLED', '1')))
+    except:
+        pass
+    return True
+
+
+def get_metrics_namespace()->str:
+    return os.getenv('METRICS_NAMESPACE', METRICS_NAMESPACE_DEFAULT)
+
 
+def consumed_capacity_units(response: dict)->float:
+    """
+        Total capacity units in a DynamoDB response requested with `ReturnConsumedCapacity='TOTAL'`. BatchWriteItem
+        and TransactWriteItems return a list (one entry per table), the other operations a single dict.
+    """
+    if isinstance(response, dict) is False:
+        return 0.0
+    consumed_capacity = response.get('ConsumedCapacity', list())
+    if isinstance(consumed_capacity, dict) is True:
+        consumed_capacity = [consumed_capacity,]
+    return sum([float(table_capacity.get('CapacityUnits', 0)) for table_capacity in consumed_capacity])
+
+
+class MetricsCollector:
+    """
+        Collects step durations and AWS API call counters during an invocation and writes them as CloudWatch Embedded
+        Metric Format (EMF) log lines when `flush()` is called at the end of the invocation. Recording a value is only
+        a list append under a lock - the JSON documents are built in `flush()`, one per set of dimension values (split
+        when the EMF limits of 100 metrics per document or 100 values per metric are reached).
+
+            StepDuration        Milliseconds    Step
+            AwsCallDuration     Milliseconds    Service, Operation
+            AwsCalls            Count           Service, Operation
+            AwsCallErrors       Count           Service, Operation
+            ConsumedCapacity    Count           Service, Operation (DynamoDB capacity units)
+
+        All metrics also have the `FunctionName` dimension, plus the dimensions set with `set_dimensions()` by the
+        thread that recorded the value (for example the `TransactionType`).
+
+        See https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+    """
+
+    def __init__(self, function_name: str, namespace: str=METRICS_NAMESPACE_DEFAULT, writer=None):
+        self.function_name = function_name
+        self.namespace = namespace
+        self.writer = writer
+        self.enabled = True
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.metrics = dict()
+
+    def set_dimensions(self, **dimensions):
+        self.local.dimensions = dimensions
+
+    def clear_dimensions(self):
+        self.local.dimensions = dict()
+
+    def put_metric(self, name: str, value: float, unit: str='Count', dimensions: dict=None, aggregate: bool=False):
+        """
+            With `aggregate` the value is added to the current value instead of being recorded as another sample
+        """
+        if self.enabled is False:
+            return
+        metric_dimensions = dict(getattr(self.local, 'dimensions', dict()))
+        if dimensions is not None:
+            metric_dimensions.update(dimensions)
+        dimensions_key = tuple(sorted(metric_dimensions.items()))
+        with self.lock:
+            if dimensions_key not in self.metrics:
+                self.metrics[dimensions_key] = dict()
+            if name not in self.metrics[dimensions_key]:
+                self.metrics[dimensions_key][name] = {'Unit': unit, 'Values': list()}
+            values = self.metrics[dimensions_key][name]['Values']
+            if aggregate is True and len(values) > 0:
+                values[0] += value
+            else:
+                values.append(value)
+
+    def increment(self, name: str, value: float=1, dimensions: dict=None):
+        self.put_metric(name=name, value=value, unit='Count', dimensions=dimensions, aggregate=True)
+
+    @contextmanager
+    def timer(self, step: str):
+        """
+            Record the duration of a named step. Can also be used as a function decorator.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.put_metric(name='StepDuration', value=round((time.perf_counter() - start) * 1000, 3), unit='Milliseconds', dimensions={'Step': step})
+
+    @contextmanager
+    def aws_call(self, service: str, operation: str):
+        """
+            Time and count an AWS API call. Store the response in the yielded dict under `Response` to also record
+            the DynamoDB consumed capacity:
+
+                with METRICS.aws_call(service='DynamoDB', operation='PutItem') as call:
+                    call['Response'] = client.put_item(...)
+        """
+        call = dict()
+        dimensions = {'Service': service, 'Operation': operation}
+        start = time.perf_counter()
+        try:
+            yield call
+        except:
+            self.increment(name='AwsCallErrors', dimensions=dimensions)
+            raise
+        finally:
+            self.put_metric(name='AwsCallDuration', value=round((time.perf_counter() - start) * 1000, 3), unit='Milliseconds', dimensions=dimensions)
+            self.increment(name='AwsCalls', dimensions=dimensions)
+            capacity_units = consumed_capacity_units(response=call.get('Response'))
+            if capacity_units > 0:
+                self.increment(name='ConsumedCapacity', value=capacity_units, dimensions=dimensions)
+
+    def _write(self, document: dict):
+        # EMF documents must be written as is - the log formatter prefix would stop CloudWatch from extracting them
+        if self.writer is not None:
+            self.writer(document)
+            return
+        sys.stdout.write('{}\n'.format(json.dumps(document)))
+
+    def flush(self)->int:
+        """
+            Write all recorded metrics as EMF documents and return the number of documents written
+        """
+        with self.lock:
+            metrics = self.metrics
+            self.metrics = dict()
+        documents_qty = 0
+        timestamp = int(time.time() * 1000)
+        for dimensions_key, dimension_metrics in metrics.items():
+            dimension_values = {'FunctionName': self.function_name}
+            dimension_values.update(dict(dimensions_key))
+            metric_names = list(dimension_metrics.keys())
+            for name_offset in range(0, len(metric_names), EMF_MAX_METRICS_PER_DOCUMENT):
+                document_metric_names = metric_names[name_offset:name_offset+EMF_MAX_METRICS_PER_DOCUMENT]
+                value_offset = 0
+                while True:
+                    metric_definitions = list()
+                    document = dict(dimension_values)
+                    for metric_name in document_metric_names:
+                        values = dimension_metrics[metric_name]['Values'][value_offset:value_offset+EMF_MAX_VALUES_PER_METRIC]
+                        if len(values) == 0:
+                            continue
+                        metric_definitions.append({'Name': metric_name, 'Unit': dimension_metrics[metric_name]['Unit']})
+                        document[metric_name] = values if len(values) > 1 else values[0]
+                    if len(metric_definitions) == 0:
+                        break
+                    document['_aws'] = {
+                        'Timestamp': timestamp,
+                        'CloudWatchMetrics': [
+                            {
+                                'Namespace': self.namespace,
+                                'Dimensions': [sorted(dimension_values.keys()),],
+                                'Metrics': metric_definitions,
+                            }
+                        ],
+                    }
+                    self._write(document=document)
+                    documents_qty += 1
+                    value_offset += EMF_MAX_VALUES_PER_METRIC
+        return documents_qty
+
+
+METRICS = MetricsCollector(function_name=os.getenv('AWS_LAMBDA_FUNCTION_NAME', 'tx_processing_consumer'))
 
 
 ###############################################################################
@@ -128,21 +545,190 @@ def debug_log(message: str, variables_as_dict: dict=dict(), variable_as_list: li
 ###############################################################################
 
 
+BATCH_WRITE_MAX_ITEMS = 25
+TRANSACT_WRITE_MAX_ITEMS = 100
+BATCH_WRITE_THROTTLING_ERROR_CODES = (
+    'ProvisionedThroughputExceededException',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'InternalServerError',
+)
+
+
+class BatchWriter:
+    """
+        Buffered DynamoDB writer. Puts and deletes are accumulated and written with BatchWriteItem, at most 25 write
+        requests per call (the DynamoDB maximum).
+
+        * A write to a key that is already buffered replaces the buffered write, so the last write wins exactly like
+          a sequence of put_item/delete_item calls would. This also keeps duplicate keys out of a single request,
+          which DynamoDB rejects.
+        * UnprocessedItems are retried with full jitter exponential back-off (a random delay between 0 and
+          `base_delay * 2^attempt` seconds, capped at `max_delay`) up to `max_retries` times.
+        * Back-pressure: every call that returns UnprocessedItems halves the number of writes sent per call (down to
+          1) and every fully processed call grows it again by one. When `capacity_units_per_second` is set, calls are
+          also paced so that the consumed write capacity stays at or below that rate.
+        * The buffer is flushed automatically once it holds `flush_size` writes. Call `flush()` or `close()` (or use
+          the writer as a context manager) to write the remainder, for example at the end of an SQS batch.
+
+        A writer is not thread safe - use one writer per thread. Writes that could not be completed are kept in
+        `failed` as `(table_name, write_request)` tuples and make `flush()` and `close()` return False.
+    """
+
+    def __init__(
+        self,
+        boto3_clazz=boto3,
+        logger=get_logger(),
+        key_attributes: tuple=('PK', 'SK',),
+        flush_size: int=BATCH_WRITE_MAX_ITEMS,
+        max_retries: int=8,
+        base_delay: float=0.05,
+        max_delay: float=5.0,
+        capacity_units_per_second: float=None
+    ):
+        self.boto3_clazz = boto3_clazz
+        self.logger = logger
+        self.key_attributes = key_attributes
+        self.flush_size = max(1, flush_size)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.capacity_units_per_second = capacity_units_per_second
+        self.request_size = BATCH_WRITE_MAX_ITEMS
+        self.pending = OrderedDict()
+        self.failed = list()
+        self.closed = False
+        self.stats = {'Calls': 0, 'Writes': 0, 'Retries': 0, 'ConsumedCapacity': 0.0}
+        self._last_call_timestamp = None
+        self._last_call_capacity = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+        return False
+
+    def put(self, table_name: str, record_data: dict)->bool:
+        return self._buffer(table_name=table_name, item=record_data, write_request={'PutRequest': {'Item': record_data}})
+
+    def delete(self, table_name: str, key: dict)->bool:
+        return self._buffer(table_name=table_name, item=key, write_request={'DeleteRequest': {'Key': key}})
+
+    def flush(self)->bool:
+        write_requests = list(self.pending.values())
+        self.pending = OrderedDict()
+        while len(write_requests) > 0:
+            chunk = write_requests[:self.request_size]
+            write_requests = write_requests[self.request_size:]
+            self.failed += self._write(write_requests=chunk)
+        return len(self.failed) == 0
+
+    def close(self)->bool:
+        result = self.flush()
+        self.closed = True
+        self.logger.info('BatchWriter closed. stats={}'.format(self.stats))
+        if result is False:
+            self.logger.error('BatchWriter failed to write {} items'.format(len(self.failed)))
+        return result
+
+    def _buffer(self, table_name: str, item: dict, write_request: dict)->bool:
+        if self.closed is True:
+            raise Exception('BatchWriter is closed')
+        pending_key = (table_name,) + tuple(tuple(item[attribute].items()) for attribute in self.key_attributes if attribute in item)
+        self.pending.pop(pending_key, None)
+        self.pending[pending_key] = (table_name, write_request,)
+        if len(self.pending) >= self.flush_size:
+            return self.flush()
+        return True
+
+    def _pace(self):
+        if self.capacity_units_per_second is None or self._last_call_timestamp is None:
+            return
+        delay = self._last_call_capacity / self.capacity_units_per_second - (time.time() - self._last_call_timestamp)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _write(self, write_requests: list)->list:
+        """
+            Write up to 25 `(table_name, write_request)` tuples and return the tuples that could not be written
+        """
+        request_items = dict()
+        for table_name, write_request in write_requests:
+            if table_name not in request_items:
+                request_items[table_name] = list()
+            request_items[table_name].append(write_request)
+        attempt = 0
+        while len(request_items) > 0:
+            self._pace()
+            unprocessed_items = dict()
+            try:
+                client=get_client(client_name='dynamodb', region='eu-central-1', boto3_clazz=self.boto3_clazz)
+                with METRICS.aws_call(service='DynamoDB', operation='BatchWriteItem') as call:
+                    response = client.batch_write_item(
+                        RequestItems=request_items,
+                        ReturnConsumedCapacity='TOTAL'
+                    )
+                    call['Response'] = response
+                debug_log(message='response={}', variable_as_list=[response,], logger=self.logger)
+                self._last_call_capacity = 0.0
+                for consumed_capacity in response.get('ConsumedCapacity', list()):
+                    self._last_call_capacity += float(consumed_capacity.get('CapacityUnits', 0))
+                self.stats['ConsumedCapacity'] += self._last_call_capacity
+                if 'UnprocessedItems' in response:
+                    unprocessed_items = response['UnprocessedItems']
+            except Exception as e:
+                error_response = dict()
+                if hasattr(e, 'response') is True:
+                    error_response = e.response
+                if error_response.get('Error', dict()).get('Code') not in BATCH_WRITE_THROTTLING_ERROR_CODES:
+                    self.logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+                    return [(table_name, write_request,) for table_name, table_requests in request_items.items() for write_request in table_requests]
+                self.logger.warning('BatchWriteItem throttled: {}'.format(error_response['Error']['Code']))
+                unprocessed_items = request_items
+            self._last_call_timestamp = time.time()
+            self.stats['Calls'] += 1
+            unprocessed_qty = sum([len(table_requests) for table_requests in unprocessed_items.values()])
+            self.stats['Writes'] += sum([len(table_requests) for table_requests in request_items.values()]) - unprocessed_qty
+            if unprocessed_qty > 0:
+                self.request_size = max(1, self.request_size // 2)
+                attempt += 1
+                if attempt > self.max_retries:
+                    self.logger.error('Unprocessed items remain after {} retries: {}'.format(self.max_retries, unprocessed_items))
+                    return [(table_name, write_request,) for table_name, table_requests in unprocessed_items.items() for write_request in table_requests]
+                self.stats['Retries'] += 1
+                time.sleep(random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt))))
+            else:
+                self.request_size = min(BATCH_WRITE_MAX_ITEMS, self.request_size + 1)
+            request_items = unprocessed_items
+        return list()
+
+
 def create_dynamodb_record(
     table_name: str,
     record_data: dict,
     boto3_clazz=boto3,
-    logger=get_logger()
+    logger=get_logger(),
+    batch: dict=None,
+    writer: BatchWriter=None
 )->bool:
+    if batch is not None:
+        # Batch mode: stage the record - it will be written by commit_batch() at the end of the SQS batch
+        batch['PendingWrites'][(table_name, record_data['PK']['S'], record_data['SK']['S'])] = record_data
+        return True
+    if writer is not None:
+        return writer.put(table_name=table_name, record_data=record_data)
     try:
         client=get_client(client_name='dynamodb', region='eu-central-1', boto3_clazz=boto3_clazz)
-        response = client.put_item(
-            TableName=table_name,
-            Item=record_data,
-            ReturnValues='NONE',
-            ReturnConsumedCapacity='TOTAL',
-            ReturnItemCollectionMetrics='SIZE'
-        )
+        with METRICS.aws_call(service='DynamoDB', operation='PutItem') as call:
+            response = client.put_item(
+                TableName=table_name,
+                Item=record_data,
+                ReturnValues='NONE',
+                ReturnConsumedCapacity='TOTAL',
+                ReturnItemCollectionMetrics='SIZE'
+            )
+            call['Response'] = response
         debug_log(message='response={}', variable_as_list=[response,], logger=logger)
         return True
     except:
@@ -155,89 +741,109 @@ def get_dynamodb_record_by_key(
     boto3_clazz=boto3,
     logger=get_logger()
 )->dict:
+    """
+        Errors are raised: a balance record that could not be read must not be mistaken for a balance of 0
+    """
     record = dict()
     try:
         client=get_client(client_name='dynamodb', region='eu-central-1', boto3_clazz=boto3_clazz)
-        response = client.get_item(
-            TableName=os.getenv('DYNAMODB_ACCOUNTS_TABLE_NAME'),
-            Key=key,
-            ConsistentRead=True,
-            ReturnConsumedCapacity='TOTAL'
-        )
+        with METRICS.aws_call(service='DynamoDB', operation='GetItem') as call:
+            response = client.get_item(
+                TableName=os.getenv('DYNAMODB_ACCOUNTS_TABLE_NAME'),
+                Key=key,
+                ConsistentRead=True,
+                ReturnConsumedCapacity='TOTAL'
+            )
+            call['Response'] = response
         debug_log(message='response={}', variable_as_list=[response,], logger=logger)
         if 'Item' in response:
-            for field_name, field_data in response['Item'].items():
-                for field_data_type, field_data_value in field_data.items():
-                    if field_data_type == 'S':
-                        record[field_name] = '{}'.format(field_data_value)
-                    if field_data_type == 'N':
-                        record[field_name] = Decimal(field_data_value)
-                    if field_data_type == 'BOOL':
-                        record[field_name] = field_data_value        
+            record = decode_item(item=response['Item'])
     except:
         logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+        raise
     if 'Balance' not in record:
             record['Balance'] = Decimal('0')
     debug_log(message='record={}', variable_as_list=[record,], logger=logger)
     return record
 
 
+QUERY_PAGE_SIZE_DEFAULT = 100
+
+
+def paginate_dynamodb_query(
+    query_parameters: dict,
+    page_size: int=QUERY_PAGE_SIZE_DEFAULT,
+    max_items: int=None,
+    start_key: dict=None,
+    boto3_clazz=boto3,
+    logger=get_logger()
+):
+    """
+        Generator that yields decoded records from a DynamoDB Query, fetching the next page only when the caller
+        asks for more records.
+
+        The `query_parameters` are passed to `client.query()` as is, with `Limit` and `ExclusiveStartKey` managed by
+        this function. Iteration ends when the last page is read or after `max_items` records were yielded. The
+        caller can also simply stop iterating at any time to prevent further round trips.
+
+        Note that when a `QueryFilter` is used, DynamoDB applies the `Limit` before the filter, so a page may contain
+        fewer than `page_size` records.
+    """
+    client = get_client(client_name='dynamodb', region='eu-central-1', boto3_clazz=boto3_clazz)
+    parameters = dict(query_parameters)
+    items_yielded = 0
+    next_key = start_key
+    while True:
+        parameters['Limit'] = page_size
+        if max_items is not None and 'QueryFilter' not in parameters and 'FilterExpression' not in parameters:
+            parameters['Limit'] = max(1, min(page_size, max_items - items_yielded))
+        if next_key is not None:
+            parameters['ExclusiveStartKey'] = next_key
+        with METRICS.aws_call(service='DynamoDB', operation='Query') as call:
+            response = client.query(**parameters)
+            call['Response'] = response
+        debug_log(message='response={}', variable_as_list=[response,], logger=logger)
+        for record in decode_items(items=response.get('Items', list())):
+            yield record
+            items_yielded += 1
+            if max_items is not None and items_yielded >= max_items:
+                return
+        next_key = response.get('LastEvaluatedKey', None)
+        if next_key is None:
+            return
+
+
 def get_dynamodb_record_by_indexed_query(
     key: dict,
     index_name: str,
     use_consistent_read: bool=False,
     boto3_clazz=boto3,
     logger=get_logger(),
-    next_token: dict=None
+    next_token: dict=None,
+    page_size: int=QUERY_PAGE_SIZE_DEFAULT,
+    max_items: int=None
 )->list:
     records = list()
     try:
-        client=get_client(client_name='dynamodb', region='eu-central-1', boto3_clazz=boto3_clazz)
-        
-        response = dict()
-        if next_token is None:
-            response = client.query(
-                TableName=os.getenv('DYNAMODB_ACCOUNTS_TABLE_NAME'),
-                IndexName=index_name,
-                Select='ALL_ATTRIBUTES',
-                Limit=10,
-                ConsistentRead=use_consistent_read,
-                KeyConditions=key,
-                ReturnConsumedCapacity='TOTAL'
-            )
-        else:
-            response = client.query(
-                TableName=os.getenv('DYNAMODB_ACCOUNTS_TABLE_NAME'),
-                IndexName=index_name,
-                Select='ALL_ATTRIBUTES',
-                Limit=10,
-                ConsistentRead=use_consistent_read,
-                KeyConditions=key,
-                ReturnConsumedCapacity='TOTAL',
-                ExclusiveStartKey=next_token
-            )
-
-        debug_log(message='response={}', variable_as_list=[response,], logger=logger)
-        if 'Items' in response:
-            for item in response['Items']:
-                record = dict()
-                for field_name, field_data in item:
-                    for field_data_type, field_data_value in field_data.items():
-                        if field_data_type == 'S':
-                            record[field_name] = '{}'.format(field_data_value)
-                        if field_data_type == 'N':
-                            record[field_name] = Decimal(field_data_value)
-                        if field_data_type == 'BOOL':
-                            record[field_name] = field_data_value   
-                records.append(record)
-
-        if 'LastEvaluatedKey' in response:
-            records += get_dynamodb_record_by_indexed_query(key=key,index_name=index_name,use_consistent_read=use_consistent_read,boto3_clazz=boto3_clazz,logger=logger,next_token=response['LastEvaluatedKey'])
+        for record in paginate_dynamodb_query(
+            query_parameters={
+                'TableName': os.getenv('DYNAMODB_ACCOUNTS_TABLE_NAME'),
+                'IndexName': index_name,
+                'Select': 'ALL_ATTRIBUTES',
+                'ConsistentRead': use_consistent_read,
+                'KeyConditions': key,
+                'ReturnConsumedCapacity': 'TOTAL',
+            },
+            page_size=page_size,
+            max_items=max_items,
+            start_key=next_token,
+            boto3_clazz=boto3_clazz,
+            logger=logger
+        ):
+            records.append(record)
     except:
         logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
-    if 'Balance' not in records:
-            records['Balance'] = Decimal('0')
-    debug_log(message='record={}', variable_as_list=[records,], logger=logger)
+    debug_log(message='records={}', variable_as_list=[records,], logger=logger)
     return records
 
 
@@ -247,57 +853,111 @@ def get_dynamodb_record_by_primary_index_query_with_filter(
     use_consistent_read: bool=False,
     boto3_clazz=boto3,
     logger=get_logger(),
-    next_token: dict=None
+    next_token: dict=None,
+    batch: dict=None,
+    page_size: int=QUERY_PAGE_SIZE_DEFAULT,
+    max_items: int=None
 )->list:
+    """
+        Errors are raised: an empty result must mean that no matching record exists, not that the query failed
+    """
     records = list()
     debug_log(message='key={}', variable_as_list=[key,], logger=logger)
     debug_log(message='query_filter={}', variable_as_list=[query_filter,], logger=logger)
+    if batch is not None and next_token is None:
+        # Records staged earlier in the same batch are not in the table yet
+        records += batch_find_pending_records(
+            batch=batch,
+            table_name=os.getenv('DYNAMODB_ACCOUNTS_TABLE_NAME'),
+            conditions={**key, **query_filter},
+            logger=logger
+        )
+    if max_items is not None:
+        if len(records) >= max_items:
+            records = records[0:max_items]
+            debug_log(message='records={}', variable_as_list=[records,], logger=logger)
+            return records
+        max_items = max_items - len(records)
+    try:
+        for record in paginate_dynamodb_query(
+            query_parameters={
+                'TableName': os.getenv('DYNAMODB_ACCOUNTS_TABLE_NAME'),
+                'Select': 'ALL_ATTRIBUTES',
+                'ConsistentRead': use_consistent_read,
+                'KeyConditions': key,
+                'ReturnConsumedCapacity': 'TOTAL',
+                'QueryFilter': query_filter,
+            },
+            page_size=page_size,
+            max_items=max_items,
+            start_key=next_token,
+            boto3_clazz=boto3_clazz,
+            logger=logger
+        ):
+            logger.info('Retrieved record: {}'.format(record))
+            records.append(record)
+    except:
+        logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+        raise
+    debug_log(message='records={}', variable_as_list=[records,], logger=logger)
+    return records
+
+
+def batch_write_dynamodb_records(
+    records: list,
+    max_retries: int=5,
+    boto3_clazz=boto3,
+    logger=get_logger()
+)->bool:
+    """
+        Write all `records`, a list of `(table_name, record_data)` tuples, with a `BatchWriter`.
+    """
+    writer = BatchWriter(boto3_clazz=boto3_clazz, logger=logger, max_retries=max_retries)
+    try:
+        for table_name, record_data in records:
+            writer.put(table_name=table_name, record_data=record_data)
+    except:
+        logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+    return writer.close()
+
+
+def transact_write_dynamodb_records(
+    transact_items: list,
+    boto3_clazz=boto3,
+    logger=get_logger()
+)->str:
+    """
+        Commit all `transact_items` (TransactWriteItems format) in a single all-or-nothing transaction.
+
+        Returns one of:
+
+            COMMITTED   - all items were written
+            CONFLICT    - a condition check failed or another transaction touched the same items - safe to retry
+            FAILED      - any other error
+    """
     try:
         client=get_client(client_name='dynamodb', region='eu-central-1', boto3_clazz=boto3_clazz)
-        response = dict()
-        if next_token is None:
-            response = client.query(
-                TableName=os.getenv('DYNAMODB_ACCOUNTS_TABLE_NAME'),
-                Select='ALL_ATTRIBUTES',
-                Limit=10,
-                ConsistentRead=use_consistent_read,
-                KeyConditions=key,
-                ReturnConsumedCapacity='TOTAL',
-                QueryFilter=query_filter
-            )
-        else:
-            response = client.query(
-                TableName=os.getenv('DYNAMODB_ACCOUNTS_TABLE_NAME'),
-                Select='ALL_ATTRIBUTES',
-                Limit=10,
-                ConsistentRead=use_consistent_read,
-                KeyConditions=key,
+        with METRICS.aws_call(service='DynamoDB', operation='TransactWriteItems') as call:
+            response = client.transact_write_items(
+                TransactItems=transact_items,
                 ReturnConsumedCapacity='TOTAL',
-                ExclusiveStartKey=next_token,
-                QueryFilter=query_filter
+                ReturnItemCollectionMetrics='SIZE'
             )
-
+            call['Response'] = response
         debug_log(message='response={}', variable_as_list=[response,], logger=logger)
-        if 'Items' in response:
-            for item in response['Items']:
-                record = dict()
-                for field_name, field_data in item.items():
-                    for field_data_type, field_data_value in field_data.items():
-                        if field_data_type == 'S':
-                            record[field_name] = '{}'.format(field_data_value)
-                        if field_data_type == 'N':
-                            record[field_name] = Decimal(field_data_value)
-                        if field_data_type == 'BOOL':
-                            record[field_name] = field_data_value   
-                logger.info('Retrieved record: {}'.format(record))
-                records.append(record)
-
-        if 'LastEvaluatedKey' in response:
-            records += get_dynamodb_record_by_primary_index_query_with_filter(key=key,query_filter=query_filter,use_consistent_read=use_consistent_read,boto3_clazz=boto3_clazz,logger=logger,next_token=response['LastEvaluatedKey'])
-    except:
+        return 'COMMITTED'
+    except Exception as e:
+        error_response = dict()
+        if hasattr(e, 'response') is True:
+            error_response = e.response
+        if 'Error' in error_response:
+            if error_response['Error']['Code'] == 'TransactionCanceledException' and 'CancellationReasons' in error_response:
+                for reason in error_response['CancellationReasons']:
+                    if reason['Code'] in ('ConditionalCheckFailed', 'TransactionConflict'):
+                        logger.warning('Transaction cancelled: {}'.format(error_response['CancellationReasons']))
+                        return 'CONFLICT'
         logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
-    debug_log(message='records={}', variable_as_list=[records,], logger=logger)
-    return records
+    return 'FAILED'
 
 
 def send_sqs_tx_cleanup_message(
@@ -307,12 +967,13 @@ def send_sqs_tx_cleanup_message(
 )->bool:
     try:
         json_body = json.dumps(body)
-        session = get_session(boto3_clazz=boto3_clazz)
-        sqs = session.resource('sqs')
-        queue = sqs.get_queue_by_name(QueueName='AccountTransactionCleanupQueue')
-        response = queue.send_message(
-            MessageBody=json_body
-        )
+        client = get_client(client_name='sqs', boto3_clazz=boto3_clazz)
+        queue_url = get_queue_url(queue_name='AccountTransactionCleanupQueue', boto3_clazz=boto3_clazz)
+        with METRICS.aws_call(service='SQS', operation='SendMessage'):
+            response = client.send_message(
+                QueueUrl=queue_url,
+                MessageBody=json_body
+            )
         debug_log(message='response={}', variable_as_list=[response,], logger=logger)
         return True
     except:
@@ -320,76 +981,244 @@ def send_sqs_tx_cleanup_message(
     return False
 
 
+###############################################################################
+###                                                                         ###
+###                     B A L A N C E    C A C H E                          ###
+###                                                                         ###
+###############################################################################
+
+
+class BalanceVersionConflict(Exception):
+    """
+        Raised when a balance commit is rejected because the balance version changed since it was read
+    """
+
+    def __init__(self, account_ref: str):
+        super().__init__('Balance version conflict on account {}'.format(account_ref))
+        self.account_ref = account_ref
+
+
+BALANCE_CACHE = OrderedDict()
+BALANCE_CACHE_LOCK = threading.Lock()
+REDIS_CLIENT = None
+
+
+def balance_cache_enabled()->bool:
+    if 'Environment' not in cache:
+        return False
+    return cache['Environment']['Data']['BALANCE_CACHE_SIZE'] > 0
+
+
+def get_redis_client(logger=get_logger()):
+    """
+        Returns a Redis client if REDIS_HOST is configured and the redis package is available, otherwise None
+    """
+    global REDIS_CLIENT
+    if redis is None or cache['Environment']['Data']['REDIS_HOST'] == '':
+        return None
+    if REDIS_CLIENT is None:
+        try:
+            REDIS_CLIENT = redis.Redis(
+                host=cache['Environment']['Data']['REDIS_HOST'],
+                port=cache['Environment']['Data']['REDIS_PORT'],
+                db=0,
+                socket_timeout=1,
+                socket_connect_timeout=1
+            )
+        except:
+            logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+    return REDIS_CLIENT
+
+
+def _balance_cache_serialize(balances: dict)->str:
+    return json.dumps(
+        {
+            'Available': str(balances['Available']),
+            'Actual': str(balances['Actual']),
+            'Versions': {
+                'Available': str(_helper_balance_version(updated_balances=balances, balance_type='Available')),
+                'Actual': str(_helper_balance_version(updated_balances=balances, balance_type='Actual')),
+            },
+        }
+    )
+
+
+def _balance_cache_deserialize(data: str)->dict:
+    raw = json.loads(data)
+    return {
+        'Available': Decimal(raw['Available']),
+        'Actual': Decimal(raw['Actual']),
+        'Versions': {
+            'Available': Decimal(raw['Versions']['Available']),
+            'Actual': Decimal(raw['Versions']['Actual']),
+        },
+    }
+
+
+def balance_cache_get(account_ref: str, logger=get_logger())->dict:
+    """
+        Returns a copy of the cached balances (with versions) of the account, or None on a cache miss.
+
+        The process local LRU is checked first, followed by Redis (when configured). A Redis hit is copied into the
+        local LRU.
+    """
+    if balance_cache_enabled() is False:
+        return None
+    now = get_utc_timestamp(with_decimal=False)
+    with BALANCE_CACHE_LOCK:
+        if account_ref in BALANCE_CACHE:
+            entry = BALANCE_CACHE[account_ref]
+            if entry['Expiry'] > now:
+                BALANCE_CACHE.move_to_end(account_ref)
+                return copy.deepcopy(entry['Balances'])
+            del BALANCE_CACHE[account_ref]
+    redis_client = get_redis_client(logger=logger)
+    if redis_client is not None:
+        try:
+            data = redis_client.get('balance_{}'.format(account_ref))
+            if data is not None:
+                balances = _balance_cache_deserialize(data=data.decode('utf-8'))
+                _balance_cache_put_local(account_ref=account_ref, balances=balances)
+                return balances
+        except:
+            logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+    return None
+
+
+def _balance_cache_put_local(account_ref: str, balances: dict):
+    with BALANCE_CACHE_LOCK:
+        BALANCE_CACHE[account_ref] = {
+            'Expiry': get_utc_timestamp(with_decimal=False) + cache['Environment']['Data']['BALANCE_CACHE_TTL'],
+            'Balances': copy.deepcopy(balances),
+        }
+        BALANCE_CACHE.move_to_end(account_ref)
+        while len(BALANCE_CACHE) > cache['Environment']['Data']['BALANCE_CACHE_SIZE']:
+            BALANCE_CACHE.popitem(last=False)
+
+
+def balance_cache_put(account_ref: str, balances: dict, logger=get_logger()):
+    """
+        Write through: called with the balances (and versions) as they are in DynamoDB after a successful commit
+    """
+    if balance_cache_enabled() is False:
+        return
+    _balance_cache_put_local(account_ref=account_ref, balances=balances)
+    redis_client = get_redis_client(logger=logger)
+    if redis_client is not None:
+        try:
+            redis_client.set(
+                'balance_{}'.format(account_ref),
+                _balance_cache_serialize(balances=balances),
+                ex=cache['Environment']['Data']['BALANCE_CACHE_TTL']
+            )
+        except:
+            logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+            balance_cache_invalidate(account_ref=account_ref, logger=logger)
+
+
+def balance_cache_invalidate(account_ref: str, logger=get_logger()):
+    if balance_cache_enabled() is False:
+        return
+    with BALANCE_CACHE_LOCK:
+        if account_ref in BALANCE_CACHE:
+            del BALANCE_CACHE[account_ref]
+    redis_client = get_redis_client(logger=logger)
+    if redis_client is not None:
+        try:
+            redis_client.delete('balance_{}'.format(account_ref))
+        except:
+            logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+    logger.info('Balance cache invalidated for account {}'.format(account_ref))
+
+
 ###############################################################################
 ###                                                                         ###
 ###                 E V E N T    S T A T E     U P D A T E S                ###
 ###                                                                         ###
 ###############################################################################
 
+@METRICS.timer(step='UpdateObjectState')
 def update_object_sate(
     tx_data: dict,
     logger=get_logger(),
-    boto3_clazz=boto3
+    boto3_clazz=boto3,
+    batch: dict=None,
+    tx_context: dict=None
 ):
     try:
-        tx_date = _helper_tx_date(timestamp=tx_data['EventTimeStamp'])
-        tx_time = _helper_tx_time(timestamp=tx_data['EventTimeStamp'])
-        object_state_key = {
-            'PK'                : { 'S'     : 'KEY#{}'.format(tx_data['EventSourceDataResource']['S3Key'])  },
-            'SK'                : { 'S'     : 'STATE'                                                       },
-        }
-        object_state_data = {
-            'TransactionDate'   : { 'N'     : '{}'.format(tx_date)                                          },
-            'TransactionTime'   : { 'N'     : '{}'.format(tx_time)                                          },
-            'InEventBucket'     : { 'BOOL'  : True                                                          },
-            'InArchiveBucket'   : { 'BOOL'  : False                                                         },
-            'InRejectedBucket'  : { 'BOOL'  : False                                                         },
-            'AccountNumber'     : { 'S'     : '{}'.format(tx_data['ReferenceAccount'])                      },
-            'Processed'         : { 'BOOL'  : True                                                          },
-        }
-        object_state = {**object_state_key, **object_state_data}
+        tx_context = _helper_transaction_context(tx_data=tx_data, tx_context=tx_context)
+        object_state = encode_item(record={
+            'PK'                : tx_context['ObjectKey'],
+            'SK'                : 'STATE',
+            'TransactionDate'   : tx_context['TransactionDate'],
+            'TransactionTime'   : tx_context['TransactionTime'],
+            'InEventBucket'     : True,
+            'InArchiveBucket'   : False,
+            'InRejectedBucket'  : False,
+            'AccountNumber'     : '{}'.format(tx_data['ReferenceAccount']),
+            'Processed'         : True,
+        })
         create_dynamodb_record(
             table_name=os.getenv('DYNAMODB_OBJECT_TABLE_NAME'),
             record_data=object_state,
             boto3_clazz=boto3_clazz,
-            logger=logger
+            logger=logger,
+            batch=batch
         )
         logger.info('OBJECT STATE RECORD UPDATED')
     except:
         logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
 
+def build_object_event_record(
+    origin_event_key: str, 
+    tx_date: int,
+    tx_time: int,
+    reference_account_number: str,
+    event_type: str='ProcessingEvent',
+    is_error: bool=False,
+    error_message: str='no-error'
+)->dict:
+    return encode_item(record={
+        'PK'                : 'KEY#{}'.format(origin_event_key),
+        'SK'                : 'EVENT#{}'.format(get_utc_timestamp(with_decimal=False)),
+        'TransactionDate'   : tx_date,
+        'TransactionTime'   : tx_time,
+        'EventType'         : event_type,
+        'AccountNumber'     : '{}'.format(reference_account_number),
+        'ErrorState'        : is_error,
+        'ErrorReason'       : error_message,
+    })
+
+
 def update_object_table_add_event(
     origin_event_key: str, 
     event_timestamp: str,
-    tx_date: Decimal,
-    tx_time: Decimal,
+    tx_date: int,
+    tx_time: int,
     reference_account_number: str,
     event_type: str='ProcessingEvent',
     is_error: bool=False,
     error_message: str='no-error',
     boto3_clazz=boto3,
-    logger=get_logger()
+    logger=get_logger(),
+    batch: dict=None
 ):
     try:
-        object_event_key = {
-            'PK'                : { 'S'     : 'KEY#{}'.format(origin_event_key)                         },
-            'SK'                : { 'S'     : 'EVENT#{}'.format(get_utc_timestamp(with_decimal=False))  },
-        }
-        object_event_data = {
-            'TransactionDate'   : { 'N'     : '{}'.format(tx_date)                                      },
-            'TransactionTime'   : { 'N'     : '{}'.format(tx_time)                                      },
-            'EventType'         : { 'S'     : event_type                                                },
-            'AccountNumber'     : { 'S'     : '{}'.format(reference_account_number)                     },
-            'ErrorState'        : { 'BOOL'  : is_error                                                  },
-            'ErrorReason'       : { 'S'     : error_message                                             },
-        }
-        object_event = {**object_event_key, **object_event_data}
-
+        object_event = build_object_event_record(
+            origin_event_key=origin_event_key,
+            tx_date=tx_date,
+            tx_time=tx_time,
+            reference_account_number=reference_account_number,
+            event_type=event_type,
+            is_error=is_error,
+            error_message=error_message
+        )
         create_dynamodb_record(
             table_name=os.getenv('DYNAMODB_OBJECT_TABLE_NAME'),
             record_data=object_event,
             boto3_clazz=boto3_clazz,
-            logger=logger
+            logger=logger,
+            batch=batch
         )
         logger.info('OBJECT STATE EVENT RECORD CREATED')
 
@@ -397,6 +1226,166 @@ def update_object_table_add_event(
         logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
 
 
+###############################################################################
+###                                                                         ###
+###                         I D E M P O T E N C Y                           ###
+###                                                                         ###
+###############################################################################
+
+
+IDEMPOTENCY_SK_PREFIX = 'IDEMPOTENCY#'
+BATCH_GET_MAX_KEYS = 100
+
+
+def build_idempotency_key(tx_data: dict)->dict:
+    """
+        Every processed transaction has an idempotency record in the partition of its reference account, keyed by the
+        request ID and the event key. The `Outcome` of the record is either:
+
+            APPLIED:    The balances were updated - the record is committed together with the balance records
+            REJECTED:   The transaction was rejected (for example insufficient funds) - retrying must not apply it
+                        later against a different balance
+
+        A redelivered or replayed transaction finds the record and is skipped with the same outcome.
+    """
+    return {
+        'PK'                : { 'S': '{}'.format(tx_data['ReferenceAccount'])                                                                   },
+        'SK'                : { 'S': '{}{}#{}'.format(IDEMPOTENCY_SK_PREFIX, tx_data['RequestId'], tx_data['EventSourceDataResource']['S3Key']) },
+    }
+
+
+def build_idempotency_record(tx_data: dict, tx_context: dict=None, outcome: str='APPLIED')->dict:
+    """
+        The record deliberately has no `RequestId` or `EventKey` attribute: verification events find their pending
+        transaction by `RequestId`, and the `EventKeyIdx` index only has to contain the transaction records.
+    """
+    tx_context = _helper_transaction_context(tx_data=tx_data, tx_context=tx_context)
+    idempotency_data = encode_item(record={
+        'Outcome'           : outcome,
+        'TransactionType'   : '{}'.format(tx_data['TransactionType']),
+        'TransactionDate'   : tx_context['TransactionDate'],
+        'TransactionTime'   : tx_context['TransactionTime'],
+        'ProcessedTimestamp': get_utc_timestamp(with_decimal=False),
+    })
+    return {**build_idempotency_key(tx_data=tx_data), **idempotency_data}
+
+
+def build_idempotency_put_item(tx_data: dict, tx_context: dict=None)->dict:
+    """
+        TransactWriteItems put of the APPLIED idempotency record that cancels the transaction when a record already
+        exists
+    """
+    return {
+        'Put': {
+            'TableName': os.getenv('DYNAMODB_ACCOUNTS_TABLE_NAME'),
+            'Item': build_idempotency_record(tx_data=tx_data, tx_context=tx_context, outcome='APPLIED'),
+            'ConditionExpression': 'attribute_not_exists(SK)',
+        }
+    }
+
+
+def get_recorded_outcome(key: dict, boto3_clazz=boto3, logger=get_logger())->str:
+    """
+        Returns the `Outcome` of the idempotency record, or None when there is no record.
+
+        Unlike the other helpers, errors are raised: an idempotency check that cannot be done must fail the message
+        instead of risking a transaction being applied twice.
+    """
+    client=get_client(client_name='dynamodb', region='eu-central-1', boto3_clazz=boto3_clazz)
+    with METRICS.aws_call(service='DynamoDB', operation='GetItem') as call:
+        response = client.get_item(
+            TableName=os.getenv('DYNAMODB_ACCOUNTS_TABLE_NAME'),
+            Key=key,
+            ConsistentRead=True,
+            ProjectionExpression='Outcome',
+            ReturnConsumedCapacity='TOTAL'
+        )
+        call['Response'] = response
+    debug_log(message='response={}', variable_as_list=[response,], logger=logger)
+    if 'Item' in response:
+        return response['Item'].get('Outcome', {'S': 'APPLIED'})['S']
+    return None
+
+
+def get_recorded_outcomes(keys: list, max_retries: int=5, boto3_clazz=boto3, logger=get_logger())->dict:
+    """
+        Returns the `Outcome` of the idempotency records that exist, by `(PK, SK)`, reading up to 100 keys per
+        BatchGetItem call. Errors are raised, like in `get_recorded_outcome()`.
+    """
+    table_name = os.getenv('DYNAMODB_ACCOUNTS_TABLE_NAME')
+    outcomes = dict()
+    client=get_client(client_name='dynamodb', region='eu-central-1', boto3_clazz=boto3_clazz)
+    for chunk_start in range(0, len(keys), BATCH_GET_MAX_KEYS):
+        request_items = {
+            table_name: {
+                'Keys': keys[chunk_start:chunk_start + BATCH_GET_MAX_KEYS],
+                'ConsistentRead': True,
+                'ProjectionExpression': 'PK, SK, Outcome',
+            }
+        }
+        attempt = 0
+        while len(request_items) > 0:
+            if attempt > max_retries:
+                raise Exception('BatchGetItem keys still unprocessed after {} retries'.format(max_retries))
+            if attempt > 0:
+                time.sleep(min(2.0, 0.05 * (2 ** attempt)) * random.random())
+            attempt += 1
+            with METRICS.aws_call(service='DynamoDB', operation='BatchGetItem') as call:
+                response = client.batch_get_item(RequestItems=request_items, ReturnConsumedCapacity='TOTAL')
+                call['Response'] = response
+            for item in response.get('Responses', dict()).get(table_name, list()):
+                outcomes[(item['PK']['S'], item['SK']['S'])] = item.get('Outcome', {'S': 'APPLIED'})['S']
+            request_items = response.get('UnprocessedKeys', dict())
+    debug_log(message='outcomes={}', variable_as_list=[outcomes,], logger=logger)
+    return outcomes
+
+
+def prefetch_transaction_outcomes(records: list, batch: dict, boto3_clazz=boto3, logger=get_logger()):
+    """
+        Read the idempotency records of all the SQS records of a shard up front, so the idempotency check of each
+        transaction in batch mode is a dictionary lookup. When the read fails, every transaction is checked on its own.
+    """
+    keys = dict()
+    for record in records:
+        try:
+            key = build_idempotency_key(tx_data=json.loads(record['body']))
+            keys[(key['PK']['S'], key['SK']['S'])] = key
+        except:
+            logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+    try:
+        batch['TransactionOutcomes'] = get_recorded_outcomes(keys=list(keys.values()), boto3_clazz=boto3_clazz, logger=logger)
+    except:
+        logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+        batch['TransactionOutcomes'] = None
+
+
+def get_transaction_outcome(tx_data: dict, boto3_clazz=boto3, logger=get_logger(), batch: dict=None)->str:
+    """
+        The outcome of an earlier processing of the transaction, or None when the transaction was never processed
+    """
+    key = build_idempotency_key(tx_data=tx_data)
+    if batch is not None:
+        if (key['PK']['S'], key['SK']['S']) in batch['StagedOutcomes']:
+            return batch['StagedOutcomes'][(key['PK']['S'], key['SK']['S'])]
+        if batch.get('TransactionOutcomes', None) is not None:
+            return batch['TransactionOutcomes'].get((key['PK']['S'], key['SK']['S']), None)
+    return get_recorded_outcome(key=key, boto3_clazz=boto3_clazz, logger=logger)
+
+
+def record_rejected_transaction(tx_data: dict, boto3_clazz=boto3, logger=get_logger(), batch: dict=None, tx_context: dict=None):
+    idempotency_record = build_idempotency_record(tx_data=tx_data, tx_context=tx_context, outcome='REJECTED')
+    if batch is not None:
+        # Committed with the balances of the account: the rejection depends on the balances staged before it
+        batch_stage_account_write(batch=batch, account_ref=tx_data['ReferenceAccount'], balance_records=list(), idempotency_record=idempotency_record)
+        return
+    create_dynamodb_record(
+        table_name=os.getenv('DYNAMODB_ACCOUNTS_TABLE_NAME'),
+        record_data=idempotency_record,
+        boto3_clazz=boto3_clazz,
+        logger=logger
+    )
+
+
 ###############################################################################
 ###                                                                         ###
 ###               T R A N S A C T I O N    P R O C E S S I N G              ###
@@ -404,12 +1393,33 @@ def update_object_table_add_event(
 ###############################################################################
 
 
-def _helper_tx_date(timestamp: int)->str:
-    return Decimal(datetime.utcfromtimestamp(timestamp).strftime('%Y%m%d'))
+def new_transaction_context(tx_data: dict)->dict:
+    """
+        Values derived from `tx_data` that are used by most records written for a transaction, computed once per
+        transaction instead of for every record:
+
+            TransactionDate:        YYYYMMDD of the EventTimeStamp (UTC)
+            TransactionTime:        HHMMSS of the EventTimeStamp (UTC)
+            TransactionTimestamp:   The EventTimeStamp in seconds
+            EventKey:               The S3 key of the event object
+            ObjectKey:              The PK of the event object in the object table
+            EventRawData:           The JSON serialized `tx_data` - a handler that changes `tx_data` must update it
+    """
+    date_time = datetime.utcfromtimestamp(tx_data['EventTimeStamp']).strftime('%Y%m%d%H%M%S')
+    return {
+        'TransactionDate': int(date_time[0:8]),
+        'TransactionTime': int(date_time[8:14]),
+        'TransactionTimestamp': int(tx_data['EventTimeStamp']),
+        'EventKey': tx_data['EventSourceDataResource']['S3Key'],
+        'ObjectKey': 'KEY#{}'.format(tx_data['EventSourceDataResource']['S3Key']),
+        'EventRawData': json.dumps(tx_data),
+    }
 
 
-def _helper_tx_time(timestamp: int)->str:
-    return Decimal(datetime.utcfromtimestamp(timestamp).strftime('%H%M%S'))
+def _helper_transaction_context(tx_data: dict, tx_context: dict=None)->dict:
+    if tx_context is None:
+        return new_transaction_context(tx_data=tx_data)
+    return tx_context
 
 
 def _helper_event_types_as_tuple(
@@ -424,36 +1434,126 @@ def _helper_event_types_as_tuple(
     return tuple(event_types)
 
 
+def _helper_get_balance_record(
+    account_ref: str,
+    type: str='Available',
+    boto3_clazz=boto3,
+    logger=get_logger()
+)->dict:
+    """
+        Returns a dict with the `Balance` and the `Version` of the balance record. Records that do not exist yet (or
+        that were created before versioning was introduced) have version 0. Read errors are raised.
+    """
+    balance_record = {
+        'Balance': Decimal('0'),
+        'Version': Decimal('0'),
+    }
+    key = {
+        'PK'        : { 'S': '{}'.format(account_ref)                   },
+        'SK'        : { 'S': 'SAVINGS#BALANCE#{}'.format(type.upper())  },
+    }
+    record = get_dynamodb_record_by_key(key=key, boto3_clazz=boto3_clazz, logger=logger)
+    if isinstance(record['Balance'], Decimal) is True:
+        balance_record['Balance'] = record['Balance']
+    if 'Version' in record:
+        if isinstance(record['Version'], Decimal) is True:
+            balance_record['Version'] = record['Version']
+    return balance_record
+
+
 def _helper_get_balance(
     account_ref: str,
     type: str='Available',
     boto3_clazz=boto3,
     logger=get_logger()
 )->Decimal:
-    try:
-        key = {
-            'PK'        : { 'S': '{}'.format(account_ref)                   },
-            'SK'        : { 'S': 'SAVINGS#BALANCE#{}'.format(type.upper())  },
+    return _helper_get_balance_record(account_ref=account_ref, type=type, boto3_clazz=boto3_clazz, logger=logger)['Balance']
+
+
+def _helper_get_previous_transaction_data(
+    tx_data: dict,
+    boto3_clazz=boto3,
+    logger=get_logger(),
+    batch: dict=None
+)->dict:
+    """
+        Returns the `tx_data` of the pending transaction referenced by `PreviousRequestIdReference`, or an empty dict
+        when there is no such transaction. Query errors are raised, so that the verifying transaction is retried
+        instead of rejected.
+    """
+    key = {
+        'PK': {
+            'AttributeValueList': [
+                {
+                    'S': tx_data['ReferenceAccount'],
+                },
+            ],
+            'ComparisonOperator': 'EQ'
         }
-        balance = get_dynamodb_record_by_key(key=key, boto3_clazz=boto3_clazz, logger=logger)['Balance']
-        if isinstance(balance, Decimal) is True:
-            return balance
-    except:
-        logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
-    return Decimal('0')
+    }
+    filter = {
+            'RequestId': {
+                'AttributeValueList': [
+                    {
+                        'S': '{}'.format(tx_data['PreviousRequestIdReference']),
+                    },
+                ],
+                'ComparisonOperator': 'EQ'
+            }
+        }
+    records = get_dynamodb_record_by_primary_index_query_with_filter(
+        key=key,
+        query_filter=filter,
+        use_consistent_read=True,
+        boto3_clazz=boto3_clazz,
+        logger=logger,
+        batch=batch,
+        max_items=1
+    )
+    if len(records) == 0:
+        return dict()
+    previous_record = json.loads(records[0]['EventRawData'])
+    logger.info('Previous unverified transaction data: {}'.format(previous_record))
+    return previous_record
 
 
+@METRICS.timer(step='CalculateUpdatedBalances')
 def _helper_calculate_updated_balances(
     account_ref: str,
     amount: Decimal,
     effect_on_actual_balance: str=None,
     effect_on_available_balance: str=None,
     boto3_clazz=boto3,
-    logger=get_logger()
+    logger=get_logger(),
+    batch: dict=None,
+    required_available: Decimal=None
 )->dict:
+    """
+        The balances may come from the balance cache, in batch mode when the account is loaded into the batch. Every
+        balance commit is conditional on the versions of the balances, so a stale cached balance makes the commit fail
+        (the account is then removed from the cache and the transaction retried) instead of overwriting a newer
+        balance. When `required_available` is given and the cached available balance is lower, the balances are read
+        from DynamoDB instead, so that a stale cache can never be the reason for rejecting a transaction.
+    """
     balances = dict()
-    balances['Available'] = _helper_get_balance(account_ref=account_ref, type='Available', boto3_clazz=boto3_clazz, logger=logger)
-    balances['Actual'] = _helper_get_balance(account_ref=account_ref, type='Actual', boto3_clazz=boto3_clazz, logger=logger)
+    if batch is not None and account_ref in batch['Balances']:
+        balances = copy.deepcopy(batch['Balances'][account_ref])
+    else:
+        cached_balances = balance_cache_get(account_ref=account_ref, logger=logger)
+        if cached_balances is not None and required_available is not None:
+            if int(cached_balances['Available'].compare(required_available)) < 0:
+                cached_balances = None
+        if cached_balances is not None:
+            logger.info('[account_reference={}] Balances retrieved from cache'.format(account_ref))
+            balances = cached_balances
+        else:
+            balances['Versions'] = dict()
+            for balance_type in ('Available', 'Actual'):
+                balance_record = _helper_get_balance_record(account_ref=account_ref, type=balance_type, boto3_clazz=boto3_clazz, logger=logger)
+                balances[balance_type] = balance_record['Balance']
+                balances['Versions'][balance_type] = balance_record['Version']
+        if batch is not None:
+            batch['Balances'][account_ref] = copy.deepcopy(balances)
     effect = dict()
     effect['Available'] = effect_on_available_balance
     effect['Actual'] = effect_on_actual_balance
@@ -473,55 +1573,110 @@ def _helper_calculate_updated_balances(
     return balances
 
 
-def _helper_commit_transaction_events(
+def _helper_build_transaction_event_records(
     tx_data: dict, 
     event_types: tuple,
     effect_on_actual_balance: str='None',
     effect_on_available_balance: str='None',
-    boto3_clazz=boto3,
-    logger=get_logger()
-):
-    tx_date_value = _helper_tx_date(timestamp=tx_data['EventTimeStamp'])
-    tx_time_value = _helper_tx_time(timestamp=tx_data['EventTimeStamp'])
+    tx_context: dict=None
+)->list:
+    """
+        The `CommitTimestamp` is the time the record is written, not the event time. The account ledger snapshots
+        use it (through the sparse `CommitTimestampIdx` index) to find the transactions committed since a snapshot,
+        which also includes events that were processed long after they were created. Records staged in a batch are
+        stamped again by `commit_batch()`.
+    """
+    records = list()
+    tx_context = _helper_transaction_context(tx_data=tx_data, tx_context=tx_context)
+    commit_timestamp = get_utc_timestamp(with_decimal=False)
     previous_request_id = "n/a"
     if 'PreviousRequestIdReference' in tx_data:
         previous_request_id = tx_data['PreviousRequestIdReference']
     for event_type in event_types:
-        event_key = {
-            'PK'        : { 'S': tx_data['ReferenceAccount']                                                                                                                },
-            'SK'        : { 'S': 'TRANSACTIONS#{}#{}#{}'.format(event_type, tx_data['EventSourceDataResource']['S3Bucket'], tx_data['EventSourceDataResource']['S3Key'])    },
-        }
-        event_data = {
-            'TransactionDate'           : { 'N': '{}'.format(tx_date_value)                                 },
-            'TransactionTime'           : { 'N': '{}'.format(tx_time_value)                                 },
-            'EventKey'                  : { 'S': '{}'.format(tx_data['EventSourceDataResource']['S3Key'])   },
-            'EventRawData'              : { 'S': '{}'.format(json.dumps(tx_data))                           },
-            'Amount'                    : { 'N': '{}'.format(tx_data['Amount'])                             },
-            'TransactionType'           : { 'S': '{}'.format(tx_data['TransactionType'])                    },
-            'RequestId'                 : { 'S': '{}'.format(tx_data['RequestId'])                          },
-            'PreviousRequestIdReference': { 'S': '{}'.format(previous_request_id)                           },
-            'EffectOnActualBalance'     : { 'S': '{}'.format(effect_on_actual_balance)                      },
-            'EffectOnAvailableBalance'  : { 'S': '{}'.format(effect_on_available_balance)                   },
-        }
-        create_dynamodb_record(
-            table_name=os.getenv('DYNAMODB_ACCOUNTS_TABLE_NAME'),
-            record_data={**event_key, **event_data},
-            boto3_clazz=boto3_clazz,
-            logger=logger
-        )
+        records.append(encode_item(record={
+            'PK'                        : tx_data['ReferenceAccount'],
+            'SK'                        : 'TRANSACTIONS#{}#{}#{}'.format(event_type, tx_data['EventSourceDataResource']['S3Bucket'], tx_data['EventSourceDataResource']['S3Key']),
+            'TransactionDate'           : tx_context['TransactionDate'],
+            'TransactionTime'           : tx_context['TransactionTime'],
+            'TransactionTimestamp'      : tx_context['TransactionTimestamp'],
+            'CommitTimestamp'           : commit_timestamp,
+            'EventKey'                  : tx_context['EventKey'],
+            'EventRawData'              : tx_context['EventRawData'],
+            'Amount'                    : Decimal('{}'.format(tx_data['Amount'])),
+            'TransactionType'           : '{}'.format(tx_data['TransactionType']),
+            'RequestId'                 : '{}'.format(tx_data['RequestId']),
+            'PreviousRequestIdReference': '{}'.format(previous_request_id),
+            'EffectOnActualBalance'     : '{}'.format(effect_on_actual_balance),
+            'EffectOnAvailableBalance'  : '{}'.format(effect_on_available_balance),
+        }))
+    return records
+
+
+def _helper_balance_version(updated_balances: dict, balance_type: str)->Decimal:
+    if 'Versions' in updated_balances:
+        if balance_type in updated_balances['Versions']:
+            return updated_balances['Versions'][balance_type]
+    return Decimal('0')
 
 
+def _helper_next_balances(updated_balances: dict)->dict:
+    """
+        The balances (and versions) as they will be after `updated_balances` has been committed
+    """
+    next_balances = copy.deepcopy(updated_balances)
+    next_balances['Versions'] = dict()
+    for balance_type in ('Available', 'Actual'):
+        next_balances['Versions'][balance_type] = _helper_balance_version(updated_balances=updated_balances, balance_type=balance_type) + 1
+    return next_balances
+
+
+def _helper_build_balance_records(
+    tx_data: dict, 
+    updated_balances: dict,
+    tx_context: dict=None
+)->list:
+    """
+        Each committed balance record increments the `Version` read with the balance. The version is used by the
+        transactional commit path as an optimistic lock on the balance.
+    """
+    records = list()
+    tx_context = _helper_transaction_context(tx_data=tx_data, tx_context=tx_context)
+    for balance_type in ('Available', 'Actual'):
+        version = _helper_balance_version(updated_balances=updated_balances, balance_type=balance_type)
+        records.append(encode_item(record={
+            'PK'                        : tx_data['ReferenceAccount'],
+            'SK'                        : 'SAVINGS#BALANCE#{}'.format(balance_type.upper()),
+            'LastTransactionDate'       : tx_context['TransactionDate'],
+            'LastTransactionTime'       : tx_context['TransactionTime'],
+            'EventKey'                  : tx_context['EventKey'],
+            'Balance'                   : Decimal('{}'.format(updated_balances[balance_type])),
+            'Version'                   : version + 1,
+        }))
+    return records
+
+
+@METRICS.timer(step='CommitUpdatedBalances')
 def _helper_commit_updated_balances(
     tx_data: dict, 
     updated_balances: dict=None,
+    event_records: list=None,
     effect_on_actual_balance: str='None',
     effect_on_available_balance: str='None',
     boto3_clazz=boto3,
-    logger=get_logger()
+    logger=get_logger(),
+    batch: dict=None,
+    tx_context: dict=None
 ):
-    tx_date_value = _helper_tx_date(timestamp=tx_data['EventTimeStamp'])
-    tx_time_value = _helper_tx_time(timestamp=tx_data['EventTimeStamp'])
-
+    """
+        The transaction records (`event_records`, see `_helper_build_transaction_event_records()`) and the
+        idempotency record of the transaction (see `build_idempotency_key()`) are committed together with the balance
+        records, so that the ledger of the account only ever has transaction records with a committed balance effect.
+
+        Outside of batch mode both balances and the idempotency record are committed in one TransactWriteItems call,
+        and only if the balance versions still match the versions that were read. The balances of an account can
+        also be changed by a transfer from another account, which is processed in another message group, so the
+        balances read may be stale even without the balance cache.
+    """
     if updated_balances is None:
         updated_balances = _helper_calculate_updated_balances(
             account_ref=tx_data['ReferenceAccount'],
@@ -529,29 +1684,227 @@ def _helper_commit_updated_balances(
             effect_on_actual_balance=effect_on_actual_balance,
             effect_on_available_balance=effect_on_available_balance,
             boto3_clazz=boto3_clazz,
-            logger=logger
+            logger=logger,
+            batch=batch
         )
 
-    for balance_type in ('Available', 'Actual'):
-        actual_balance_data = {
-            'PK'                        : { 'S': tx_data['ReferenceAccount']                                },
-            'SK'                        : { 'S': 'SAVINGS#BALANCE#{}'.format(balance_type.upper())          },
-            'LastTransactionDate'       : { 'N': '{}'.format(tx_date_value)                                 },
-            'LastTransactionTime'       : { 'N': '{}'.format(tx_time_value)                                 },
-            'EventKey'                  : { 'S': '{}'.format(tx_data['EventSourceDataResource']['S3Key'])   },
-            'Balance'                   : { 'N': '{}'.format(str(updated_balances[balance_type]))           },
-        }
-        create_dynamodb_record(
-            table_name=os.getenv('DYNAMODB_ACCOUNTS_TABLE_NAME'),
-            record_data=actual_balance_data,
+    if event_records is None:
+        event_records = list()
+
+    if batch is None:
+        transact_items = [{'Put': {'TableName': os.getenv('DYNAMODB_ACCOUNTS_TABLE_NAME'), 'Item': event_record}} for event_record in event_records]
+        transact_items += _helper_build_conditional_balance_put_items(tx_data=tx_data, updated_balances=updated_balances, tx_context=tx_context)
+        transact_items.append(build_idempotency_put_item(tx_data=tx_data, tx_context=tx_context))
+        commit_status = transact_write_dynamodb_records(
+            transact_items=transact_items,
             boto3_clazz=boto3_clazz,
             logger=logger
         )
+        if commit_status == 'COMMITTED':
+            balance_cache_put(account_ref=tx_data['ReferenceAccount'], balances=_helper_next_balances(updated_balances=updated_balances), logger=logger)
+            return
+        balance_cache_invalidate(account_ref=tx_data['ReferenceAccount'], logger=logger)
+        if commit_status == 'CONFLICT':
+            raise BalanceVersionConflict(account_ref=tx_data['ReferenceAccount'])
+        raise Exception('Balance commit failed for account {}'.format(tx_data['ReferenceAccount']))
+
+    # Batch mode: the balance records are committed per account by commit_batch(), conditional on the version they were loaded with
+    batch_stage_account_write(
+        batch=batch,
+        account_ref=tx_data['ReferenceAccount'],
+        balance_records=_helper_build_balance_records(tx_data=tx_data, updated_balances=updated_balances, tx_context=tx_context),
+        idempotency_record=build_idempotency_record(tx_data=tx_data, tx_context=tx_context),
+        event_records=event_records
+    )
+    batch['Balances'][tx_data['ReferenceAccount']] = _helper_next_balances(updated_balances=updated_balances)
 
 
-def cash_deposit(tx_data: dict, logger=get_logger(), boto3_clazz=boto3)->bool:
+def _helper_build_conditional_balance_put_items(
+    tx_data: dict,
+    updated_balances: dict,
+    tx_context: dict=None
+)->list:
+    """
+        Balance puts that only succeed if the balance record still has the version that was read
+    """
+    put_items = list()
+    for balance_record in _helper_build_balance_records(tx_data=tx_data, updated_balances=updated_balances, tx_context=tx_context):
+        put_items.append(build_conditional_balance_put_item(balance_record=balance_record))
+    return put_items
+
+
+def build_conditional_balance_put_item(balance_record: dict, version: Decimal=None)->dict:
+    """
+        TransactWriteItems put of a balance record built by `_helper_build_balance_records()`, conditional on the
+        stored record having `version` (or no version at all when `version` is 0). By default this is the version
+        before the `Version` of the record.
+    """
+    if version is None:
+        version = Decimal(balance_record['Version']['N']) - 1
+    put = {
+        'TableName': os.getenv('DYNAMODB_ACCOUNTS_TABLE_NAME'),
+        'Item': balance_record,
+        'ConditionExpression': 'attribute_not_exists(Version)',
+    }
+    if version.compare(Decimal('0')) != Decimal('0'):
+        put['ConditionExpression'] = 'Version = :version'
+        put['ExpressionAttributeValues'] = { ':version': { 'N': '{}'.format(version) } }
+    return {'Put': put}
+
+
+@METRICS.timer(step='CommitTransferTransaction')
+def _helper_commit_inter_account_transfer_transaction(
+    tx_data_outgoing: dict,
+    tx_data_incoming: dict,
+    max_attempts: int=3,
+    boto3_clazz=boto3,
+    logger=get_logger(),
+    tx_context_outgoing: dict=None,
+    tx_context_incoming: dict=None,
+    batch: dict=None
+)->bool:
+    """
+        Commits both sides of an inter account transfer, and the object table processing event, in a single
+        TransactWriteItems call.
+
+        Each balance put is conditional on the balance version read at the start of the attempt, so a concurrent
+        update of either account cancels the whole transaction. On a conflict the balances are read again, funds are
+        re-checked and the transaction is retried up to `max_attempts` times.
+
+        Only insufficient funds rejects the transfer (returns False). A commit that fails for any other reason, or
+        that still conflicts after `max_attempts`, is raised so that the message is retried.
+
+        In batch mode the records staged in `batch` must already be committed (see `inter_account_transfer()`). The
+        balances of the batch are used and updated with the committed balances.
+    """
+    tx_context_outgoing = _helper_transaction_context(tx_data=tx_data_outgoing, tx_context=tx_context_outgoing)
+    tx_context_incoming = _helper_transaction_context(tx_data=tx_data_incoming, tx_context=tx_context_incoming)
+    outgoing_transfer_amount = Decimal(tx_data_outgoing['Amount'])
+    same_account = tx_data_outgoing['ReferenceAccount'] == tx_data_incoming['ReferenceAccount']
+    attempt = 0
+    while attempt < max_attempts:
+        attempt += 1
+        logger.info('STEP: Transactional commit attempt {} of {}'.format(attempt, max_attempts))
+
+        account_balances_outgoing = _helper_calculate_updated_balances(
+            account_ref=tx_data_outgoing['ReferenceAccount'],
+            amount=outgoing_transfer_amount,
+            effect_on_actual_balance='None',
+            effect_on_available_balance='None',
+            boto3_clazz=boto3_clazz,
+            logger=logger,
+            batch=batch,
+            required_available=outgoing_transfer_amount
+        )
+        if int(account_balances_outgoing['Available'].compare(outgoing_transfer_amount)) < 0:
+            logger.error('Insufficient Funds')
+            update_object_table_add_event(
+                origin_event_key=tx_data_outgoing['EventSourceDataResource']['S3Key'],
+                event_timestamp=tx_data_outgoing['EventTimeStamp'],
+                tx_date=tx_context_outgoing['TransactionDate'],
+                tx_time=tx_context_outgoing['TransactionTime'],
+                reference_account_number=tx_data_outgoing['ReferenceAccount'],
+                event_type='ProcessingEvent',
+                is_error=True,
+                error_message='Insufficient funds in Source account {} - Available {} but amount requested was {}'.format(tx_data_outgoing['ReferenceAccount'], account_balances_outgoing['Available'], outgoing_transfer_amount),
+                boto3_clazz=boto3_clazz,
+                logger=logger,
+                batch=batch
+            )
+            return False
+        account_balances_outgoing['Actual'] = account_balances_outgoing['Actual'] - outgoing_transfer_amount
+        account_balances_outgoing['Available'] = account_balances_outgoing['Available'] - outgoing_transfer_amount
+
+        if same_account is True:
+            # A transfer to the same account leaves the balances unchanged, but is still recorded
+            account_balances_incoming = copy.deepcopy(account_balances_outgoing)
+            account_balances_incoming['Actual'] = account_balances_incoming['Actual'] + outgoing_transfer_amount
+            account_balances_incoming['Available'] = account_balances_incoming['Available'] + outgoing_transfer_amount
+        else:
+            account_balances_incoming = _helper_calculate_updated_balances(
+                account_ref=tx_data_incoming['ReferenceAccount'],
+                amount=outgoing_transfer_amount,
+                effect_on_actual_balance='Increase',
+                effect_on_available_balance='Increase',
+                boto3_clazz=boto3_clazz,
+                logger=logger,
+                batch=batch
+            )
+
+        transact_items = list()
+        if same_account is False:
+            # For a transfer to the same account the incoming records have the same keys and replace these
+            for event_record in _helper_build_transaction_event_records(
+                tx_data=tx_data_outgoing,
+                event_types=_helper_event_types_as_tuple(is_pending=False, is_verified=True),
+                effect_on_actual_balance='Decrease',
+                effect_on_available_balance='Decrease',
+                tx_context=tx_context_outgoing
+            ):
+                transact_items.append({'Put': {'TableName': os.getenv('DYNAMODB_ACCOUNTS_TABLE_NAME'), 'Item': event_record}})
+            transact_items += _helper_build_conditional_balance_put_items(tx_data=tx_data_outgoing, updated_balances=account_balances_outgoing, tx_context=tx_context_outgoing)
+        for event_record in _helper_build_transaction_event_records(
+            tx_data=tx_data_incoming,
+            event_types=_helper_event_types_as_tuple(is_pending=False, is_verified=True),
+            effect_on_actual_balance='Increase',
+            effect_on_available_balance='Increase',
+            tx_context=tx_context_incoming
+        ):
+            transact_items.append({'Put': {'TableName': os.getenv('DYNAMODB_ACCOUNTS_TABLE_NAME'), 'Item': event_record}})
+        transact_items += _helper_build_conditional_balance_put_items(tx_data=tx_data_incoming, updated_balances=account_balances_incoming, tx_context=tx_context_incoming)
+        transact_items.append(build_idempotency_put_item(tx_data=tx_data_outgoing, tx_context=tx_context_outgoing))
+        transact_items.append(
+            {
+                'Put': {
+                    'TableName': os.getenv('DYNAMODB_OBJECT_TABLE_NAME'),
+                    'Item': build_object_event_record(
+                        origin_event_key=tx_context_outgoing['EventKey'],
+                        tx_date=tx_context_outgoing['TransactionDate'],
+                        tx_time=tx_context_outgoing['TransactionTime'],
+                        reference_account_number=tx_data_outgoing['ReferenceAccount'],
+                        event_type='ProcessingEvent',
+                        is_error=False,
+                        error_message='no-error'
+                    )
+                }
+            }
+        )
+        debug_log(message='transact_items={}', variable_as_list=[transact_items,], logger=logger)
+
+        commit_status = transact_write_dynamodb_records(transact_items=transact_items, boto3_clazz=boto3_clazz, logger=logger)
+        if commit_status == 'COMMITTED':
+            logger.info('STEP: Transfer committed from account {} to account {}'.format(tx_data_outgoing['ReferenceAccount'], tx_data_incoming['ReferenceAccount']))
+            committed_balances = dict()
+            committed_balances[tx_data_outgoing['ReferenceAccount']] = _helper_next_balances(updated_balances=account_balances_outgoing)
+            committed_balances[tx_data_incoming['ReferenceAccount']] = _helper_next_balances(updated_balances=account_balances_incoming)
+            for account_ref, balances in committed_balances.items():
+                balance_cache_put(account_ref=account_ref, balances=balances, logger=logger)
+                if batch is not None:
+                    batch['Balances'][account_ref] = copy.deepcopy(balances)
+            if batch is not None:
+                batch_savepoint(batch=batch)
+            return True
+        for account_ref in (tx_data_outgoing['ReferenceAccount'], tx_data_incoming['ReferenceAccount'],):
+            balance_cache_invalidate(account_ref=account_ref, logger=logger)
+            if batch is not None:
+                batch['Balances'].pop(account_ref, None)
+        if commit_status == 'FAILED':
+            raise Exception('Transactional commit of transfer {} failed'.format(tx_data_outgoing['RequestId']))
+        recorded_outcome = get_transaction_outcome(tx_data=tx_data_outgoing, boto3_clazz=boto3_clazz, logger=logger)
+        if recorded_outcome is not None:
+            logger.warning('Transfer {} was already processed with outcome {}'.format(tx_data_outgoing['RequestId'], recorded_outcome))
+            return recorded_outcome == 'APPLIED'
+        logger.warning('Balance version conflict - retrying')
+        time.sleep(0.05 * attempt)
+
+    logger.error('Transactional commit of transfer failed after {} attempt(s)'.format(attempt))
+    raise BalanceVersionConflict(account_ref=tx_data_outgoing['ReferenceAccount'])
+
+
+def cash_deposit(tx_data: dict, logger=get_logger(), boto3_clazz=boto3, batch: dict=None, tx_context: dict=None)->bool:
     logger.info('Processing Started')
     debug_log('tx_data={}', variable_as_list=[tx_data,], logger=logger)
+    tx_context = _helper_transaction_context(tx_data=tx_data, tx_context=tx_context)
 
     effect_on_actual_balance        = 'Increase'
     effect_on_available_balance     = 'None'
@@ -565,109 +1918,68 @@ def cash_deposit(tx_data: dict, logger=get_logger(), boto3_clazz=boto3)->bool:
                 is_pending = False
                 is_verified = True
 
-    _helper_commit_transaction_events(
+    event_records = _helper_build_transaction_event_records(
         tx_data=tx_data, 
-        event_types=_helper_event_types_as_tuple(is_pending=is_pending, is_verified=is_verified), 
+        event_types=_helper_event_types_as_tuple(is_pending=is_pending, is_verified=is_verified),
         effect_on_actual_balance=effect_on_actual_balance,
         effect_on_available_balance=effect_on_available_balance,
-        boto3_clazz=boto3_clazz,
-        logger=logger
+        tx_context=tx_context
     )
 
     _helper_commit_updated_balances(
         tx_data=tx_data, 
+        event_records=event_records,
         effect_on_actual_balance=effect_on_actual_balance,
         effect_on_available_balance=effect_on_available_balance,
         boto3_clazz=boto3_clazz,
-        logger=logger
+        logger=logger,
+        batch=batch,
+        tx_context=tx_context
     )
 
     # Add event object processing record
     update_object_table_add_event(
         origin_event_key=tx_data['EventSourceDataResource']['S3Key'],
         event_timestamp=tx_data['EventTimeStamp'],
-        tx_date=_helper_tx_date(timestamp=tx_data['EventTimeStamp']),
-        tx_time=_helper_tx_time(timestamp=tx_data['EventTimeStamp']),
+        tx_date=tx_context['TransactionDate'],
+        tx_time=tx_context['TransactionTime'],
         reference_account_number=tx_data['ReferenceAccount'],
         event_type='ProcessingEvent',
         is_error=False,
         error_message='no-error',
         boto3_clazz=boto3_clazz,
-        logger=logger
+        logger=logger,
+        batch=batch
     )
 
     logger.info('Processing Done')
     return True
 
-
-def verify_cash_deposit(tx_data: dict, logger=get_logger(), boto3_clazz=boto3)->bool:
-    logger.info('Processing Started')
-    debug_log('tx_data={}', variable_as_list=[tx_data,], logger=logger)
-
-    effect_on_actual_balance        = 'None'
-    effect_on_available_balance     = 'Increase'
-    is_pending                      = False
-    is_verified                     = True
-
-    account_balances = _helper_calculate_updated_balances(
-        account_ref=tx_data['ReferenceAccount'],
-        amount=Decimal(tx_data['Amount']),
-        effect_on_actual_balance='None',
-        effect_on_available_balance='None',
-        boto3_clazz=boto3_clazz,
-        logger=logger
-    )
-
-    # Retrieve the original transaction - we need that to calculate the net effect on balances.
-    previous_record = dict()
-    verified_amount = Decimal(tx_data['Amount'])
-    try:
-        key = {
-            'PK': {
-                'AttributeValueList': [
-                    {
-                        'S': tx_data['ReferenceAccount'],
-                    },
-                ],
-                'ComparisonOperator': 'EQ'
-            }
-        }
-        filter = {
-                'RequestId': {
-                    'AttributeValueList': [
-                        {
-                            'S': '{}'.format(tx_data['PreviousRequestIdReference']),
-                        },
-                    ],
-                    'ComparisonOperator': 'EQ'
-                }
-            }
-        previous_record = json.loads(
-            get_dynamodb_record_by_primary_index_query_with_filter(
-                key=key,
-                query_filter=filter,
-                use_consistent_read=True,
-                boto3_clazz=boto3_clazz,
-                logger=logger
-            )[0]['EventRawData']
-        )
-        logger.info('Previous unverified transaction data: {}'.format(previous_record))
-    except:
-        logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
-        update_object_table_add_event(
-            origin_event_key=tx_data['EventSourceDataResource']['S3Key'],
-            event_timestamp=tx_data['EventTimeStamp'],
-            tx_date=_helper_tx_date(timestamp=tx_data['EventTimeStamp']),
-            tx_time=_helper_tx_time(timestamp=tx_data['EventTimeStamp']),
-            reference_account_number=tx_data['ReferenceAccount'],
-            event_type='ProcessingEvent',
-            is_error=True,
-            error_message='EXCEPTION: {}'.format(traceback.format_exc()),
-            boto3_clazz=boto3_clazz,
-            logger=logger
-        )
-        return False
-
+
+def verify_cash_deposit(tx_data: dict, logger=get_logger(), boto3_clazz=boto3, batch: dict=None, tx_context: dict=None)->bool:
+    logger.info('Processing Started')
+    debug_log('tx_data={}', variable_as_list=[tx_data,], logger=logger)
+    tx_context = _helper_transaction_context(tx_data=tx_data, tx_context=tx_context)
+
+    effect_on_actual_balance        = 'None'
+    effect_on_available_balance     = 'Increase'
+    is_pending                      = False
+    is_verified                     = True
+
+    account_balances = _helper_calculate_updated_balances(
+        account_ref=tx_data['ReferenceAccount'],
+        amount=Decimal(tx_data['Amount']),
+        effect_on_actual_balance='None',
+        effect_on_available_balance='None',
+        boto3_clazz=boto3_clazz,
+        logger=logger,
+        batch=batch
+    )
+
+    # Retrieve the original transaction - we need that to calculate the net effect on balances.
+    verified_amount = Decimal(tx_data['Amount'])
+    previous_record = _helper_get_previous_transaction_data(tx_data=tx_data, boto3_clazz=boto3_clazz, logger=logger, batch=batch)
+
     if len(previous_record) > 0:
         original_amount = Decimal(previous_record['Amount'])
         if verified_amount.compare(original_amount) != Decimal('0'):
@@ -682,55 +1994,60 @@ def verify_cash_deposit(tx_data: dict, logger=get_logger(), boto3_clazz=boto3)->
         update_object_table_add_event(
             origin_event_key=tx_data['EventSourceDataResource']['S3Key'],
             event_timestamp=tx_data['EventTimeStamp'],
-            tx_date=_helper_tx_date(timestamp=tx_data['EventTimeStamp']),
-            tx_time=_helper_tx_time(timestamp=tx_data['EventTimeStamp']),
+            tx_date=tx_context['TransactionDate'],
+            tx_time=tx_context['TransactionTime'],
             reference_account_number=tx_data['ReferenceAccount'],
             event_type='ProcessingEvent',
             is_error=True,
             error_message='No previous pending record was found',
             boto3_clazz=boto3_clazz,
-            logger=logger
+            logger=logger,
+            batch=batch
         )
         return False
 
     # Commit to DB
-    _helper_commit_transaction_events(
+    event_records = _helper_build_transaction_event_records(
         tx_data=tx_data, 
-        event_types=_helper_event_types_as_tuple(is_pending=is_pending, is_verified=is_verified), 
+        event_types=_helper_event_types_as_tuple(is_pending=is_pending, is_verified=is_verified),
         effect_on_actual_balance=effect_on_actual_balance,
         effect_on_available_balance=effect_on_available_balance,
-        boto3_clazz=boto3_clazz,
-        logger=logger
+        tx_context=tx_context
     )
 
     _helper_commit_updated_balances(
         tx_data=tx_data, 
+        event_records=event_records,
         updated_balances=account_balances,
         boto3_clazz=boto3_clazz,
-        logger=logger
+        logger=logger,
+        batch=batch,
+        tx_context=tx_context
     )
 
     # Add event object processing record
     update_object_table_add_event(
         origin_event_key=tx_data['EventSourceDataResource']['S3Key'],
         event_timestamp=tx_data['EventTimeStamp'],
-        tx_date=_helper_tx_date(timestamp=tx_data['EventTimeStamp']),
-        tx_time=_helper_tx_time(timestamp=tx_data['EventTimeStamp']),
+        tx_date=tx_context['TransactionDate'],
+        tx_time=tx_context['TransactionTime'],
         reference_account_number=tx_data['ReferenceAccount'],
         event_type='ProcessingEvent',
         is_error=False,
         error_message='no-error',
         boto3_clazz=boto3_clazz,
-        logger=logger
+        logger=logger,
+        batch=batch
     )
 
     logger.info('Processing Done')
     return True
 
 
-def cash_withdrawal(tx_data: dict, logger=get_logger(), boto3_clazz=boto3)->bool:
+def cash_withdrawal(tx_data: dict, logger=get_logger(), boto3_clazz=boto3, batch: dict=None, tx_context: dict=None)->bool:
     logger.info('Processing Started')
     debug_log('tx_data={}', variable_as_list=[tx_data,], logger=logger)
+    tx_context = _helper_transaction_context(tx_data=tx_data, tx_context=tx_context)
 
     effect_on_actual_balance        = 'Decrease'
     effect_on_available_balance     = 'Decrease'
@@ -744,7 +2061,9 @@ def cash_withdrawal(tx_data: dict, logger=get_logger(), boto3_clazz=boto3)->bool
         effect_on_actual_balance='None',
         effect_on_available_balance='None',
         boto3_clazz=boto3_clazz,
-        logger=logger
+        logger=logger,
+        batch=batch,
+        required_available=Decimal(tx_data['Amount'])
     )
     available = account_balances['Available']
     withdraw_amount = Decimal(tx_data['Amount'])
@@ -756,14 +2075,15 @@ def cash_withdrawal(tx_data: dict, logger=get_logger(), boto3_clazz=boto3)->bool
         update_object_table_add_event(
             origin_event_key=tx_data['EventSourceDataResource']['S3Key'],
             event_timestamp=tx_data['EventTimeStamp'],
-            tx_date=_helper_tx_date(timestamp=tx_data['EventTimeStamp']),
-            tx_time=_helper_tx_time(timestamp=tx_data['EventTimeStamp']),
+            tx_date=tx_context['TransactionDate'],
+            tx_time=tx_context['TransactionTime'],
             reference_account_number=tx_data['ReferenceAccount'],
             event_type='ProcessingEvent',
             is_error=True,
             error_message='Insufficient funds in Source account {} - Available {} but amount requested was {}'.format(tx_data['ReferenceAccount'], account_balances['Available'], withdraw_amount),
             boto3_clazz=boto3_clazz,
-            logger=logger
+            logger=logger,
+            batch=batch
         )
         return False
     logger.info('Funds are available')
@@ -772,41 +2092,44 @@ def cash_withdrawal(tx_data: dict, logger=get_logger(), boto3_clazz=boto3)->bool
     account_balances['Actual'] = account_balances['Actual'] - withdraw_amount    
     account_balances['Available'] = account_balances['Available'] - withdraw_amount    
 
-    _helper_commit_transaction_events(
+    event_records = _helper_build_transaction_event_records(
         tx_data=tx_data, 
-        event_types=_helper_event_types_as_tuple(is_pending=is_pending, is_verified=is_verified), 
+        event_types=_helper_event_types_as_tuple(is_pending=is_pending, is_verified=is_verified),
         effect_on_actual_balance=effect_on_actual_balance,
         effect_on_available_balance=effect_on_available_balance,
-        boto3_clazz=boto3_clazz,
-        logger=logger
+        tx_context=tx_context
     )
 
     _helper_commit_updated_balances(
         tx_data=tx_data, 
+        event_records=event_records,
         updated_balances=account_balances,
         boto3_clazz=boto3_clazz,
-        logger=logger
+        logger=logger,
+        batch=batch,
+        tx_context=tx_context
     )
 
     # Add event object processing record
     update_object_table_add_event(
         origin_event_key=tx_data['EventSourceDataResource']['S3Key'],
         event_timestamp=tx_data['EventTimeStamp'],
-        tx_date=_helper_tx_date(timestamp=tx_data['EventTimeStamp']),
-        tx_time=_helper_tx_time(timestamp=tx_data['EventTimeStamp']),
+        tx_date=tx_context['TransactionDate'],
+        tx_time=tx_context['TransactionTime'],
         reference_account_number=tx_data['ReferenceAccount'],
         event_type='ProcessingEvent',
         is_error=False,
         error_message='no-error',
         boto3_clazz=boto3_clazz,
-        logger=logger
+        logger=logger,
+        batch=batch
     )
 
     logger.info('Processing Done')
-    return False
+    return True
 
 
-def incoming_payment(tx_data: dict, logger=get_logger(), boto3_clazz=boto3)->bool:
+def incoming_payment(tx_data: dict, logger=get_logger(), boto3_clazz=boto3, batch: dict=None, tx_context: dict=None)->bool:
     """
         tx_data = {
             "EventTimeStamp": 1668399202, 
@@ -827,6 +2150,7 @@ def incoming_payment(tx_data: dict, logger=get_logger(), boto3_clazz=boto3)->boo
     """
     logger.info('Processing Started')
     debug_log('tx_data={}', variable_as_list=[tx_data,], logger=logger)
+    tx_context = _helper_transaction_context(tx_data=tx_data, tx_context=tx_context)
 
     effect_on_actual_balance        = 'Increase'
     effect_on_available_balance     = 'Increase'
@@ -834,44 +2158,48 @@ def incoming_payment(tx_data: dict, logger=get_logger(), boto3_clazz=boto3)->boo
     is_verified                     = True
 
 
-    _helper_commit_transaction_events(
+    event_records = _helper_build_transaction_event_records(
         tx_data=tx_data, 
         event_types=_helper_event_types_as_tuple(is_pending=is_pending, is_verified=is_verified),  # event_types = ('VERIFIED',)
         effect_on_actual_balance=effect_on_actual_balance,
         effect_on_available_balance=effect_on_available_balance,
-        boto3_clazz=boto3_clazz,
-        logger=logger
+        tx_context=tx_context
     )
 
     _helper_commit_updated_balances(
         tx_data=tx_data, 
+        event_records=event_records,
         effect_on_actual_balance=effect_on_actual_balance,
         effect_on_available_balance=effect_on_available_balance,
         boto3_clazz=boto3_clazz,
-        logger=logger
+        logger=logger,
+        batch=batch,
+        tx_context=tx_context
     )
 
     # Add event object processing record
     update_object_table_add_event(
         origin_event_key=tx_data['EventSourceDataResource']['S3Key'],
         event_timestamp=tx_data['EventTimeStamp'],
-        tx_date=_helper_tx_date(timestamp=tx_data['EventTimeStamp']),
-        tx_time=_helper_tx_time(timestamp=tx_data['EventTimeStamp']),
+        tx_date=tx_context['TransactionDate'],
+        tx_time=tx_context['TransactionTime'],
         reference_account_number=tx_data['ReferenceAccount'],
         event_type='ProcessingEvent',
         is_error=False,
         error_message='no-error',
         boto3_clazz=boto3_clazz,
-        logger=logger
+        logger=logger,
+        batch=batch
     )
 
     logger.info('Processing Done')
     return True
 
 
-def outgoing_payment_unverified(tx_data: dict, logger=get_logger(), boto3_clazz=boto3)->bool:
+def outgoing_payment_unverified(tx_data: dict, logger=get_logger(), boto3_clazz=boto3, batch: dict=None, tx_context: dict=None)->bool:
     logger.info('Processing Started')
     debug_log('tx_data={}', variable_as_list=[tx_data,], logger=logger)
+    tx_context = _helper_transaction_context(tx_data=tx_data, tx_context=tx_context)
 
     effect_on_actual_balance        = 'Decrease'
     effect_on_available_balance     = 'Decrease'
@@ -885,7 +2213,9 @@ def outgoing_payment_unverified(tx_data: dict, logger=get_logger(), boto3_clazz=
         effect_on_actual_balance='None',
         effect_on_available_balance='None',
         boto3_clazz=boto3_clazz,
-        logger=logger
+        logger=logger,
+        batch=batch,
+        required_available=Decimal(tx_data['Amount'])
     )
     available = account_balances['Available']
     outgoing_payment_amount = Decimal(tx_data['Amount'])
@@ -897,14 +2227,15 @@ def outgoing_payment_unverified(tx_data: dict, logger=get_logger(), boto3_clazz=
         update_object_table_add_event(
             origin_event_key=tx_data['EventSourceDataResource']['S3Key'],
             event_timestamp=tx_data['EventTimeStamp'],
-            tx_date=_helper_tx_date(timestamp=tx_data['EventTimeStamp']),
-            tx_time=_helper_tx_time(timestamp=tx_data['EventTimeStamp']),
+            tx_date=tx_context['TransactionDate'],
+            tx_time=tx_context['TransactionTime'],
             reference_account_number=tx_data['ReferenceAccount'],
             event_type='ProcessingEvent',
             is_error=True,
             error_message='Insufficient funds in Source account {} - Available {} but amount requested was {}'.format(tx_data['ReferenceAccount'], account_balances['Available'], outgoing_payment_amount),
             boto3_clazz=boto3_clazz,
-            logger=logger
+            logger=logger,
+            batch=batch
         )
         return False
     logger.info('Funds are available')
@@ -913,43 +2244,47 @@ def outgoing_payment_unverified(tx_data: dict, logger=get_logger(), boto3_clazz=
     account_balances['Actual'] = account_balances['Actual'] - outgoing_payment_amount    
     account_balances['Available'] = account_balances['Available'] - outgoing_payment_amount  
 
-    _helper_commit_transaction_events(
+    event_records = _helper_build_transaction_event_records(
         tx_data=tx_data, 
-        event_types=_helper_event_types_as_tuple(is_pending=is_pending, is_verified=is_verified), 
+        event_types=_helper_event_types_as_tuple(is_pending=is_pending, is_verified=is_verified),
         effect_on_actual_balance=effect_on_actual_balance,
         effect_on_available_balance=effect_on_available_balance,
-        boto3_clazz=boto3_clazz,
-        logger=logger
+        tx_context=tx_context
     )
 
     _helper_commit_updated_balances(
         tx_data=tx_data, 
+        event_records=event_records,
         updated_balances=account_balances,
         boto3_clazz=boto3_clazz,
-        logger=logger
+        logger=logger,
+        batch=batch,
+        tx_context=tx_context
     )
 
     # Add event object processing record
     update_object_table_add_event(
         origin_event_key=tx_data['EventSourceDataResource']['S3Key'],
         event_timestamp=tx_data['EventTimeStamp'],
-        tx_date=_helper_tx_date(timestamp=tx_data['EventTimeStamp']),
-        tx_time=_helper_tx_time(timestamp=tx_data['EventTimeStamp']),
+        tx_date=tx_context['TransactionDate'],
+        tx_time=tx_context['TransactionTime'],
         reference_account_number=tx_data['ReferenceAccount'],
         event_type='ProcessingEvent',
         is_error=False,
         error_message='no-error',
         boto3_clazz=boto3_clazz,
-        logger=logger
+        logger=logger,
+        batch=batch
     )
 
     logger.info('Processing Done')
     return True
 
 
-def outgoing_payment_verified(tx_data: dict, logger=get_logger(), boto3_clazz=boto3)->bool:
+def outgoing_payment_verified(tx_data: dict, logger=get_logger(), boto3_clazz=boto3, batch: dict=None, tx_context: dict=None)->bool:
     logger.info('Processing Started')
     debug_log('tx_data={}', variable_as_list=[tx_data,], logger=logger)
+    tx_context = _helper_transaction_context(tx_data=tx_data, tx_context=tx_context)
 
     effect_on_actual_balance        = 'None'
     effect_on_available_balance     = 'None'
@@ -957,109 +2292,68 @@ def outgoing_payment_verified(tx_data: dict, logger=get_logger(), boto3_clazz=bo
     is_verified                     = True
 
     # Get amount from previous pending transaction
-    previous_record = dict()
-    try:
-        key = {
-            'PK': {
-                'AttributeValueList': [
-                    {
-                        'S': tx_data['ReferenceAccount'],
-                    },
-                ],
-                'ComparisonOperator': 'EQ'
-            }
-        }
-        filter = {
-                'RequestId': {
-                    'AttributeValueList': [
-                        {
-                            'S': '{}'.format(tx_data['PreviousRequestIdReference']),
-                        },
-                    ],
-                    'ComparisonOperator': 'EQ'
-                }
-            }
-        previous_record = json.loads(
-            get_dynamodb_record_by_primary_index_query_with_filter(
-                key=key,
-                query_filter=filter,
-                use_consistent_read=True,
-                boto3_clazz=boto3_clazz,
-                logger=logger
-            )[0]['EventRawData']
-        )
-        logger.info('Previous unverified transaction data: {}'.format(previous_record))
-        tx_data['Amount'] = previous_record['Amount']
-    except:
-        logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
-        update_object_table_add_event(
-            origin_event_key=tx_data['EventSourceDataResource']['S3Key'],
-            event_timestamp=tx_data['EventTimeStamp'],
-            tx_date=_helper_tx_date(timestamp=tx_data['EventTimeStamp']),
-            tx_time=_helper_tx_time(timestamp=tx_data['EventTimeStamp']),
-            reference_account_number=tx_data['ReferenceAccount'],
-            event_type='ProcessingEvent',
-            is_error=True,
-            error_message='EXCEPTION: {}'.format(traceback.format_exc()),
-            boto3_clazz=boto3_clazz,
-            logger=logger
-        )
-        return False
-
+    previous_record = _helper_get_previous_transaction_data(tx_data=tx_data, boto3_clazz=boto3_clazz, logger=logger, batch=batch)
     if len(previous_record) == 0:
         logger.error('No previous pending record was found')
         update_object_table_add_event(
             origin_event_key=tx_data['EventSourceDataResource']['S3Key'],
             event_timestamp=tx_data['EventTimeStamp'],
-            tx_date=_helper_tx_date(timestamp=tx_data['EventTimeStamp']),
-            tx_time=_helper_tx_time(timestamp=tx_data['EventTimeStamp']),
+            tx_date=tx_context['TransactionDate'],
+            tx_time=tx_context['TransactionTime'],
             reference_account_number=tx_data['ReferenceAccount'],
             event_type='ProcessingEvent',
             is_error=True,
             error_message='No previous pending record was found',
             boto3_clazz=boto3_clazz,
-            logger=logger
+            logger=logger,
+            batch=batch
         )
         return False
+    tx_data['Amount'] = previous_record['Amount']
+    tx_context['EventRawData'] = json.dumps(tx_data)
 
-    _helper_commit_transaction_events(
+    event_records = _helper_build_transaction_event_records(
         tx_data=tx_data, 
-        event_types=_helper_event_types_as_tuple(is_pending=is_pending, is_verified=is_verified), 
+        event_types=_helper_event_types_as_tuple(is_pending=is_pending, is_verified=is_verified),
         effect_on_actual_balance=effect_on_actual_balance,
         effect_on_available_balance=effect_on_available_balance,
-        boto3_clazz=boto3_clazz,
-        logger=logger
+        tx_context=tx_context
     )
 
     _helper_commit_updated_balances(
         tx_data=tx_data, 
+        event_records=event_records,
         effect_on_actual_balance=effect_on_actual_balance,
         effect_on_available_balance=effect_on_available_balance,
         boto3_clazz=boto3_clazz,
-        logger=logger
+        logger=logger,
+        batch=batch,
+        tx_context=tx_context
     )
 
     # Add event object processing record
     update_object_table_add_event(
         origin_event_key=tx_data['EventSourceDataResource']['S3Key'],
         event_timestamp=tx_data['EventTimeStamp'],
-        tx_date=_helper_tx_date(timestamp=tx_data['EventTimeStamp']),
-        tx_time=_helper_tx_time(timestamp=tx_data['EventTimeStamp']),
+        tx_date=tx_context['TransactionDate'],
+        tx_time=tx_context['TransactionTime'],
         reference_account_number=tx_data['ReferenceAccount'],
         event_type='ProcessingEvent',
         is_error=False,
         error_message='no-error',
         boto3_clazz=boto3_clazz,
-        logger=logger
+        logger=logger,
+        batch=batch
     )
 
     logger.info('Processing Done')
     return True
 
 
-def outgoing_payment_rejected(tx_data: dict, logger=get_logger(), boto3_clazz=boto3)->bool:
+def outgoing_payment_rejected(tx_data: dict, logger=get_logger(), boto3_clazz=boto3, batch: dict=None, tx_context: dict=None)->bool:
     logger.info('Processing Started')
     debug_log('tx_data={}', variable_as_list=[tx_data,], logger=logger)
+    tx_context = _helper_transaction_context(tx_data=tx_data, tx_context=tx_context)
 
     effect_on_actual_balance        = 'Increase'
     effect_on_available_balance     = 'Increase'
@@ -1067,222 +2361,480 @@ def outgoing_payment_rejected(tx_data: dict, logger=get_logger(), boto3_clazz=bo
     is_verified                     = True
 
     # Get amount from previous pending transaction
-    previous_record = dict()
-    try:
-        key = {
-            'PK': {
-                'AttributeValueList': [
-                    {
-                        'S': tx_data['ReferenceAccount'],
-                    },
-                ],
-                'ComparisonOperator': 'EQ'
-            }
-        }
-        filter = {
-                'RequestId': {
-                    'AttributeValueList': [
-                        {
-                            'S': '{}'.format(tx_data['PreviousRequestIdReference']),
-                        },
-                    ],
-                    'ComparisonOperator': 'EQ'
-                }
-            }
-        previous_record = json.loads(
-            get_dynamodb_record_by_primary_index_query_with_filter(
-                key=key,
-                query_filter=filter,
-                use_consistent_read=True,
-                boto3_clazz=boto3_clazz,
-                logger=logger
-            )[0]['EventRawData']
-        )
-        logger.info('Previous unverified transaction data: {}'.format(previous_record))
-        tx_data['Amount'] = previous_record['Amount']
-    except:
-        logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
-        update_object_table_add_event(
-            origin_event_key=tx_data['EventSourceDataResource']['S3Key'],
-            event_timestamp=tx_data['EventTimeStamp'],
-            tx_date=_helper_tx_date(timestamp=tx_data['EventTimeStamp']),
-            tx_time=_helper_tx_time(timestamp=tx_data['EventTimeStamp']),
-            reference_account_number=tx_data['ReferenceAccount'],
-            event_type='ProcessingEvent',
-            is_error=True,
-            error_message='EXCEPTION: {}'.format(traceback.format_exc()),
-            boto3_clazz=boto3_clazz,
-            logger=logger
-        )
-        return False
-
+    previous_record = _helper_get_previous_transaction_data(tx_data=tx_data, boto3_clazz=boto3_clazz, logger=logger, batch=batch)
     if len(previous_record) == 0:
         logger.error('No previous pending record was found')
         update_object_table_add_event(
             origin_event_key=tx_data['EventSourceDataResource']['S3Key'],
             event_timestamp=tx_data['EventTimeStamp'],
-            tx_date=_helper_tx_date(timestamp=tx_data['EventTimeStamp']),
-            tx_time=_helper_tx_time(timestamp=tx_data['EventTimeStamp']),
+            tx_date=tx_context['TransactionDate'],
+            tx_time=tx_context['TransactionTime'],
             reference_account_number=tx_data['ReferenceAccount'],
             event_type='ProcessingEvent',
             is_error=True,
             error_message='No previous pending record was found',
             boto3_clazz=boto3_clazz,
-            logger=logger
+            logger=logger,
+            batch=batch
         )
         return False
+    tx_data['Amount'] = previous_record['Amount']
+    tx_context['EventRawData'] = json.dumps(tx_data)
 
-    _helper_commit_transaction_events(
+    event_records = _helper_build_transaction_event_records(
         tx_data=tx_data, 
-        event_types=_helper_event_types_as_tuple(is_pending=is_pending, is_verified=is_verified), 
+        event_types=_helper_event_types_as_tuple(is_pending=is_pending, is_verified=is_verified),
         effect_on_actual_balance=effect_on_actual_balance,
         effect_on_available_balance=effect_on_available_balance,
-        boto3_clazz=boto3_clazz,
-        logger=logger
+        tx_context=tx_context
     )
 
     _helper_commit_updated_balances(
         tx_data=tx_data, 
+        event_records=event_records,
         effect_on_actual_balance=effect_on_actual_balance,
         effect_on_available_balance=effect_on_available_balance,
         boto3_clazz=boto3_clazz,
-        logger=logger
+        logger=logger,
+        batch=batch,
+        tx_context=tx_context
     )
 
     # Add event object processing record
     update_object_table_add_event(
         origin_event_key=tx_data['EventSourceDataResource']['S3Key'],
         event_timestamp=tx_data['EventTimeStamp'],
-        tx_date=_helper_tx_date(timestamp=tx_data['EventTimeStamp']),
-        tx_time=_helper_tx_time(timestamp=tx_data['EventTimeStamp']),
+        tx_date=tx_context['TransactionDate'],
+        tx_time=tx_context['TransactionTime'],
         reference_account_number=tx_data['ReferenceAccount'],
         event_type='ProcessingEvent',
         is_error=False,
         error_message='no-error',
         boto3_clazz=boto3_clazz,
-        logger=logger
+        logger=logger,
+        batch=batch
     )
 
     logger.info('Processing Done')
     return True
 
 
-def inter_account_transfer(tx_data: dict, logger=get_logger(), boto3_clazz=boto3)->bool:
+def inter_account_transfer(tx_data: dict, logger=get_logger(), boto3_clazz=boto3, batch: dict=None, tx_context: dict=None)->bool:
     logger.info('Processing Started')
     debug_log('tx_data={}', variable_as_list=[tx_data,], logger=logger)
-
-    effect_on_actual_balance_outgoing        = 'Decrease'
-    effect_on_available_balance_outgoing     = 'Decrease'
-    is_pending_outgoing                      = False
-    is_verified_outgoing                     = True
-
-    effect_on_actual_balance_incoming        = 'Increase'
-    effect_on_available_balance_incoming     = 'Increase'
-    is_pending_incoming                      = False
-    is_verified_incoming                     = True
+    tx_context = _helper_transaction_context(tx_data=tx_data, tx_context=tx_context)
 
     tx_data_outgoing = copy.deepcopy(tx_data)
     tx_data_incoming = copy.deepcopy(tx_data)
     tx_data_incoming['ReferenceAccount'] = copy.deepcopy(tx_data_outgoing['TargetAccount'])
+    tx_context_incoming = new_transaction_context(tx_data=tx_data_incoming)
     logger.info('Processing transfer from account {} to account {}'.format(tx_data_outgoing['ReferenceAccount'],tx_data_incoming['ReferenceAccount']))
 
-    # Check funds available
-    logger.info('STEP: Check funds available on OUTGOING account {}'.format(tx_data_outgoing['ReferenceAccount']))
-    account_balances_outgoing = _helper_calculate_updated_balances(
-        account_ref=tx_data_outgoing['ReferenceAccount'],
-        amount=Decimal(tx_data['Amount']),
-        effect_on_actual_balance='None',
-        effect_on_available_balance='None',
+    if batch is not None:
+        # The transfer is committed right away, so the records staged for the earlier transactions of the shard are
+        # committed first and the transfer is based on their committed balance versions
+        if commit_batch(batch=batch, boto3_clazz=boto3_clazz, logger=logger) is False:
+            raise Exception('Failed to commit the staged records of the batch before transfer {}'.format(tx_data['RequestId']))
+
+    # Both accounts are committed atomically, guarded by the balance versions
+    result = _helper_commit_inter_account_transfer_transaction(
+        tx_data_outgoing=tx_data_outgoing,
+        tx_data_incoming=tx_data_incoming,
         boto3_clazz=boto3_clazz,
-        logger=logger
+        logger=logger,
+        tx_context_outgoing=tx_context,
+        tx_context_incoming=tx_context_incoming,
+        batch=batch
     )
-    available_outgoing = account_balances_outgoing['Available']
-    outgoing_transfer_amount = Decimal(tx_data['Amount'])
-    logger.info('Requesting transfer of {} from available balance of {} on account reference {}'.format(str(outgoing_transfer_amount), str(available_outgoing), tx_data_outgoing['ReferenceAccount']))
+    logger.info('Processing Done')
+    return result
 
-    # if available_outgoing.compare(outgoing_transfer_amount) < Decimal('0') is True:   # Negative balances not allowed - reject transaction
-    if int(available_outgoing.compare(outgoing_transfer_amount)) < 0:
-        logger.error('Insufficient Funds')
-        update_object_table_add_event(
-            origin_event_key=tx_data['EventSourceDataResource']['S3Key'],
-            event_timestamp=tx_data['EventTimeStamp'],
-            tx_date=_helper_tx_date(timestamp=tx_data['EventTimeStamp']),
-            tx_time=_helper_tx_time(timestamp=tx_data['EventTimeStamp']),
-            reference_account_number=tx_data['ReferenceAccount'],
-            event_type='ProcessingEvent',
-            is_error=True,
-            error_message='Insufficient funds in Source account {} - Available {} but amount requested was {}'.format(tx_data_outgoing['ReferenceAccount'], account_balances_outgoing['Available'], outgoing_transfer_amount),
-            boto3_clazz=boto3_clazz,
-            logger=logger
-        )
-        return False
-    logger.info('Funds are available')
 
-    # Adjust balances
-    logger.info('STEP: Adjusting account balances on OUTGOING account {}'.format(tx_data_outgoing['ReferenceAccount']))
-    account_balances_outgoing['Actual'] = account_balances_outgoing['Actual'] - outgoing_transfer_amount    
-    account_balances_outgoing['Available'] = account_balances_outgoing['Available'] - outgoing_transfer_amount  
-
-    # Process OUTGOING
-    logger.info('STEP: Committing transaction EVENT on OUTGOING account {}'.format(tx_data_outgoing['ReferenceAccount']))
-    _helper_commit_transaction_events(
-        tx_data=tx_data_outgoing, 
-        event_types=_helper_event_types_as_tuple(is_pending=is_pending_outgoing, is_verified=is_verified_outgoing), 
-        effect_on_actual_balance=effect_on_actual_balance_outgoing,
-        effect_on_available_balance=effect_on_available_balance_outgoing,
-        boto3_clazz=boto3_clazz,
-        logger=logger
-    )
+###############################################################################
+###                                                                         ###
+###                   B A T C H    P R O C E S S I N G                      ###
+###                                                                         ###
+###############################################################################
 
-    logger.info('STEP: Committing transaction UPDATE_BALANCES on OUTGOING account {}'.format(tx_data_outgoing['ReferenceAccount']))
-    _helper_commit_updated_balances(
-        tx_data=tx_data, 
-        updated_balances=account_balances_outgoing,
-        effect_on_actual_balance=effect_on_actual_balance_outgoing,
-        effect_on_available_balance=effect_on_available_balance_outgoing,
-        boto3_clazz=boto3_clazz,
-        logger=logger
-    )
 
+def new_batch_context()->dict:
+    """
+        The batch context holds the in-memory state of an SQS batch while it is being processed:
+
+            Balances:       account_ref -> {'Available': Decimal, 'Actual': Decimal, 'Versions': dict} - loaded once
+                            per account
+            PendingWrites:  (table_name, PK, SK) -> record_data - the last write to a key wins, exactly like a
+                            sequence of put_item calls would. Holds all records except the transaction, balance and
+                            idempotency records.
+            AccountWrites:  account_ref -> list of the transaction records, balance records and idempotency record of
+                            every transaction, in FIFO order (see `batch_stage_account_write()`)
+            StagedOutcomes: (PK, SK) -> Outcome of the idempotency records staged in the batch
+            TransactionOutcomes:
+                            (PK, SK) -> Outcome of the idempotency records that already existed when the shard
+                            started, or None when they have to be read per transaction
+            Savepoint:      The staged state before the current transaction (see `batch_savepoint()`)
+    """
+    return {
+        'Balances': dict(),
+        'PendingWrites': dict(),
+        'AccountWrites': dict(),
+        'StagedOutcomes': dict(),
+        'TransactionOutcomes': None,
+        'Savepoint': None,
+    }
 
-    # Process INCOMING
-    logger.info('STEP: Committing transaction EVENT on INCOMING account {}'.format(tx_data_incoming['ReferenceAccount']))
-    _helper_commit_transaction_events(
-        tx_data=tx_data_incoming, 
-        event_types=_helper_event_types_as_tuple(is_pending=is_pending_incoming, is_verified=is_verified_incoming),  # event_types = ('VERIFIED',)
-        effect_on_actual_balance=effect_on_actual_balance_incoming,
-        effect_on_available_balance=effect_on_available_balance_incoming,
-        boto3_clazz=boto3_clazz,
-        logger=logger
-    )
 
-    logger.info('STEP: Committing transaction UPDATE_BALANCES on INCOMING account {}'.format(tx_data_incoming['ReferenceAccount']))
-    _helper_commit_updated_balances(
-        tx_data=tx_data_incoming, 
-        effect_on_actual_balance=effect_on_actual_balance_incoming,
-        effect_on_available_balance=effect_on_available_balance_incoming,
-        boto3_clazz=boto3_clazz,
-        logger=logger
-    )
+def batch_stage_account_write(batch: dict, account_ref: str, balance_records: list, idempotency_record: dict=None, event_records: list=None):
+    """
+        Stage the transaction records and balance records (none for a rejected transaction) and the idempotency
+        record of one transaction. The records are kept per account and in order, so that `commit_batch()` can commit
+        them with the balance version they were based on.
+    """
+    if account_ref not in batch['AccountWrites']:
+        batch['AccountWrites'][account_ref] = list()
+    if event_records is None:
+        event_records = list()
+    batch['AccountWrites'][account_ref].append({'EventRecords': event_records, 'BalanceRecords': balance_records, 'IdempotencyRecord': idempotency_record})
+    if idempotency_record is not None:
+        batch['StagedOutcomes'][(idempotency_record['PK']['S'], idempotency_record['SK']['S'])] = idempotency_record['Outcome']['S']
 
-    # Add event object processing record
-    update_object_table_add_event(
-        origin_event_key=tx_data['EventSourceDataResource']['S3Key'],
-        event_timestamp=tx_data['EventTimeStamp'],
-        tx_date=_helper_tx_date(timestamp=tx_data['EventTimeStamp']),
-        tx_time=_helper_tx_time(timestamp=tx_data['EventTimeStamp']),
-        reference_account_number=tx_data['ReferenceAccount'],
-        event_type='ProcessingEvent',
-        is_error=False,
-        error_message='no-error',
-        boto3_clazz=boto3_clazz,
-        logger=logger
-    )
 
-    logger.info('Processing Done')
+def batch_savepoint(batch: dict):
+    """
+        Remember the staged state of the batch. When the next transaction fails, `batch_rollback()` drops everything
+        it staged, so that only the writes of the transactions that completed are committed.
+    """
+    batch['Savepoint'] = {
+        'Balances': copy.deepcopy(batch['Balances']),
+        'PendingWrites': dict(batch['PendingWrites']),
+        'AccountWrites': {account_ref: list(account_writes) for account_ref, account_writes in batch['AccountWrites'].items()},
+        'StagedOutcomes': dict(batch['StagedOutcomes']),
+    }
+
+
+def batch_rollback(batch: dict, logger=get_logger()):
+    if batch['Savepoint'] is None:
+        return
+    logger.warning('Dropping the records staged by the failed transaction')
+    batch['Balances'] = copy.deepcopy(batch['Savepoint']['Balances'])
+    batch['PendingWrites'] = dict(batch['Savepoint']['PendingWrites'])
+    batch['AccountWrites'] = {account_ref: list(account_writes) for account_ref, account_writes in batch['Savepoint']['AccountWrites'].items()}
+    batch['StagedOutcomes'] = dict(batch['Savepoint']['StagedOutcomes'])
+
+
+def batch_find_pending_records(
+    batch: dict,
+    table_name: str,
+    conditions: dict,
+    logger=get_logger()
+)->list:
+    """
+        Find records staged in the batch that match all the `EQ` conditions (legacy KeyConditions/QueryFilter format)
+    """
+    records = list()
+    try:
+        staged_records = [(pending_key[0], record_data) for pending_key, record_data in batch['PendingWrites'].items()]
+        for account_writes in batch['AccountWrites'].values():
+            for account_write in account_writes:
+                staged_records += [(os.getenv('DYNAMODB_ACCOUNTS_TABLE_NAME'), event_record) for event_record in account_write['EventRecords']]
+        for staged_table_name, record_data in staged_records:
+            if staged_table_name != table_name:
+                continue
+            match = True
+            for field_name, condition in conditions.items():
+                if condition['ComparisonOperator'] != 'EQ' or field_name not in record_data:
+                    match = False
+                elif record_data[field_name] != condition['AttributeValueList'][0]:
+                    match = False
+            if match is True:
+                records.append(decode_item(item=record_data))
+    except:
+        logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+    debug_log(message='records={}', variable_as_list=[records,], logger=logger)
+    return records
+
+
+def build_account_commits(account_writes: list)->list:
+    """
+        Split the staged writes of one account into TransactWriteItems calls of at most 100 items. Each call puts the
+        balance records as they are after its last transaction, conditional on the version they had before its first
+        transaction, together with the transaction records and idempotency records of its transactions.
+
+        Returns a list of `(transact_items, number_of_account_writes)` tuples, in order.
+    """
+    commits = list()
+    chunk_start = 0
+    while chunk_start < len(account_writes):
+        chunk = list()
+        chunk_items = 0
+        for account_write in account_writes[chunk_start:]:
+            # Room is kept for the two balance records
+            account_write_items = len(account_write['EventRecords'])
+            if account_write['IdempotencyRecord'] is not None:
+                account_write_items += 1
+            if len(chunk) > 0 and chunk_items + account_write_items > TRANSACT_WRITE_MAX_ITEMS - 2:
+                break
+            chunk.append(account_write)
+            chunk_items += account_write_items
+        base_versions = dict()
+        balance_records = OrderedDict()
+        event_records = OrderedDict()
+        idempotency_put_items = list()
+        for account_write in chunk:
+            for event_record in account_write['EventRecords']:
+                event_records[event_record['SK']['S']] = event_record
+            for balance_record in account_write['BalanceRecords']:
+                if balance_record['SK']['S'] not in base_versions:
+                    base_versions[balance_record['SK']['S']] = Decimal(balance_record['Version']['N']) - 1
+                balance_records[balance_record['SK']['S']] = balance_record
+            if account_write['IdempotencyRecord'] is not None:
+                idempotency_put_items.append(
+                    {
+                        'Put': {
+                            'TableName': os.getenv('DYNAMODB_ACCOUNTS_TABLE_NAME'),
+                            'Item': account_write['IdempotencyRecord'],
+                            'ConditionExpression': 'attribute_not_exists(SK)',
+                        }
+                    }
+                )
+        transact_items = list()
+        for event_record in event_records.values():
+            transact_items.append({'Put': {'TableName': os.getenv('DYNAMODB_ACCOUNTS_TABLE_NAME'), 'Item': event_record}})
+        for sort_key, balance_record in balance_records.items():
+            transact_items.append(build_conditional_balance_put_item(balance_record=balance_record, version=base_versions[sort_key]))
+        commits.append((transact_items + idempotency_put_items, len(chunk)))
+        chunk_start += len(chunk)
+    return commits
+
+
+@METRICS.timer(step='CommitBatch')
+def commit_batch(
+    batch: dict,
+    boto3_clazz=boto3,
+    logger=get_logger()
+)->bool:
+    """
+        Write everything staged in the batch:
+
+        1. The object table records (`PendingWrites`) are written with a BatchWriter. Their keys are deterministic, so
+           writing them again when the messages are retried is safe.
+        2. The transaction, balance and idempotency records are committed per account with TransactWriteItems (see
+           `build_account_commits()`). The transaction records get the time of this commit as their
+           `CommitTimestamp`. The balance puts are conditional on the version the balances were loaded
+           with, so a concurrent update of the account (for example a transfer committed by another invocation)
+           cancels the commit instead of being overwritten.
+
+        Returns False when anything could not be committed - all messages of the shard must then be retried. The
+        accounts committed before the failure have their idempotency records, so their transactions are skipped on
+        the retry.
+    """
+    pending_writes = list()
+    for pending_key, record_data in batch['PendingWrites'].items():
+        pending_writes.append((pending_key[0], record_data))
+    logger.info('Committing {} staged records and the balances of {} accounts'.format(len(pending_writes), len(batch['AccountWrites'])))
+    if len(pending_writes) > 0:
+        if batch_write_dynamodb_records(records=pending_writes, boto3_clazz=boto3_clazz, logger=logger) is False:
+            return False
+    batch['PendingWrites'] = dict()
+    for account_ref in list(batch['AccountWrites'].keys()):
+        commit_timestamp = encode_attribute_value(value=get_utc_timestamp(with_decimal=False))
+        for account_write in batch['AccountWrites'][account_ref]:
+            for event_record in account_write['EventRecords']:
+                event_record['CommitTimestamp'] = commit_timestamp
+        for transact_items, number_of_account_writes in build_account_commits(account_writes=batch['AccountWrites'][account_ref]):
+            commit_status = transact_write_dynamodb_records(transact_items=transact_items, boto3_clazz=boto3_clazz, logger=logger)
+            if commit_status != 'COMMITTED':
+                logger.error('Commit of account {} failed with status {}'.format(account_ref, commit_status))
+                return False
+            for account_write in batch['AccountWrites'][account_ref][0:number_of_account_writes]:
+                idempotency_record = account_write['IdempotencyRecord']
+                if idempotency_record is not None and batch['TransactionOutcomes'] is not None:
+                    batch['TransactionOutcomes'][(idempotency_record['PK']['S'], idempotency_record['SK']['S'])] = idempotency_record['Outcome']['S']
+            batch['AccountWrites'][account_ref] = batch['AccountWrites'][account_ref][number_of_account_writes:]
+        del batch['AccountWrites'][account_ref]
+    batch['StagedOutcomes'] = dict()
+    batch_savepoint(batch=batch)
     return True
 
 
+def shard_records_by_account(records: list, logger=get_logger())->list:
+    """
+        Split the SQS records into shards that can safely be processed concurrently.
+
+        Records are first grouped by reference account (the FIFO message group ID). An inter account transfer also
+        updates the target account, so the groups of the source and target accounts are merged into the same shard.
+        Within a shard the records keep the order in which they were received, which preserves the per account order
+        guaranteed by the FIFO queue.
+    """
+    parents = dict()
+
+    def find(account_ref):
+        while parents[account_ref] != account_ref:
+            parents[account_ref] = parents[parents[account_ref]]
+            account_ref = parents[account_ref]
+        return account_ref
+
+    def union(account_ref_a, account_ref_b):
+        parents.setdefault(account_ref_a, account_ref_a)
+        parents.setdefault(account_ref_b, account_ref_b)
+        root_a = find(account_ref_a)
+        root_b = find(account_ref_b)
+        if root_a != root_b:
+            parents[root_b] = root_a
+
+    record_accounts = list()
+    for record in records:
+        account_ref = 'unknown'
+        try:
+            tx_data = json.loads(record['body'])
+            if 'ReferenceAccount' in tx_data:
+                account_ref = tx_data['ReferenceAccount']
+            union(account_ref, account_ref)
+            if tx_data.get('TransactionType', None) == 'InterAccountTransfer' and 'TargetAccount' in tx_data:
+                union(account_ref, tx_data['TargetAccount'])
+        except:
+            logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+            union(account_ref, account_ref)
+        record_accounts.append((account_ref, record))
+
+    shards = dict()
+    for account_ref, record in record_accounts:
+        shard_key = find(account_ref)
+        if shard_key not in shards:
+            shards[shard_key] = list()
+        shards[shard_key].append(record)
+    logger.info('Batch of {} records split into {} shards'.format(len(records), len(shards)))
+    return list(shards.values())
+
+
+def shard_accounts(records: list)->set:
+    """
+        All the accounts whose balances may be changed by the records of a shard
+    """
+    accounts = set()
+    for record in records:
+        try:
+            tx_data = json.loads(record['body'])
+            if 'ReferenceAccount' in tx_data:
+                accounts.add(tx_data['ReferenceAccount'])
+            if tx_data.get('TransactionType', None) == 'InterAccountTransfer' and 'TargetAccount' in tx_data:
+                accounts.add(tx_data['TargetAccount'])
+        except:
+            pass
+    return accounts
+
+
+def process_shard(
+    records: list,
+    logger=get_logger(),
+    boto3_clazz=boto3,
+    batch_mode: bool=False
+)->dict:
+    """
+        Process the records of one shard in order and return the result per SQS message ID:
+
+            OK:         The transaction was processed
+            REJECTED:   The transaction was processed but rejected (for example insufficient funds, unknown type)
+            ERROR:      An exception was raised or, in batch mode, the batch commit failed
+
+        After the first ERROR the remaining records of the shard are not processed and are also marked as ERROR. SQS
+        FIFO requires this: a failed message may not be overtaken by later messages of the same message group. In
+        batch mode the records staged by the failed transaction are dropped, and only the writes of the transactions
+        before it are committed.
+    """
+    results = dict()
+    batch = None
+    if batch_mode is True:
+        # Balances are loaded once per account, all transactions of the shard are applied in memory in FIFO order
+        # and all DynamoDB writes are committed at the end of the shard (see commit_batch()).
+        batch = new_batch_context()
+        prefetch_transaction_outcomes(records=records, batch=batch, boto3_clazz=boto3_clazz, logger=logger)
+    for record in records:
+        message_id = record.get('messageId', 'unknown')
+        if 'ERROR' in results.values():
+            logger.warning('Message {} not processed because an earlier message in the shard failed'.format(message_id))
+            results[message_id] = 'ERROR'
+            continue
+        if batch is not None:
+            batch_savepoint(batch=batch)
+        try:
+            tx_data = json.loads(record['body'])
+            METRICS.set_dimensions(TransactionType=tx_data.get('TransactionType', 'unknown'))
+            with METRICS.timer(step='ProcessTransaction'):
+                processed = process_transaction(tx_data=tx_data, logger=logger, boto3_clazz=boto3_clazz, batch=batch)
+            if processed is True:
+                results[message_id] = 'OK'
+            else:
+                results[message_id] = 'REJECTED'
+        except:
+            logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+            results[message_id] = 'ERROR'
+            if batch is not None:
+                batch_rollback(batch=batch, logger=logger)
+        METRICS.increment(name='Records', dimensions={'Result': results[message_id]})
+        METRICS.clear_dimensions()
+    if batch is not None:
+        if commit_batch(batch=batch, boto3_clazz=boto3_clazz, logger=logger) is True:
+            logger.info('Batch Committed')
+            for account_ref, balances in batch['Balances'].items():
+                balance_cache_put(account_ref=account_ref, balances=balances, logger=logger)
+        else:
+            logger.error('Batch Commit Failed')
+            for message_id in results.keys():
+                results[message_id] = 'ERROR'
+    if 'ERROR' in results.values():
+        # The state of the accounts in the shard is unknown - the failed messages will be delivered again
+        for account_ref in shard_accounts(records=records):
+            balance_cache_invalidate(account_ref=account_ref, logger=logger)
+    return results
+
+
+def process_records(
+    records: list,
+    logger=get_logger(),
+    boto3_clazz=boto3,
+    batch_mode: bool=False,
+    max_workers: int=1
+)->dict:
+    """
+        Process all SQS records and return the result per SQS message ID (see `process_shard()`).
+
+        With `max_workers` greater than 1 the shards are processed concurrently on a bounded thread pool. The work is
+        almost entirely DynamoDB I/O, so threads give a near linear latency reduction for batches with many accounts.
+    """
+    results = dict()
+    shards = shard_records_by_account(records=records, logger=logger)
+    if max_workers > 1 and len(shards) > 1:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(shards))) as executor:
+            futures = [
+                executor.submit(process_shard, records=shard_records, logger=logger, boto3_clazz=boto3_clazz, batch_mode=batch_mode)
+                for shard_records in shards
+            ]
+            for future in futures:
+                results.update(future.result())
+    else:
+        for shard_records in shards:
+            results.update(process_shard(records=shard_records, logger=logger, boto3_clazz=boto3_clazz, batch_mode=batch_mode))
+    debug_log('results={}', variable_as_list=[results,], logger=logger)
+    return results
+
+
+def build_batch_response(failed_message_ids: list, logger=get_logger())->dict:
+    """
+        Build the handler response in the shape expected by an SQS event source mapping with ReportBatchItemFailures
+        enabled. Only the listed messages are returned to the queue, all other messages in the batch are deleted.
+    """
+    result = 'Ok'
+    if len(failed_message_ids) > 0:
+        result = 'PartialFailure'
+        logger.warning('Messages reported as failed: {}'.format(failed_message_ids))
+    return {
+        'Result': result,
+        'Message': None,
+        'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed_message_ids],
+    }
+
+
 ###############################################################################
 ###                                                                         ###
 ###                         M A I N    H A N D L E R                        ###
@@ -1301,6 +2853,67 @@ TX_TYPE_HANDLER_MAP = {
     'InterAccountTransfer': inter_account_transfer,
 }
 
+
+def process_transaction(
+    tx_data: dict,
+    logger=get_logger(),
+    boto3_clazz=boto3,
+    batch: dict=None,
+    max_attempts: int=3
+)->bool:
+    """
+        When a balance commit is rejected because the cached balance was stale, the account is already removed from
+        the balance cache and the transaction is processed again from the start with balances read from DynamoDB. All
+        records written before the balance commit use deterministic keys, so writing them again is safe.
+
+        Before any balance is read, a transaction whose idempotency record exists is skipped with the recorded outcome:
+        it was already processed by an earlier delivery of the same message, or by an earlier replay of the event.
+
+        A handler only returns False for a business rejection (for example insufficient funds, or no pending
+        transaction to verify), which is recorded as REJECTED. Errors reading or writing DynamoDB are raised by the
+        handlers instead, so the message is retried and no idempotency record is written.
+    """
+    if 'TransactionType' in tx_data:
+        if tx_data['TransactionType'] in TX_TYPE_HANDLER_MAP:
+            logger.info('Processing Transaction. tx_data={}'.format(tx_data))
+            result = False
+            original_tx_data = copy.deepcopy(tx_data)
+            attempt = 0
+            while attempt < max_attempts:
+                attempt += 1
+                tx_context = new_transaction_context(tx_data=tx_data)
+                recorded_outcome = get_transaction_outcome(tx_data=tx_data, boto3_clazz=boto3_clazz, logger=logger, batch=batch)
+                if recorded_outcome is not None:
+                    logger.warning('Transaction {} of event {} was already processed with outcome {} - skipping'.format(tx_data['RequestId'], tx_context['EventKey'], recorded_outcome))
+                    METRICS.increment(name='DuplicateTransactions')
+                    return recorded_outcome == 'APPLIED'
+                try:
+                    result = TX_TYPE_HANDLER_MAP[tx_data['TransactionType']](tx_data=tx_data, logger=logger, boto3_clazz=boto3_clazz, batch=batch, tx_context=tx_context)
+                    break
+                except BalanceVersionConflict as e:
+                    logger.warning('{} - processing transaction again (attempt {} of {})'.format(str(e), attempt, max_attempts))
+                    if attempt >= max_attempts:
+                        raise
+                    tx_data = copy.deepcopy(original_tx_data)
+            if result is True:
+                logger.info('Transaction Processed for Event: {}'.format(tx_data['EventSourceDataResource']))
+            else:
+                logger.error('Transaction Processing Returned Failure.')
+                record_rejected_transaction(tx_data=tx_data, boto3_clazz=boto3_clazz, logger=logger, batch=batch, tx_context=tx_context)
+            update_object_sate(
+                tx_data=tx_data,
+                logger=logger,
+                boto3_clazz=boto3_clazz,
+                batch=batch,
+                tx_context=tx_context
+            )
+            return result
+        else:
+            logger.error('Field TransactionType has unrecognized value. Cannot proceed with transaction processing. tx_data={}'.format(tx_data))
+    else:
+        logger.error('Expected field TransactionType but not present. Cannot proceed with transaction processing. tx_data={}'.format(tx_data))
+    return False
+
     
 def handler(
     event,
@@ -1315,6 +2928,9 @@ def handler(
     refresh_environment_cache(logger=logger)
     if cache['Environment']['Data']['DEBUG'] is True and run_from_main is False:
         logger  = get_logger(level=logging.DEBUG)
+    METRICS.enabled = cache['Environment']['Data']['METRICS_ENABLED']
+    METRICS.namespace = cache['Environment']['Data']['METRICS_NAMESPACE']
+    handler_start = time.perf_counter()
     
     debug_log('event={}', variable_as_list=[event], logger=logger)
     """
@@ -1356,30 +2972,29 @@ def handler(
             }        
 
     """
+    failed_message_ids = list()
     try:
-        for record in event['Records']:
-            tx_data = json.loads(record['body'])
-            if 'TransactionType' in tx_data:
-                if tx_data['TransactionType'] in TX_TYPE_HANDLER_MAP:
-                    logger.info('Processing Transaction. tx_data={}'.format(tx_data))
-                    if TX_TYPE_HANDLER_MAP[tx_data['TransactionType']](tx_data=tx_data, logger=logger, boto3_clazz=boto3_clazz) is True:
-                        logger.info('Transaction Processed for Event: {}'.format(tx_data['EventSourceDataResource']))
-                    else:
-                        logger.error('Transaction Processing Returned Failure.')
-                    update_object_sate(
-                        tx_data=tx_data,
-                        logger=logger,
-                        boto3_clazz=boto3_clazz
-                    )
-                else:
-                    logger.error('Field TransactionType has unrecognized value. Cannot proceed with transaction processing. tx_data={}'.format(tx_data))
-            else:
-                logger.error('Expected field TransactionType but not present. Cannot proceed with transaction processing. tx_data={}'.format(tx_data))
+        results = process_records(
+            records=event['Records'],
+            logger=logger,
+            boto3_clazz=boto3_clazz,
+            batch_mode=cache['Environment']['Data']['BATCH_MODE'],
+            max_workers=cache['Environment']['Data']['MAX_WORKERS']
+        )
+        for message_id, result in results.items():
+            if result == 'ERROR':
+                failed_message_ids.append(message_id)
+            elif result != 'OK':
+                logger.warning('Message {} result: {}'.format(message_id, result))
     except:
         logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+        failed_message_ids = [record['messageId'] for record in event.get('Records', list()) if 'messageId' in record]
 
-
-    return {"Result": "Ok", "Message": None}    # Adapt to suite the use case....
+    METRICS.put_metric(name='StepDuration', value=round((time.perf_counter() - handler_start) * 1000, 3), unit='Milliseconds', dimensions={'Step': 'Handler'})
+    METRICS.increment(name='Messages', value=len(event.get('Records', list())))
+    METRICS.increment(name='FailedMessages', value=len(failed_message_ids))
+    METRICS.flush()
+    return build_batch_response(failed_message_ids=failed_message_ids, logger=logger)
 
 
 ###############################################################################
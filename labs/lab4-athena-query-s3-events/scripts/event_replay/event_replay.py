@@ -0,0 +1,538 @@
+"""
+Replay of archived transaction events into a restored accounts table, for the point in time recovery scenarios
+described in the README:
+
+    S3 Inventory manifest and/or bucket listing -> events created after the restore timestamp, in creation order
+        -> payloads fetched in parallel -> enriched like s3_new_event_bucket_object_create
+        -> tx_processing_consumer.process_records() -> restored DynamoDB tables
+
+The events are not sent through SQS. The consumer's `process_records()` splits every window of events into shards of
+accounts (accounts linked by inter account transfers end up in the same shard), processes the shards in parallel and
+the events of a shard in order with the `TX_TYPE_HANDLER_MAP` functions - exactly like a consumer invocation, but
+with windows of thousands of events instead of SQS batches of 10.
+
+S3 has no record of the order in which the events were received, so the `LastModified` time of the objects is used.
+Objects created in the same second are ordered with the pending events (for example `cash_deposit_`) before the
+events verifying them (for example `verify_cash_deposit_`) and then by key.
+
+Progress is written to a checkpoint file after every window, together with the events that failed. When an event of
+an account fails, the later events of that account are skipped (and recorded) to preserve the order of the account's
+transactions. Running the same command again resumes after the last completed window, and `--retry-failed` first
+replays the failed and skipped events again, in their original order.
+
+Examples:
+
+    # Only build the replay plan and show what would be replayed
+    python3 event_replay.py --bucket "$ARCHIVE_BUCKET_NAME_PARAM" --since 2023-01-10T08:00:00Z --dry-run
+
+    # Events from the daily inventory, plus the events created after the inventory was taken
+    python3 event_replay.py --since 2023-01-10T08:00:00Z \\
+        --inventory-manifest s3://$ARCHIVE_INVENTORY_BUCKET_NAME_PARAM/.../2023-01-11T01-00Z/manifest.json \\
+        --bucket "$NEW_EVENT_BUCKET_NAME_PARAM" \\
+        --accounts-table lab4_accounts_restored --object-table lab4_event_objects_restored \\
+        --checkpoint-file replay-2023-01-10.json
+
+The Lambda function modules are loaded from `../../lambda_functions`, so this script must be run from a checkout of
+the repository.
+"""
+import argparse
+import csv
+import gzip
+import hashlib
+import importlib.util
+import io
+import json
+import logging
+import os
+import time
+import traceback
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import boto3
+
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_FUNCTIONS_DIR = os.path.join(SCRIPT_DIR, '..', '..', 'lambda_functions')
+
+# The s3_new_event_bucket_object_create function rejects larger objects, so they were never processed
+MAX_EVENT_OBJECT_SIZE = 1024
+
+# Events that reference an earlier pending event of the same account
+VERIFICATION_KEY_PREFIXES = (
+    'verify_cash_deposit_',
+    'outgoing_payment_verified_',
+    'outgoing_payment_rejected_',
+)
+
+RESULTS = ('OK', 'REJECTED', 'ERROR', 'SKIPPED',)
+
+
+def load_lambda_module(module_name: str):
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(LAMBDA_FUNCTIONS_DIR, module_name, '{}.py'.format(module_name)))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def parse_timestamp(value: str)->float:
+    """
+        Accepts a UNIX timestamp or an ISO 8601 date and time - a time without a time zone is taken to be UTC
+    """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def save_json_file(file_name: str, data):
+    """
+        Write to a temporary file first, so an interrupted write never leaves a corrupt checkpoint behind
+    """
+    temporary_file_name = '{}.tmp'.format(file_name)
+    with open(temporary_file_name, 'w') as f:
+        f.write(json.dumps(data, indent=4))
+    os.replace(temporary_file_name, file_name)
+
+
+def load_json_file(file_name: str):
+    with open(file_name, 'r') as f:
+        return json.loads(f.read())
+
+
+###############################################################################
+###                                                                         ###
+###                           E V E N T    S O U R C E S                    ###
+###                                                                         ###
+###############################################################################
+
+
+def parse_s3_url(url: str)->tuple:
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme != 's3' or parsed.netloc == '' or parsed.path in ('', '/'):
+        raise Exception('Expected an S3 URL like s3://bucket/key but got "{}"'.format(url))
+    return parsed.netloc, parsed.path.lstrip('/')
+
+
+def read_inventory_manifest(manifest_url: str, s3_client)->list:
+    """
+        Read all objects listed in an S3 Inventory report. Only the CSV format is supported, and the inventory must
+        include the optional `LastModifiedDate` field. Object keys are URL encoded in inventory reports.
+    """
+    manifest_bucket, manifest_key = parse_s3_url(url=manifest_url)
+    manifest = json.loads(s3_client.get_object(Bucket=manifest_bucket, Key=manifest_key)['Body'].read().decode('utf-8'))
+    if manifest.get('fileFormat', 'CSV') != 'CSV':
+        raise Exception('Inventory format "{}" is not supported - only CSV inventories can be replayed'.format(manifest['fileFormat']))
+    schema = [field_name.strip() for field_name in manifest['fileSchema'].split(',')]
+    if 'LastModifiedDate' not in schema:
+        raise Exception('The inventory does not include the LastModifiedDate field, which is required to order the events')
+    objects = list()
+    for inventory_file in manifest['files']:
+        data = s3_client.get_object(Bucket=manifest_bucket, Key=inventory_file['key'])['Body'].read()
+        if inventory_file['key'].endswith('.gz'):
+            data = gzip.decompress(data)
+        for row in csv.reader(io.StringIO(data.decode('utf-8'))):
+            fields = dict(zip(schema, row))
+            if fields.get('IsLatest', 'true') != 'true' or fields.get('IsDeleteMarker', 'false') == 'true':
+                continue
+            size = None
+            if fields.get('Size', '') != '':
+                size = int(fields['Size'])
+            objects.append({
+                'Bucket': fields['Bucket'],
+                'Key': urllib.parse.unquote_plus(fields['Key']),
+                'Size': size,
+                'LastModified': parse_timestamp(value=fields['LastModifiedDate']),
+            })
+    print('Inventory "{}": {} objects in {} files'.format(manifest_url, len(objects), len(manifest['files'])))
+    return objects
+
+
+def list_bucket_objects(bucket: str, prefix: str, s3_client)->list:
+    objects = list()
+    parameters = {'Bucket': bucket, 'Prefix': prefix}
+    while True:
+        response = s3_client.list_objects_v2(**parameters)
+        for s3_object in response.get('Contents', list()):
+            objects.append({
+                'Bucket': bucket,
+                'Key': s3_object['Key'],
+                'Size': s3_object['Size'],
+                'LastModified': s3_object['LastModified'].timestamp(),
+            })
+        if response.get('IsTruncated', False) is False:
+            break
+        parameters['ContinuationToken'] = response['NextContinuationToken']
+    print('Bucket "{}": {} objects'.format(bucket, len(objects)))
+    return objects
+
+
+def build_replay_plan(objects: list, since: float, until: float, resolve_event_key)->tuple:
+    """
+        Returns the events to replay as `[bucket, key, last_modified]` lists in replay order, plus the number of
+        objects that were ignored. An object found in more than one source (for example in the inventory and in the
+        bucket listing) is only replayed once.
+    """
+    candidates = dict()
+    ignored = 0
+    for s3_object in objects:
+        if s3_object['LastModified'] <= since or (until is not None and s3_object['LastModified'] > until):
+            continue
+        route = resolve_event_key(key=s3_object['Key'])
+        if route is None or (s3_object['Size'] is not None and s3_object['Size'] > MAX_EVENT_OBJECT_SIZE):
+            ignored += 1
+            continue
+        rank = 0
+        if route['Prefix'] in VERIFICATION_KEY_PREFIXES:
+            rank = 1
+        candidates[(s3_object['Bucket'], s3_object['Key'])] = (s3_object['LastModified'], rank)
+    ordered = sorted(candidates.items(), key=lambda item: (item[1][0], item[1][1], item[0][1]))
+    plan = [[bucket, key, last_modified] for (bucket, key), (last_modified, rank) in ordered]
+    return plan, ignored
+
+
+###############################################################################
+###                                                                         ###
+###                              C H E C K P O I N T                        ###
+###                                                                         ###
+###############################################################################
+
+
+def get_plan_digest(plan: list)->str:
+    return hashlib.sha256(json.dumps(plan).encode('utf-8')).hexdigest()
+
+
+def new_checkpoint(selection: dict, plan: list, plan_file: str)->dict:
+    now = datetime.now(timezone.utc).isoformat()
+    return {
+        'Selection': selection,
+        'PlanFile': plan_file,
+        'PlanDigest': get_plan_digest(plan=plan),
+        'PlanSize': len(plan),
+        'NextIndex': 0,
+        'Counters': dict([(result, 0) for result in RESULTS]),
+        'BlockedAccounts': list(),
+        'FailedEvents': list(),
+        'Started': now,
+        'Updated': now,
+        'Completed': False,
+    }
+
+
+def load_checkpoint(checkpoint_file: str, selection: dict)->tuple:
+    checkpoint = load_json_file(file_name=checkpoint_file)
+    if checkpoint['Selection'] != selection:
+        raise Exception(
+            'Checkpoint "{}" was created for a different selection: {} - use --restart to start over'.format(
+                checkpoint_file,
+                checkpoint['Selection']
+            )
+        )
+    plan = load_json_file(file_name=checkpoint['PlanFile'])
+    if get_plan_digest(plan=plan) != checkpoint['PlanDigest']:
+        raise Exception('Plan file "{}" does not match the checkpoint'.format(checkpoint['PlanFile']))
+    return checkpoint, plan
+
+
+###############################################################################
+###                                                                         ###
+###                                  R E P L A Y                            ###
+###                                                                         ###
+###############################################################################
+
+
+def fetch_payload(s3_client, bucket: str, key: str)->str:
+    return s3_client.get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8')
+
+
+def fetch_window_payloads(executor: ThreadPoolExecutor, s3_client, entries: list)->list:
+    return [executor.submit(fetch_payload, s3_client, bucket, key) for bucket, key, last_modified in entries]
+
+
+def build_transaction(bucket: str, key: str, payload_json: str, create_module, logger)->dict:
+    """
+        Enrich the event payload in the same way as s3_new_event_bucket_object_create does before sending it to the
+        transaction queue. Returns None when that function would have rejected the event.
+    """
+    try:
+        route = create_module.resolve_event_key(key=key)
+        tx_data = json.loads(payload_json)
+        request_id = create_module.extract_request_id(key=key, logger=logger, route=route)
+        if request_id is None:
+            return None
+        tx_data['RequestId'] = request_id
+        tx_data['EventSourceDataResource'] = {'S3Key': key, 'S3Bucket': bucket}
+        tx_type_and_reference_account = create_module.determine_tx_type_and_reference_account(data=tx_data, logger=logger, route=route)
+        if 'unknown' in (tx_type_and_reference_account['TxType'], tx_type_and_reference_account['ReferenceAccount']):
+            return None
+        tx_data['TransactionType'] = tx_type_and_reference_account['TxType']
+        tx_data['ReferenceAccount'] = tx_type_and_reference_account['ReferenceAccount']
+        return tx_data
+    except:
+        logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+    return None
+
+
+def replay_window(
+    indexes: list,
+    plan: list,
+    payloads: list,
+    checkpoint: dict,
+    consumer_module,
+    create_module,
+    batch_mode: bool,
+    max_workers: int,
+    boto3_clazz=boto3,
+    logger=logging.getLogger()
+)->dict:
+    """
+        Replay the plan entries with the given indexes (ascending) and update the counters, blocked accounts and failed
+        events of the checkpoint. The plan index of an event is used as its message ID.
+    """
+    window_counters = dict([(result, 0) for result in RESULTS])
+    blocked_accounts = set(checkpoint['BlockedAccounts'])
+    records = list()
+    record_entries = dict()
+
+    def record_result(index: int, result: str, accounts: set):
+        window_counters[result] += 1
+        if result != 'OK':
+            bucket, key, last_modified = plan[index]
+            checkpoint['FailedEvents'].append({
+                'Index': index,
+                'Bucket': bucket,
+                'Key': key,
+                'Result': result,
+                'Accounts': sorted(accounts),
+            })
+
+    for index, payload_json in zip(indexes, payloads):
+        bucket, key, last_modified = plan[index]
+        tx_data = build_transaction(bucket=bucket, key=key, payload_json=payload_json, create_module=create_module, logger=logger)
+        if tx_data is None:
+            logger.warning('Event "{}" rejected - the transaction type or reference account is not recognized'.format(key))
+            record_result(index=index, result='REJECTED', accounts=set())
+            continue
+        record = {'messageId': '{}'.format(index), 'body': json.dumps(tx_data)}
+        accounts = consumer_module.shard_accounts(records=[record])
+        if len(accounts & blocked_accounts) > 0:
+            # An earlier event of the account failed - processing this event now would change the order. The other
+            # account of a transfer is blocked as well, as its later events may depend on this one.
+            blocked_accounts.update(accounts)
+            record_result(index=index, result='SKIPPED', accounts=accounts)
+            continue
+        records.append(record)
+        record_entries[record['messageId']] = (index, accounts)
+
+    results = dict()
+    if len(records) > 0:
+        results = consumer_module.process_records(
+            records=records,
+            logger=logger,
+            boto3_clazz=boto3_clazz,
+            batch_mode=batch_mode,
+            max_workers=max_workers
+        )
+    for record in records:
+        index, accounts = record_entries[record['messageId']]
+        result = results.get(record['messageId'], 'ERROR')
+        if result == 'ERROR':
+            blocked_accounts.update(accounts)
+        record_result(index=index, result=result, accounts=accounts)
+
+    checkpoint['BlockedAccounts'] = sorted(blocked_accounts)
+    for result, qty in window_counters.items():
+        checkpoint['Counters'][result] += qty
+    return window_counters
+
+
+def replay_events(
+    indexes: list,
+    plan: list,
+    checkpoint: dict,
+    checkpoint_file: str,
+    args,
+    consumer_module,
+    create_module,
+    s3_client,
+    boto3_clazz=boto3,
+    logger=logging.getLogger()
+)->int:
+    """
+        Replay the plan entries with the given indexes (ascending) in windows of `--window-size` events. The payloads of
+        the next window are downloaded while the current window is processed, and the checkpoint is saved after every
+        window. A failed download raises an exception, leaving the checkpoint at the last completed window.
+    """
+    windows = [indexes[start:start + args.window_size] for start in range(0, len(indexes), args.window_size)]
+    replayed = 0
+    with ThreadPoolExecutor(max_workers=args.fetch_workers) as executor:
+        next_payloads = None
+        for window_idx, window_indexes in enumerate(windows):
+            if next_payloads is None:
+                next_payloads = fetch_window_payloads(executor=executor, s3_client=s3_client, entries=[plan[index] for index in window_indexes])
+            payload_futures = next_payloads
+            next_payloads = None
+            if window_idx + 1 < len(windows):
+                next_payloads = fetch_window_payloads(executor=executor, s3_client=s3_client, entries=[plan[index] for index in windows[window_idx + 1]])
+            payloads = [future.result() for future in payload_futures]
+
+            window_counters = replay_window(
+                indexes=window_indexes,
+                plan=plan,
+                payloads=payloads,
+                checkpoint=checkpoint,
+                consumer_module=consumer_module,
+                create_module=create_module,
+                batch_mode=args.batch_mode,
+                max_workers=args.workers,
+                boto3_clazz=boto3_clazz,
+                logger=logger
+            )
+            checkpoint['NextIndex'] = max(checkpoint['NextIndex'], window_indexes[-1] + 1)
+            checkpoint['Updated'] = datetime.now(timezone.utc).isoformat()
+            save_json_file(file_name=checkpoint_file, data=checkpoint)
+            replayed += len(window_indexes)
+            print('   {} of {} events replayed - {}'.format(replayed, len(indexes), window_counters))
+    return replayed
+
+
+def run(args, boto3_clazz=boto3)->dict:
+    # The consumer reads the table names from the environment when it writes, so the restored tables are set first
+    os.environ['DYNAMODB_ACCOUNTS_TABLE_NAME'] = args.accounts_table
+    os.environ['DYNAMODB_OBJECT_TABLE_NAME'] = args.object_table
+    consumer_module = load_lambda_module(module_name='tx_processing_consumer')
+    create_module = load_lambda_module(module_name='s3_new_event_bucket_object_create')
+    consumer_module.METRICS.enabled = False
+    create_module.METRICS.enabled = False
+    logger = consumer_module.get_logger(level=getattr(logging, args.log_level))
+    consumer_module.refresh_environment_cache(logger=logger)
+    create_module.refresh_environment_cache(logger=logger)
+    s3_client = boto3_clazz.client('s3', region_name=args.region)
+
+    selection = {
+        'InventoryManifests': args.inventory_manifest,
+        'Bucket': args.bucket,
+        'Prefix': args.prefix,
+        'Since': parse_timestamp(value=args.since),
+        'Until': parse_timestamp(value=args.until) if args.until is not None else None,
+        'AccountsTable': args.accounts_table,
+        'ObjectTable': args.object_table,
+    }
+    plan_file = '{}.plan'.format(args.checkpoint_file)
+    if os.path.exists(args.checkpoint_file) is True and args.restart is False and args.dry_run is False:
+        checkpoint, plan = load_checkpoint(checkpoint_file=args.checkpoint_file, selection=selection)
+        print('Resuming from checkpoint "{}" at event {} of {}'.format(args.checkpoint_file, checkpoint['NextIndex'], checkpoint['PlanSize']))
+    else:
+        objects = list()
+        for manifest_url in args.inventory_manifest:
+            objects += read_inventory_manifest(manifest_url=manifest_url, s3_client=s3_client)
+        if args.bucket is not None:
+            objects += list_bucket_objects(bucket=args.bucket, prefix=args.prefix, s3_client=s3_client)
+        plan, ignored = build_replay_plan(
+            objects=objects,
+            since=selection['Since'],
+            until=selection['Until'],
+            resolve_event_key=create_module.resolve_event_key
+        )
+        print('Replay plan: {} events to replay, {} objects ignored'.format(len(plan), ignored))
+        if args.dry_run is True:
+            return {
+                'Events': len(plan),
+                'Ignored': ignored,
+                'FirstEvent': plan[0] if len(plan) > 0 else None,
+                'LastEvent': plan[-1] if len(plan) > 0 else None,
+            }
+        save_json_file(file_name=plan_file, data=plan)
+        checkpoint = new_checkpoint(selection=selection, plan=plan, plan_file=plan_file)
+        save_json_file(file_name=args.checkpoint_file, data=checkpoint)
+
+    start = time.time()
+    replayed = 0
+    if args.retry_failed is True and len(checkpoint['FailedEvents']) > 0:
+        retry_indexes = sorted([failed_event['Index'] for failed_event in checkpoint['FailedEvents'] if failed_event['Result'] in ('ERROR', 'SKIPPED',)])
+        retried = set(retry_indexes)
+        print('Retrying {} failed and skipped events'.format(len(retry_indexes)))
+        for failed_event in checkpoint['FailedEvents']:
+            if failed_event['Index'] in retried:
+                checkpoint['Counters'][failed_event['Result']] -= 1
+        checkpoint['FailedEvents'] = [failed_event for failed_event in checkpoint['FailedEvents'] if failed_event['Index'] not in retried]
+        checkpoint['BlockedAccounts'] = list()
+        replayed += replay_events(
+            indexes=retry_indexes,
+            plan=plan,
+            checkpoint=checkpoint,
+            checkpoint_file=args.checkpoint_file,
+            args=args,
+            consumer_module=consumer_module,
+            create_module=create_module,
+            s3_client=s3_client,
+            boto3_clazz=boto3_clazz,
+            logger=logger
+        )
+    replayed += replay_events(
+        indexes=list(range(checkpoint['NextIndex'], len(plan))),
+        plan=plan,
+        checkpoint=checkpoint,
+        checkpoint_file=args.checkpoint_file,
+        args=args,
+        consumer_module=consumer_module,
+        create_module=create_module,
+        s3_client=s3_client,
+        boto3_clazz=boto3_clazz,
+        logger=logger
+    )
+    duration = time.time() - start
+    checkpoint['Completed'] = True
+    save_json_file(file_name=args.checkpoint_file, data=checkpoint)
+
+    return {
+        'Events': len(plan),
+        'Replayed': replayed,
+        'Counters': checkpoint['Counters'],
+        'BlockedAccounts': len(checkpoint['BlockedAccounts']),
+        'FailedEvents': len(checkpoint['FailedEvents']),
+        'DurationSeconds': round(duration, 3),
+        'EventsPerSecond': round(replayed / duration, 1) if duration > 0 else 0.0,
+        'CheckpointFile': args.checkpoint_file,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Lab4 event replay after a DynamoDB point in time restore')
+    parser.add_argument('--since', type=str, required=True, help='Restore timestamp (UNIX timestamp or ISO 8601) - only events created after it are replayed')
+    parser.add_argument('--until', type=str, default=None, help='Optionally, only replay events created up to this time')
+    parser.add_argument('--inventory-manifest', type=str, action='append', default=list(), help='S3 URL of an S3 Inventory manifest.json (can be repeated)')
+    parser.add_argument('--bucket', type=str, default=None, help='Also list all objects in this bucket')
+    parser.add_argument('--prefix', type=str, default='', help='Only list the objects with this key prefix')
+    parser.add_argument('--accounts-table', type=str, default=os.getenv('DYNAMODB_ACCOUNTS_TABLE_NAME', 'lab4_accounts_v1'))
+    parser.add_argument('--object-table', type=str, default=os.getenv('DYNAMODB_OBJECT_TABLE_NAME', 'lab4_event_objects_v1'))
+    parser.add_argument('--region', type=str, default=os.getenv('AWS_REGION', 'eu-central-1'))
+    parser.add_argument('--window-size', type=int, default=2000, help='Number of events replayed (and checkpointed) together')
+    parser.add_argument('--workers', type=int, default=32, help='Number of account shards processed in parallel')
+    parser.add_argument('--fetch-workers', type=int, default=64, help='Number of parallel S3 downloads')
+    parser.add_argument('--no-batch-mode', dest='batch_mode', action='store_false', help='Write every transaction to DynamoDB immediately instead of once per shard')
+    parser.add_argument('--checkpoint-file', type=str, default='event_replay_checkpoint.json')
+    parser.add_argument('--restart', action='store_true', help='Ignore an existing checkpoint and build a new replay plan')
+    parser.add_argument('--retry-failed', action='store_true', help='First replay the failed and skipped events of the checkpoint again')
+    parser.add_argument('--dry-run', action='store_true', help='Only build the replay plan')
+    parser.add_argument('--log-level', type=str, default='WARNING', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR',))
+    parser.add_argument('--results-file', type=str, default=None, help='Also write the results as JSON to this file')
+    args = parser.parse_args()
+    if len(args.inventory_manifest) == 0 and args.bucket is None:
+        parser.error('at least one of --inventory-manifest or --bucket is required')
+
+    result = run(args=args)
+
+    print(json.dumps(result, indent=4))
+    if args.results_file is not None:
+        with open(args.results_file, 'w') as f:
+            f.write(json.dumps(result, indent=4))
+
+
+if __name__ == '__main__':
+    main()
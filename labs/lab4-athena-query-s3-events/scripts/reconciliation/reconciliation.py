@@ -0,0 +1,530 @@
+"""
+Offline reconciliation of the accounts table: the balances of every account are recalculated from all its
+`TRANSACTIONS#...` records and compared with the `SAVINGS#BALANCE#AVAILABLE` and `SAVINGS#BALANCE#ACTUAL` records.
+
+    Parallel segmented Scan of the accounts table -> columns (NumPy arrays) of transactions and balances
+        -> group by sums of the `EffectOnAvailableBalance` and `EffectOnActualBalance` effects per account
+        -> comparison with the balance records -> consistent per account re-check of the mismatches
+
+The balance effects are applied exactly like the `account_ledger_snapshot` Lambda function replays a ledger, including
+`Adjusted` effects (a verified cash deposit with a different amount than the pending deposit), but for all accounts at
+once with array operations instead of a replay per account. Amounts are converted to integers in the smallest unit of
+the currency (`--decimal-places`) so that the sums are exact.
+
+A Scan does not read the table at a single point in time, so an account that processed transactions during the Scan
+can show up as a mismatch. Mismatches are therefore checked again with consistent reads of only that account (unless
+`--no-recheck` is used). The reconciliation is intended for tables that are not changing, for example after an event
+replay into a restored table.
+
+Examples:
+
+    # Reconcile a restored accounts table after an event replay
+    python3 reconciliation.py --accounts-table lab4_accounts_restored --segments 16 --results-file reconciliation.json
+
+    # Reconcile the live table, with fewer parallel segments to limit the read throughput
+    python3 reconciliation.py --segments 4
+"""
+import argparse
+import json
+import logging
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+import boto3
+import numpy
+
+
+TRANSACTION_SK_PREFIX = 'TRANSACTIONS#'
+BALANCE_SK_PREFIX = 'SAVINGS#BALANCE#'
+BALANCE_TYPES = ('Available', 'Actual',)
+RESULTS = ('OK', 'MISMATCH', 'MISSING_BALANCE', 'ERROR', 'CHANGED',)
+RECHECK_MAX_ATTEMPTS = 3
+
+# Only the attributes needed for the reconciliation are returned by the Scan
+PROJECTION_EXPRESSION = 'PK, SK, Amount, EffectOnAvailableBalance, EffectOnActualBalance, RequestId, PreviousRequestIdReference, Balance, Version'
+
+# Amounts are only exact as integers in a float64 up to 2**53
+MAX_EXACT_UNITS = 2 ** 52
+
+
+def get_logger(level=logging.INFO):
+    logger = logging.getLogger('reconciliation')
+    if len(logger.handlers) == 0:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+        logger.addHandler(handler)
+    logger.setLevel(level)
+    return logger
+
+
+###############################################################################
+###                                                                         ###
+###                                 E X P O R T                             ###
+###                                                                         ###
+###############################################################################
+
+
+def new_columns()->dict:
+    """
+        The raw string values of the items, one list per column:
+
+            Transactions:   Account, SK, Amount, EffectOnAvailableBalance, EffectOnActualBalance, RequestId,
+                            PreviousRequestIdReference ('' when the record does not have the attribute)
+            Balances:       Account, BalanceType, Balance, Version
+    """
+    return {
+        'Transactions': {
+            'Account': list(),
+            'SK': list(),
+            'Amount': list(),
+            'EffectOnAvailableBalance': list(),
+            'EffectOnActualBalance': list(),
+            'RequestId': list(),
+            'PreviousRequestIdReference': list(),
+        },
+        'Balances': {
+            'Account': list(),
+            'BalanceType': list(),
+            'Balance': list(),
+            'Version': list(),
+        },
+        'ItemsRead': 0,
+    }
+
+
+def _helper_string_value(item: dict, attribute_name: str, default: str='')->str:
+    if attribute_name not in item:
+        return default
+    return list(item[attribute_name].values())[0]
+
+
+def add_items_to_columns(items: list, columns: dict)->dict:
+    """
+        Add the transaction and balance items (in the DynamoDB attribute value format) to the columns - all other
+        items of the accounts table (snapshots, idempotency records) are ignored
+    """
+    transactions = columns['Transactions']
+    balances = columns['Balances']
+    for item in items:
+        columns['ItemsRead'] += 1
+        sk = item['SK']['S']
+        if sk.startswith(TRANSACTION_SK_PREFIX):
+            transactions['Account'].append(item['PK']['S'])
+            transactions['SK'].append(sk)
+            transactions['Amount'].append(item['Amount']['N'])
+            transactions['EffectOnAvailableBalance'].append(_helper_string_value(item=item, attribute_name='EffectOnAvailableBalance', default='None'))
+            transactions['EffectOnActualBalance'].append(_helper_string_value(item=item, attribute_name='EffectOnActualBalance', default='None'))
+            transactions['RequestId'].append(_helper_string_value(item=item, attribute_name='RequestId'))
+            transactions['PreviousRequestIdReference'].append(_helper_string_value(item=item, attribute_name='PreviousRequestIdReference'))
+        elif sk.startswith(BALANCE_SK_PREFIX):
+            balance_type = sk[len(BALANCE_SK_PREFIX):].capitalize()
+            if balance_type not in BALANCE_TYPES:
+                continue
+            balances['Account'].append(item['PK']['S'])
+            balances['BalanceType'].append(balance_type)
+            balances['Balance'].append(item['Balance']['N'])
+            balances['Version'].append(_helper_string_value(item=item, attribute_name='Version', default='0'))
+    return columns
+
+
+def merge_columns(columns_list: list)->dict:
+    merged = new_columns()
+    for columns in columns_list:
+        for table in ('Transactions', 'Balances',):
+            for column_name, values in columns[table].items():
+                merged[table][column_name] += values
+        merged['ItemsRead'] += columns['ItemsRead']
+    return merged
+
+
+def scan_segment(
+    dynamodb_client,
+    table_name: str,
+    segment: int,
+    total_segments: int,
+    page_size: int,
+    logger=get_logger()
+)->dict:
+    columns = new_columns()
+    parameters = {
+        'TableName': table_name,
+        'ProjectionExpression': PROJECTION_EXPRESSION,
+        'Segment': segment,
+        'TotalSegments': total_segments,
+        'Limit': page_size,
+    }
+    while True:
+        response = dynamodb_client.scan(**parameters)
+        add_items_to_columns(items=response.get('Items', list()), columns=columns)
+        if response.get('LastEvaluatedKey', None) is None:
+            break
+        parameters['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    logger.info('Segment {} of {}: read {} items'.format(segment + 1, total_segments, columns['ItemsRead']))
+    return columns
+
+
+def export_accounts_table(
+    dynamodb_client,
+    table_name: str,
+    total_segments: int,
+    page_size: int,
+    logger=get_logger()
+)->dict:
+    """
+        Read the complete accounts table with a parallel Scan, one thread per segment
+    """
+    with ThreadPoolExecutor(max_workers=total_segments) as executor:
+        futures = [
+            executor.submit(
+                scan_segment,
+                dynamodb_client=dynamodb_client,
+                table_name=table_name,
+                segment=segment,
+                total_segments=total_segments,
+                page_size=page_size,
+                logger=logger
+            )
+            for segment in range(0, total_segments)
+        ]
+        return merge_columns(columns_list=[future.result() for future in futures])
+
+
+def export_account(
+    dynamodb_client,
+    table_name: str,
+    account_ref: str,
+    logger=get_logger()
+)->dict:
+    """
+        Read all items of a single account with a consistent Query
+    """
+    columns = new_columns()
+    parameters = {
+        'TableName': table_name,
+        'ConsistentRead': True,
+        'KeyConditions': {
+            'PK': {'AttributeValueList': [{'S': account_ref},], 'ComparisonOperator': 'EQ'},
+        },
+    }
+    while True:
+        response = dynamodb_client.query(**parameters)
+        add_items_to_columns(items=response.get('Items', list()), columns=columns)
+        if response.get('LastEvaluatedKey', None) is None:
+            break
+        parameters['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    logger.debug('[account_reference={}] Read {} items'.format(account_ref, columns['ItemsRead']))
+    return columns
+
+
+###############################################################################
+###                                                                         ###
+###                          R E C O N C I L I A T I O N                    ###
+###                                                                         ###
+###############################################################################
+
+
+def to_units(values: list, decimal_places: int)->numpy.ndarray:
+    """
+        Convert decimal strings to int64 amounts in the smallest unit of the currency, for example cents. Raises an
+        exception when an amount has more decimal places, because the sums would no longer be exact.
+    """
+    scaled = numpy.asarray(values, dtype=numpy.float64) * (10 ** decimal_places)
+    units = numpy.rint(scaled)
+    if units.size > 0:
+        if numpy.abs(units).max() >= MAX_EXACT_UNITS:
+            raise Exception('Amounts are too large to be reconciled exactly with {} decimal places'.format(decimal_places))
+        inexact = numpy.flatnonzero(numpy.abs(scaled - units) > 1e-3)
+        if inexact.size > 0:
+            raise Exception('Amount "{}" has more than {} decimal places - use a larger --decimal-places'.format(values[inexact[0]], decimal_places))
+    return units.astype(numpy.int64)
+
+
+def from_units(units: int, decimal_places: int)->str:
+    return '{}'.format(Decimal(int(units)).scaleb(-decimal_places))
+
+
+def build_transaction_arrays(transactions: dict, accounts: numpy.ndarray, decimal_places: int)->dict:
+    """
+        The transactions as arrays, sorted by account and SK (the order in which the ledger replays them), with the
+        account as an index into `accounts`
+    """
+    account = numpy.asarray(transactions['Account'], dtype=str)
+    sk = numpy.asarray(transactions['SK'], dtype=str)
+    order = numpy.lexsort((sk, account,))
+    return {
+        'AccountIndex': numpy.searchsorted(accounts, account[order]),
+        'Account': account[order],
+        'Amount': to_units(values=transactions['Amount'], decimal_places=decimal_places)[order],
+        'EffectOnAvailableBalance': numpy.asarray(transactions['EffectOnAvailableBalance'], dtype=str)[order],
+        'EffectOnActualBalance': numpy.asarray(transactions['EffectOnActualBalance'], dtype=str)[order],
+        'RequestId': numpy.asarray(transactions['RequestId'], dtype=str)[order],
+        'PreviousRequestIdReference': numpy.asarray(transactions['PreviousRequestIdReference'], dtype=str)[order],
+    }
+
+
+def get_original_amounts(tx: dict)->tuple:
+    """
+        For every transaction the `Amount` of the first transaction of the same account with the `RequestId` in its
+        `PreviousRequestIdReference` - the pending transaction an `Adjusted` effect corrects.
+
+        Returns `(original_amounts, found)` where `found` is False for the transactions without such a transaction.
+    """
+    original_amounts = numpy.zeros(tx['Amount'].size, dtype=numpy.int64)
+    found = numpy.zeros(tx['Amount'].size, dtype=bool)
+    with_request_id = numpy.flatnonzero(tx['RequestId'] != '')
+    if with_request_id.size == 0:
+        return original_amounts, found
+    request_keys = numpy.char.add(numpy.char.add(tx['Account'][with_request_id], '\t'), tx['RequestId'][with_request_id])
+    # numpy.unique() returns the index of the first occurrence, and the transactions are in ledger order
+    unique_keys, first_index = numpy.unique(request_keys, return_index=True)
+    reference_keys = numpy.char.add(numpy.char.add(tx['Account'], '\t'), tx['PreviousRequestIdReference'])
+    positions = numpy.minimum(numpy.searchsorted(unique_keys, reference_keys), unique_keys.size - 1)
+    found = (unique_keys[positions] == reference_keys) & (tx['PreviousRequestIdReference'] != '')
+    original_amounts[found] = tx['Amount'][with_request_id[first_index[positions[found]]]]
+    return original_amounts, found
+
+
+def calculate_ledger_balances(tx: dict, account_count: int)->dict:
+    """
+        The balances per account after applying all transactions, plus the number of transactions per account and the
+        number of `Adjusted` effects without a pending transaction per account
+    """
+    original_amounts, found = get_original_amounts(tx=tx)
+    ledger = {
+        'TransactionCount': numpy.bincount(tx['AccountIndex'], minlength=account_count),
+    }
+    missing_references = numpy.zeros(tx['Amount'].size, dtype=bool)
+    for balance_type in BALANCE_TYPES:
+        effects = tx['EffectOn{}Balance'.format(balance_type)]
+        adjusted = effects == 'Adjusted'
+        changes = numpy.where(effects == 'Increase', tx['Amount'], 0)
+        changes = changes - numpy.where(effects == 'Decrease', tx['Amount'], 0)
+        changes = changes + numpy.where(adjusted & found, tx['Amount'] - original_amounts, 0)
+        missing_references |= adjusted & ~found
+        totals = numpy.zeros(account_count, dtype=numpy.int64)
+        numpy.add.at(totals, tx['AccountIndex'], changes)
+        ledger[balance_type] = totals
+    ledger['MissingReferences'] = numpy.bincount(tx['AccountIndex'][missing_references], minlength=account_count)
+    return ledger
+
+
+def build_balance_arrays(balances: dict, accounts: numpy.ndarray, decimal_places: int)->dict:
+    """
+        The balances and versions of the balance records per account - `Has...` is False for the accounts without
+        that balance record
+    """
+    account_index = numpy.searchsorted(accounts, numpy.asarray(balances['Account'], dtype=str))
+    balance_type = numpy.asarray(balances['BalanceType'], dtype=str)
+    amounts = to_units(values=balances['Balance'], decimal_places=decimal_places)
+    versions = numpy.asarray(balances['Version'], dtype=numpy.int64)
+    arrays = dict()
+    for name in BALANCE_TYPES:
+        selected = balance_type == name
+        arrays[name] = numpy.zeros(accounts.size, dtype=numpy.int64)
+        arrays[name][account_index[selected]] = amounts[selected]
+        arrays['Has{}'.format(name)] = numpy.zeros(accounts.size, dtype=bool)
+        arrays['Has{}'.format(name)][account_index[selected]] = True
+        arrays['{}Version'.format(name)] = numpy.zeros(accounts.size, dtype=numpy.int64)
+        arrays['{}Version'.format(name)][account_index[selected]] = versions[selected]
+    return arrays
+
+
+def reconcile_columns(columns: dict, decimal_places: int, include_ok: bool=False)->tuple:
+    """
+        Compare the ledger balances with the balance records of all accounts in the columns. Returns `(summary,
+        results)` with the number of accounts per result and the details of the accounts that do not reconcile (of
+        all accounts with `include_ok`):
+
+            OK:                 The balances match
+            MISMATCH:           At least one balance differs from the ledger
+            MISSING_BALANCE:    The account has transactions, but no (or only one) balance record
+            ERROR:              An `Adjusted` effect references a pending transaction that does not exist
+    """
+    accounts = numpy.unique(numpy.asarray(columns['Transactions']['Account'] + columns['Balances']['Account'], dtype=str))
+    tx = build_transaction_arrays(transactions=columns['Transactions'], accounts=accounts, decimal_places=decimal_places)
+    ledger = calculate_ledger_balances(tx=tx, account_count=accounts.size)
+    balances = build_balance_arrays(balances=columns['Balances'], accounts=accounts, decimal_places=decimal_places)
+
+    has_balances = balances['HasAvailable'] & balances['HasActual']
+    mismatch = numpy.zeros(accounts.size, dtype=bool)
+    for balance_type in BALANCE_TYPES:
+        mismatch |= ledger[balance_type] != balances[balance_type]
+    result_codes = numpy.zeros(accounts.size, dtype=numpy.int64)
+    result_codes[mismatch] = RESULTS.index('MISMATCH')
+    result_codes[~has_balances] = RESULTS.index('MISSING_BALANCE')
+    result_codes[ledger['MissingReferences'] > 0] = RESULTS.index('ERROR')
+
+    summary = dict()
+    for code, count in enumerate(numpy.bincount(result_codes, minlength=len(RESULTS))):
+        if count > 0:
+            summary[RESULTS[code]] = int(count)
+    results = list()
+    for index in (range(0, accounts.size) if include_ok is True else numpy.flatnonzero(result_codes != RESULTS.index('OK'))):
+        result = {
+            'Account': '{}'.format(accounts[index]),
+            'Result': RESULTS[result_codes[index]],
+            'TransactionCount': int(ledger['TransactionCount'][index]),
+            'Ledger': dict(),
+            'Balances': dict(),
+            'Versions': dict(),
+        }
+        for balance_type in BALANCE_TYPES:
+            result['Ledger'][balance_type] = from_units(units=ledger[balance_type][index], decimal_places=decimal_places)
+            result['Balances'][balance_type] = from_units(units=balances[balance_type][index], decimal_places=decimal_places) if balances['Has{}'.format(balance_type)][index] else None
+            result['Versions'][balance_type] = int(balances['{}Version'.format(balance_type)][index])
+        if result['Result'] == 'ERROR':
+            result['Message'] = '{} Adjusted effect(s) without a pending transaction'.format(int(ledger['MissingReferences'][index]))
+        results.append(result)
+    return summary, results
+
+
+def recheck_account(
+    dynamodb_client,
+    table_name: str,
+    account_ref: str,
+    decimal_places: int,
+    logger=get_logger()
+)->dict:
+    """
+        Reconcile a single account again with consistent reads. The account is read until the balance versions are
+        the same in two reads in a row, so that the transactions and balances are compared at the same point in time.
+    """
+    previous_versions = None
+    for attempt in range(0, RECHECK_MAX_ATTEMPTS + 1):
+        columns = export_account(dynamodb_client=dynamodb_client, table_name=table_name, account_ref=account_ref, logger=logger)
+        account_results = reconcile_columns(columns=columns, decimal_places=decimal_places, include_ok=True)[1]
+        if len(account_results) == 0:
+            raise Exception('[account_reference={}] The account no longer exists'.format(account_ref))
+        result = account_results[0]
+        if result['Versions'] == previous_versions:
+            return result
+        previous_versions = result['Versions']
+        logger.info('[account_reference={}] Re-check read {} (versions {})'.format(account_ref, attempt + 1, previous_versions))
+    result['Result'] = 'CHANGED'
+    return result
+
+
+def recheck_accounts(
+    dynamodb_client,
+    table_name: str,
+    results: list,
+    decimal_places: int,
+    workers: int,
+    logger=get_logger()
+)->int:
+    """
+        Replace the results of the accounts that do not reconcile with the results of a consistent re-check. Returns
+        the number of accounts checked again.
+    """
+    positions = [position for position, result in enumerate(results) if result['Result'] != 'OK']
+    if len(positions) == 0:
+        return 0
+    logger.info('Re-checking {} accounts'.format(len(positions)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            position: executor.submit(
+                recheck_account,
+                dynamodb_client=dynamodb_client,
+                table_name=table_name,
+                account_ref=results[position]['Account'],
+                decimal_places=decimal_places,
+                logger=logger
+            )
+            for position in positions
+        }
+        for position, future in futures.items():
+            try:
+                scan_result = results[position]['Result']
+                results[position] = future.result()
+                results[position]['ScanResult'] = scan_result
+                results[position]['Rechecked'] = True
+            except:
+                logger.error('EXCEPTION: {}'.format(traceback.format_exc()))
+                results[position]['Rechecked'] = False
+    return len(positions)
+
+
+def run(args, boto3_clazz=boto3)->dict:
+    logger = get_logger(level=getattr(logging, args.log_level))
+    dynamodb_client = boto3_clazz.client('dynamodb', region_name=args.region)
+
+    start = time.time()
+    columns = export_accounts_table(
+        dynamodb_client=dynamodb_client,
+        table_name=args.accounts_table,
+        total_segments=args.segments,
+        page_size=args.page_size,
+        logger=logger
+    )
+    export_duration = time.time() - start
+    print('Read {} items ({} transactions, {} balance records) in {} seconds'.format(
+        columns['ItemsRead'],
+        len(columns['Transactions']['Account']),
+        len(columns['Balances']['Account']),
+        round(export_duration, 3)
+    ))
+
+    start = time.time()
+    summary, results = reconcile_columns(columns=columns, decimal_places=args.decimal_places, include_ok=args.all_accounts)
+    reconcile_duration = time.time() - start
+
+    start = time.time()
+    rechecked = 0
+    if args.recheck is True:
+        rechecked = recheck_accounts(
+            dynamodb_client=dynamodb_client,
+            table_name=args.accounts_table,
+            results=results,
+            decimal_places=args.decimal_places,
+            workers=args.segments,
+            logger=logger
+        )
+    recheck_duration = time.time() - start
+
+    for result in results:
+        if result.get('Rechecked', False) is True and result['Result'] != result['ScanResult']:
+            summary[result['ScanResult']] -= 1
+            summary[result['Result']] = summary.get(result['Result'], 0) + 1
+    summary = dict([(result_name, count) for result_name, count in summary.items() if count > 0])
+    return {
+        'AccountsTable': args.accounts_table,
+        'ItemsRead': columns['ItemsRead'],
+        'Transactions': len(columns['Transactions']['Account']),
+        'Accounts': sum(summary.values()),
+        'Summary': summary,
+        'RecheckedAccounts': rechecked,
+        'ExportSeconds': round(export_duration, 3),
+        'ReconcileSeconds': round(reconcile_duration, 3),
+        'RecheckSeconds': round(recheck_duration, 3),
+        'Results': [result for result in results if args.all_accounts is True or result['Result'] != 'OK'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Lab4 reconciliation of the account balances with the transactions')
+    parser.add_argument('--accounts-table', type=str, default=os.getenv('DYNAMODB_ACCOUNTS_TABLE_NAME', 'lab4_accounts_v1'))
+    parser.add_argument('--region', type=str, default=os.getenv('AWS_REGION', 'eu-central-1'))
+    parser.add_argument('--segments', type=int, default=8, help='Number of parallel Scan segments (and threads)')
+    parser.add_argument('--page-size', type=int, default=1000, help='Maximum number of items per Scan request')
+    parser.add_argument('--decimal-places', type=int, default=2, help='Decimal places of the currency - amounts are summed as integers in this unit')
+    parser.add_argument('--no-recheck', dest='recheck', action='store_false', help='Do not re-check the accounts that do not reconcile with consistent reads')
+    parser.add_argument('--all-accounts', action='store_true', help='Include the accounts that reconcile in the results')
+    parser.add_argument('--log-level', type=str, default='WARNING', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR',))
+    parser.add_argument('--results-file', type=str, default=None, help='Also write the results as JSON to this file')
+    args = parser.parse_args()
+    if args.segments < 1:
+        parser.error('--segments must be at least 1')
+
+    result = run(args=args)
+
+    print(json.dumps(result, indent=4))
+    if args.results_file is not None:
+        with open(args.results_file, 'w') as f:
+            f.write(json.dumps(result, indent=4))
+
+
+if __name__ == '__main__':
+    main()
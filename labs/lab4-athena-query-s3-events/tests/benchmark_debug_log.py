@@ -0,0 +1,90 @@
+"""
+Micro benchmark comparing the original inspect based `debug_log()` with the current lazy implementation in the
+transaction processing consumer.
+
+Usage:
+
+    python3 benchmark_debug_log.py [ITERATIONS]
+
+The consumer module imports boto3 at load time, so boto3 must be installed (no AWS calls are made).
+"""
+import io
+import logging
+import os
+import sys
+import timeit
+from inspect import getframeinfo, stack
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda_functions', 'tx_processing_consumer'))
+import tx_processing_consumer
+
+
+ITERATIONS = 20000
+if len(sys.argv) > 1:
+    ITERATIONS = int(sys.argv[1])
+
+
+def get_logger(level=logging.INFO):
+    logger = logging.getLogger('benchmark_debug_log')
+    for h in logger.handlers:
+        logger.removeHandler(h)
+    formatter = logging.Formatter('%(funcName)s:%(lineno)d -  %(levelname)s - %(message)s')
+    ch = logging.StreamHandler(io.StringIO())
+    ch.setLevel(level)
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+    logger.setLevel(level)
+    logger.propagate = False
+    return logger
+
+
+cache = {'Environment': {'Data': {'DEBUG': False}}}
+tx_processing_consumer.refresh_environment_cache()
+
+
+def legacy_debug_log(message: str, variables_as_dict: dict=dict(), variable_as_list: list=list(), logger=get_logger(level=logging.INFO)):
+    """
+        Verbatim copy of the original implementation
+    """
+    if cache['Environment']['Data']['DEBUG'] is True:
+        try:
+            caller = getframeinfo(stack()[1][0])
+            caller_str = '{}():{}'.format(caller.function, caller.lineno)
+            message = '[{}]  {}'.format(caller_str, message)
+            if len(variables_as_dict) > 0:
+                logger.debug(message.format(**variables_as_dict))
+            else:
+                logger.debug(message.format(*variable_as_list))
+        except:
+            pass
+
+
+def run_scenario(name: str, debug: bool, level: int):
+    logger = get_logger(level=level)
+    cache['Environment']['Data']['DEBUG'] = debug
+    tx_processing_consumer.cache['Environment']['Data']['DEBUG'] = debug
+    variables = {'AccountNumber': '1234567890', 'Amount': 100.25, 'Items': list(range(20))}
+
+    def call_legacy():
+        legacy_debug_log(message='account={AccountNumber} amount={Amount} items={Items}', variables_as_dict=variables, logger=logger)
+
+    def call_current():
+        tx_processing_consumer.debug_log(message='account={AccountNumber} amount={Amount} items={Items}', variables_as_dict=variables, logger=logger)
+
+    legacy_time = min(timeit.repeat(call_legacy, number=ITERATIONS, repeat=3))
+    current_time = min(timeit.repeat(call_current, number=ITERATIONS, repeat=3))
+    print(
+        '{:<36} legacy: {:>9.3f} us/call   current: {:>9.3f} us/call   speedup: {:>8.1f}x'.format(
+            name,
+            legacy_time / ITERATIONS * 1000000,
+            current_time / ITERATIONS * 1000000,
+            legacy_time / current_time if current_time > 0 else 0.0
+        )
+    )
+
+
+print('Iterations per run: {}'.format(ITERATIONS))
+run_scenario(name='DEBUG=0', debug=False, level=logging.INFO)
+run_scenario(name='DEBUG=1, logger level INFO', debug=True, level=logging.INFO)
+run_scenario(name='DEBUG=1, logger level DEBUG', debug=True, level=logging.DEBUG)
@@ -0,0 +1,85 @@
+"""
+Micro benchmark comparing the original per-field unmarshalling loop with the `decode_items()` codec in the
+transaction processing consumer, using synthetic pages of DynamoDB items.
+
+Usage:
+
+    python3 benchmark_dynamodb_codec.py [ITEMS_PER_PAGE]
+
+The consumer module imports boto3 at load time, so boto3 must be installed (no AWS calls are made).
+"""
+import os
+import sys
+import timeit
+from decimal import Decimal
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda_functions', 'tx_processing_consumer'))
+import tx_processing_consumer
+
+
+ITEMS_PER_PAGE = 10000
+if len(sys.argv) > 1:
+    ITEMS_PER_PAGE = int(sys.argv[1])
+
+
+def build_page(item_qty: int)->list:
+    items = list()
+    for i in range(item_qty):
+        items.append(
+            {
+                'PK'                : { 'S'     : '{}'.format(100000 + (i % 50))                },
+                'SK'                : { 'S'     : 'TRANSACTIONS#VERIFIED#{}'.format(1660000000 + i) },
+                'TransactionDate'   : { 'N'     : '{}'.format(20220801 + (i % 28))              },
+                'TransactionTime'   : { 'N'     : '{}'.format(120000 + i)                       },
+                'Amount'            : { 'N'     : '{}.{}'.format(i, i % 100)                    },
+                'Balance'           : { 'N'     : '{}'.format(i * 3)                            },
+                'Processed'         : { 'BOOL'  : True                                          },
+                'RequestId'         : { 'S'     : 'request-{}'.format(i)                        },
+            }
+        )
+    return items
+
+
+def legacy_decode(items: list)->list:
+    """
+        Verbatim copy of the loop previously used in get_dynamodb_record_by_primary_index_query_with_filter()
+    """
+    records = list()
+    for item in items:
+        record = dict()
+        for field_name, field_data in item.items():
+            for field_data_type, field_data_value in field_data.items():
+                if field_data_type == 'S':
+                    record[field_name] = '{}'.format(field_data_value)
+                if field_data_type == 'N':
+                    record[field_name] = Decimal(field_data_value)
+                if field_data_type == 'BOOL':
+                    record[field_name] = field_data_value
+        records.append(record)
+    return records
+
+
+page = build_page(item_qty=ITEMS_PER_PAGE)
+assert legacy_decode(items=page) == tx_processing_consumer.decode_items(items=page)
+
+records = tx_processing_consumer.decode_items(items=page)
+typed_record = {
+    'PK': '100010',
+    'Amount': Decimal('10.50'),
+    'Tags': {'a', 'b'},
+    'Limits': {Decimal('1'), 2},
+    'Payload': b'\x00\x01',
+    'History': [1, 'two', {'three': 3.5}],
+    'Flags': {'Processed': True, 'ErrorState': None},
+}
+assert tx_processing_consumer.decode_item(item=tx_processing_consumer.encode_item(record=typed_record))['History'][2]['three'] == Decimal('3.5')
+
+legacy_time = min(timeit.repeat(lambda: legacy_decode(items=page), number=5, repeat=3)) / 5
+codec_time = min(timeit.repeat(lambda: tx_processing_consumer.decode_items(items=page), number=5, repeat=3)) / 5
+encode_time = min(timeit.repeat(lambda: [tx_processing_consumer.encode_item(record=record) for record in records], number=5, repeat=3)) / 5
+
+print('Items per page: {}'.format(ITEMS_PER_PAGE))
+print('legacy decode loop : {:>9.2f} ms/page'.format(legacy_time * 1000))
+print('decode_items()     : {:>9.2f} ms/page   speedup: {:.1f}x'.format(codec_time * 1000, legacy_time / codec_time))
+print('encode_item() x N  : {:>9.2f} ms/page'.format(encode_time * 1000))
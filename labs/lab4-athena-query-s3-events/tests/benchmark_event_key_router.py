@@ -0,0 +1,122 @@
+"""
+Benchmark comparing the original linear prefix scans used to route an event key (key validation, transaction type
+and account field lookup, request ID extraction) with the compiled event key router in the S3 event Lambda function.
+
+The benchmark resolves synthetic keys against the 8 built-in event types and against synthetic configurations with
+hundreds of event types. The legacy scans are timed on at most 100000 of the keys, as they get very slow with many
+event types.
+
+Usage:
+
+    python3 benchmark_event_key_router.py [KEY_QTY]
+
+The Lambda module imports boto3 at load time, so boto3 must be installed (no AWS calls are made).
+"""
+import os
+import random
+import sys
+import time
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda_functions', 's3_new_event_bucket_object_create'))
+import s3_new_event_bucket_object_create as s3_lambda
+
+
+KEY_QTY = 1000000
+if len(sys.argv) > 1:
+    KEY_QTY = int(sys.argv[1])
+LEGACY_KEY_QTY = min(KEY_QTY, 100000)
+
+
+def legacy_route(key: str, key_prefixes: tuple, account_field_names: dict, tx_type_ids: dict)->tuple:
+    """
+        The lookups previously done by validate_key_is_recognized(), determine_tx_type_and_reference_account() and
+        extract_request_id(), without the logging
+    """
+    if key.endswith('.event') is False:
+        return None
+    recognized = False
+    for acceptable_key_prefix in key_prefixes:
+        if key.startswith(acceptable_key_prefix):
+            recognized = True
+            break
+    if recognized is False:
+        return None
+    tx_type = 'unknown'
+    account_field_name = None
+    for key_starts_with_value, account_reference_field_name in account_field_names.items():
+        if key.startswith(key_starts_with_value):
+            tx_type = tx_type_ids[key_starts_with_value]
+            account_field_name = account_reference_field_name
+    request_id = None
+    for key_prefix in key_prefixes:
+        if key.startswith(key_prefix):
+            request_id = key.replace(key_prefix, '').replace('.event', '')
+    return (tx_type, account_field_name, request_id,)
+
+
+def router_route(key: str, router: dict)->tuple:
+    route = s3_lambda.resolve_event_key(key=key, router=router)
+    if route is None:
+        return None
+    return (route['TxType'], route['AccountFieldName'], key[len(route['Prefix']):-len(route['Extension'])],)
+
+
+def build_configuration(event_type_qty: int)->tuple:
+    if event_type_qty <= len(s3_lambda.ACCEPTABLE_KEY_PREFIXES):
+        return (s3_lambda.ACCEPTABLE_KEY_PREFIXES, s3_lambda.ACCOUNT_FIELD_NAME_BASED_ON_TRANSACTION_TYPE, s3_lambda.TX_ACCOUNT_TYPE_ID_MAP,)
+    key_prefixes = list(s3_lambda.ACCEPTABLE_KEY_PREFIXES)
+    account_field_names = dict(s3_lambda.ACCOUNT_FIELD_NAME_BASED_ON_TRANSACTION_TYPE)
+    tx_type_ids = dict(s3_lambda.TX_ACCOUNT_TYPE_ID_MAP)
+    idx = 0
+    while len(key_prefixes) < event_type_qty:
+        idx += 1
+        key_prefix = 'synthetic_event_type_{}_'.format(idx)
+        key_prefixes.append(key_prefix)
+        account_field_names[key_prefix] = random.choice(('SourceAccount', 'TargetAccount',))
+        tx_type_ids[key_prefix] = 'SyntheticEventType{}'.format(idx)
+    return (tuple(key_prefixes), account_field_names, tx_type_ids,)
+
+
+def build_keys(key_prefixes: tuple, key_qty: int)->list:
+    keys = list()
+    for idx in range(key_qty):
+        if idx % 10 == 9:
+            keys.append('unknown_event_type_{}.event'.format(idx))     # 10% unrecognized keys
+        else:
+            keys.append('{}test{}.event'.format(random.choice(key_prefixes), idx))
+    return keys
+
+
+def run_scenario(event_type_qty: int):
+    key_prefixes, account_field_names, tx_type_ids = build_configuration(event_type_qty=event_type_qty)
+    router = s3_lambda.compile_event_key_router(key_prefixes=key_prefixes, account_field_names=account_field_names, tx_type_ids=tx_type_ids)
+    keys = build_keys(key_prefixes=key_prefixes, key_qty=KEY_QTY)
+    for key in keys[:1000]:
+        assert legacy_route(key, key_prefixes, account_field_names, tx_type_ids) == router_route(key, router)
+
+    legacy_keys = keys[:LEGACY_KEY_QTY]
+    start = time.perf_counter()
+    for key in legacy_keys:
+        legacy_route(key, key_prefixes, account_field_names, tx_type_ids)
+    legacy_time = (time.perf_counter() - start) / len(legacy_keys)
+
+    start = time.perf_counter()
+    for key in keys:
+        router_route(key, router)
+    router_time = (time.perf_counter() - start) / len(keys)
+
+    print(
+        '{:>4} event types   legacy: {:>8.3f} us/key   router: {:>8.3f} us/key   speedup: {:>6.1f}x'.format(
+            len(key_prefixes),
+            legacy_time * 1000000,
+            router_time * 1000000,
+            legacy_time / router_time
+        )
+    )
+
+
+random.seed(1)
+print('Keys per scenario: {}'.format(KEY_QTY))
+for event_type_qty in (8, 100, 500):
+    run_scenario(event_type_qty=event_type_qty)
@@ -0,0 +1,407 @@
+"""
+Load generator and throughput benchmark for the lab4 event pipeline.
+
+Synthesizes transaction events across a configurable number of accounts and transaction mix (using the `build_*_event`
+functions from `prepare_test_events.py`), uploads them to the new event bucket in parallel with an optional rate
+limit and measures the end-to-end latency from upload until the object state record in the object table is marked as
+`Processed` by the transaction consumer.
+
+Examples:
+
+    # Synthesize only - measures the generator itself, no AWS calls
+    python3 load_generator.py --events 1000000 --dry-run
+
+    # 10000 events over 500 accounts at 200 events/second, tracking the latency of every 10th event
+    python3 load_generator.py --events 10000 --accounts 500 --rate 200 --workers 32 \\
+        --bucket "$NEW_EVENT_BUCKET_NAME_PARAM" --object-table "$DYNAMODB_OBJECT_TABLE_NAME_PARAM" --latency-sample 10
+
+    # Upload throughput against a local stand-in (MinIO, moto server) or an in-process moto mock
+    python3 load_generator.py --events 100000 --endpoint-url http://localhost:9000 --create-bucket
+    python3 load_generator.py --events 100000 --moto
+
+The transaction mix is given as `key_prefix=weight` pairs, for example:
+
+    --mix cash_deposit_=30,incoming_payment_=30,cash_withdrawal_=20,inter_account_transfer_=20
+
+Verification events (`verify_cash_deposit_`, `outgoing_payment_verified_` and `outgoing_payment_rejected_`) always
+reference an earlier pending event of the same account. When no pending event is available, the pending event type
+itself is generated instead.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import boto3
+from botocore.config import Config
+try:
+    import moto
+except ImportError:     # moto is optional and only needed for --moto
+    moto = None
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import prepare_test_events
+
+
+DEFAULT_TRANSACTION_MIX = {
+    'cash_deposit_'                 : 20,
+    'verify_cash_deposit_'          : 5,
+    'incoming_payment_'             : 25,
+    'cash_withdrawal_'              : 15,
+    'outgoing_payment_unverified_'  : 15,
+    'outgoing_payment_verified_'    : 10,
+    'outgoing_payment_rejected_'    : 2,
+    'inter_account_transfer_'       : 8,
+}
+
+PENDING_EVENT_TYPES = {
+    # "Verification Event Type"     : "Pending Event Type it references"
+    'verify_cash_deposit_'          : 'cash_deposit_',
+    'outgoing_payment_verified_'    : 'outgoing_payment_unverified_',
+    'outgoing_payment_rejected_'    : 'outgoing_payment_unverified_',
+}
+
+LATENCY_PERCENTILES = (50, 90, 95, 99,)
+
+
+def parse_transaction_mix(mix: str)->dict:
+    transaction_mix = dict()
+    for mix_item in mix.split(','):
+        tx_type, weight = mix_item.split('=')
+        tx_type = tx_type.strip()
+        if tx_type not in prepare_test_events.EVENT_BUILD_MAPPING:
+            raise Exception('Unknown transaction type "{}" - expected one of {}'.format(tx_type, list(prepare_test_events.EVENT_BUILD_MAPPING.keys())))
+        transaction_mix[tx_type] = float(weight)
+    return transaction_mix
+
+
+def build_test_data_row(tx_type: str, account: str, customer_number: int, linked_request_id: str='n/a', other_account: str='n/a', instant_verify: bool=True)->dict:
+    """
+        Build a record with the same fields as a row of the CSV test data files
+    """
+    now = datetime.now()
+    amount = random.randint(1, 500)
+    return {
+        'Transaction Date Year'         : '{}'.format(now.year),
+        'Transaction Date Month'        : '{}'.format(now.month),
+        'Transaction Date Day'          : '{}'.format(now.day),
+        'Transaction Date 24HR Time'    : now.strftime('%H%M'),
+        'Transaction Type'              : tx_type,
+        'Reference Account'             : account,
+        'CustomerNumber'                : '{}'.format(customer_number),
+        'Amount'                        : '{}'.format(amount),
+        'Transaction Description'       : 'Load Test',
+        'Location'                      : 'Branch A',
+        'Reference'                     : 'Load Test {}'.format(tx_type),
+        'Instant Verify Flag'           : '{}'.format(instant_verify).lower(),
+        'Notes-100'                     : '0',
+        'Notes-50'                      : '0',
+        'Notes-20'                      : '0',
+        'Notes-10'                      : '{}'.format(int(amount / 10)),
+        'Coins-50'                      : '0',
+        'Coins-20'                      : '0',
+        'Coins-10'                      : '0',
+        'Coins-5'                       : '0',
+        'Destination Bank'              : 'AAA Bank',
+        'Destination Account Reference' : other_account,
+        'Linked RequestId'              : linked_request_id,
+        'Source Bank'                   : 'BBB Bank',
+        'Source Reference'              : other_account,
+        'Verified by Employee ID'       : 'e0001',
+        'Final Finding'                 : 'Load Test',
+    }
+
+
+def synthesize_events(event_qty: int, account_qty: int, transaction_mix: dict, request_id_prefix: str):
+    """
+        Generator yielding `(tx_type, key_name, event_data)` tuples - events are built lazily, so millions of events
+        never have to be held in memory.
+    """
+    accounts = ['{}'.format(100010 + (idx * 10)) for idx in range(account_qty)]
+    tx_types = list(transaction_mix.keys())
+    weights = list(transaction_mix.values())
+    pending_events = dict()
+    for pending_tx_type in set(PENDING_EVENT_TYPES.values()):
+        pending_events[pending_tx_type] = deque()
+    for event_idx in range(event_qty):
+        tx_type = random.choices(tx_types, weights=weights)[0]
+        request_id = '{}{:09}'.format(request_id_prefix, event_idx + 1)
+        account_idx = random.randrange(account_qty)
+        linked_request_id = 'n/a'
+        instant_verify = True
+        if tx_type in PENDING_EVENT_TYPES:
+            if len(pending_events[PENDING_EVENT_TYPES[tx_type]]) > 0:
+                account_idx, linked_request_id = pending_events[PENDING_EVENT_TYPES[tx_type]].popleft()
+            else:
+                tx_type = PENDING_EVENT_TYPES[tx_type]
+        if tx_type == 'cash_deposit_' and random.random() < 0.3:
+            instant_verify = False
+            pending_events[tx_type].append((account_idx, request_id,))
+        if tx_type == 'outgoing_payment_unverified_':
+            pending_events[tx_type].append((account_idx, request_id,))
+        other_account = 'n/a'
+        if tx_type == 'inter_account_transfer_' and account_qty > 1:
+            other_account = accounts[(account_idx + random.randrange(1, account_qty)) % account_qty]
+        elif tx_type in ('incoming_payment_', 'outgoing_payment_unverified_',):
+            other_account = '{}'.format(random.randint(5000000000, 5999999999))
+        row = build_test_data_row(
+            tx_type=tx_type,
+            account=accounts[account_idx],
+            customer_number=330000000 + account_idx,
+            linked_request_id=linked_request_id,
+            other_account=other_account,
+            instant_verify=instant_verify
+        )
+        yield (
+            tx_type,
+            '{}{}.event'.format(tx_type, request_id),
+            prepare_test_events.EVENT_BUILD_MAPPING[tx_type](data=row),
+        )
+
+
+class RateLimiter:
+    """
+        Spaces calls to `acquire()` evenly at `rate` calls per second (a rate of 0 means unlimited)
+    """
+
+    def __init__(self, rate: float=0):
+        self.interval = 0.0
+        if rate > 0:
+            self.interval = 1.0 / rate
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.interval == 0.0:
+            return
+        with self.lock:
+            slot = max(self.next_slot, time.monotonic())
+            self.next_slot = slot + self.interval
+        delay = slot - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class LatencyTracker:
+    """
+        Polls the object table in a background thread and records the time from upload until the object state record
+        of an event is marked as Processed. The resolution of the measurement is the poll interval.
+    """
+
+    def __init__(self, dynamodb_client, table_name: str, poll_interval: float=1.0):
+        self.client = dynamodb_client
+        self.table_name = table_name
+        self.poll_interval = poll_interval
+        self.outstanding = dict()       # key_name -> upload completed timestamp
+        self.latencies = list()
+        self.lock = threading.Lock()
+        self.uploads_completed = threading.Event()
+        self.timeout_at = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def add(self, key_name: str, uploaded_timestamp: float):
+        with self.lock:
+            self.outstanding[key_name] = uploaded_timestamp
+
+    def finish(self, timeout: float):
+        self.timeout_at = time.time() + timeout
+        self.uploads_completed.set()
+        self.thread.join()
+
+    def _poll(self, key_names: list):
+        for chunk_start in range(0, len(key_names), 100):
+            keys = [{'PK': {'S': 'KEY#{}'.format(key_name)}, 'SK': {'S': 'STATE'}} for key_name in key_names[chunk_start:chunk_start+100]]
+            response = self.client.batch_get_item(
+                RequestItems={
+                    self.table_name: {
+                        'Keys': keys,
+                        'ProjectionExpression': 'PK, #p',
+                        'ExpressionAttributeNames': {'#p': 'Processed'},
+                    }
+                }
+            )
+            now = time.time()
+            for item in response.get('Responses', dict()).get(self.table_name, list()):
+                if item.get('Processed', dict()).get('BOOL', False) is True:
+                    key_name = item['PK']['S'][len('KEY#'):]
+                    with self.lock:
+                        if key_name in self.outstanding:
+                            self.latencies.append(now - self.outstanding.pop(key_name))
+
+    def _run(self):
+        while True:
+            with self.lock:
+                key_names = list(self.outstanding.keys())
+            if len(key_names) > 0:
+                try:
+                    self._poll(key_names=key_names)
+                except Exception as e:
+                    print('WARNING: Latency poll failed: {}'.format(e))
+            if self.uploads_completed.is_set():
+                with self.lock:
+                    if len(self.outstanding) == 0:
+                        return
+                if time.time() > self.timeout_at:
+                    return
+            time.sleep(self.poll_interval)
+
+
+def percentile(sorted_values: list, pct: float)->float:
+    """
+        Nearest-rank percentile of an already sorted list
+    """
+    if len(sorted_values) == 0:
+        return 0.0
+    rank = max(1, math.ceil(pct * len(sorted_values) / 100.0))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def run(args)->dict:
+    random.seed(args.seed)
+    prepare_test_events.VERBOSE = False
+    transaction_mix = DEFAULT_TRANSACTION_MIX
+    if args.mix is not None:
+        transaction_mix = parse_transaction_mix(mix=args.mix)
+    request_id_prefix = args.request_id_prefix
+    if request_id_prefix is None:
+        # Unique per run - SQS FIFO de-duplicates identical messages for 5 minutes
+        request_id_prefix = 'lg{}x'.format(int(time.time()))
+
+    stats = {'Generated': 0, 'Uploaded': 0, 'Failed': 0, 'Bytes': 0, 'TxTypes': dict()}
+    stats_lock = threading.Lock()
+    client_config = Config(max_pool_connections=max(10, args.workers), retries={'max_attempts': 10, 'mode': 'adaptive'})
+    s3_client = None
+    tracker = None
+    if args.dry_run is False:
+        s3_client = boto3.client('s3', region_name=args.region, endpoint_url=args.endpoint_url, config=client_config)
+        if args.create_bucket is True:
+            bucket_configuration = dict()
+            if args.region != 'us-east-1':
+                bucket_configuration = {'CreateBucketConfiguration': {'LocationConstraint': args.region}}
+            try:
+                s3_client.create_bucket(Bucket=args.bucket, **bucket_configuration)
+            except Exception as e:
+                print('WARNING: Bucket not created: {}'.format(e))
+        if args.object_table is not None and args.latency_sample > 0:
+            tracker = LatencyTracker(
+                dynamodb_client=boto3.client('dynamodb', region_name=args.region, endpoint_url=args.dynamodb_endpoint_url, config=client_config),
+                table_name=args.object_table,
+                poll_interval=args.poll_interval
+            )
+            tracker.start()
+
+    def upload(key_name: str, event_data: dict, track: bool):
+        body = json.dumps(event_data).encode('utf-8')
+        try:
+            s3_client.put_object(ACL='private', Body=body, Bucket=args.bucket, Key=key_name)
+            uploaded_timestamp = time.time()
+            if track is True:
+                tracker.add(key_name=key_name, uploaded_timestamp=uploaded_timestamp)
+            with stats_lock:
+                stats['Uploaded'] += 1
+                stats['Bytes'] += len(body)
+        except Exception as e:
+            with stats_lock:
+                stats['Failed'] += 1
+            print('ERROR: Upload of "{}" failed: {}'.format(key_name, e))
+
+    limiter = RateLimiter(rate=args.rate)
+    in_flight = threading.BoundedSemaphore(args.workers * 4)
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for tx_type, key_name, event_data in synthesize_events(
+            event_qty=args.events,
+            account_qty=args.accounts,
+            transaction_mix=transaction_mix,
+            request_id_prefix=request_id_prefix
+        ):
+            stats['Generated'] += 1
+            stats['TxTypes'][tx_type] = stats['TxTypes'].get(tx_type, 0) + 1
+            if args.dry_run is True:
+                continue
+            limiter.acquire()
+            in_flight.acquire()
+            future = executor.submit(upload, key_name, event_data, tracker is not None and stats['Generated'] % args.latency_sample == 0)
+            future.add_done_callback(lambda f: in_flight.release())
+            if args.progress > 0 and stats['Generated'] % args.progress == 0:
+                print('   {} events generated, {} uploaded, {} failed'.format(stats['Generated'], stats['Uploaded'], stats['Failed']))
+    duration = time.time() - start
+
+    result = {
+        'RequestIdPrefix': request_id_prefix,
+        'Events': stats['Generated'],
+        'Uploaded': stats['Uploaded'],
+        'Failed': stats['Failed'],
+        'Bytes': stats['Bytes'],
+        'DurationSeconds': round(duration, 3),
+        'EventsPerSecond': round(stats['Generated'] / duration, 1) if duration > 0 else 0.0,
+        'TransactionTypes': stats['TxTypes'],
+    }
+    if tracker is not None:
+        print('Waiting up to {} seconds for tracked events to be processed...'.format(args.latency_timeout))
+        tracker.finish(timeout=args.latency_timeout)
+        latencies = sorted(tracker.latencies)
+        result['Latency'] = {
+            'Tracked': len(latencies) + len(tracker.outstanding),
+            'Processed': len(latencies),
+            'TimedOut': len(tracker.outstanding),
+            'MaxSeconds': round(latencies[-1], 3) if len(latencies) > 0 else 0.0,
+        }
+        for pct in LATENCY_PERCENTILES:
+            result['Latency']['P{}Seconds'.format(pct)] = round(percentile(sorted_values=latencies, pct=pct), 3)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Lab4 event load generator')
+    parser.add_argument('--events', type=int, default=1000, help='Number of events to generate')
+    parser.add_argument('--accounts', type=int, default=100, help='Number of accounts to spread the events over')
+    parser.add_argument('--mix', type=str, default=None, help='Transaction mix as key_prefix=weight pairs, comma separated')
+    parser.add_argument('--rate', type=float, default=0, help='Maximum uploads per second (0 = unlimited)')
+    parser.add_argument('--workers', type=int, default=16, help='Number of parallel uploads')
+    parser.add_argument('--bucket', type=str, default=os.getenv('NEW_EVENT_BUCKET_NAME_PARAM', prepare_test_events.EVENT_BUCKET_NAME))
+    parser.add_argument('--region', type=str, default=os.getenv('AWS_REGION', 'eu-central-1'))
+    parser.add_argument('--endpoint-url', type=str, default=None, help='S3 endpoint of a local stand-in, for example MinIO or a moto server')
+    parser.add_argument('--create-bucket', action='store_true', help='Create the bucket first (local stand-ins)')
+    parser.add_argument('--moto', action='store_true', help='Upload to an in-process moto S3 mock (implies --create-bucket)')
+    parser.add_argument('--object-table', type=str, default=os.getenv('DYNAMODB_OBJECT_TABLE_NAME_PARAM'), help='Object table to poll for end-to-end latency')
+    parser.add_argument('--dynamodb-endpoint-url', type=str, default=None)
+    parser.add_argument('--latency-sample', type=int, default=10, help='Track the latency of every Nth event (0 = disabled)')
+    parser.add_argument('--latency-timeout', type=float, default=300, help='Seconds to wait for tracked events after the last upload')
+    parser.add_argument('--poll-interval', type=float, default=1.0)
+    parser.add_argument('--request-id-prefix', type=str, default=None)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--progress', type=int, default=10000, help='Print progress every N events (0 = disabled)')
+    parser.add_argument('--dry-run', action='store_true', help='Synthesize the events without uploading')
+    parser.add_argument('--results-file', type=str, default=None, help='Also write the results as JSON to this file')
+    args = parser.parse_args()
+
+    if args.moto is True:
+        if moto is None:
+            raise Exception('moto is not installed')
+        mock = getattr(moto, 'mock_aws', None) or getattr(moto, 'mock_s3')
+        args.create_bucket = True
+        args.object_table = None
+        with mock():
+            result = run(args=args)
+    else:
+        result = run(args=args)
+
+    print(json.dumps(result, indent=4))
+    if args.results_file is not None:
+        with open(args.results_file, 'w') as f:
+            f.write(json.dumps(result, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,758 @@
+"""
+In-process simulator of the lab4 event pipeline, to profile and regression test the hot path without AWS:
+
+    load generator -> fake S3 -> S3 event notification (SNS envelope) -> ingest queue
+        -> s3_new_event_bucket_object_create.handler -> in-memory SQS FIFO queue (message groups)
+        -> tx_processing_consumer.handler -> fake DynamoDB
+
+Both Lambda handlers run unmodified - the fake AWS services are passed in as `boto3_clazz`. Every fake service call
+can be slowed down with a fixed plus random latency, and the fake DynamoDB can return a share of BatchWriteItem
+requests as UnprocessedItems. The simulator reports per stage timing, queue depth, throughput counters, end-to-end
+latency percentiles and a digest of the final account balances, so two runs with different settings (or code) can
+be compared.
+
+Examples:
+
+    python3 pipeline_simulator.py --events 2000 --accounts 50
+    python3 pipeline_simulator.py --events 5000 --accounts 200 --consumer-concurrency 4 --dynamodb-latency-ms 5 \\
+        --consumer-env BATCH_MODE=1 --consumer-env MAX_WORKERS=4 --results-file results.json
+
+The Lambda modules import boto3 at load time, so boto3 must be installed (no AWS calls are made).
+"""
+import argparse
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import deque, OrderedDict
+from decimal import Decimal
+
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_FUNCTIONS_DIR = os.path.join(TESTS_DIR, '..', 'lambda_functions')
+sys.path.insert(0, TESTS_DIR)
+import load_generator
+import prepare_test_events
+
+
+EVENT_BUCKET_NAME = 'lab4-new-events-simulated'
+OBJECT_TABLE_NAME = 'lab4-simulated-objects'
+ACCOUNTS_TABLE_NAME = 'lab4-simulated-accounts'
+TRANSACTION_QUEUE_NAME = 'AccountTransactionQueue.fifo'
+
+
+def load_lambda_module(module_name: str):
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(LAMBDA_FUNCTIONS_DIR, module_name, '{}.py'.format(module_name)))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def percentile(sorted_values: list, pct: float)->float:
+    return load_generator.percentile(sorted_values=sorted_values, pct=pct)
+
+
+###############################################################################
+###                                                                         ###
+###                               M E T R I C S                             ###
+###                                                                         ###
+###############################################################################
+
+
+class Metrics:
+    """
+        Thread safe counters and duration samples, keyed by name
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = OrderedDict()
+        self.durations = OrderedDict()
+
+    def increment(self, name: str, value: int=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record(self, name: str, duration: float):
+        with self.lock:
+            if name not in self.durations:
+                self.durations[name] = list()
+            self.durations[name].append(duration)
+
+    def summary(self)->dict:
+        with self.lock:
+            result = {'Counters': dict(self.counters), 'Timings': dict()}
+            for name, durations in self.durations.items():
+                sorted_durations = sorted(durations)
+                result['Timings'][name] = {
+                    'Count': len(sorted_durations),
+                    'TotalSeconds': round(sum(sorted_durations), 3),
+                    'MeanMs': round(sum(sorted_durations) / len(sorted_durations) * 1000, 3),
+                    'P50Ms': round(percentile(sorted_values=sorted_durations, pct=50) * 1000, 3),
+                    'P95Ms': round(percentile(sorted_values=sorted_durations, pct=95) * 1000, 3),
+                    'P99Ms': round(percentile(sorted_values=sorted_durations, pct=99) * 1000, 3),
+                    'MaxMs': round(sorted_durations[-1] * 1000, 3),
+                }
+            return result
+
+
+class LatencyModel:
+
+    def __init__(self, latency_ms: float=0.0, jitter_ms: float=0.0, seed: int=1):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.random = random.Random(seed)
+
+    def wait(self):
+        delay_ms = self.latency_ms
+        if self.jitter_ms > 0:
+            delay_ms += self.random.uniform(0, self.jitter_ms)
+        if delay_ms > 0:
+            time.sleep(delay_ms / 1000.0)
+
+
+###############################################################################
+###                                                                         ###
+###                      F A K E    A W S    S E R V I C E S                ###
+###                                                                         ###
+###############################################################################
+
+
+class SimulatedTransactionCanceledException(Exception):
+
+    def __init__(self, cancellation_reasons: list):
+        super().__init__('TransactionCanceledException')
+        self.response = {
+            'Error': {'Code': 'TransactionCanceledException', 'Message': 'Transaction cancelled'},
+            'CancellationReasons': cancellation_reasons,
+        }
+
+
+class SimulatedStreamingBody:
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def read(self, *args, **kwargs):
+        return self.data
+
+
+class SimulatedS3:
+
+    def __init__(self, metrics: Metrics, latency: LatencyModel, on_object_created=None):
+        self.metrics = metrics
+        self.latency = latency
+        self.on_object_created = on_object_created
+        self.lock = threading.Lock()
+        self.objects = dict()
+
+    def put_object(self, Bucket: str, Key: str, Body: bytes, **kwargs):
+        self.metrics.increment('S3.PutObject')
+        self.latency.wait()
+        with self.lock:
+            self.objects[(Bucket, Key)] = Body
+        if self.on_object_created is not None:
+            self.on_object_created(bucket_name=Bucket, key=Key, size=len(Body))
+        return {}
+
+    def get_object(self, Bucket: str, Key: str, **kwargs):
+        self.metrics.increment('S3.GetObject')
+        self.latency.wait()
+        with self.lock:
+            data = self.objects[(Bucket, Key)]
+        return {'Body': SimulatedStreamingBody(data=data), 'ContentLength': len(data)}
+
+
+class SimulatedDynamoDb:
+    """
+        Tables are kept as PK -> {SK -> item}. Only the operations and the condition/comparison expressions used by
+        the lab4 Lambda functions are supported.
+    """
+
+    def __init__(self, metrics: Metrics, latency: LatencyModel, unprocessed_rate: float=0.0, seed: int=1):
+        self.metrics = metrics
+        self.latency = latency
+        self.unprocessed_rate = unprocessed_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.tables = dict()
+
+    def _table(self, table_name: str)->dict:
+        if table_name not in self.tables:
+            self.tables[table_name] = dict()
+        return self.tables[table_name]
+
+    def _call(self, operation: str):
+        self.metrics.increment('DynamoDB.{}'.format(operation))
+        self.latency.wait()
+
+    def _put(self, table_name: str, item: dict):
+        self._table(table_name).setdefault(item['PK']['S'], dict())[item['SK']['S']] = item
+
+    def _get(self, table_name: str, key: dict)->dict:
+        return self._table(table_name).get(key['PK']['S'], dict()).get(key['SK']['S'])
+
+    def _delete(self, table_name: str, key: dict):
+        self._table(table_name).get(key['PK']['S'], dict()).pop(key['SK']['S'], None)
+
+    def _matches(self, item: dict, conditions: dict)->bool:
+        for field_name, condition in conditions.items():
+            if field_name not in item:
+                return False
+            expected = condition['AttributeValueList'][0]
+            if condition['ComparisonOperator'] == 'EQ':
+                if item[field_name] != expected:
+                    return False
+            elif condition['ComparisonOperator'] == 'BEGINS_WITH':
+                if list(item[field_name].values())[0].startswith(list(expected.values())[0]) is False:
+                    return False
+            else:
+                raise Exception('Unsupported ComparisonOperator: {}'.format(condition['ComparisonOperator']))
+        return True
+
+    def _condition_holds(self, existing_item: dict, put: dict)->bool:
+        condition_expression = put.get('ConditionExpression')
+        if condition_expression is None:
+            return True
+        if condition_expression == 'attribute_not_exists(Version)':
+            return existing_item is None or 'Version' not in existing_item
+        if condition_expression == 'attribute_not_exists(SK)':
+            return existing_item is None
+        if condition_expression == 'Version = :version':
+            return existing_item is not None and existing_item.get('Version') == put['ExpressionAttributeValues'][':version']
+        raise Exception('Unsupported ConditionExpression: {}'.format(condition_expression))
+
+    def put_item(self, TableName: str, Item: dict, **kwargs):
+        self._call('PutItem')
+        with self.lock:
+            self._put(table_name=TableName, item=Item)
+        return {}
+
+    def get_item(self, TableName: str, Key: dict, **kwargs):
+        self._call('GetItem')
+        with self.lock:
+            item = self._get(table_name=TableName, key=Key)
+        if item is None:
+            return {}
+        return {'Item': item}
+
+    def query(self, TableName: str, KeyConditions: dict, QueryFilter: dict=None, Limit: int=None, ExclusiveStartKey: dict=None, **kwargs):
+        self._call('Query')
+        with self.lock:
+            table = self._table(TableName)
+            if 'PK' in KeyConditions and KeyConditions['PK']['ComparisonOperator'] == 'EQ':
+                partitions = [table.get(KeyConditions['PK']['AttributeValueList'][0]['S'], dict())]
+            else:
+                partitions = list(table.values())
+            candidates = list()
+            for partition in partitions:
+                for sort_key in sorted(partition.keys()):
+                    if self._matches(item=partition[sort_key], conditions=KeyConditions) is True:
+                        candidates.append(partition[sort_key])
+        if ExclusiveStartKey is not None:
+            start_position = ExclusiveStartKey['Position']['N']
+            candidates = candidates[int(start_position):]
+        else:
+            start_position = '0'
+        response = {}
+        if Limit is not None and len(candidates) > Limit:
+            candidates = candidates[:Limit]
+            response['LastEvaluatedKey'] = {'Position': {'N': '{}'.format(int(start_position) + Limit)}}
+        if QueryFilter is not None:
+            candidates = [item for item in candidates if self._matches(item=item, conditions=QueryFilter) is True]
+        response['Items'] = candidates
+        response['Count'] = len(candidates)
+        return response
+
+    def batch_write_item(self, RequestItems: dict, **kwargs):
+        self._call('BatchWriteItem')
+        unprocessed_items = dict()
+        with self.lock:
+            for table_name, write_requests in RequestItems.items():
+                if len(write_requests) > 25:
+                    raise Exception('ValidationException: Too many items requested for the BatchWriteItem call')
+                for write_request in write_requests:
+                    if self.unprocessed_rate > 0 and self.random.random() < self.unprocessed_rate:
+                        unprocessed_items.setdefault(table_name, list()).append(write_request)
+                        continue
+                    if 'PutRequest' in write_request:
+                        self._put(table_name=table_name, item=write_request['PutRequest']['Item'])
+                    else:
+                        self._delete(table_name=table_name, key=write_request['DeleteRequest']['Key'])
+        if len(unprocessed_items) > 0:
+            self.metrics.increment('DynamoDB.UnprocessedItems', sum([len(requests) for requests in unprocessed_items.values()]))
+        return {'UnprocessedItems': unprocessed_items, 'ConsumedCapacity': list()}
+
+    def batch_get_item(self, RequestItems: dict, **kwargs):
+        self._call('BatchGetItem')
+        responses = dict()
+        with self.lock:
+            for table_name, request in RequestItems.items():
+                responses[table_name] = list()
+                for key in request['Keys']:
+                    item = self._get(table_name=table_name, key=key)
+                    if item is not None:
+                        responses[table_name].append(item)
+        return {'Responses': responses, 'UnprocessedKeys': dict()}
+
+    def transact_write_items(self, TransactItems: list, **kwargs):
+        self._call('TransactWriteItems')
+        with self.lock:
+            cancellation_reasons = list()
+            for transact_item in TransactItems:
+                code = 'None'
+                if 'Put' in transact_item:
+                    put = transact_item['Put']
+                    if self._condition_holds(existing_item=self._get(table_name=put['TableName'], key=put['Item']), put=put) is False:
+                        code = 'ConditionalCheckFailed'
+                cancellation_reasons.append({'Code': code})
+            if len([reason for reason in cancellation_reasons if reason['Code'] != 'None']) > 0:
+                self.metrics.increment('DynamoDB.TransactionCanceled')
+                raise SimulatedTransactionCanceledException(cancellation_reasons=cancellation_reasons)
+            for transact_item in TransactItems:
+                if 'Put' in transact_item:
+                    self._put(table_name=transact_item['Put']['TableName'], item=transact_item['Put']['Item'])
+                elif 'Delete' in transact_item:
+                    self._delete(table_name=transact_item['Delete']['TableName'], key=transact_item['Delete']['Key'])
+        return {}
+
+
+class SimulatedQueue:
+    """
+        Standard queue - no ordering guarantees are relied upon
+    """
+
+    def __init__(self, name: str, max_receive_count: int=5):
+        self.name = name
+        self.max_receive_count = max_receive_count
+        self.lock = threading.Lock()
+        self.messages = deque()
+        self.in_flight = dict()
+        self.dead_letters = list()
+
+    def send(self, body: str, message_group_id: str=None, deduplication_id: str=None)->str:
+        message = {'messageId': str(uuid.uuid4()), 'body': body, 'MessageGroupId': message_group_id, 'ReceiveCount': 0, 'SentTimestamp': time.time()}
+        with self.lock:
+            self.messages.append(message)
+        return message['messageId']
+
+    def receive(self, max_messages: int=10)->list:
+        with self.lock:
+            batch = list()
+            while len(self.messages) > 0 and len(batch) < max_messages:
+                batch.append(self.messages.popleft())
+            for message in batch:
+                message['ReceiveCount'] += 1
+                self.in_flight[message['messageId']] = message
+            return batch
+
+    def complete(self, messages: list, failed_message_ids: list)->tuple:
+        """
+            Delete the processed messages and make the failed messages visible again. Returns the tuple
+            `(deleted_messages, returned_messages)`.
+        """
+        deleted = list()
+        returned = list()
+        with self.lock:
+            for message in messages:
+                self.in_flight.pop(message['messageId'], None)
+                if message['messageId'] in failed_message_ids:
+                    returned.append(message)
+                else:
+                    deleted.append(message)
+            self._return_messages(messages=returned)
+        return (deleted, returned,)
+
+    def _return_messages(self, messages: list):
+        for message in messages:
+            if message['ReceiveCount'] >= self.max_receive_count:
+                self.dead_letters.append(message)
+            else:
+                self.messages.append(message)
+
+    def depth(self)->int:
+        with self.lock:
+            return len(self.messages) + len(self.in_flight)
+
+
+class SimulatedFifoQueue(SimulatedQueue):
+    """
+        FIFO queue with message groups: messages of a group are delivered in order, and no message of a group is
+        delivered while an earlier message of the same group is in flight. Messages with a deduplication ID that was
+        already seen are accepted but not delivered again.
+    """
+
+    def __init__(self, name: str, max_receive_count: int=5):
+        super().__init__(name=name, max_receive_count=max_receive_count)
+        self.groups = OrderedDict()
+        self.groups_in_flight = set()
+        self.deduplication_ids = set()
+
+    def send(self, body: str, message_group_id: str=None, deduplication_id: str=None)->str:
+        if deduplication_id is None:
+            deduplication_id = hashlib.sha256(body.encode('utf-8')).hexdigest()
+        message = {'messageId': str(uuid.uuid4()), 'body': body, 'MessageGroupId': message_group_id, 'ReceiveCount': 0, 'SentTimestamp': time.time()}
+        with self.lock:
+            if deduplication_id in self.deduplication_ids:
+                return message['messageId']
+            self.deduplication_ids.add(deduplication_id)
+            if message_group_id not in self.groups:
+                self.groups[message_group_id] = deque()
+            self.groups[message_group_id].append(message)
+        return message['messageId']
+
+    def receive(self, max_messages: int=10)->list:
+        with self.lock:
+            batch = list()
+            for message_group_id, group_messages in self.groups.items():
+                if len(batch) >= max_messages:
+                    break
+                if message_group_id in self.groups_in_flight or len(group_messages) == 0:
+                    continue
+                self.groups_in_flight.add(message_group_id)
+                while len(group_messages) > 0 and len(batch) < max_messages:
+                    batch.append(group_messages.popleft())
+            for message in batch:
+                message['ReceiveCount'] += 1
+                self.in_flight[message['messageId']] = message
+            for message_group_id in [group_id for group_id, group_messages in self.groups.items() if len(group_messages) == 0 and group_id not in self.groups_in_flight]:
+                del self.groups[message_group_id]
+            return batch
+
+    def _return_messages(self, messages: list):
+        # Failed messages go back to the front of their group, in their original order
+        for message in reversed(messages):
+            if message['ReceiveCount'] >= self.max_receive_count:
+                self.dead_letters.append(message)
+                continue
+            if message['MessageGroupId'] not in self.groups:
+                self.groups[message['MessageGroupId']] = deque()
+            self.groups[message['MessageGroupId']].appendleft(message)
+
+    def complete(self, messages: list, failed_message_ids: list)->tuple:
+        result = super().complete(messages=messages, failed_message_ids=failed_message_ids)
+        with self.lock:
+            for message in messages:
+                self.groups_in_flight.discard(message['MessageGroupId'])
+        return result
+
+    def depth(self)->int:
+        with self.lock:
+            return sum([len(group_messages) for group_messages in self.groups.values()]) + len(self.in_flight)
+
+
+class SimulatedSqs:
+
+    def __init__(self, metrics: Metrics, latency: LatencyModel, queues: dict):
+        self.metrics = metrics
+        self.latency = latency
+        self.queues = queues
+
+    def get_queue_url(self, QueueName: str, **kwargs):
+        self.metrics.increment('SQS.GetQueueUrl')
+        return {'QueueUrl': QueueName}
+
+    def send_message(self, QueueUrl: str, MessageBody: str, MessageGroupId: str=None, MessageDeduplicationId: str=None, **kwargs):
+        self.metrics.increment('SQS.SendMessage')
+        self.latency.wait()
+        if QueueUrl not in self.queues:
+            if QueueUrl.endswith('.fifo') is True:
+                self.queues[QueueUrl] = SimulatedFifoQueue(name=QueueUrl)
+            else:
+                self.queues[QueueUrl] = SimulatedQueue(name=QueueUrl)
+        message_id = self.queues[QueueUrl].send(body=MessageBody, message_group_id=MessageGroupId, deduplication_id=MessageDeduplicationId)
+        return {'MessageId': message_id}
+
+
+class SimulatedAws:
+    """
+        Stands in for the boto3 module: `client()` returns the simulated service clients
+    """
+
+    def __init__(self, s3: SimulatedS3, dynamodb: SimulatedDynamoDb, sqs: SimulatedSqs):
+        self.clients = {'s3': s3, 'dynamodb': dynamodb, 'sqs': sqs}
+
+    def client(self, client_name: str, *args, **kwargs):
+        if client_name not in self.clients:
+            raise Exception('Simulated AWS service "{}" is not available'.format(client_name))
+        return self.clients[client_name]
+
+
+###############################################################################
+###                                                                         ###
+###                             S I M U L A T O R                           ###
+###                                                                         ###
+###############################################################################
+
+
+def build_s3_notification_body(bucket_name: str, key: str, size: int)->str:
+    """
+        The S3 event notification as delivered to the ingest queue by the SNS subscription
+    """
+    s3_event = {
+        'Records': [
+            {
+                'eventVersion': '2.1',
+                'eventSource': 'aws:s3',
+                'eventName': 'ObjectCreated:Put',
+                's3': {
+                    'bucket': {'name': bucket_name},
+                    'object': {'key': key, 'size': size},
+                },
+            }
+        ]
+    }
+    return json.dumps({'Type': 'Notification', 'Message': json.dumps(s3_event)})
+
+
+def to_sqs_event(messages: list)->dict:
+    records = list()
+    for message in messages:
+        records.append(
+            {
+                'messageId': message['messageId'],
+                'body': message['body'],
+                'attributes': {'MessageGroupId': message['MessageGroupId'], 'ApproximateReceiveCount': '{}'.format(message['ReceiveCount'])},
+                'eventSource': 'aws:sqs',
+            }
+        )
+    return {'Records': records}
+
+
+class PipelineSimulator:
+
+    def __init__(self, args):
+        self.args = args
+        self.metrics = Metrics()
+        self.ingest_queue = SimulatedQueue(name='S3EventIngestQueue')
+        self.transaction_queue = SimulatedFifoQueue(name=TRANSACTION_QUEUE_NAME)
+        self.s3 = SimulatedS3(metrics=self.metrics, latency=LatencyModel(args.s3_latency_ms, args.latency_jitter_ms, args.seed), on_object_created=self.on_object_created)
+        self.dynamodb = SimulatedDynamoDb(metrics=self.metrics, latency=LatencyModel(args.dynamodb_latency_ms, args.latency_jitter_ms, args.seed), unprocessed_rate=args.dynamodb_unprocessed_rate, seed=args.seed)
+        self.sqs = SimulatedSqs(metrics=self.metrics, latency=LatencyModel(args.sqs_latency_ms, args.latency_jitter_ms, args.seed), queues={TRANSACTION_QUEUE_NAME: self.transaction_queue})
+        self.aws = SimulatedAws(s3=self.s3, dynamodb=self.dynamodb, sqs=self.sqs)
+        self.upload_timestamps = dict()
+        self.end_to_end_latencies = list()
+        self.lock = threading.Lock()
+        self.producer_done = threading.Event()
+        self.stages_in_flight = {'Ingest': 0, 'Consumer': 0}
+        self.queue_depth_samples = {'Ingest': list(), 'Transaction': list()}
+
+        os.environ['DYNAMODB_OBJECT_TABLE_NAME'] = OBJECT_TABLE_NAME
+        os.environ['DYNAMODB_ACCOUNTS_TABLE_NAME'] = ACCOUNTS_TABLE_NAME
+        for environment_setting in args.ingest_env + args.consumer_env:
+            name, value = environment_setting.split('=', 1)
+            os.environ[name] = value
+        self.ingest_lambda = load_lambda_module(module_name='s3_new_event_bucket_object_create')
+        self.consumer_lambda = load_lambda_module(module_name='tx_processing_consumer')
+        self.lambda_metrics = Metrics()
+        for lambda_module in (self.ingest_lambda, self.consumer_lambda):
+            lambda_module.METRICS.writer = self.collect_lambda_metrics
+        self.lambda_logger = logging.getLogger('pipeline_simulator.lambda')
+        self.lambda_logger.setLevel(args.log_level)
+        logging.getLogger().setLevel(args.log_level)
+
+    def collect_lambda_metrics(self, document: dict):
+        """
+            Receives the Embedded Metric Format documents of the Lambda functions instead of stdout. Step durations are
+            kept per function, step and transaction type, all other metrics are summed.
+        """
+        for metric_definition in document['_aws']['CloudWatchMetrics'][0]['Metrics']:
+            values = document[metric_definition['Name']]
+            if isinstance(values, list) is False:
+                values = [values,]
+            name_parts = [document['FunctionName'], metric_definition['Name']]
+            for dimension_name in ('Step', 'Service', 'Operation', 'Result', 'TransactionType',):
+                if dimension_name in document:
+                    name_parts.append(document[dimension_name])
+            name = '/'.join(name_parts)
+            if metric_definition['Unit'] == 'Milliseconds':
+                for value in values:
+                    self.lambda_metrics.record(name, value / 1000.0)
+            else:
+                self.lambda_metrics.increment(name, sum(values))
+
+    def on_object_created(self, bucket_name: str, key: str, size: int):
+        with self.lock:
+            self.upload_timestamps[key] = time.time()
+        self.ingest_queue.send(body=build_s3_notification_body(bucket_name=bucket_name, key=key, size=size))
+
+    def synthesize_events(self)->list:
+        """
+            The events are generated up front: the Lambda functions and the simulated services also draw random
+            numbers, and the same seed must always produce the same event stream
+        """
+        prepare_test_events.VERBOSE = False
+        random.seed(self.args.seed)
+        transaction_mix = load_generator.DEFAULT_TRANSACTION_MIX
+        if self.args.mix is not None:
+            transaction_mix = load_generator.parse_transaction_mix(mix=self.args.mix)
+        return list(
+            load_generator.synthesize_events(
+                event_qty=self.args.events,
+                account_qty=self.args.accounts,
+                transaction_mix=transaction_mix,
+                request_id_prefix='sim'
+            )
+        )
+
+    def produce(self, events: list):
+        limiter = load_generator.RateLimiter(rate=self.args.rate)
+        try:
+            for tx_type, key_name, event_data in events:
+                limiter.acquire()
+                start = time.perf_counter()
+                self.s3.put_object(Bucket=EVENT_BUCKET_NAME, Key=key_name, Body=json.dumps(event_data).encode('utf-8'))
+                self.metrics.record('Stage.Upload', time.perf_counter() - start)
+                self.metrics.increment('Events.Uploaded')
+        finally:
+            self.producer_done.set()
+
+    def is_finished(self)->bool:
+        with self.lock:
+            stages_idle = self.stages_in_flight['Ingest'] == 0 and self.stages_in_flight['Consumer'] == 0
+        return self.producer_done.is_set() and stages_idle and self.ingest_queue.depth() == 0 and self.transaction_queue.depth() == 0
+
+    def run_stage(self, stage_name: str, queue: SimulatedQueue, lambda_module, batch_size: int):
+        while True:
+            with self.lock:
+                messages = queue.receive(max_messages=batch_size)
+                if len(messages) > 0:
+                    self.stages_in_flight[stage_name] += 1
+            if len(messages) == 0:
+                if self.is_finished() is True:
+                    return
+                time.sleep(0.001)
+                continue
+            failed_message_ids = list()
+            start = time.perf_counter()
+            try:
+                response = lambda_module.handler(
+                    event=to_sqs_event(messages=messages),
+                    context=None,
+                    logger=self.lambda_logger,
+                    boto3_clazz=self.aws,
+                    run_from_main=True
+                )
+                failed_message_ids = [failure['itemIdentifier'] for failure in response.get('batchItemFailures', list())]
+            except:
+                self.metrics.increment('{}.HandlerExceptions'.format(stage_name))
+                failed_message_ids = [message['messageId'] for message in messages]
+            duration = time.perf_counter() - start
+            self.metrics.record('Stage.{}.Invocation'.format(stage_name), duration)
+            self.metrics.record('Stage.{}.PerMessage'.format(stage_name), duration / len(messages))
+            self.metrics.increment('{}.Invocations'.format(stage_name))
+            deleted, returned = queue.complete(messages=messages, failed_message_ids=failed_message_ids)
+            self.metrics.increment('{}.MessagesProcessed'.format(stage_name), len(deleted))
+            self.metrics.increment('{}.MessagesReturned'.format(stage_name), len(returned))
+            if stage_name == 'Consumer':
+                now = time.time()
+                with self.lock:
+                    for message in deleted:
+                        key = json.loads(message['body'])['EventSourceDataResource']['S3Key']
+                        if key in self.upload_timestamps:
+                            self.end_to_end_latencies.append(now - self.upload_timestamps.pop(key))
+            with self.lock:
+                self.stages_in_flight[stage_name] -= 1
+
+    def sample_queue_depths(self):
+        while self.is_finished() is False:
+            self.queue_depth_samples['Ingest'].append(self.ingest_queue.depth())
+            self.queue_depth_samples['Transaction'].append(self.transaction_queue.depth())
+            time.sleep(self.args.sample_interval)
+
+    def account_balances(self)->dict:
+        balances = dict()
+        for partition_key, partition in self.dynamodb.tables.get(ACCOUNTS_TABLE_NAME, dict()).items():
+            for sort_key, item in partition.items():
+                if sort_key.startswith('SAVINGS#BALANCE#') is True:
+                    balances['{}#{}'.format(partition_key, sort_key)] = item['Balance']['N']
+        return balances
+
+    def run(self)->dict:
+        threads = [threading.Thread(target=self.produce, args=(self.synthesize_events(),), daemon=True)]
+        for idx in range(self.args.ingest_concurrency):
+            threads.append(threading.Thread(target=self.run_stage, args=('Ingest', self.ingest_queue, self.ingest_lambda, self.args.ingest_batch_size,), daemon=True))
+        for idx in range(self.args.consumer_concurrency):
+            threads.append(threading.Thread(target=self.run_stage, args=('Consumer', self.transaction_queue, self.consumer_lambda, self.args.consumer_batch_size,), daemon=True))
+        threads.append(threading.Thread(target=self.sample_queue_depths, daemon=True))
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.time() - start
+
+        summary = self.metrics.summary()
+        lambda_summary = self.lambda_metrics.summary()
+        balances = self.account_balances()
+        latencies = sorted(self.end_to_end_latencies)
+        result = {
+            'Events': self.args.events,
+            'DurationSeconds': round(duration, 3),
+            'EventsPerSecond': round(self.args.events / duration, 1) if duration > 0 else 0.0,
+            'Counters': summary['Counters'],
+            'Timings': summary['Timings'],
+            'LambdaCounters': lambda_summary['Counters'],
+            'LambdaTimings': lambda_summary['Timings'],
+            'QueueDepth': dict(),
+            'EndToEndLatency': {
+                'Completed': len(latencies),
+                'P50Ms': round(percentile(sorted_values=latencies, pct=50) * 1000, 3),
+                'P95Ms': round(percentile(sorted_values=latencies, pct=95) * 1000, 3),
+                'P99Ms': round(percentile(sorted_values=latencies, pct=99) * 1000, 3),
+                'MaxMs': round(latencies[-1] * 1000, 3) if len(latencies) > 0 else 0.0,
+            },
+            'DeadLetters': {
+                'Ingest': len(self.ingest_queue.dead_letters),
+                'Transaction': len(self.transaction_queue.dead_letters),
+            },
+            'Accounts': len(set([balance_key.split('#')[0] for balance_key in balances.keys()])),
+            'BalanceTotal': '{}'.format(sum([Decimal(balance) for balance in balances.values()])),
+            'BalancesDigest': hashlib.sha256(json.dumps(balances, sort_keys=True).encode('utf-8')).hexdigest(),
+        }
+        for queue_name, samples in self.queue_depth_samples.items():
+            result['QueueDepth'][queue_name] = {
+                'Max': max(samples) if len(samples) > 0 else 0,
+                'Mean': round(sum(samples) / len(samples), 1) if len(samples) > 0 else 0.0,
+            }
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Lab4 in-process pipeline simulator')
+    parser.add_argument('--events', type=int, default=1000)
+    parser.add_argument('--accounts', type=int, default=50)
+    parser.add_argument('--mix', type=str, default=None, help='Transaction mix as key_prefix=weight pairs (see load_generator.py)')
+    parser.add_argument('--rate', type=float, default=0, help='Maximum uploads per second (0 = unlimited)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--ingest-concurrency', type=int, default=1, help='Concurrent ingest Lambda invocations')
+    parser.add_argument('--ingest-batch-size', type=int, default=10)
+    parser.add_argument('--consumer-concurrency', type=int, default=1, help='Concurrent consumer Lambda invocations')
+    parser.add_argument('--consumer-batch-size', type=int, default=10)
+    parser.add_argument('--s3-latency-ms', type=float, default=0.0)
+    parser.add_argument('--sqs-latency-ms', type=float, default=0.0)
+    parser.add_argument('--dynamodb-latency-ms', type=float, default=0.0)
+    parser.add_argument('--latency-jitter-ms', type=float, default=0.0, help='Random extra latency added to every simulated call')
+    parser.add_argument('--dynamodb-unprocessed-rate', type=float, default=0.0, help='Share of BatchWriteItem requests returned as unprocessed')
+    parser.add_argument('--ingest-env', action='append', default=list(), help='NAME=VALUE environment setting for the ingest Lambda')
+    parser.add_argument('--consumer-env', action='append', default=list(), help='NAME=VALUE environment setting for the consumer Lambda')
+    parser.add_argument('--sample-interval', type=float, default=0.05, help='Queue depth sample interval in seconds')
+    parser.add_argument('--log-level', type=str, default='CRITICAL', help='Log level of the Lambda functions')
+    parser.add_argument('--results-file', type=str, default=None)
+    args = parser.parse_args()
+
+    result = PipelineSimulator(args=args).run()
+    print(json.dumps(result, indent=4))
+    if args.results_file is not None:
+        with open(args.results_file, 'w') as f:
+            f.write(json.dumps(result, indent=4))
+
+
+if __name__ == '__main__':
+    main()
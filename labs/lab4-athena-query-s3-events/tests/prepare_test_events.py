@@ -8,38 +8,38 @@ from datetime import datetime
 
 
 STEP = False
+VERBOSE = True  # The load generator sets this to False - printing every event does not scale to millions of events
+EVENT_BUCKET_NAME = 'lab4-new-events-qpwoeiryt'
 
-file_name = None
-if len(sys.argv) > 1:
-    file_name = sys.argv[1]
 
-if len(sys.argv) > 2:
-    STEP = True
+def log(message: str):
+    if VERBOSE is True:
+        print(message)
 
-if file_name is None:
-    raise Exception('A filename containing test data must be provided')
 
-print('Parsing test data file: {}'.format(file_name))
+def read_test_data(file_name: str)->list:
+    print('Parsing test data file: {}'.format(file_name))
 
-if os.path.exists(file_name) is False:
-    raise Exception('ERR: File does not appear to exist')
+    if os.path.exists(file_name) is False:
+        raise Exception('ERR: File does not appear to exist')
 
-if os.path.isfile(file_name) is False:
-    raise Exception('ERR: Not a file?')
+    if os.path.isfile(file_name) is False:
+        raise Exception('ERR: Not a file?')
 
-reader = None
-test_data = list()
-with open(file_name, newline='') as csv_file:
-    reader = csv.DictReader(csv_file)
-    keys = reader.fieldnames
-    for row in reader:
-        record = dict()
-        for key in keys:
-            record[key] = row[key]
-        test_data.append(record)
+    reader = None
+    test_data = list()
+    with open(file_name, newline='') as csv_file:
+        reader = csv.DictReader(csv_file)
+        keys = reader.fieldnames
+        for row in reader:
+            record = dict()
+            for key in keys:
+                record[key] = row[key]
+            test_data.append(record)
 
-# print('JSON test_data={}'.format(json.dumps(test_data)))
-print('Test Data contains {} records/transaction events'.format(len(test_data)-1))
+    # print('JSON test_data={}'.format(json.dumps(test_data)))
+    print('Test Data contains {} records/transaction events'.format(len(test_data)-1))
+    return test_data
 
 
 def _create_datetime_object_from_test_data(data: dict)->int:
@@ -61,7 +61,7 @@ def _create_datetime_object_from_test_data(data: dict)->int:
 
 def build_cash_deposit_event(data: dict)->dict:
     event_data = dict()
-    print('Preparing a cash deposit event for source account {}'.format(data['Reference Account']))
+    log('Preparing a cash deposit event for source account {}'.format(data['Reference Account']))
 
     event_data['EventTimeStamp']                = _create_datetime_object_from_test_data(data=data)
     event_data['TargetAccount']                 = data['Reference Account']
@@ -90,7 +90,7 @@ def build_cash_deposit_event(data: dict)->dict:
 
 def build_verify_cash_deposit_event(data: dict)->dict:
     event_data = dict()
-    print('Preparing a cash deposit verification event for source account {}'.format(data['Reference Account']))
+    log('Preparing a cash deposit verification event for source account {}'.format(data['Reference Account']))
 
     event_data['EventTimeStamp']                = _create_datetime_object_from_test_data(data=data)
     event_data['TargetAccount']                 = data['Reference Account']
@@ -123,7 +123,7 @@ def build_verify_cash_deposit_event(data: dict)->dict:
 
 def build_incoming_payment_event(data: dict)->dict:
     event_data = dict()
-    print('Preparing an incoming payment event for source account {}'.format(data['Reference Account']))
+    log('Preparing an incoming payment event for source account {}'.format(data['Reference Account']))
 
     event_data['EventTimeStamp']                = _create_datetime_object_from_test_data(data=data)
     event_data['TargetAccount']                 = data['Reference Account']
@@ -138,7 +138,7 @@ def build_incoming_payment_event(data: dict)->dict:
 
 def build_outgoing_payment_unverified_event(data: dict)->dict:
     event_data = dict()
-    print('Preparing an unverified outgoing payment event for source account {}'.format(data['Reference Account']))
+    log('Preparing an unverified outgoing payment event for source account {}'.format(data['Reference Account']))
 
     event_data['EventTimeStamp']                = _create_datetime_object_from_test_data(data=data)
     event_data['SourceAccount']                 = data['Reference Account']
@@ -153,7 +153,7 @@ def build_outgoing_payment_unverified_event(data: dict)->dict:
 
 def build_outgoing_payment_verified_event(data: dict)->dict:
     event_data = dict()
-    print('Preparing an verified on previous outgoing payment event for source account {}'.format(data['Reference Account']))
+    log('Preparing an verified on previous outgoing payment event for source account {}'.format(data['Reference Account']))
 
     event_data['EventTimeStamp']                = _create_datetime_object_from_test_data(data=data)
     event_data['SourceAccount']                 = data['Reference Account']
@@ -165,7 +165,7 @@ def build_outgoing_payment_verified_event(data: dict)->dict:
 
 def build_outgoing_payment_rejected_event(data: dict)->dict:
     event_data = dict()
-    print('Preparing a rejected payment event for source account {}'.format(data['Reference Account']))
+    log('Preparing a rejected payment event for source account {}'.format(data['Reference Account']))
 
     event_data['EventTimeStamp']                = _create_datetime_object_from_test_data(data=data)
     event_data['SourceAccount']                 = data['Reference Account']
@@ -177,7 +177,7 @@ def build_outgoing_payment_rejected_event(data: dict)->dict:
 
 def build_cash_withdrawal_event(data: dict)->dict:
     event_data = dict()
-    print('Preparing a cash withdrawal event for source account {}'.format(data['Reference Account']))
+    log('Preparing a cash withdrawal event for source account {}'.format(data['Reference Account']))
 
     event_data['EventTimeStamp']                = _create_datetime_object_from_test_data(data=data)
     event_data['SourceAccount']                 = data['Reference Account']
@@ -202,7 +202,7 @@ def build_cash_withdrawal_event(data: dict)->dict:
 
 def build_inter_account_transfer_event(data: dict)->dict:
     event_data = dict()
-    print('Preparing an inter-account transfer event for source account {}'.format(data['Reference Account']))
+    log('Preparing an inter-account transfer event for source account {}'.format(data['Reference Account']))
 
     event_data['EventTimeStamp']                = _create_datetime_object_from_test_data(data=data)
     event_data['SourceAccount']                 = data['Reference Account']
@@ -219,15 +219,26 @@ def build_inter_account_transfer_event(data: dict)->dict:
 ###                                                                                                                 ###
 #######################################################################################################################
 
-def upload_event(event_data: dict, key_name: str)->bool:
+S3_CLIENT = None
+
+
+def get_s3_client():
+    global S3_CLIENT
+    if S3_CLIENT is None:
+        S3_CLIENT = boto3.client('s3')
+    return S3_CLIENT
+
+
+def upload_event(event_data: dict, key_name: str, bucket_name: str=EVENT_BUCKET_NAME, s3_client=None)->bool:
     if len(event_data) > 0:
-        print('   Uploading data to key: {}'.format(key_name))
-        print('      data: {}'.format(json.dumps(event_data)))
-        s3_client = boto3.client('s3')
+        log('   Uploading data to key: {}'.format(key_name))
+        log('      data: {}'.format(json.dumps(event_data)))
+        if s3_client is None:
+            s3_client = get_s3_client()
         s3_client.put_object(
             ACL='private',
             Body=json.dumps(event_data).encode('utf-8'),
-            Bucket='lab4-new-events-qpwoeiryt',
+            Bucket=bucket_name,
             Key=key_name
         )
 
@@ -248,15 +259,28 @@ EVENT_BUILD_MAPPING = {
 }
 
 
-tx_counter = 0
-for event_record in test_data:
-    tx_counter += 1
-    request_id = f'r{tx_counter:07}'
-    upload_event(
-        event_data=EVENT_BUILD_MAPPING[event_record['Transaction Type']](data=copy.deepcopy(event_record)),
-        key_name='{}{}.event'.format(event_record['Transaction Type'], request_id)
-    )
-    print()
-    if STEP is True:
-        input('Press ENTER for next transaction')
-    print()
+if __name__ == '__main__':
+    file_name = None
+    if len(sys.argv) > 1:
+        file_name = sys.argv[1]
+
+    if len(sys.argv) > 2:
+        STEP = True
+
+    if file_name is None:
+        raise Exception('A filename containing test data must be provided')
+
+    test_data = read_test_data(file_name=file_name)
+
+    tx_counter = 0
+    for event_record in test_data:
+        tx_counter += 1
+        request_id = f'r{tx_counter:07}'
+        upload_event(
+            event_data=EVENT_BUILD_MAPPING[event_record['Transaction Type']](data=copy.deepcopy(event_record)),
+            key_name='{}{}.event'.format(event_record['Transaction Type'], request_id)
+        )
+        print()
+        if STEP is True:
+            input('Press ENTER for next transaction')
+        print()